@@ -0,0 +1,115 @@
+"""Benchmark write_file_carefully under background I/O load
+
+Compares the old implementation, which ran the global sync command three times per file,
+with the current one, which fsyncs only the file and its directory.
+A background thread keeps writing a large file without syncing it,
+so that there are always dirty pages for a global sync to flush,
+like on a node that is busy downloading an update.
+
+Run from the neuralupgrade directory:
+
+    python -m benchmarks.bench_filewriter [--writes 20] [--load-mib 256]
+
+Pass --directory to write somewhere other than a temporary directory, like a mounted FAT filesystem.
+"""
+
+import argparse
+import datetime
+import glob
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+from neuralupgrade.filewriter import write_file_carefully
+
+
+GRUB_CFG = Path(__file__).parent.parent / "tests" / "data" / "scenarios" / "ab_same" / "efisys" / "grub" / "grub.cfg"
+
+BOOT_CMD = """\
+setenv bootargs "earlyprintk=dbgp console=tty0 console=ttyAMA0,115200 loglevel=7 psyopsos=psyopsOS-A"
+load mmc 0:2 0x80200000 /kernel
+load mmc 0:2 0x82200000 /initramfs
+load mmc 0:1 0x8a200000 /bcm2711-rpi-4-b.dtb
+booti 0x80200000 0x82200000:${filesize} 0x8a200000
+"""
+
+
+def legacy_write_file_carefully(filepath, contents, updated, binary=False, max_old_files=10, max_old_days=30):
+    """write_file_carefully() as it was before it used fsync"""
+    nowstamp = updated.strftime("%Y%m%d-%H%M%S.%f")
+    filepath_tmp = f"{filepath}.new.{nowstamp}"
+    this_backup = f"{filepath}.old.{nowstamp}"
+    with open(filepath_tmp, "wb" if binary else "w") as f:
+        f.write(contents)
+    if os.path.exists(filepath):
+        shutil.copy(filepath, this_backup)
+        subprocess.run(["sync"], check=True)
+    shutil.move(filepath_tmp, filepath)
+    subprocess.run(["sync"], check=True)
+    for idx, oldfile in enumerate(glob.glob(f"{filepath}.old.*")):
+        if idx < max_old_files:
+            continue
+        olddate = datetime.datetime.fromtimestamp(os.path.getmtime(oldfile))
+        if (datetime.datetime.now() - olddate).days > max_old_days:
+            os.remove(oldfile)
+    subprocess.run(["sync"], check=True)
+
+
+def background_load(path: str, size_mib: int, stop: threading.Event):
+    """Keep rewriting a large file without syncing it"""
+    block = os.urandom(1024 * 1024)
+    while not stop.is_set():
+        with open(path, "wb") as f:
+            for _ in range(size_mib):
+                if stop.is_set():
+                    break
+                f.write(block)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--writes", type=int, default=20, help="Writes of each file per case, default: %(default)s")
+    parser.add_argument(
+        "--load-mib", type=int, default=256, help="Size of the background load file, 0 to disable, default: %(default)s"
+    )
+    parser.add_argument("--directory", help="Where to write the files, default: a temporary directory")
+    parsed = parser.parse_args()
+
+    with open(GRUB_CFG) as f:
+        grub_cfg = f.read()
+
+    with tempfile.TemporaryDirectory(dir=parsed.directory) as tmpdir:
+        stop = threading.Event()
+        loader = None
+        if parsed.load_mib:
+            loadfile = os.path.join(tempfile.gettempdir(), f"bench_filewriter_load.{os.getpid()}")
+            loader = threading.Thread(target=background_load, args=(loadfile, parsed.load_mib, stop), daemon=True)
+            loader.start()
+            time.sleep(1)
+
+        try:
+            print(f"{parsed.writes} writes each of grub.cfg and boot.cmd, {parsed.load_mib} MiB background load")
+            for name, func in [("legacy (sync)", legacy_write_file_carefully), ("fsync", write_file_carefully)]:
+                casedir = os.path.join(tmpdir, name.split()[0])
+                os.mkdir(casedir)
+                began = time.monotonic()
+                for i in range(parsed.writes):
+                    updated = datetime.datetime.now()
+                    func(os.path.join(casedir, "grub.cfg"), f"{grub_cfg}\n# {i}\n", updated)
+                    func(os.path.join(casedir, "boot.cmd"), f"{BOOT_CMD}\n# {i}\n", updated)
+                elapsed = time.monotonic() - began
+                per_write = elapsed / (parsed.writes * 2) * 1000
+                print(f"{name:<16} {elapsed:7.2f}s total  {per_write:8.2f}ms per file")
+        finally:
+            stop.set()
+            if loader is not None:
+                loader.join()
+                os.remove(loadfile)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+"""Benchmark minisign verification
+
+Compares running the minisign binary, like minisign_verify() used to,
+with the in-process verifier, and with the verification cache
+that avoids reading the same file again later in the same run.
+
+Run from the neuralupgrade directory:
+
+    python -m benchmarks.bench_minisign [--size-mib 600]
+
+The minisign binary comparison is skipped if minisign isn't in the PATH.
+"""
+
+import argparse
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+
+from neuralupgrade.minisign import SecretKey, clear_verification_cache, verify_file, verify_file_cached
+
+
+def subprocess_verify(path: str, pubkey_path: str):
+    """The subprocess call that minisign_verify() used before the in-process verifier"""
+    subprocess.run(["minisign", "-V", "-p", pubkey_path, "-m", path], check=True, capture_output=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size-mib", type=int, default=600, help="Size of the test file, default: %(default)s")
+    parser.add_argument("--repeat", type=int, default=3, help="Verifications per case, default: %(default)s")
+    parsed = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, "psyopsOS.tar")
+        with open(path, "wb") as f:
+            for _ in range(parsed.size_mib):
+                f.write(os.urandom(1024 * 1024))
+        seckey = SecretKey.generate()
+        seckey.sign_file(path, "type=psyopsOS version=bench")
+        pubkey_path = os.path.join(tmpdir, "minisign.pubkey")
+        with open(pubkey_path, "w") as f:
+            f.write(f"untrusted comment: bench key\n{seckey.public_key.to_string()}\n")
+
+        cases = []
+        if shutil.which("minisign"):
+            cases.append(("minisign subprocess", lambda: subprocess_verify(path, pubkey_path)))
+        else:
+            print("minisign not found in PATH, skipping the subprocess comparison")
+        cases.append(("in-process", lambda: verify_file(path, seckey.public_key)))
+        clear_verification_cache()
+        cases.append(("in-process, cached", lambda: verify_file_cached(path, seckey.public_key)))
+
+        print(f"{parsed.size_mib} MiB file, {parsed.repeat} verifications each")
+        for name, func in cases:
+            began = time.monotonic()
+            for _ in range(parsed.repeat):
+                func()
+            elapsed = time.monotonic() - began
+            print(f"{name:<24} {elapsed:7.2f}s total  {elapsed / parsed.repeat:7.2f}s each")
+
+
+if __name__ == "__main__":
+    main()
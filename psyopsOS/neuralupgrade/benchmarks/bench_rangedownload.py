@@ -0,0 +1,85 @@
+"""Benchmark update downloads over a throttled local HTTP server
+
+Compares the old single-stream 8 KiB download loop with download_ranged()
+at a few different connection counts.
+Each response is throttled separately, which approximates
+a server or link that limits throughput per connection.
+
+Run from the neuralupgrade directory:
+
+    python -m benchmarks.bench_rangedownload [--size-mib 64] [--throttle-mib 16]
+"""
+
+import argparse
+import hashlib
+import os
+import tempfile
+import time
+
+import requests
+
+from neuralupgrade.rangedownload import download_ranged
+
+from tests.rangehttpd import RangeHTTPServer, RangeRequestHandler
+
+
+def legacy_download(url: str, output: str):
+    """The download loop that download_update() used before download_ranged()"""
+    with requests.get(url, stream=True) as response:
+        response.raise_for_status()
+        with open(output, "wb") as file:
+            for chunk in response.iter_content(chunk_size=8192):
+                if not chunk:
+                    continue
+                file.write(chunk)
+
+
+def sha256(path: str) -> str:
+    with open(path, "rb") as f:
+        return hashlib.file_digest(f, "sha256").hexdigest()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size-mib", type=int, default=64, help="Size of the test file, default: %(default)s")
+    parser.add_argument(
+        "--throttle-mib", type=int, default=16, help="Per-connection throttle in MiB/s, default: %(default)s"
+    )
+    parser.add_argument(
+        "--connections", type=int, nargs="+", default=[1, 4, 8], help="Connection counts, default: %(default)s"
+    )
+    parsed = parser.parse_args()
+
+    class ThrottledHandler(RangeRequestHandler):
+        throttle_bytes_per_second = parsed.throttle_mib * 1024 * 1024
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        servedir = os.path.join(tmpdir, "serve")
+        os.mkdir(servedir)
+        source = os.path.join(servedir, "psyopsOS.tar")
+        with open(source, "wb") as f:
+            for _ in range(parsed.size_mib):
+                f.write(os.urandom(1024 * 1024))
+        expected = sha256(source)
+
+        cases = [("legacy 8 KiB loop", lambda url, out: legacy_download(url, out))]
+        for connections in parsed.connections:
+            cases.append(
+                (f"download_ranged x{connections}", lambda url, out, c=connections: download_ranged(url, out, c))
+            )
+
+        print(f"{parsed.size_mib} MiB file, throttled to {parsed.throttle_mib} MiB/s per connection")
+        with RangeHTTPServer(servedir, ThrottledHandler) as baseurl:
+            for name, func in cases:
+                output = os.path.join(tmpdir, "out.tar")
+                began = time.monotonic()
+                func(f"{baseurl}/psyopsOS.tar", output)
+                elapsed = time.monotonic() - began
+                if sha256(output) != expected:
+                    raise Exception(f"{name} produced a corrupt download")
+                os.remove(output)
+                print(f"{name:<24} {elapsed:7.2f}s  {parsed.size_mib / elapsed:8.1f} MiB/s")
+
+
+if __name__ == "__main__":
+    main()
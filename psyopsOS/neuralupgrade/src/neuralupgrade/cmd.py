@@ -11,17 +11,34 @@ import platform
 import sys
 import textwrap
 import traceback
-from typing import Callable, List
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, List, Optional
+
+import requests
 
 from neuralupgrade import dictify, logger
 
 from neuralupgrade.coginitivedefects import MultiError
-from neuralupgrade.downloader import download_repository_file, download_update, download_update_signature
+from neuralupgrade.delta import MANIFEST_SUFFIX
+from neuralupgrade.downloader import (
+    DownloadedSignatureResult,
+    StreamedUpdate,
+    download_repository_file,
+    download_update,
+    download_update_signature,
+    open_update_stream,
+)
 from neuralupgrade.filesystems import Filesystem, Filesystems, Sides, flipside
 from neuralupgrade.firmware import Firmware
 from neuralupgrade.firmware.fwtype import FirmwareTypeMap, UnknownFirmwareError, detect_firmware
+from neuralupgrade.inventory import SystemInventory
+from neuralupgrade.minisign import DEFAULT_PUBKEY_PATH, PublicKey
 from neuralupgrade.osupdates import apply_updates, check_updates, get_system_metadata
+from neuralupgrade.peerserver import DEFAULT_PORT, serve
+from neuralupgrade.rangedownload import DEFAULT_CONNECTIONS
+from neuralupgrade.timings import timings
 from neuralupgrade.update_metadata import parse_trusted_comment
+from neuralupgrade.updatecache import DEFAULT_KEEP, UpdateCache
 
 
 def display_dict(d, indent=0, indent_step=4):
@@ -155,6 +172,13 @@ def subcommand_show(
     display_dict(metadata)
 
 
+def get_update_cache(parsed: argparse.Namespace) -> Optional[UpdateCache]:
+    """Return the update cache if --cache-dir was passed"""
+    if not parsed.cache_dir:
+        return None
+    return UpdateCache(parsed.cache_dir, keep=parsed.cache_keep)
+
+
 def subcommand_apply(
     parsed: argparse.Namespace,
     parser: argparse.ArgumentParser,
@@ -167,7 +191,14 @@ def subcommand_apply(
         parser.error("Cannot specify 'nonbooted' and 'a' or 'b' at the same time")
     updating_os = "a" in parsed.target or "b" in parsed.target or "nonbooted" in parsed.target
     updating_esp = "efisys" in parsed.target
+    if parsed.stream and not parsed.os_version:
+        parser.error("--stream requires --os-version")
+    if parsed.stream and len([t for t in parsed.target if t in ["a", "b", "nonbooted"]]) > 1:
+        parser.error("--stream can only apply the OS update to one side")
+    if parsed.delta and (parsed.stream or not parsed.os_version):
+        parser.error("--delta requires --os-version and cannot be used with --stream")
     os_tar = ""
+    os_stream: Optional[StreamedUpdate] = None
     esp_tar = ""
     os_tar_downloaded = False
     esp_tar_downloaded = False
@@ -176,6 +207,26 @@ def subcommand_apply(
         if updating_os:
             if parsed.os_tar:
                 os_tar = parsed.os_tar
+            elif parsed.stream:
+                os_stream = open_update_stream(
+                    firmware, parsed.repository, parsed.psyopsOS_filename_format, parsed.os_version
+                )
+            elif parsed.os_version and parsed.delta:
+                # Reuse chunks from the booted side, which has the files from the last update extracted to it
+                with filesystems.bylabel(sides.booted).mount(writable=False) as booted_mountpoint:
+                    os_tar = download_update(
+                        firmware,
+                        parsed.repository,
+                        parsed.psyopsOS_filename_format,
+                        parsed.os_version,
+                        parsed.update_tmpdir,
+                        pubkey=parsed.pubkey,
+                        verify=parsed.verify,
+                        connections=parsed.download_connections,
+                        delta_source=str(booted_mountpoint),
+                        cache=get_update_cache(parsed),
+                    )
+                os_tar_downloaded = True
             elif parsed.os_version:
                 os_tar = download_update(
                     firmware,
@@ -185,6 +236,8 @@ def subcommand_apply(
                     parsed.update_tmpdir,
                     pubkey=parsed.pubkey,
                     verify=parsed.verify,
+                    connections=parsed.download_connections,
+                    cache=get_update_cache(parsed),
                 )
                 os_tar_downloaded = True
             else:
@@ -201,6 +254,8 @@ def subcommand_apply(
                     parsed.update_tmpdir,
                     pubkey=parsed.pubkey,
                     verify=parsed.verify,
+                    connections=parsed.download_connections,
+                    cache=get_update_cache(parsed),
                 )
                 esp_tar_downloaded = True
             else:
@@ -220,14 +275,24 @@ def subcommand_apply(
             pubkey=parsed.pubkey,
             no_update_default_boot_label=parsed.no_boot_cfg,
             default_boot_label=parsed.default_boot_label,
+            single_pass=parsed.single_pass,
+            ostar_stream=os_stream,
+            parallel=parsed.parallel,
         )
     except Exception as exc:
         update_err = exc
     finally:
         cleanup_errs = []
+        try:
+            if os_stream:
+                os_stream.close()
+        except Exception as e:
+            cleanup_errs.append(e)
         try:
             if os_tar_downloaded:
                 os.remove(os_tar)
+                if os.path.exists(os_tar + MANIFEST_SUFFIX):
+                    os.remove(os_tar + MANIFEST_SUFFIX)
         except Exception as e:
             cleanup_errs.append(e)
         try:
@@ -249,6 +314,7 @@ def subcommand_download(parsed: argparse.Namespace, parser: argparse.ArgumentPar
     output: str = parsed.output
     if len(parsed.type) > 1 and not output.endswith("/"):
         output += "/"
+    session = requests.Session()
     if "psyopsOS" in parsed.type:
         download_update(
             firmware,
@@ -258,6 +324,9 @@ def subcommand_download(parsed: argparse.Namespace, parser: argparse.ArgumentPar
             output,
             pubkey=parsed.pubkey,
             verify=parsed.verify,
+            connections=parsed.download_connections,
+            cache=get_update_cache(parsed),
+            session=session,
         )
     if "psyopsESP" in parsed.type:
         download_update(
@@ -268,9 +337,57 @@ def subcommand_download(parsed: argparse.Namespace, parser: argparse.ArgumentPar
             output,
             pubkey=parsed.pubkey,
             verify=parsed.verify,
+            connections=parsed.download_connections,
+            cache=get_update_cache(parsed),
+            session=session,
         )
 
 
+def prefetch_update(
+    parsed: argparse.Namespace,
+    firmware: Firmware,
+    filename_format: str,
+    version: str,
+    signature: Optional[DownloadedSignatureResult],
+    cache: UpdateCache,
+    session: Optional[requests.Session] = None,
+) -> str:
+    """Download and verify an update into the update cache, returning its filename
+
+    The update is downloaded to a directory in the cache rather than --update-tmpdir,
+    which is usually a tmpfs, so that prefetching doesn't hold the update in memory;
+    an interrupted prefetch is resumed from there next time.
+    The download is on the same filesystem as the cache,
+    so it is verified in place and moved into the cache rather than written twice.
+    """
+    if signature is None:
+        signature = download_update_signature(firmware, parsed.repository, filename_format, version, session)
+    filename = signature.unverified_metadata["filename"]
+    cached = cache.get(filename)
+    if cached is not None and cached.minisig_text == signature.text:
+        logger.info(f"{filename} is already in update cache {cache.root}")
+        return filename
+    staging = os.path.join(cache.root, "prefetch") + "/"
+    os.makedirs(staging, exist_ok=True)
+    # Verified as it is added to the cache
+    path = download_update(
+        firmware,
+        parsed.repository,
+        filename_format,
+        version,
+        staging,
+        verify=False,
+        connections=parsed.download_connections,
+        session=session,
+        signature=signature,
+    )
+    cache.add(path, signature.text, PublicKey.from_file(parsed.pubkey or DEFAULT_PUBKEY_PATH), move=True)
+    for staged in [path, f"{path}.minisig"]:
+        if os.path.exists(staged):
+            os.remove(staged)
+    return filename
+
+
 def subcommand_check(
     parsed: argparse.Namespace,
     parser: argparse.ArgumentParser,
@@ -278,6 +395,11 @@ def subcommand_check(
     sides: Sides,
     firmware: Firmware,
 ):
+    if parsed.prefetch and not parsed.cache_dir:
+        parser.error("--prefetch requires --cache-dir")
+    if parsed.prefetch and not parsed.verify:
+        parser.error("--prefetch cannot be used with --no-verify, because only verified updates are cached")
+    session = requests.Session()
     checked = check_updates(
         filesystems,
         sides,
@@ -287,7 +409,29 @@ def subcommand_check(
         parsed.repository,
         parsed.psyopsOS_filename_format,
         parsed.psyopsESP_filename_format,
+        session=session,
     )
+
+    # Start prefetching before printing anything, so the download overlaps with whatever reads our output
+    prefetches: dict[str, Future] = {}
+    executor = ThreadPoolExecutor() if parsed.prefetch else None
+    if executor is not None:
+        cache = get_update_cache(parsed)
+        for fs, fsmd in checked.items():
+            filename_format = parsed.psyopsESP_filename_format if fs == "efisys" else parsed.psyopsOS_filename_format
+            if fsmd["up_to_date"] or filename_format in prefetches:
+                continue
+            prefetches[filename_format] = executor.submit(
+                prefetch_update,
+                parsed,
+                firmware,
+                filename_format,
+                fsmd["compared_to"],
+                fsmd["signature"],
+                cache,
+                session=session,
+            )
+
     for fs, fsmd in checked.items():
         if fsmd["up_to_date"]:
             print(f"{fs}: {fsmd['label']} is version {fsmd['compared_to']}")
@@ -296,11 +440,35 @@ def subcommand_check(
                 f"{fs}: {fsmd['label']} is currently version {fsmd['current_version']}, not version {fsmd['compared_to']}"
             )
 
+    if executor is not None:
+        sys.stdout.flush()
+        errors = []
+        with executor:
+            for filename_format, future in prefetches.items():
+                try:
+                    with timings.phase(f"prefetch {filename_format}"):
+                        print(f"Prefetched update {future.result()} to {parsed.cache_dir}")
+                except Exception as exc:
+                    logger.error(f"Could not prefetch {filename_format}: {exc}")
+                    errors.append(exc)
+        if errors:
+            raise MultiError("Could not prefetch updates", errors)
+
+
+def subcommand_serve(parsed: argparse.Namespace, parser: argparse.ArgumentParser):
+    cache = get_update_cache(parsed)
+    if cache is None:
+        parser.error("serve requires --cache-dir")
+    serve(cache, parsed.address, parsed.port)
+
 
 def getparser(prog=None) -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser(prog=prog, description="Update psyopsOS boot media")
     parser.add_argument("--debug", "-d", help="Drop into pdb on exception", action="store_true")
     parser.add_argument("--verbose", "-v", help="Verbose logging", action="store_true")
+    parser.add_argument(
+        "--timings", action="store_true", help="Print how long each phase of the command took to stderr when it finishes"
+    )
     subparsers = parser.add_subparsers(dest="subcommand", help="Subcommand to run", required=True)
 
     # verification options
@@ -367,7 +535,7 @@ def getparser(prog=None) -> argparse.ArgumentParser:
     repository_group.add_argument(
         "--repository",
         default="https://psyops.micahrl.com/os",
-        help="URL for the psyopsOS update repository, default: %(default)s",
+        help="URL for the psyopsOS update repository, or a comma-separated list of URLs to try in order, like LAN peers running 'neuralupgrade serve' followed by the upstream repository, default: %(default)s",
     )
     repository_group.add_argument(
         "--psyopsOS-filename-format",
@@ -379,6 +547,23 @@ def getparser(prog=None) -> argparse.ArgumentParser:
         default="psyopsESP.{fwtype}.{version}.tar",
         help="The format string for the versioned psyopsOS tarfile. Used as the base for the filename in S3, and also of the signature file.",
     )
+    repository_group.add_argument(
+        "--download-connections",
+        type=int,
+        default=DEFAULT_CONNECTIONS,
+        help="The maximum number of parallel connections to use when downloading an update, default: %(default)s",
+    )
+    repository_group.add_argument(
+        "--cache-dir",
+        default="",
+        help="A directory on persistent storage to keep verified updates in; updates found there are not downloaded again, and the directory can be served to other nodes with 'neuralupgrade serve'",
+    )
+    repository_group.add_argument(
+        "--cache-keep",
+        type=int,
+        default=DEFAULT_KEEP,
+        help="The number of updates to keep in --cache-dir, default: %(default)s",
+    )
 
     # neuralupgrade show
     show_parser = subparsers.add_parser(
@@ -454,6 +639,11 @@ def getparser(prog=None) -> argparse.ArgumentParser:
         choices=["a", "b", "nonbooted", "efisys"],
         help="The target filesystem(s) to check",
     )
+    check_parser.add_argument(
+        "--prefetch",
+        action="store_true",
+        help="Download and verify out of date updates into --cache-dir, so that a later apply of the same version uses them instead of downloading them again",
+    )
 
     # neuralupgrade apply
     apply_parser = subparsers.add_parser("apply", help="Apply psyopsOS or EFI system partition updates")
@@ -470,6 +660,26 @@ def getparser(prog=None) -> argparse.ArgumentParser:
         action="store_true",
         help="Skip updating the boot configuration file (only applies when target includes nonbooted)",
     )
+    apply_parser.add_argument(
+        "--parallel",
+        action="store_true",
+        help="Update the A and B sides and prepare the EFI system partition at the same time, which is faster when they are on separate devices; the boot configuration is written only after all of them succeed",
+    )
+    apply_parser.add_argument(
+        "--single-pass",
+        action="store_true",
+        help="Read the psyopsOS tarball only once, verifying its signature while extracting it to a staging directory which is moved into place only if the signature is valid",
+    )
+    apply_parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="With --os-version, verify and extract the psyopsOS tarball as it is downloaded instead of saving it to --update-tmpdir first; only one OS side may be targeted, and an interrupted download must be restarted from the beginning",
+    )
+    apply_parser.add_argument(
+        "--delta",
+        action="store_true",
+        help="With --os-version, download only the parts of the psyopsOS tarball that aren't already on the booted side, if the repository has a chunk manifest for it",
+    )
     os_update_group = apply_parser.add_mutually_exclusive_group()
     os_update_group.add_argument("--os-tar", help="A local path to a psyopsOS tarball to apply")
     os_update_group.add_argument("--os-version", help="A version in the remote repository to apply")
@@ -477,6 +687,16 @@ def getparser(prog=None) -> argparse.ArgumentParser:
     esp_update_group.add_argument("--esp-tar", help="A local path to an efisys tarball to apply")
     esp_update_group.add_argument("--esp-version", help="A version in the remote repository to apply")
 
+    # neuralupgrade serve
+    serve_parser = subparsers.add_parser(
+        "serve",
+        help="Serve updates in --cache-dir to other nodes over HTTP, so they can use this node in their --repository list",
+    )
+    serve_parser.add_argument("--address", default="", help="The address to listen on, default: all addresses")
+    serve_parser.add_argument(
+        "--port", type=int, default=DEFAULT_PORT, help="The port to listen on, default: %(default)s"
+    )
+
     # neuralupgrade set-default
     set_default_parser = subparsers.add_parser(
         "set-default", help="Set the default boot label in the boot configuration file"
@@ -502,27 +722,53 @@ def main_implementation(arguments: list[str]) -> int:
 
     logger.debug(f"Arguments: {parsed}")
 
+    if parsed.timings:
+        timings.enable()
+    try:
+        return run_subcommand(parsed, parser)
+    finally:
+        if parsed.timings:
+            timings.report()
+
+
+def run_subcommand(parsed: argparse.Namespace, parser: argparse.ArgumentParser) -> int:
     if parsed.efisys_mock and not parsed.efisys_mountpoint:
         parser.error("Cannot use --efisys-mock without --efisys-mountpoint")
     if parsed.a_mock and not parsed.a_mountpoint:
         parser.error("Cannot use --a-mock without --a-mountpoint")
     if parsed.b_mock and not parsed.b_mountpoint:
         parser.error("Cannot use --b-mock without --b-mountpoint")
+    with timings.phase("inventory"):
+        inventory = SystemInventory.snapshot()
     filesystems = Filesystems(
         efisys=Filesystem(
             parsed.efisys_label,
             device=parsed.efisys_dev,
             mountpoint=parsed.efisys_mountpoint,
             mockmount=parsed.efisys_mock,
+            inventory=inventory,
+        ),
+        a=Filesystem(
+            parsed.a_label,
+            device=parsed.a_dev,
+            mountpoint=parsed.a_mountpoint,
+            mockmount=parsed.a_mock,
+            inventory=inventory,
+        ),
+        b=Filesystem(
+            parsed.b_label,
+            device=parsed.b_dev,
+            mountpoint=parsed.b_mountpoint,
+            mockmount=parsed.b_mock,
+            inventory=inventory,
         ),
-        a=Filesystem(parsed.a_label, device=parsed.a_dev, mountpoint=parsed.a_mountpoint, mockmount=parsed.a_mock),
-        b=Filesystem(parsed.b_label, device=parsed.b_dev, mountpoint=parsed.b_mountpoint, mockmount=parsed.b_mock),
     )
     if parsed.fwtype:
         firmware = FirmwareTypeMap[parsed.fwtype]()
     else:
         try:
-            firmware = detect_firmware()
+            with timings.phase("detect firmware"):
+                firmware = detect_firmware()
         except UnknownFirmwareError as e:
             parser.error(f"Could not detect firmware: {e}")
 
@@ -531,19 +777,23 @@ def main_implementation(arguments: list[str]) -> int:
     if parsed.booted_mock:
         sides = Sides(parsed.booted_mock, flipside(parsed.booted_mock, filesystems))
     else:
-        sides = Sides.detect(filesystems)
+        sides = Sides.detect(filesystems, inventory)
 
     if not parsed.update_tmpdir.endswith("/"):
         parsed.update_tmpdir += "/"
 
     if parsed.subcommand == "show":
-        subcommand_show(parsed, parser, filesystems, sides, firmware)
+        with timings.phase("show"):
+            subcommand_show(parsed, parser, filesystems, sides, firmware)
     elif parsed.subcommand == "download":
         subcommand_download(parsed, parser, firmware)
     elif parsed.subcommand == "check":
-        subcommand_check(parsed, parser, filesystems, sides, firmware)
+        with timings.phase("check"):
+            subcommand_check(parsed, parser, filesystems, sides, firmware)
     elif parsed.subcommand == "apply":
         subcommand_apply(parsed, parser, filesystems, sides, firmware)
+    elif parsed.subcommand == "serve":
+        subcommand_serve(parsed, parser)
     elif parsed.subcommand == "set-default":
         with filesystems.efisys.mount(writable=True):
             firmware.write_default_boot_label(filesystems, parsed.label)
@@ -0,0 +1,366 @@
+"""Delta updates using content-defined chunks
+
+Consecutive psyopsOS builds share most of their bytes,
+but a full update still downloads the whole ostar.
+To avoid that, telekinesis publishes a chunk manifest next to each ostar,
+FILENAME.tar.chunks.json, which describes the tarball as a sequence of regions:
+
+- Literal regions: tar headers, padding, and the end-of-archive marker, embedded in the manifest
+- Member regions: the contents of each file in the tarball, as a list of chunks with their SHA-256 hashes
+
+Chunk boundaries are content-defined:
+a chunk ends after the first occurrence of ANCHOR at least MIN_CHUNK_SIZE bytes into it,
+or at MAX_CHUNK_SIZE bytes if there is no such anchor.
+This means an insertion or deletion in a file only changes the chunks around it,
+and the rest of the file is chunked identically to the previous version.
+
+To update, neuralupgrade indexes the chunks of the files already on the booted side,
+downloads just the chunks it doesn't have with HTTP Range requests against the full tarball,
+and reassembles the new tarball locally.
+The manifest is not signed; the reassembled tarball is verified with its minisig like any other download,
+so a bad manifest can only cause a failed update, not a compromised one.
+"""
+
+import argparse
+import base64
+import hashlib
+import json
+import os
+import tarfile
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import BinaryIO, Optional
+
+import requests
+
+from neuralupgrade import logger
+from neuralupgrade.rangedownload import REPOSITORY_TIMEOUT
+
+
+MANIFEST_SUFFIX = ".chunks.json"
+"""Appended to the tarball filename to get the manifest filename"""
+
+MANIFEST_FORMAT = "psyopsOS-chunks-v1"
+
+ANCHOR = b"\x8f\x3c"
+"""Chunk boundary marker; with random-looking data, expect one every 64KiB"""
+
+MIN_CHUNK_SIZE = 64 * 1024
+MAX_CHUNK_SIZE = 1024 * 1024
+
+READ_SIZE = 4 * 1024 * 1024
+
+COALESCE_GAP = 256 * 1024
+"""Download chunks separated by less than this many bytes in one request, including the gap"""
+
+MAX_RANGE_SIZE = 16 * 1024 * 1024
+"""Don't coalesce chunks into ranges larger than this, since each range is held in memory"""
+
+FETCH_CONNECTIONS = 4
+
+
+class Chunker:
+    """Split data into content-defined chunks as it is fed in
+
+    Feeding the same bytes always makes the same chunks, however they are split up between calls to update(),
+    so a writer can chunk a file as it writes it rather than reading it back afterwards.
+    """
+
+    def __init__(self):
+        self.chunks: list[tuple[str, int]] = []
+        """(sha256 hexdigest, size) tuples of the chunks cut so far"""
+        self._buf = bytearray()
+
+    def _cut(self):
+        anchor = self._buf.find(ANCHOR, MIN_CHUNK_SIZE, MAX_CHUNK_SIZE)
+        cut = anchor + len(ANCHOR) if anchor != -1 else min(MAX_CHUNK_SIZE, len(self._buf))
+        self.chunks.append((hashlib.sha256(memoryview(self._buf)[:cut]).hexdigest(), cut))
+        del self._buf[:cut]
+
+    def update(self, data: bytes):
+        self._buf += data
+        while len(self._buf) >= MAX_CHUNK_SIZE:
+            self._cut()
+
+    def finish(self) -> list[tuple[str, int]]:
+        """Cut whatever is left and return all the chunks"""
+        while self._buf:
+            self._cut()
+        return self.chunks
+
+
+def chunk_stream(stream: BinaryIO, length: int) -> list[tuple[str, int]]:
+    """Split the next `length` bytes of a stream into content-defined chunks
+
+    Return a list of (sha256 hexdigest, size) tuples.
+    """
+    chunker = Chunker()
+    remaining = length
+    while remaining > 0:
+        block = stream.read(min(READ_SIZE, remaining))
+        if not block:
+            raise EOFError(f"Stream ended with {remaining} bytes left to chunk")
+        chunker.update(block)
+        remaining -= len(block)
+    return chunker.finish()
+
+
+def literal_region(data: bytes) -> dict:
+    """A manifest region for bytes that are embedded in the manifest"""
+    return {"literal": base64.b64encode(data).decode()}
+
+
+def member_region(name: str, offset: int, chunks: list[tuple[str, int]]) -> dict:
+    """A manifest region for the contents of a tarball member, starting at offset in the tarball"""
+    return {"member": name, "offset": offset, "chunks": chunks}
+
+
+def build_manifest(filename: str, size: int, regions: list[dict]) -> dict:
+    """Build a chunk manifest from its regions, which must cover all `size` bytes of the tarball in order"""
+    return {
+        "format": MANIFEST_FORMAT,
+        "filename": filename,
+        "size": size,
+        "chunker": {"anchor": ANCHOR.hex(), "min": MIN_CHUNK_SIZE, "max": MAX_CHUNK_SIZE},
+        "regions": regions,
+    }
+
+
+def make_manifest(tarball: str, filename: Optional[str] = None) -> dict:
+    """Build the chunk manifest for a tarball by reading it
+
+    Arguments:
+    - tarball: The path to the tarball
+    - filename: The name the tarball is published under, if different from its local name
+    """
+    size = os.path.getsize(tarball)
+    regions: list[dict] = []
+    pos = 0
+    with open(tarball, "rb") as f:
+        with tarfile.open(tarball, "r:") as tar:
+            members = [m for m in tar.getmembers() if m.isfile() and m.size > 0]
+        for member in members:
+            f.seek(pos)
+            regions.append(literal_region(f.read(member.offset_data - pos)))
+            f.seek(member.offset_data)
+            regions.append(member_region(member.name, member.offset_data, chunk_stream(f, member.size)))
+            pos = member.offset_data + member.size
+        f.seek(pos)
+        regions.append(literal_region(f.read(size - pos)))
+    return build_manifest(filename or os.path.basename(tarball), size, regions)
+
+
+def write_manifest(tarball: str, filename: Optional[str] = None) -> str:
+    """Write the chunk manifest for a tarball next to it, returning its path"""
+    manifest = make_manifest(tarball, filename)
+    path = tarball + MANIFEST_SUFFIX
+    with open(path, "w") as f:
+        json.dump(manifest, f)
+    return path
+
+
+def _check_manifest(manifest: dict):
+    if manifest.get("format") != MANIFEST_FORMAT:
+        raise ValueError(f"Unsupported chunk manifest format {manifest.get('format')}")
+    chunker = manifest["chunker"]
+    if (chunker["anchor"], chunker["min"], chunker["max"]) != (ANCHOR.hex(), MIN_CHUNK_SIZE, MAX_CHUNK_SIZE):
+        raise ValueError(f"Unsupported chunker parameters {chunker}")
+
+
+@dataclass
+class LocalChunk:
+    path: str
+    offset: int
+    size: int
+
+
+def index_local_chunks(directory: str, manifest: dict) -> dict[str, LocalChunk]:
+    """Index the chunks of files in a directory that might be reused for a manifest
+
+    The directory is typically the booted side, which has the files from the previous ostar extracted into it.
+    If the directory has a manifest from when it was installed (psyopsOS.tar.chunks.json),
+    use that rather than reading every file;
+    chunks are verified when they are read, so a stale index just means more downloading.
+    """
+    installed_manifest_path = os.path.join(directory, "psyopsOS.tar" + MANIFEST_SUFFIX)
+    installed_manifest = None
+    try:
+        with open(installed_manifest_path) as f:
+            installed_manifest = json.load(f)
+        _check_manifest(installed_manifest)
+        logger.debug(f"Using installed chunk manifest {installed_manifest_path} to index {directory}")
+    except (FileNotFoundError, ValueError, KeyError) as exc:
+        logger.debug(f"Not using installed chunk manifest {installed_manifest_path}: {exc}")
+        installed_manifest = None
+
+    index: dict[str, LocalChunk] = {}
+    if installed_manifest is not None:
+        regions = [r for r in installed_manifest["regions"] if "member" in r]
+        for region in regions:
+            path = os.path.join(directory, region["member"])
+            offset = 0
+            for digest, size in region["chunks"]:
+                index.setdefault(digest, LocalChunk(path, offset, size))
+                offset += size
+        return index
+
+    names = {r["member"] for r in manifest["regions"] if "member" in r}
+    for name in sorted(names):
+        path = os.path.join(directory, name)
+        if not os.path.isfile(path):
+            continue
+        offset = 0
+        with open(path, "rb") as f:
+            for digest, size in chunk_stream(f, os.path.getsize(path)):
+                index.setdefault(digest, LocalChunk(path, offset, size))
+                offset += size
+    return index
+
+
+@dataclass
+class _Placement:
+    """Where a chunk goes in the output, and where it can be found in the remote tarball"""
+
+    digest: str
+    size: int
+    output_offset: int
+    remote_offset: int
+
+
+def _read_local_chunk(chunk: LocalChunk, digest: str) -> Optional[bytes]:
+    try:
+        with open(chunk.path, "rb") as f:
+            f.seek(chunk.offset)
+            data = f.read(chunk.size)
+    except OSError:
+        return None
+    if hashlib.sha256(data).hexdigest() != digest:
+        return None
+    return data
+
+
+def _coalesce(placements: list[_Placement]) -> list[list[_Placement]]:
+    """Group placements that are close together in the remote tarball into a single range"""
+    groups: list[list[_Placement]] = []
+    for placement in sorted(placements, key=lambda p: p.remote_offset):
+        if groups:
+            last = groups[-1][-1]
+            gap = placement.remote_offset - (last.remote_offset + last.size)
+            span = placement.remote_offset + placement.size - groups[-1][0].remote_offset
+            if gap < COALESCE_GAP and span <= MAX_RANGE_SIZE:
+                groups[-1].append(placement)
+                continue
+        groups.append([placement])
+    return groups
+
+
+def _fetch_group(session: requests.Session, url: str, group: list[_Placement], fd: int):
+    start = group[0].remote_offset
+    end = group[-1].remote_offset + group[-1].size
+    response = session.get(url, headers={"Range": f"bytes={start}-{end - 1}"}, timeout=REPOSITORY_TIMEOUT)
+    response.raise_for_status()
+    if response.status_code != 206 or len(response.content) != end - start:
+        raise Exception(f"Server did not return the requested range {start}-{end - 1} of {url}")
+    data = response.content
+    for placement in group:
+        chunk = data[placement.remote_offset - start : placement.remote_offset - start + placement.size]
+        if hashlib.sha256(chunk).hexdigest() != placement.digest:
+            raise Exception(f"Chunk at {placement.remote_offset} of {url} does not match the manifest")
+        os.pwrite(fd, chunk, placement.output_offset)
+
+
+@dataclass
+class DeltaResult:
+    reused_bytes: int
+    downloaded_bytes: int
+    literal_bytes: int
+
+
+def rebuild_from_delta(
+    manifest: dict,
+    tarball_url: str,
+    local_directory: str,
+    output: str,
+    session: Optional[requests.Session] = None,
+    connections: int = FETCH_CONNECTIONS,
+) -> DeltaResult:
+    """Reassemble a tarball from local chunks and chunks downloaded from the full tarball
+
+    Arguments:
+    - manifest: The chunk manifest for the tarball
+    - tarball_url: The URL of the full tarball, which must support Range requests
+    - local_directory: A directory containing files from a previous version, like the booted side
+    - output: Where to write the reassembled tarball
+    - session: A requests session to use
+    - connections: How many ranges to download at once
+
+    The output is NOT verified; the caller must check it against its signature.
+    """
+    _check_manifest(manifest)
+    session = session or requests.Session()
+    index = index_local_chunks(local_directory, manifest)
+    result = DeltaResult(0, 0, 0)
+
+    missing: list[_Placement] = []
+    with open(output, "wb") as f:
+        f.truncate(manifest["size"])
+    fd = os.open(output, os.O_WRONLY)
+    try:
+        pos = 0
+        for region in manifest["regions"]:
+            if "literal" in region:
+                literal = base64.b64decode(region["literal"])
+                os.pwrite(fd, literal, pos)
+                pos += len(literal)
+                result.literal_bytes += len(literal)
+                continue
+            remote_offset = region["offset"]
+            for digest, size in region["chunks"]:
+                local = index.get(digest)
+                data = _read_local_chunk(local, digest) if local else None
+                if data is not None:
+                    os.pwrite(fd, data, pos)
+                    result.reused_bytes += size
+                else:
+                    missing.append(_Placement(digest, size, pos, remote_offset))
+                    result.downloaded_bytes += size
+                pos += size
+                remote_offset += size
+        if pos != manifest["size"]:
+            raise Exception(f"Chunk manifest describes {pos} bytes, but says the tarball is {manifest['size']} bytes")
+
+        groups = _coalesce(missing)
+        logger.info(
+            f"Delta update: reusing {result.reused_bytes} bytes from {local_directory}, "
+            f"downloading {result.downloaded_bytes} bytes in {len(groups)} range request(s)"
+        )
+        with ThreadPoolExecutor(max_workers=max(1, connections)) as executor:
+            for future in [executor.submit(_fetch_group, session, tarball_url, group, fd) for group in groups]:
+                future.result()
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    return result
+
+
+def download_manifest(tarball_url: str, session: Optional[requests.Session] = None) -> Optional[dict]:
+    """Download the chunk manifest for a tarball, or return None if there isn't one"""
+    session = session or requests.Session()
+    response = session.get(tarball_url + MANIFEST_SUFFIX, timeout=REPOSITORY_TIMEOUT)
+    if response.status_code == 404:
+        return None
+    response.raise_for_status()
+    return response.json()
+
+
+def main():
+    """Write chunk manifests for tarballs; used by telekinesis when building an ostar"""
+    parser = argparse.ArgumentParser(prog="python -m neuralupgrade.delta", description=main.__doc__)
+    parser.add_argument("tarball", help="The tarball to write a manifest for")
+    parser.add_argument("--filename", help="The name the tarball will be published as, if different")
+    parsed = parser.parse_args()
+    print(write_manifest(parsed.tarball, parsed.filename))
+
+
+if __name__ == "__main__":
+    main()
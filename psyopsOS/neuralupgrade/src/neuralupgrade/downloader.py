@@ -1,11 +1,18 @@
 from dataclasses import dataclass
+import json
 import os
+from typing import BinaryIO, Optional
 
 import requests
 
 from neuralupgrade import logger
+from neuralupgrade.coginitivedefects import MultiError
+from neuralupgrade.delta import MANIFEST_SUFFIX, download_manifest, rebuild_from_delta
 from neuralupgrade.firmware import Firmware
+from neuralupgrade.minisign import DEFAULT_PUBKEY_PATH, PublicKey
+from neuralupgrade.rangedownload import DEFAULT_CONNECTIONS, REPOSITORY_TIMEOUT, download_ranged
 from neuralupgrade.update_metadata import minisign_verify, parse_trusted_comment
+from neuralupgrade.updatecache import UpdateCache
 
 
 def is_folder(path: str) -> bool:
@@ -19,17 +26,52 @@ def is_folder(path: str) -> bool:
     return path.endswith("/")
 
 
-def download_repository_file(repository_url: str, filename: str) -> str:
+def repository_urls(repository_url: str) -> list[str]:
+    """Split a comma-separated list of repository URLs
+
+    Repositories are tried in order,
+    so a list of LAN peers serving their update cache can be followed by the upstream repository.
+    """
+    return [url.strip().rstrip("/") for url in repository_url.split(",") if url.strip()]
+
+
+def get_repository_file(
+    repository_url: str, filename: str, stream: bool = False, session: Optional[requests.Session] = None
+) -> requests.Response:
+    """Get a file from the first repository that has it
+
+    Return the response, which the caller must close if stream is True.
+    Pass a session to reuse its keep-alive connections across requests.
+    """
+    getter = session.get if session is not None else requests.get
+    errors: list[Exception] = []
+    for repo in repository_urls(repository_url):
+        url = f"{repo}/{filename}"
+        logger.debug(f"Requesting {url}")
+        try:
+            response = getter(url, stream=stream, timeout=REPOSITORY_TIMEOUT)
+            try:
+                response.raise_for_status()
+            except Exception:
+                response.close()
+                raise
+            return response
+        except requests.exceptions.RequestException as exc:
+            logger.debug(f"Could not get {url}: {exc}")
+            errors.append(exc)
+    raise MultiError(f"Could not get {filename} from any repository in {repository_url}", errors)
+
+
+def download_repository_file(
+    repository_url: str, filename: str, session: Optional[requests.Session] = None
+) -> str:
     """Download a repository file and return its contents
 
     Not suitable for large files which should be streamed.
     """
-    url = f"{repository_url}/{filename}"
-    logger.debug(f"Downloading file from {url}")
-    response = requests.get(url)
-    response.raise_for_status()
+    response = get_repository_file(repository_url, filename, session=session)
     text_content = response.text
-    logger.debug(f"Item retrieved from {url}: {response.text}")
+    logger.debug(f"Item retrieved from {response.url}: {response.text}")
     return text_content
 
 
@@ -41,7 +83,11 @@ class DownloadedSignatureResult:
 
 
 def download_update_signature(
-    firmware: Firmware, repository_url: str, filename_format: str, version: str
+    firmware: Firmware,
+    repository_url: str,
+    filename_format: str,
+    version: str,
+    session: Optional[requests.Session] = None,
 ) -> DownloadedSignatureResult:
     """Download a psyopsOS update signature
 
@@ -53,11 +99,9 @@ def download_update_signature(
     minisig_filename = (
         filename_format.format(fwtype=firmware.fwtype, arch=firmware.architecture, version=version) + ".minisig"
     )
-    minisig_url = f"{repository_url}/{minisig_filename}"
-
-    logger.debug(f"Downloading update minisig from {minisig_url}")
-    response = requests.get(minisig_url)
-    response.raise_for_status()
+    logger.debug(f"Downloading update minisig {minisig_filename} from {repository_url}")
+    response = get_repository_file(repository_url, minisig_filename, session=session)
+    minisig_url = response.url
     text_content = response.text
     logger.debug(f"Update minisig retrieved from {minisig_url}: {response.text}")
     unverified_metadata = parse_trusted_comment(sigcontents=text_content)
@@ -66,6 +110,68 @@ def download_update_signature(
     return DownloadedSignatureResult(minisig_url, text_content, unverified_metadata)
 
 
+@dataclass
+class StreamedUpdate:
+    """An update that is being downloaded as it is read
+
+    Use open_update_stream() to create one, and close it when finished.
+    """
+
+    url: str
+    signature: DownloadedSignatureResult
+    response: requests.Response
+
+    @property
+    def stream(self) -> BinaryIO:
+        """The HTTP response body as a file-like object"""
+        return self.response.raw
+
+    def close(self):
+        self.response.close()
+
+
+def open_update_stream(
+    firmware: Firmware, repository_url: str, filename_format: str, version: str
+) -> StreamedUpdate:
+    """Start downloading a psyopsOS update without saving it anywhere
+
+    The tarball is not verified here;
+    whatever reads the stream must verify it against the signature.
+    The stream cannot be resumed or rewound,
+    so if the connection drops, the caller must start over.
+    """
+    downloaded = download_update_signature(firmware, repository_url, filename_format, version)
+    response = get_repository_file(repository_url, downloaded.unverified_metadata["filename"], stream=True)
+    logger.debug(f"Streaming update from {response.url}")
+    # Undo any Content-Encoding, like iter_content() would
+    response.raw.decode_content = True
+    return StreamedUpdate(response.url, downloaded, response)
+
+
+def _download_delta(
+    update_url: str,
+    update_local_path: str,
+    delta_source: str,
+    connections: int,
+    session: Optional[requests.Session] = None,
+) -> bool:
+    """Try to download an update as a delta from delta_source, returning whether it worked"""
+    try:
+        manifest = download_manifest(update_url, session)
+        if manifest is None:
+            logger.info(f"No chunk manifest for {update_url}, downloading the whole update")
+            return False
+        rebuild_from_delta(
+            manifest, update_url, delta_source, update_local_path, session=session, connections=connections
+        )
+        with open(update_local_path + MANIFEST_SUFFIX, "w") as file:
+            json.dump(manifest, file)
+        return True
+    except Exception as exc:
+        logger.warning(f"Delta update from {delta_source} failed, downloading the whole update: {exc}")
+        return False
+
+
 def download_update(
     firmware: Firmware,
     repository_url: str,
@@ -74,21 +180,50 @@ def download_update(
     output: str,
     pubkey: str = "",
     verify: bool = True,
+    connections: int = DEFAULT_CONNECTIONS,
+    delta_source: str = "",
+    cache: Optional[UpdateCache] = None,
+    session: Optional[requests.Session] = None,
+    signature: Optional[DownloadedSignatureResult] = None,
 ):
     """Download a psyopsOS update to the specified output location.
 
     If the output is a directory, the file will be saved with the default filename.
 
+    The repository_url may be a comma-separated list of repositories, which are tried in order.
+
+    The tarball is downloaded over up to `connections` parallel ranged requests,
+    and an interrupted download is resumed on the next attempt;
+    see rangedownload.py.
+
+    If delta_source is a directory containing files from a previous update, like the booted side,
+    and the repository has a chunk manifest for the update,
+    only the parts of the update that aren't already in delta_source are downloaded;
+    see delta.py.
+    If that fails for any reason, the whole update is downloaded instead.
+
+    If a cache is passed, the update is copied from the cache if it is there,
+    and added to the cache after it is downloaded and verified;
+    see updatecache.py.
+
+    If the output already exists and verifies against the signature,
+    like after an interrupted apply, it is used as-is.
+
+    Pass a session to reuse its keep-alive connections,
+    and a signature if it has already been downloaded, like by check_updates().
+
     First download the minisig file,
     then find the tarball filename from the minisig,
     download that from the repo,
     and finally verify that the signature matches the tarball.
     """
 
-    downloaded = download_update_signature(firmware, repository_url, filename_format, version)
+    if signature is not None:
+        downloaded = signature
+    else:
+        downloaded = download_update_signature(firmware, repository_url, filename_format, version, session)
 
     update_filename = downloaded.unverified_metadata["filename"]
-    update_url = f"{repository_url}/{update_filename}"
 
     if is_folder(output):
         update_local_path = f"{output}{update_filename}"
@@ -106,17 +241,45 @@ def download_update(
     with open(minisig_filepath, "w") as file:
         file.write(downloaded.text)
 
-    logger.debug(f"Downloading update from {update_url} to {update_local_path}")
-    with requests.get(update_url, stream=True) as response:
-        response.raise_for_status()
-        with open(update_local_path, "wb") as file:
-            for chunk in response.iter_content(chunk_size=8192):
-                if not chunk:
-                    continue
-                file.write(chunk)
+    if verify and os.path.exists(update_local_path):
+        try:
+            minisign_verify(update_local_path, pubkey)
+            logger.info(f"Using already downloaded update at {update_local_path}")
+            return update_local_path
+        except Exception as exc:
+            logger.debug(f"Existing file at {update_local_path} does not verify, downloading it again: {exc}")
+
+    if cache is not None:
+        pubkey_obj = PublicKey.from_file(pubkey or DEFAULT_PUBKEY_PATH) if verify else None
+        cached = cache.get(update_filename)
+        if cached is not None and cached.minisig_text == downloaded.text:
+            # Verified as it is copied, if verification is enabled
+            if cache.copy_out(update_filename, update_local_path, pubkey_obj) is not None:
+                logger.info(f"Using {update_filename} from update cache {cache.root}")
+                return update_local_path
+
+    errors: list[Exception] = []
+    for repo in repository_urls(repository_url):
+        update_url = f"{repo}/{update_filename}"
+        try:
+            delta = delta_source and _download_delta(
+                update_url, update_local_path, delta_source, connections, session
+            )
+            if not delta:
+                logger.debug(f"Downloading update from {update_url} to {update_local_path}")
+                download_ranged(update_url, update_local_path, connections=connections, session=session)
+            break
+        except Exception as exc:
+            logger.warning(f"Could not download update from {update_url}: {exc}")
+            errors.append(exc)
+    else:
+        raise MultiError(f"Could not download {update_filename} from any repository in {repository_url}", errors)
     logger.debug(f"Update downloaded to {update_local_path}")
 
-    if verify:
+    if verify and cache is not None:
+        # Adding to the cache verifies the update as it is copied
+        cache.add(update_local_path, downloaded.text, PublicKey.from_file(pubkey or DEFAULT_PUBKEY_PATH))
+    elif verify:
         minisign_verify(update_local_path, pubkey)
 
     return update_local_path
@@ -1,5 +1,4 @@
 from dataclasses import dataclass
-import json
 import subprocess
 import time
 from typing import Optional
@@ -7,6 +6,15 @@ from typing import Optional
 from neuralupgrade import logger
 from neuralupgrade.coginitivedefects import MultiError
 from neuralupgrade.dictify import Dictifiable
+from neuralupgrade.inventory import (
+    SystemInventory,
+    is_mountpoint,
+    mounts_for_device,
+    read_cmdline,
+    read_fstab,
+    read_mountinfo,
+)
+from neuralupgrade.timings import timings
 
 
 class UmountError(Exception):
@@ -15,33 +23,17 @@ class UmountError(Exception):
 
 def fstab() -> list[dict]:
     """Return the contents of /etc/fstab as a list of dicts"""
-    filesystems = []
-    with open("/etc/fstab") as f:
-        for line in f.readlines():
-            line = line.strip()
-            if not line or line.startswith("#"):
-                continue
-            fs = {}
-            (
-                fs["device"],
-                fs["mountpoint"],
-                fs["fstype"],
-                fs["options"],
-                fs["dump"],
-                fs["pass"],
-            ) = line.split()
-            filesystems.append(fs)
-    return filesystems
+    return read_fstab()
 
 
 def umount_retry(mountpoint: str, attempts: int = 2, sleepbetween: int = 1) -> None:
     """Unmount a mountpoint, retrying if it fails."""
     for attempt in range(attempts):
-        if not subprocess.run(["mountpoint", "-q", mountpoint]).returncode == 0:
+        if not is_mountpoint(mountpoint):
             logger.debug(f"{mountpoint} is not mounted, no need to umount")
             return
         subprocess.run(["umount", "-l", mountpoint])
-        if not subprocess.run(["mountpoint", "-q", mountpoint]).returncode == 0:
+        if not is_mountpoint(mountpoint):
             logger.debug(f"Umounted {mountpoint} (attempt {attempt + 1}/{attempts})")
             return
         logger.debug(
@@ -79,14 +71,21 @@ class Mount:
     and then unmount it when the context manager is exited.
     """
 
-    def __init__(self, device: str, mountpoint: str, writable: bool = False):
+    def __init__(
+        self, device: str, mountpoint: str, writable: bool = False, inventory: Optional[SystemInventory] = None
+    ):
         self.device = device
         self.mountpoint = mountpoint
         self.writable = writable
+        self.inventory = inventory
         self.exit_remount_ro = False
         self.exit_leave_mounted = False
 
     def __enter__(self):
+        with timings.phase(f"mount {self.device}"):
+            return self._enter()
+
+    def _enter(self):
         # If the device is mounted anywhere aside from the fstab mountpoint
         # and/or is mounted ro, then we unmount it from all mountpoints and remount it rw to the fstab mountpoint.
         # POSIX doesn't allow different permissions like ro and rw for the same device mounted to two separate places,
@@ -132,19 +131,24 @@ class Mount:
             logger.debug(f"Filesystem on {self.device} is not mounted, mounting {option} to {self.mountpoint}")
             subprocess.run(["mount", "-o", option, self.device, self.mountpoint], check=True)
 
+        if not self.exit_leave_mounted:
+            self.mounts_changed()
         return self.mountpoint
 
     def __exit__(self, exc_type, exc_value, traceback):
         cleanup_errs = []
         try:
-            if self.exit_remount_ro:
-                logger.debug(f"Remounting filesystem on {self.device} ro")
-                subprocess.run(["mount", "-o", "ro,remount", self.mountpoint], check=True)
-            elif self.exit_leave_mounted:
-                logger.debug(f"Leaving filesystem on {self.device} mounted")
-            else:
-                logger.debug(f"Unmounting filesystem on {self.device}")
-                umount_retry(self.mountpoint)
+            with timings.phase(f"umount {self.device}"):
+                if self.exit_remount_ro:
+                    logger.debug(f"Remounting filesystem on {self.device} ro")
+                    subprocess.run(["mount", "-o", "ro,remount", self.mountpoint], check=True)
+                elif self.exit_leave_mounted:
+                    logger.debug(f"Leaving filesystem on {self.device} mounted")
+                else:
+                    logger.debug(f"Unmounting filesystem on {self.device}")
+                    umount_retry(self.mountpoint)
+                if not self.exit_leave_mounted:
+                    self.mounts_changed()
         except Exception as e:
             cleanup_errs.append(e)
 
@@ -170,12 +174,19 @@ class Mount:
         if exc_type:
             return False
 
-    def get_existing_mountpoints(self):
-        """Return a list of mountpoints where the device is mounted"""
-        findmnt_json = subprocess.run(["findmnt", self.device, "--json"], capture_output=True)
-        logger.debug(f"findmnt --json {self.device} -> {findmnt_json.stdout.decode('utf-8')}")
-        if findmnt_json.returncode == 0:
-            return json.loads(findmnt_json.stdout)["filesystems"]
+    def get_existing_mountpoints(self) -> list[dict]:
+        """Return a list of mountpoints where the device is mounted, like `findmnt DEVICE --json`"""
+        if self.inventory is not None:
+            existing = self.inventory.mounts_for_device(self.device)
+        else:
+            existing = mounts_for_device(self.device, read_mountinfo())
+        logger.debug(f"Existing mounts of {self.device}: {existing}")
+        return existing
+
+    def mounts_changed(self):
+        """Reload the inventory's mount table after we have mounted or unmounted something"""
+        if self.inventory is not None:
+            self.inventory.reload_mounts()
 
 
 class Filesystem(Dictifiable):
@@ -192,10 +203,18 @@ class Filesystem(Dictifiable):
                     Useful for test mocking and examples.
                     Requires that label and mountpoint are specified.
                     The label and device are not used and may be fake values.
+    inventory:      A SystemInventory to look up the device and mountpoint in,
+                    instead of running blkid and reading /etc/fstab for each lookup
     """
 
     def __init__(
-        self, label: str = "", device: str = "", mountpoint: str = "", writable: bool = False, mockmount: bool = False
+        self,
+        label: str = "",
+        device: str = "",
+        mountpoint: str = "",
+        writable: bool = False,
+        mockmount: bool = False,
+        inventory: Optional[SystemInventory] = None,
     ):
         if mockmount:
             if not (label and mountpoint):
@@ -206,25 +225,32 @@ class Filesystem(Dictifiable):
         self._device = device
         self._mountpoint = mountpoint
         self.mockmount = mockmount
+        self.inventory = inventory
 
     @property
     def device(self):
         """The device path of the filesystem"""
+        if not self._device and self.inventory is not None:
+            self._device = self.inventory.device_for_label(self.label) or ""
         if not self._device:
-            blkid_L = subprocess.run(["blkid", "-L", self.label], check=True, capture_output=True)
+            with timings.phase(f"blkid -L {self.label}"):
+                blkid_L = subprocess.run(["blkid", "-L", self.label], check=True, capture_output=True)
             self._device = blkid_L.stdout.decode("utf-8").strip()
         return self._device
 
+    def _fstab(self) -> list[dict]:
+        return self.inventory.fstab if self.inventory is not None else fstab()
+
     def find_mountpoint_by_device(self) -> str:
         """Return the mountpoint of the filesystem by device via /etc/fstab"""
-        for fs in fstab():
+        for fs in self._fstab():
             if fs["device"] == self.device:
                 return fs["mountpoint"]
         raise KeyError(f"Could not find {self.device} in fstab")
 
     def find_mountpoint_by_label(self) -> str:
         """Return the mountpoint of the filesystem by label via /etc/fstab"""
-        for fs in fstab():
+        for fs in self._fstab():
             if fs["device"] == f"LABEL={self.label}":
                 return fs["mountpoint"]
         raise KeyError(f"Could not find {self.label} in fstab")
@@ -248,7 +274,7 @@ class Filesystem(Dictifiable):
         """A context manager for mounting the filesystem"""
         if self.mockmount:
             return MockMount(self.mountpoint)
-        return Mount(self.device, self.mountpoint, writable)
+        return Mount(self.device, self.mountpoint, writable, inventory=self.inventory)
 
     def __repr__(self):
         return f"Filesystem(label={self.label!r}, device={self.device!r}, mountpoint={self.mountpoint!r})"
@@ -267,11 +293,15 @@ class Filesystems:
     """The collection os psyopsOS filesystems"""
 
     def __init__(
-        self, efisys: Optional[Filesystem] = None, a: Optional[Filesystem] = None, b: Optional[Filesystem] = None
+        self,
+        efisys: Optional[Filesystem] = None,
+        a: Optional[Filesystem] = None,
+        b: Optional[Filesystem] = None,
+        inventory: Optional[SystemInventory] = None,
     ):
-        self.efisys = efisys or Filesystem(label="PSYOPSOSEFI")
-        self.a = a or Filesystem(label="psyopsOS-A")
-        self.b = b or Filesystem(label="psyopsOS-B")
+        self.efisys = efisys or Filesystem(label="PSYOPSOSEFI", inventory=inventory)
+        self.a = a or Filesystem(label="psyopsOS-A", inventory=inventory)
+        self.b = b or Filesystem(label="psyopsOS-B", inventory=inventory)
 
     def bylabel(self, label: str) -> Filesystem:
         """Return the filesystem with the given label"""
@@ -287,19 +317,18 @@ class Filesystems:
         return f"Filesystems({self.efisys!r}, {self.a!r}, {self.b!r})"
 
 
-def activeside() -> str:
+def activeside(inventory: Optional[SystemInventory] = None) -> str:
     """Return the booted side (A or B), by reading from the kernel command line.
 
     Expect this to be the A or B label.
     """
-    with open("/proc/cmdline") as f:
-        cmdline = f.read()
-    for arg in cmdline.split():
-        if arg.startswith("psyopsos="):
-            thisside = arg.split("=")[1]
-            logger.debug(f"Booted side is {thisside}")
-            return thisside
-    raise ValueError("Could not determine booted side")
+    if inventory is None:
+        inventory = SystemInventory([], [], {}, read_cmdline())
+    thisside = inventory.kernel_argument("psyopsos")
+    if not thisside:
+        raise ValueError("Could not determine booted side")
+    logger.debug(f"Booted side is {thisside}")
+    return thisside
 
 
 def flipside(side: str, filesystems: Filesystems) -> str:
@@ -322,6 +351,7 @@ class Sides:
         return f"Sides(booted={self.booted!r}, nonbooted={self.nonbooted!r})"
 
     @classmethod
-    def detect(cls, filesystems: Filesystems) -> "Sides":
+    def detect(cls, filesystems: Filesystems, inventory: Optional[SystemInventory] = None) -> "Sides":
         """Detect the booted and nonbooted sides"""
-        return cls(activeside(), flipside(activeside(), filesystems))
+        booted = activeside(inventory)
+        return cls(booted, flipside(booted, filesystems))
@@ -1,13 +1,151 @@
 import datetime
-import glob
+import errno
 import os
 import shutil
-import subprocess
-from typing import Union
+from typing import Optional, Union
 
 from neuralupgrade import logger
 
 
+STAMP_FORMAT = "%Y%m%d-%H%M%S.%f"
+"""The format of the timestamp in temporary and backup filenames"""
+
+
+def fsync_directory(path: str):
+    """Flush a directory's entries to disk, so that files created or renamed in it survive a crash
+
+    Some filesystems don't support fsync on directories and fail with EINVAL;
+    on those, there is nothing more we can do.
+    """
+    fd = os.open(path, os.O_RDONLY | getattr(os, "O_DIRECTORY", 0))
+    try:
+        os.fsync(fd)
+    except OSError as exc:
+        if exc.errno != errno.EINVAL:
+            raise
+        logger.debug(f"Filesystem for {path} does not support fsync on directories")
+    finally:
+        os.close(fd)
+
+
+def fsync_file(path: str):
+    """Flush a file that was already written and closed to disk"""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def fsync_tree(root: str):
+    """Flush every file and directory under root to disk
+
+    Only the files under root are flushed,
+    unlike os.sync() or the sync command, which wait on every dirty page on every filesystem.
+    """
+    for dirpath, dirnames, filenames in os.walk(root):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            if not os.path.islink(path):
+                fsync_file(path)
+        fsync_directory(dirpath)
+
+
+def backup_file(filepath: str, backup: str):
+    """Make a backup of a file that stays the same when the file is replaced
+
+    Hard link the file if the filesystem allows it, which is instant and needs no extra space.
+    FAT filesystems like the ESP don't support hard links,
+    so copy the file there instead, and fsync the copy.
+    """
+    try:
+        os.link(filepath, backup)
+        logger.debug(f"Hard linked {filepath} to {backup}")
+        return
+    except OSError as exc:
+        logger.debug(f"Could not hard link {filepath} to {backup}, copying it instead: {exc}")
+    with open(filepath, "rb") as src, open(backup, "wb") as dst:
+        shutil.copyfileobj(src, dst)
+        dst.flush()
+        os.fsync(dst.fileno())
+    shutil.copystat(filepath, backup)
+
+
+def atomic_write(filepath: str, contents: Union[str, bytes], tmp_suffix: str = "", backup: Optional[str] = None):
+    """Replace a file's contents so that a crash leaves either the old or the new file, never a partial one
+
+    - Write the contents to a temporary file in the same directory and fsync it
+    - If backup is set and the file exists, back it up there (see backup_file())
+    - Rename the temporary file over the file
+    - fsync the directory so that the rename is on disk
+
+    Only the file and its directory are flushed,
+    unlike the sync command which flushes every dirty page on every filesystem.
+    """
+    directory = os.path.dirname(os.path.abspath(filepath))
+    filepath_tmp = f"{filepath}.new{tmp_suffix or f'.{os.getpid()}'}"
+    writemode = "wb" if isinstance(contents, bytes) else "w"
+
+    logger.debug(f"Writing new file contents to {filepath_tmp}")
+    try:
+        with open(filepath_tmp, writemode) as f:
+            f.write(contents)
+            f.flush()
+            os.fsync(f.fileno())
+
+        if backup is not None:
+            if os.path.exists(filepath):
+                logger.debug(f"Backing up old {filepath} to {backup}")
+                backup_file(filepath, backup)
+            else:
+                logger.debug(f"No old {filepath} to back up")
+
+        logger.debug(f"Moving new {filepath_tmp} to {filepath}")
+        os.replace(filepath_tmp, filepath)
+    except BaseException:
+        try:
+            os.remove(filepath_tmp)
+        except FileNotFoundError:
+            pass
+        raise
+    fsync_directory(directory)
+
+
+def _backup_time(backup: os.DirEntry, prefix: str) -> datetime.datetime:
+    """Return when a backup was made, from its filename, or its mtime if the name doesn't have a timestamp"""
+    try:
+        return datetime.datetime.strptime(backup.name[len(prefix) :], STAMP_FORMAT)
+    except ValueError:
+        return datetime.datetime.fromtimestamp(backup.stat().st_mtime)
+
+
+def prune_backups(filepath: str, max_old_files: int, max_old_days: int, now: Optional[datetime.datetime] = None):
+    """Remove backups of a file beyond the newest max_old_files, if they are older than max_old_days days
+
+    Backups are sorted by the timestamp in their name,
+    which is more precise than the mtime on FAT filesystems.
+    """
+    now = now or datetime.datetime.now()
+    directory = os.path.dirname(os.path.abspath(filepath))
+    prefix = f"{os.path.basename(filepath)}.old."
+    with os.scandir(directory) as entries:
+        backups = [(_backup_time(e, prefix), e.path) for e in entries if e.name.startswith(prefix)]
+    backups.sort(reverse=True)
+
+    removed = False
+    for backuptime, oldfile in backups[max_old_files:]:
+        if (now - backuptime).days > max_old_days:
+            logger.debug(
+                f"Removing {oldfile} because it's older than {max_old_days} days and there are more than {max_old_files} backups"
+            )
+            os.remove(oldfile)
+            removed = True
+        else:
+            logger.debug(f"Keeping {oldfile} because it's newer than {max_old_days} days")
+    if removed:
+        fsync_directory(directory)
+
+
 def write_file_carefully(
     filepath: str,
     contents: Union[str, bytes],
@@ -19,22 +157,18 @@ def write_file_carefully(
     """Write a new file carefully, and keep old versions
 
     - Write new contents to a temporary file
-    - Copy the old file to a backup location
+    - Back up the old file, with a hard link if possible or a copy if not
     - Move the new one into place
     - Keep backups, but remove more than max_old_files backups that are older than max_old_days days
 
     We create backup files with a timestamp in the filename,
-    but when we remove them we only look at the modification time.
-    On FAT32, the modification time is only accurate to 2 seconds.
-    Whatever.
+    and use that timestamp to decide which backups to remove.
+    See atomic_write() for how this survives a crash.
     """
-    stampfmt = "%Y%m%d-%H%M%S.%f"
-    nowstamp = updated.strftime(stampfmt)
-    filepath_tmp = f"{filepath}.new.{nowstamp}"
+    nowstamp = updated.strftime(STAMP_FORMAT)
     this_backup = f"{filepath}.old.{nowstamp}"
 
     readmode = "rb" if binary else "r"
-    writemode = "wb" if binary else "w"
 
     try:
         with open(filepath, readmode) as f:
@@ -45,35 +179,8 @@ def write_file_carefully(
     except FileNotFoundError:
         logger.debug(f"File {filepath} does not exist, will create it")
 
-    logger.debug(f"Writing new file contents to {filepath_tmp}")
-    with open(filepath_tmp, writemode) as f:
-        f.write(contents)
-
-    if os.path.exists(filepath):
-        logger.debug(f"Backing up old {filepath} to {this_backup}")
-        shutil.copy(filepath, this_backup)
-        subprocess.run(["sync"], check=True)
-    else:
-        logger.debug(f"No old {filepath} to back up")
-
-    logger.debug(f"Moving new {filepath_tmp} to {filepath}")
-    shutil.move(filepath_tmp, filepath)
-    subprocess.run(["sync"], check=True)
-
-    oldfiles = glob.glob(f"{filepath}.old.*")
-    for idx, oldfile in enumerate(oldfiles):
-        if idx < max_old_files:
-            logger.debug(f"Keeping {oldfile} because it's one of the {max_old_files} most recent")
-            continue
-        olddate = datetime.datetime.fromtimestamp(os.path.getmtime(oldfile))
-        if (datetime.datetime.now() - olddate).days > max_old_days:
-            logger.debug(
-                f"Removing {oldfile} because it's older than {max_old_days} days and there are more than {max_old_files} backups"
-            )
-            os.remove(oldfile)
-        else:
-            logger.debug(f"Keeping {oldfile} because it's newer than {max_old_days} days")
-    subprocess.run(["sync"], check=True)
+    atomic_write(filepath, contents, tmp_suffix=f".{nowstamp}", backup=this_backup)
+    prune_backups(filepath, max_old_files, max_old_days)
 
     if isinstance(contents, bytes):
         log_contents = f"{contents!r}"
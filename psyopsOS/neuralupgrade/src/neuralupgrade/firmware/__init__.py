@@ -37,7 +37,26 @@ class Firmware:
         verify: bool = True,
         verify_pubkey: Optional[str] = None,
     ):
-        """Update the bootloader configuration."""
+        """Update the bootloader and its configuration."""
+        self.prepare(efisys, tarball=tarball, verify=verify, verify_pubkey=verify_pubkey)
+        self.configure(filesystems, efisys, default_boot_label)
+
+    def prepare(
+        self,
+        efisys: str,
+        tarball: Optional[str] = None,
+        verify: bool = True,
+        verify_pubkey: Optional[str] = None,
+    ):
+        """Install the bootloader and extract the firmware tarball, without writing the boot configuration.
+
+        This doesn't depend on the OS sides,
+        so apply_updates() can run it while they are being updated.
+        """
+        raise NotImplementedError("Subclasses must implement this method.")
+
+    def configure(self, filesystems: Filesystems, efisys: str, default_boot_label: str):
+        """Write the boot configuration."""
         raise NotImplementedError("Subclasses must implement this method.")
 
     def read_default_boot_label(self, fw_mountpoint: str) -> str:
@@ -19,27 +19,28 @@ class RaspberryPi4UBootBootloader(Firmware):
 
     fwtype = "aarch64-rpi4uboot"
 
-    def update(
+    def prepare(
         self,
-        filesystems: Filesystems,
         efisys: str,
-        default_boot_label: str,
         tarball: Optional[str] = None,
         verify: bool = True,
         verify_pubkey: Optional[str] = None,
     ):
-        """Update the bootloader configuration.
-
-        Needs the u-boot-tools package to be installed.
-        """
-        updated = datetime.datetime.now()
-        write_rpi_cfgs_carefully(filesystems, efisys, default_boot_label, updated)
+        """Extract the boot tarball, which has the U-Boot and Raspberry Pi firmware."""
         self.apply_tarball(
             efisys=efisys,
             tarball=tarball,
             verify=verify,
             verify_pubkey=verify_pubkey,
         )
+
+    def configure(self, filesystems: Filesystems, efisys: str, default_boot_label: str):
+        """Write config.txt and boot.cmd, and compile boot.scr.
+
+        Needs the u-boot-tools package to be installed.
+        """
+        updated = datetime.datetime.now()
+        write_rpi_cfgs_carefully(filesystems, efisys, default_boot_label, updated)
         logger.debug("Done configuring U-Boot for Raspberry Pi")
 
     def read_default_boot_label(self, fw_mountpoint: str) -> str:
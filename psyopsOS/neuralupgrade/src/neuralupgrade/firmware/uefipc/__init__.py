@@ -22,16 +22,14 @@ class AMD64UEFIGrubBootloader(Firmware):
 
     fwtype = "x86_64-uefi"
 
-    def update(
+    def prepare(
         self,
-        filesystems: Filesystems,
         efisys: str,
-        default_boot_label: str,
         tarball: Optional[str] = None,
         verify: bool = True,
         verify_pubkey: Optional[str] = None,
     ):
-        """Update the bootloader configuration."""
+        """Install GRUB and extract the efisys tarball."""
         grub_install(efisys)
         self.apply_tarball(
             efisys=efisys,
@@ -39,9 +37,12 @@ class AMD64UEFIGrubBootloader(Firmware):
             verify=verify,
             verify_pubkey=verify_pubkey,
         )
+        subprocess.run(["sync"], check=True)
+
+    def configure(self, filesystems: Filesystems, efisys: str, default_boot_label: str):
+        """Write grub.cfg."""
         write_grub_cfg_carefully(filesystems, efisys, default_boot_label)
         logger.debug("Done configuring efisys")
-        subprocess.run(["sync"], check=True)
 
     def read_default_boot_label(self, fw_mountpoint: str) -> str:
         """Read the default boot label from the bootloader configuration."""
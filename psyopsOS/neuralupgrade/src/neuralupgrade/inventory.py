@@ -0,0 +1,196 @@
+"""A snapshot of the system's filesystems, mounts, and kernel command line
+
+Looking these up with blkid, findmnt, and mountpoint costs a fork and exec per call,
+and `neuralupgrade show` used to make a dozen of them.
+Instead, read the files those commands read, once, and answer lookups from memory:
+
+- /proc/self/mountinfo for what is mounted where
+- /etc/fstab for where each filesystem should be mounted
+- /dev/disk/by-label for the device of each label
+- /proc/cmdline for the booted side
+
+The mount table changes when we mount or unmount something,
+so Mount calls reload_mounts() after it does.
+/dev/disk/by-label is populated by udev or mdev, and may not exist on every system;
+Filesystem falls back to blkid when a label isn't found there.
+"""
+
+import os
+import re
+from typing import Optional
+
+from neuralupgrade import logger
+
+
+def _unescape_octal(value: str) -> str:
+    """Unescape the \\NNN octal escapes that the kernel uses for spaces etc in mountinfo and fstab"""
+    return re.sub(r"\\([0-7]{3})", lambda m: chr(int(m.group(1), 8)), value)
+
+
+def _unescape_udev(value: str) -> str:
+    """Unescape the \\xNN escapes that udev uses in /dev/disk/by-label"""
+    return re.sub(r"\\x([0-9a-fA-F]{2})", lambda m: chr(int(m.group(1), 16)), value)
+
+
+def read_mountinfo(path: str = "/proc/self/mountinfo") -> list[dict]:
+    """Return the mount table as a list of dicts, with the same keys as `findmnt --json`, plus maj:min
+
+    See proc(5) for the format, which is like:
+    36 35 98:0 /mnt1 /mnt2 rw,noatime master:1 - ext3 /dev/root rw,errors=continue
+    """
+    mounts = []
+    with open(path) as f:
+        for line in f:
+            fields = line.split()
+            separator = fields.index("-")
+            mounts.append(
+                {
+                    "target": _unescape_octal(fields[4]),
+                    "source": _unescape_octal(fields[separator + 2]),
+                    "fstype": fields[separator + 1],
+                    "options": f"{fields[5]},{fields[separator + 3]}",
+                    "maj:min": fields[2],
+                }
+            )
+    return mounts
+
+
+def read_fstab(path: str = "/etc/fstab") -> list[dict]:
+    """Return the contents of fstab as a list of dicts"""
+    filesystems = []
+    with open(path) as f:
+        for line in f.readlines():
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            fs = {}
+            (
+                fs["device"],
+                fs["mountpoint"],
+                fs["fstype"],
+                fs["options"],
+                fs["dump"],
+                fs["pass"],
+            ) = line.split()
+            fs["mountpoint"] = _unescape_octal(fs["mountpoint"])
+            filesystems.append(fs)
+    return filesystems
+
+
+def read_labels(path: str = "/dev/disk/by-label") -> dict[str, str]:
+    """Return a map of filesystem labels to device paths"""
+    labels = {}
+    for name in os.listdir(path):
+        labels[_unescape_udev(name)] = os.path.realpath(os.path.join(path, name))
+    return labels
+
+
+def read_cmdline(path: str = "/proc/cmdline") -> list[str]:
+    """Return the kernel command line arguments"""
+    with open(path) as f:
+        return f.read().split()
+
+
+def device_number(device: str) -> Optional[str]:
+    """Return the maj:min of a block device, like mountinfo shows, or None if it doesn't exist"""
+    try:
+        rdev = os.stat(device).st_rdev
+    except OSError:
+        return None
+    if not rdev:
+        return None
+    return f"{os.major(rdev)}:{os.minor(rdev)}"
+
+
+def mounts_for_device(device: str, mounts: list[dict]) -> list[dict]:
+    """Return the mounts of a device, like `findmnt DEVICE` does"""
+    number = device_number(device)
+    realdevice = os.path.realpath(device)
+    result = []
+    for mount in mounts:
+        if number and mount["maj:min"] == number:
+            result.append(mount)
+        elif mount["source"] in (device, realdevice):
+            result.append(mount)
+    return result
+
+
+def is_mountpoint(path: str, mounts: Optional[list[dict]] = None) -> bool:
+    """Return True if something is mounted at the path, like `mountpoint -q`"""
+    if mounts is None:
+        mounts = read_mountinfo()
+    realpath = os.path.realpath(path)
+    return any(mount["target"] == realpath for mount in mounts)
+
+
+class SystemInventory:
+    """The filesystems, mounts, and kernel command line of the running system, read once
+
+    Arguments:
+    mounts:     The mount table, from read_mountinfo()
+    fstab:      The fstab, from read_fstab()
+    labels:     A map of filesystem labels to devices, from read_labels()
+    cmdline:    The kernel command line arguments, from read_cmdline()
+    mountinfo_path: Where to reload the mount table from
+    """
+
+    def __init__(
+        self,
+        mounts: list[dict],
+        fstab: list[dict],
+        labels: dict[str, str],
+        cmdline: list[str],
+        mountinfo_path: str = "/proc/self/mountinfo",
+    ):
+        self.mounts = mounts
+        self.fstab = fstab
+        self.labels = labels
+        self.cmdline = cmdline
+        self.mountinfo_path = mountinfo_path
+
+    @classmethod
+    def snapshot(cls, proc: str = "/proc", etc: str = "/etc", dev: str = "/dev") -> "SystemInventory":
+        """Read the inventory from the running system
+
+        Missing files are treated as empty,
+        so that this works in containers and on systems without /dev/disk/by-label.
+        """
+
+        def read_or_empty(reader, path, empty):
+            try:
+                return reader(path)
+            except FileNotFoundError:
+                logger.debug(f"Inventory: {path} does not exist, treating it as empty")
+                return empty
+
+        mountinfo_path = os.path.join(proc, "self", "mountinfo")
+        return cls(
+            mounts=read_or_empty(read_mountinfo, mountinfo_path, []),
+            fstab=read_or_empty(read_fstab, os.path.join(etc, "fstab"), []),
+            labels=read_or_empty(read_labels, os.path.join(dev, "disk", "by-label"), {}),
+            cmdline=read_or_empty(read_cmdline, os.path.join(proc, "cmdline"), []),
+            mountinfo_path=mountinfo_path,
+        )
+
+    def reload_mounts(self):
+        """Read the mount table again, after mounting or unmounting something
+
+        This replaces the list rather than changing it,
+        so other threads see either the old or new table and never a partial one.
+        """
+        self.mounts = read_mountinfo(self.mountinfo_path)
+
+    def device_for_label(self, label: str) -> Optional[str]:
+        """Return the device for a filesystem label, or None if it isn't in /dev/disk/by-label"""
+        return self.labels.get(label)
+
+    def mounts_for_device(self, device: str) -> list[dict]:
+        """Return the mounts of a device"""
+        return mounts_for_device(device, self.mounts)
+
+    def kernel_argument(self, name: str) -> Optional[str]:
+        """Return the value of a name=value kernel command line argument, or None if it isn't set"""
+        for arg in self.cmdline:
+            if arg.startswith(f"{name}="):
+                return arg.split("=", 1)[1]
+        return None
@@ -0,0 +1,500 @@
+"""Verify minisign signatures in-process
+
+This lets us hash a file once as we read it for some other reason,
+like extracting it, rather than running the minisign binary over it separately.
+
+Minisign signs files with Ed25519.
+Modern minisign signatures (algorithm "ED", which is what we produce)
+sign the BLAKE2b-512 hash of the file rather than the file itself,
+which means that verification can be done in a streaming fashion.
+Legacy signatures (algorithm "Ed") sign the whole file,
+and so the verifier must hold the whole file in memory.
+
+Ed25519 is implemented here in pure Python (per RFC 8032) so that we don't need any dependencies.
+It is not constant-time, which doesn't matter for verification of public data.
+The signing functions are meant for tests and build tooling, not for use with high-value keys on shared machines.
+
+File formats are described at <https://jedisct1.github.io/minisign/>.
+"""
+
+import base64
+import hashlib
+import os
+import threading
+from dataclasses import dataclass
+from typing import BinaryIO, Optional
+
+
+DEFAULT_PUBKEY_PATH = "minisign.pub"
+"""The default public key path, relative to the working directory, like the minisign command uses"""
+
+READ_SIZE = 1024 * 1024
+"""How much to read at a time when hashing a file"""
+
+
+class MinisignError(Exception):
+    """A minisign key or signature is invalid, or doesn't match"""
+
+
+#### Ed25519
+
+
+_P = 2**255 - 19
+_L = 2**252 + 27742317777372353535851937790883648493
+_D = -121665 * pow(121666, _P - 2, _P) % _P
+_SQRT_M1 = pow(2, (_P - 1) // 4, _P)
+
+
+def _recover_x(y: int, sign: int) -> Optional[int]:
+    if y >= _P:
+        return None
+    x2 = (y * y - 1) * pow(_D * y * y + 1, _P - 2, _P)
+    if x2 == 0:
+        return None if sign else 0
+    x = pow(x2, (_P + 3) // 8, _P)
+    if (x * x - x2) % _P != 0:
+        x = x * _SQRT_M1 % _P
+    if (x * x - x2) % _P != 0:
+        return None
+    if (x & 1) != sign:
+        x = _P - x
+    return x
+
+
+_BY = 4 * pow(5, _P - 2, _P) % _P
+_BX = _recover_x(_BY, 0)
+assert _BX is not None
+_B = (_BX, _BY, 1, _BX * _BY % _P)
+_IDENTITY = (0, 1, 1, 0)
+
+
+def _point_add(p, q):
+    """Add two points in extended homogeneous coordinates"""
+    a = (p[1] - p[0]) * (q[1] - q[0]) % _P
+    b = (p[1] + p[0]) * (q[1] + q[0]) % _P
+    c = 2 * p[3] * q[3] * _D % _P
+    d = 2 * p[2] * q[2] % _P
+    e, f, g, h = b - a, d - c, d + c, b + a
+    return (e * f % _P, g * h % _P, f * g % _P, e * h % _P)
+
+
+def _point_mul(s: int, p):
+    q = _IDENTITY
+    while s > 0:
+        if s & 1:
+            q = _point_add(q, p)
+        p = _point_add(p, p)
+        s >>= 1
+    return q
+
+
+def _point_equal(p, q) -> bool:
+    if (p[0] * q[2] - q[0] * p[2]) % _P != 0:
+        return False
+    if (p[1] * q[2] - q[1] * p[2]) % _P != 0:
+        return False
+    return True
+
+
+def _point_compress(p) -> bytes:
+    zinv = pow(p[2], _P - 2, _P)
+    x = p[0] * zinv % _P
+    y = p[1] * zinv % _P
+    return int.to_bytes(y | ((x & 1) << 255), 32, "little")
+
+
+def _point_decompress(s: bytes):
+    if len(s) != 32:
+        raise MinisignError("Invalid Ed25519 point length")
+    y = int.from_bytes(s, "little")
+    sign = y >> 255
+    y &= (1 << 255) - 1
+    x = _recover_x(y, sign)
+    if x is None:
+        return None
+    return (x, y, 1, x * y % _P)
+
+
+def _sha512_modq(data: bytes) -> int:
+    return int.from_bytes(hashlib.sha512(data).digest(), "little") % _L
+
+
+def _secret_expand(seed: bytes) -> tuple[int, bytes]:
+    if len(seed) != 32:
+        raise MinisignError("Invalid Ed25519 seed length")
+    h = hashlib.sha512(seed).digest()
+    a = int.from_bytes(h[:32], "little")
+    a &= (1 << 254) - 8
+    a |= 1 << 254
+    return a, h[32:]
+
+
+def ed25519_public_key(seed: bytes) -> bytes:
+    """Compute the Ed25519 public key for a 32 byte secret seed"""
+    a, _ = _secret_expand(seed)
+    return _point_compress(_point_mul(a, _B))
+
+
+def ed25519_sign(seed: bytes, message: bytes) -> bytes:
+    """Sign a message with a 32 byte Ed25519 secret seed"""
+    a, prefix = _secret_expand(seed)
+    public = _point_compress(_point_mul(a, _B))
+    r = _sha512_modq(prefix + message)
+    rs = _point_compress(_point_mul(r, _B))
+    h = _sha512_modq(rs + public + message)
+    s = (r + h * a) % _L
+    return rs + int.to_bytes(s, 32, "little")
+
+
+def ed25519_verify(public: bytes, message: bytes, signature: bytes) -> bool:
+    """Verify an Ed25519 signature"""
+    if len(public) != 32 or len(signature) != 64:
+        return False
+    a = _point_decompress(public)
+    if a is None:
+        return False
+    rs = signature[:32]
+    r = _point_decompress(rs)
+    if r is None:
+        return False
+    s = int.from_bytes(signature[32:], "little")
+    if s >= _L:
+        return False
+    h = _sha512_modq(rs + public + message)
+    sb = _point_mul(s, _B)
+    ha = _point_mul(h, a)
+    return _point_equal(sb, _point_add(r, ha))
+
+
+#### Minisign keys and signatures
+
+
+ALG_LEGACY = b"Ed"
+"""Signatures over the whole file"""
+
+ALG_PREHASHED = b"ED"
+"""Signatures over the BLAKE2b-512 hash of the file"""
+
+KDF_SCRYPT = b"Sc"
+"""Secret keys encrypted with a password, using scrypt"""
+
+KDF_NONE = b"\0\0"
+"""Secret keys that are not encrypted"""
+
+CHECKSUM_BLAKE2B = b"B2"
+
+
+def _b64decode(value: str, what: str) -> bytes:
+    try:
+        return base64.b64decode(value.strip(), validate=True)
+    except ValueError as exc:
+        raise MinisignError(f"Invalid base64 in {what}") from exc
+
+
+def _keyid_str(keyid: bytes) -> str:
+    """Format a key ID the way minisign displays it"""
+    return keyid[::-1].hex().upper()
+
+
+@dataclass
+class PublicKey:
+    """A minisign public key"""
+
+    keyid: bytes
+    key: bytes
+
+    @classmethod
+    def from_string(cls, value: str) -> "PublicKey":
+        """Parse a public key from its base64 representation, like RWRFlb..."""
+        raw = _b64decode(value, "public key")
+        if len(raw) != 42 or raw[:2] != ALG_LEGACY:
+            raise MinisignError("Invalid minisign public key")
+        return cls(keyid=raw[2:10], key=raw[10:])
+
+    @classmethod
+    def from_file(cls, path: str) -> "PublicKey":
+        """Read a public key file, with its untrusted comment line"""
+        with open(path) as f:
+            lines = [line for line in f.read().splitlines() if line.strip()]
+        if not lines:
+            raise MinisignError(f"Empty public key file {path}")
+        return cls.from_string(lines[-1])
+
+    def to_string(self) -> str:
+        return base64.b64encode(ALG_LEGACY + self.keyid + self.key).decode()
+
+    def __str__(self) -> str:
+        return _keyid_str(self.keyid)
+
+
+@dataclass
+class Signature:
+    """A parsed minisign signature file"""
+
+    untrusted_comment: str
+    algorithm: bytes
+    keyid: bytes
+    signature: bytes
+    trusted_comment: str
+    global_signature: bytes
+
+    @classmethod
+    def from_string(cls, contents: str) -> "Signature":
+        lines = contents.splitlines()
+        if len(lines) < 4:
+            raise MinisignError("Minisign signature is too short")
+        untrusted_prefix = "untrusted comment: "
+        trusted_prefix = "trusted comment: "
+        if not lines[0].startswith(untrusted_prefix) or not lines[2].startswith(trusted_prefix):
+            raise MinisignError("Invalid minisign signature comments")
+        raw = _b64decode(lines[1], "signature")
+        if len(raw) != 74 or raw[:2] not in (ALG_LEGACY, ALG_PREHASHED):
+            raise MinisignError("Invalid minisign signature")
+        global_signature = _b64decode(lines[3], "global signature")
+        if len(global_signature) != 64:
+            raise MinisignError("Invalid minisign global signature")
+        return cls(
+            untrusted_comment=lines[0][len(untrusted_prefix) :],
+            algorithm=raw[:2],
+            keyid=raw[2:10],
+            signature=raw[10:],
+            trusted_comment=lines[2][len(trusted_prefix) :],
+            global_signature=global_signature,
+        )
+
+    @classmethod
+    def from_file(cls, path: str) -> "Signature":
+        with open(path) as f:
+            return cls.from_string(f.read())
+
+    def to_string(self) -> str:
+        sig = base64.b64encode(self.algorithm + self.keyid + self.signature).decode()
+        global_sig = base64.b64encode(self.global_signature).decode()
+        return "\n".join(
+            [
+                f"untrusted comment: {self.untrusted_comment}",
+                sig,
+                f"trusted comment: {self.trusted_comment}",
+                global_sig,
+                "",
+            ]
+        )
+
+
+class Verifier:
+    """Verify a signature over data that is fed to it incrementally
+
+    Call update() with each block of the signed file, in order,
+    and then verify() at the end.
+    """
+
+    def __init__(self, pubkey: PublicKey, signature: Signature):
+        if pubkey.keyid != signature.keyid:
+            raise MinisignError(
+                f"Signature key ID {_keyid_str(signature.keyid)} does not match public key ID {pubkey}"
+            )
+        self.pubkey = pubkey
+        self.signature = signature
+        self.size = 0
+        if signature.algorithm == ALG_PREHASHED:
+            self._hash = hashlib.blake2b(digest_size=64)
+            self._legacy_data = None
+        else:
+            self._hash = None
+            self._legacy_data = bytearray()
+
+    def update(self, data: bytes):
+        self.size += len(data)
+        if self._hash is not None:
+            self._hash.update(data)
+        else:
+            self._legacy_data += data
+
+    def verify(self) -> str:
+        """Check the signature and its trusted comment
+
+        Return the trusted comment if both are valid, or raise MinisignError.
+        """
+        message = self._hash.digest() if self._hash is not None else bytes(self._legacy_data)
+        if not ed25519_verify(self.pubkey.key, message, self.signature.signature):
+            raise MinisignError("Signature verification failed")
+        global_message = self.signature.signature + self.signature.trusted_comment.encode()
+        if not ed25519_verify(self.pubkey.key, global_message, self.signature.global_signature):
+            raise MinisignError("Trusted comment signature verification failed")
+        return self.signature.trusted_comment
+
+
+def verify_stream(stream: BinaryIO, pubkey: PublicKey, signature: Signature) -> str:
+    """Read a stream to the end and verify its signature, returning the trusted comment"""
+    verifier = Verifier(pubkey, signature)
+    while True:
+        block = stream.read(READ_SIZE)
+        if not block:
+            break
+        verifier.update(block)
+    return verifier.verify()
+
+
+def verify_file(path: str, pubkey: PublicKey, signature: Optional[Signature] = None) -> str:
+    """Verify a file against its signature, returning the trusted comment
+
+    If no signature is passed, read it from path + ".minisig".
+    """
+    if signature is None:
+        signature = Signature.from_file(f"{path}.minisig")
+    with open(path, "rb") as f:
+        return verify_stream(f, pubkey, signature)
+
+
+#### Verification cache
+
+
+_verified: dict[tuple, str] = {}
+_verified_lock = threading.Lock()
+
+
+def _cache_key(path: str, stat: os.stat_result, pubkey: PublicKey, signature_text: str) -> tuple:
+    return (
+        os.path.realpath(path),
+        stat.st_dev,
+        stat.st_ino,
+        stat.st_size,
+        stat.st_mtime_ns,
+        pubkey.key,
+        signature_text,
+    )
+
+
+def record_verified(path: str, stat: os.stat_result, pubkey: PublicKey, signature_text: str, trusted_comment: str):
+    """Remember that a file verified, for code that verifies a file some other way, like while copying it
+
+    The stat must be taken before the file was read,
+    and the result isn't recorded if the file has changed since then.
+    """
+    current = os.stat(path)
+    if (current.st_size, current.st_mtime_ns, current.st_ino) != (stat.st_size, stat.st_mtime_ns, stat.st_ino):
+        return
+    with _verified_lock:
+        _verified[_cache_key(path, stat, pubkey, signature_text)] = trusted_comment
+
+
+def verify_file_cached(path: str, pubkey: PublicKey, signature_text: Optional[str] = None) -> str:
+    """Verify a file against its signature, returning the trusted comment
+
+    Results are cached for the life of the process by path, size, mtime, public key, and signature,
+    so verifying the same unchanged file more than once only reads it the first time.
+    If no signature is passed, read it from path + ".minisig".
+    """
+    if signature_text is None:
+        with open(f"{path}.minisig") as f:
+            signature_text = f.read()
+    signature = Signature.from_string(signature_text)
+    stat = os.stat(path)
+    with _verified_lock:
+        cached = _verified.get(_cache_key(path, stat, pubkey, signature_text))
+    if cached is not None:
+        return cached
+    with open(path, "rb") as f:
+        stat = os.fstat(f.fileno())
+        trusted_comment = verify_stream(f, pubkey, signature)
+    record_verified(path, stat, pubkey, signature_text, trusted_comment)
+    return trusted_comment
+
+
+def clear_verification_cache():
+    with _verified_lock:
+        _verified.clear()
+
+
+#### Signing
+
+
+def _scrypt_params(opslimit: int, memlimit: int) -> tuple[int, int, int]:
+    """Return scrypt N, r, and p for minisign's opslimit and memlimit, the way libsodium picks them"""
+    opslimit = max(opslimit, 32768)
+    r = 8
+    if opslimit < memlimit // 32:
+        p = 1
+        max_n = opslimit // (r * 4)
+    else:
+        p = 0
+        max_n = memlimit // (r * 128)
+    n_log2 = 1
+    while n_log2 < 63 and (1 << n_log2) <= max_n // 2:
+        n_log2 += 1
+    if not p:
+        p = min(0x3FFFFFFF, (opslimit // 4) // (1 << n_log2)) // r
+    return 1 << n_log2, r, p
+
+
+@dataclass
+class SecretKey:
+    """An unencrypted minisign secret key"""
+
+    keyid: bytes
+    seed: bytes
+
+    @classmethod
+    def generate(cls) -> "SecretKey":
+        return cls(keyid=os.urandom(8), seed=os.urandom(32))
+
+    @property
+    def public_key(self) -> PublicKey:
+        return PublicKey(keyid=self.keyid, key=ed25519_public_key(self.seed))
+
+    @classmethod
+    def from_string(cls, contents: str, password: str = "") -> "SecretKey":
+        """Parse a secret key file made by minisign -G, decrypting it with the password if it is encrypted
+
+        The key is XORed with scrypt(password), and has a BLAKE2b checksum that tells us if the password was right.
+        """
+        lines = [line for line in contents.splitlines() if line.strip()]
+        if len(lines) < 2:
+            raise MinisignError("Minisign secret key is too short")
+        raw = _b64decode(lines[1], "secret key")
+        if len(raw) != 158 or raw[:2] != ALG_LEGACY or raw[4:6] != CHECKSUM_BLAKE2B:
+            raise MinisignError("Invalid or unsupported minisign secret key")
+        kdf, salt, keynum = raw[2:4], raw[6:38], raw[54:]
+        if kdf == KDF_SCRYPT:
+            opslimit = int.from_bytes(raw[38:46], "little")
+            memlimit = int.from_bytes(raw[46:54], "little")
+            n, r, p = _scrypt_params(opslimit, memlimit)
+            stream = hashlib.scrypt(
+                password.encode(), salt=salt, n=n, r=r, p=p, maxmem=128 * r * (n + p + 2) + 2**20, dklen=len(keynum)
+            )
+            keynum = bytes(a ^ b for a, b in zip(keynum, stream))
+        elif kdf != KDF_NONE:
+            raise MinisignError("Unsupported minisign secret key encryption")
+        keyid, seed, public, checksum = keynum[:8], keynum[8:40], keynum[40:72], keynum[72:]
+        if hashlib.blake2b(ALG_LEGACY + keyid + seed + public, digest_size=32).digest() != checksum:
+            raise MinisignError("Wrong password for minisign secret key")
+        return cls(keyid=keyid, seed=seed)
+
+    @classmethod
+    def from_file(cls, path: str, password: str = "") -> "SecretKey":
+        with open(path) as f:
+            return cls.from_string(f.read(), password)
+
+    def sign_hash(self, digest: bytes, trusted_comment: str, untrusted_comment: str = "") -> Signature:
+        """Sign a BLAKE2b-512 digest of a file, making a prehashed signature"""
+        signature = ed25519_sign(self.seed, digest)
+        global_signature = ed25519_sign(self.seed, signature + trusted_comment.encode())
+        return Signature(
+            untrusted_comment=untrusted_comment or "signature from minisign secret key",
+            algorithm=ALG_PREHASHED,
+            keyid=self.keyid,
+            signature=signature,
+            trusted_comment=trusted_comment,
+            global_signature=global_signature,
+        )
+
+    def sign_file(self, path: str, trusted_comment: str, untrusted_comment: str = "") -> Signature:
+        """Sign a file, writing path + ".minisig", and return the signature"""
+        digest = hashlib.blake2b(digest_size=64)
+        with open(path, "rb") as f:
+            while block := f.read(READ_SIZE):
+                digest.update(block)
+        signature = self.sign_hash(digest.digest(), trusted_comment, untrusted_comment)
+        with open(f"{path}.minisig", "w") as f:
+            f.write(signature.to_string())
+        return signature
@@ -5,13 +5,21 @@ import subprocess
 import traceback
 from concurrent.futures import ThreadPoolExecutor, Future, as_completed
 from dataclasses import dataclass
-from typing import Any, Optional
+from typing import Any, BinaryIO, Optional
+
+import requests
 
 from neuralupgrade import logger
-from neuralupgrade.downloader import download_update_signature
+from neuralupgrade.coginitivedefects import MultiError
+from neuralupgrade.delta import MANIFEST_SUFFIX
+from neuralupgrade.downloader import DownloadedSignatureResult, StreamedUpdate, download_update_signature
 from neuralupgrade.filesystems import Filesystem, Filesystems, Sides
+from neuralupgrade.filewriter import fsync_directory, fsync_file, fsync_tree
 from neuralupgrade.firmware import Firmware
+from neuralupgrade.minisign import DEFAULT_PUBKEY_PATH, PublicKey, Signature
 from neuralupgrade.systemmetadata import NeuralPartition, NeuralPartitionOS, SystemMetadata
+from neuralupgrade.tarstream import extract_verified
+from neuralupgrade.timings import timings
 from neuralupgrade.update_metadata import minisign_verify, parse_trusted_comment
 
 
@@ -42,12 +50,17 @@ def get_system_metadata(filesystems: Filesystems, sides: Sides, firmware: Firmwa
 
     Uses threads to speed up the process of mounting the filesystems and reading the minisig files.
     """
+
+    def timed(name: str, func, *args):
+        with timings.phase(f"metadata {name}"):
+            return func(*args)
+
     result: dict[str, Any] = {}
     with ThreadPoolExecutor() as executor:
         future_map: dict[Future[Any], str] = {
-            executor.submit(get_psyops_partition_metadata, filesystems.a): "a",
-            executor.submit(get_psyops_partition_metadata, filesystems.b): "b",
-            executor.submit(firmware.get_partition_metadata, filesystems): "firmware",
+            executor.submit(timed, "a", get_psyops_partition_metadata, filesystems.a): "a",
+            executor.submit(timed, "b", get_psyops_partition_metadata, filesystems.b): "b",
+            executor.submit(timed, "firmware", firmware.get_partition_metadata, filesystems): "firmware",
         }
 
         # Collect the results from the futures
@@ -65,7 +78,14 @@ def get_system_metadata(filesystems: Filesystems, sides: Sides, firmware: Firmwa
     )
 
 
-def apply_ostar(tarball: str, osmount: str, sidefile: str, verify: bool = True, verify_pubkey: Optional[str] = None):
+def apply_ostar(
+    tarball: str,
+    osmount: str,
+    sidefile: str,
+    verify: bool = True,
+    verify_pubkey: Optional[str] = None,
+    single_pass: bool = False,
+):
     """Apply an ostar to a device
 
     Arguments:
@@ -77,25 +97,107 @@ def apply_ostar(tarball: str, osmount: str, sidefile: str, verify: bool = True,
       See `raspberry-pi.md` for more details.
     - verify: Whether to verify the tarball signature
     - verify_pubkey: The public key to use for verification
+    - single_pass: Read the tarball only once, verifying it while extracting it to a staging directory,
+      rather than verifying it with minisign and then extracting it with tar.
+      See tarstream.py.
     """
 
+    minisig = tarball + ".minisig"
+    if single_pass:
+        minisig_text = None
+        try:
+            with open(minisig) as f:
+                minisig_text = f.read()
+        except FileNotFoundError:
+            if verify:
+                raise
+        with open(tarball, "rb") as f:
+            apply_ostar_stream(f, minisig_text, osmount, sidefile, verify=verify, verify_pubkey=verify_pubkey)
+        install_chunk_manifest(tarball, osmount)
+        logger.debug(f"Finished applying {tarball} to {osmount}")
+        return
+
     if verify:
         minisign_verify(tarball, pubkey=verify_pubkey)
-
     cmd = ["tar", "-x", "-f", tarball, "-C", osmount]
     logger.debug(f"Extracting {tarball} to {osmount} with {cmd}")
     subprocess.run(cmd, check=True)
-    minisig = tarball + ".minisig"
     try:
         shutil.copy(minisig, os.path.join(osmount, "psyopsOS.tar.minisig"))
         logger.debug(f"Copied {minisig} to {osmount}/psyopsOS.tar.minisig")
     except FileNotFoundError:
         logger.warning(f"Could not find {minisig}, partition will not know its version")
-    with open(os.path.join(osmount, sidefile), "w") as f:
+    install_chunk_manifest(tarball, osmount)
+    write_sidefile(osmount, sidefile)
+    # tar doesn't fsync what it extracts, so flush the partition's files, but not every filesystem like sync would
+    fsync_tree(osmount)
+    logger.debug(f"Finished applying {tarball} to {osmount}")
+
+
+def apply_ostar_stream(
+    stream: BinaryIO,
+    minisig_text: Optional[str],
+    osmount: str,
+    sidefile: str,
+    verify: bool = True,
+    verify_pubkey: Optional[str] = None,
+):
+    """Apply an ostar to a device from a stream, verifying it and extracting it in a single pass
+
+    The stream might be an open file or an HTTP response body;
+    it is read exactly once, from start to finish.
+
+    Arguments:
+    - stream: A readable binary stream of the tarball
+    - minisig_text: The contents of the tarball's minisig file.
+      May be None if verify is False, but then the partition will not know its version.
+    - osmount, sidefile, verify, verify_pubkey: See apply_ostar()
+    """
+    pubkey = None
+    signature = None
+    if verify:
+        if minisig_text is None:
+            raise ValueError("Cannot verify an ostar without its minisig")
+        pubkey = PublicKey.from_file(verify_pubkey or DEFAULT_PUBKEY_PATH)
+        signature = Signature.from_string(minisig_text)
+    logger.debug(f"Verifying and extracting ostar to {osmount} in a single pass")
+    # The extracted files are already on disk; see _commit_staging()
+    extract_verified(stream, osmount, pubkey=pubkey, signature=signature)
+    if minisig_text is not None:
+        minisig = os.path.join(osmount, "psyopsOS.tar.minisig")
+        with open(minisig, "w") as f:
+            f.write(minisig_text)
+        fsync_file(minisig)
+    else:
+        logger.warning("No minisig for the ostar, partition will not know its version")
+    install_chunk_manifest("", osmount)
+    write_sidefile(osmount, sidefile)
+    fsync_directory(osmount)
+
+
+def install_chunk_manifest(tarball: str, osmount: str):
+    """Copy the tarball's chunk manifest to the partition, if it has one
+
+    A later delta update can use it to find reusable chunks without reading every file; see delta.py.
+    If the tarball doesn't have a manifest, remove any manifest left over from a previous version.
+    """
+    installed = os.path.join(osmount, "psyopsOS.tar" + MANIFEST_SUFFIX)
+    manifest = tarball + MANIFEST_SUFFIX if tarball else ""
+    if manifest and os.path.exists(manifest):
+        shutil.copy(manifest, installed)
+        fsync_file(installed)
+        logger.debug(f"Copied {manifest} to {installed}")
+    elif os.path.exists(installed):
+        os.remove(installed)
+
+
+def write_sidefile(osmount: str, sidefile: str):
+    """Write the file named after the side; see apply_ostar()"""
+    path = os.path.join(osmount, sidefile)
+    with open(path, "w") as f:
         # So a file called /mnt/partition/psyopsOS-A will have the contents "psyopsOS-A"
         f.write(sidefile)
-    subprocess.run(["sync"], check=True)
-    logger.debug(f"Finished applying {tarball} to {osmount}")
+    fsync_file(path)
 
 
 def apply_updates(
@@ -109,6 +211,9 @@ def apply_updates(
     pubkey: str = "",
     no_update_default_boot_label: bool = False,
     default_boot_label: str = "",
+    single_pass: bool = False,
+    ostar_stream: Optional[StreamedUpdate] = None,
+    parallel: bool = False,
 ):
     """Apply updates to the filesystems.
 
@@ -127,8 +232,35 @@ def apply_updates(
     - pubkey: The public key to use for verification
     - no_update_default_boot_label: Whether to skip updating the default boot label
     - default_boot_label: The default boot label to use for the efisys partition
+    - single_pass: Verify and extract the ostar in a single pass; see apply_ostar()
+    - ostar_stream: A streamed ostar download to apply instead of a local ostar path.
+      It is verified and extracted as it is downloaded, so it can only be applied to one side.
+    - parallel: Update the OS sides and prepare the efisys partition at the same time.
+      The efisys files are written with Firmware.prepare() alongside the OS updates,
+      and the boot configuration is only written with Firmware.configure() once all of them succeed.
     """
 
+    if ostar_stream is not None:
+        if ostar:
+            raise ValueError("Cannot pass both ostar and ostar_stream")
+        os_targets = [t for t in targets if t in ["a", "b", "nonbooted"]]
+        if len(os_targets) > 1:
+            raise ValueError(f"A streamed ostar can only be applied to one side, but got targets {os_targets}")
+        ostar = ostar_stream.url
+
+    def apply_os(fs: Filesystem):
+        if ostar_stream is not None:
+            apply_ostar_stream(
+                ostar_stream.stream,
+                ostar_stream.signature.text,
+                fs.mountpoint,
+                fs.label,
+                verify=verify,
+                verify_pubkey=pubkey,
+            )
+        else:
+            apply_ostar(ostar, fs.mountpoint, fs.label, verify=verify, verify_pubkey=pubkey, single_pass=single_pass)
+
     # The default boot label is the partition label to use the next time the system boots (A or B).
     # When updating nonbooted, it is assumed to be the nonbooted side and cannot be passed explicitly,
     # although updating it can be skipped if no_update_default_boot_label is passed.
@@ -172,17 +304,57 @@ def apply_updates(
                     )
 
             # Handle actions
+            efisys_prepared = False
+            if parallel:
+                # Update the OS sides and prepare efisys at the same time.
+                # Mount everything from this thread first, so that only this thread uses the ExitStack.
+                os_fses: list[Filesystem] = []
+                if "nonbooted" in targets:
+                    targets.remove("nonbooted")
+                    os_fses.append(filesystems.bylabel(sides.nonbooted))
+                    if not no_update_default_boot_label:
+                        default_boot_label = sides.nonbooted
+                for side in ["a", "b"]:
+                    if side in targets:
+                        targets.remove(side)
+                        if filesystems[side].label not in [fs.label for fs in os_fses]:
+                            os_fses.append(filesystems[side])
+                for fs in os_fses:
+                    idempotently_mount(fs, writable=True)
+                if "efisys" in targets:
+                    idempotently_mount(filesystems.efisys, writable=True)
+                if verify and ostar and ostar_stream is None and not single_pass and len(os_fses) > 1:
+                    # Verify once here, so that each side finds the result in the verification cache
+                    minisign_verify(ostar, pubkey=pubkey)
+
+                errors: list[Exception] = []
+                with ThreadPoolExecutor() as executor:
+                    future_map: dict[Future[Any], str] = {
+                        executor.submit(apply_os, fs): f"{fs.label} side with {ostar} at {fs.mountpoint}"
+                        for fs in os_fses
+                    }
+                    if "efisys" in targets:
+                        prepare_future = executor.submit(
+                            firmware.prepare, filesystems.efisys.mountpoint, fwtar, verify, pubkey
+                        )
+                        future_map[prepare_future] = f"efisys with {fwtar} at {filesystems.efisys.mountpoint}"
+                    for future in as_completed(future_map):
+                        try:
+                            future.result()
+                            logger.info(f"Updated {future_map[future]}")
+                        except Exception as exc:
+                            logger.error(f"Failed to update {future_map[future]}: {exc}")
+                            errors.append(exc)
+                if errors:
+                    # Don't write a boot configuration that might point to a broken side
+                    raise MultiError("Failed to apply updates in parallel", errors)
+                efisys_prepared = "efisys" in targets
+
             if "nonbooted" in targets:
                 targets.remove("nonbooted")
                 nonbooted_fs = idempotently_mount(filesystems.bylabel(sides.nonbooted), writable=True)
-                apply_ostar(
-                    ostar,
-                    nonbooted_fs.mountpoint,
-                    nonbooted_fs.label,
-                    verify=verify,
-                    verify_pubkey=pubkey,
-                )
-                subprocess.run(["sync"], check=True)
+                # apply_os() flushes what it writes, so there's no need to sync every filesystem
+                apply_os(nonbooted_fs)
                 logger.info(f"Updated nonbooted side {sides.nonbooted} with {ostar} at {nonbooted_fs}")
                 if not no_update_default_boot_label:
                     default_boot_label = sides.nonbooted
@@ -196,22 +368,24 @@ def apply_updates(
                 if side in targets:
                     targets.remove(side)
                     this_fs = idempotently_mount(filesystems[side], writable=True)
-                    apply_ostar(ostar, this_fs.mountpoint, this_fs.label, verify=verify, verify_pubkey=pubkey)
-                    subprocess.run(["sync"], check=True)
+                    apply_os(this_fs)
                     logger.info(f"Updated {side} side with {ostar} at {this_fs.mountpoint}")
 
             if "efisys" in targets:
                 targets.remove("efisys")
                 efisys_fs = idempotently_mount(filesystems.efisys, writable=True)
                 # This handles any updates to the default_boot_label in the boot configuration file
-                firmware.update(
-                    filesystems,
-                    efisys_fs.mountpoint,
-                    default_boot_label,
-                    tarball=fwtar,
-                    verify=verify,
-                    verify_pubkey=pubkey,
-                )
+                if efisys_prepared:
+                    firmware.configure(filesystems, efisys_fs.mountpoint, default_boot_label)
+                else:
+                    firmware.update(
+                        filesystems,
+                        efisys_fs.mountpoint,
+                        default_boot_label,
+                        tarball=fwtar,
+                        verify=verify,
+                        verify_pubkey=pubkey,
+                    )
                 subprocess.run(["sync"], check=True)
                 logger.info(f"Updated efisys with {fwtar} at {efisys_fs}")
             elif default_boot_label:
@@ -242,27 +416,52 @@ def check_updates(
     repository: str,
     psyopsOS_filename_format: str,
     psyopsESP_filename_format: str,
-) -> dict[str, dict[str, str]]:
+    session: Optional[requests.Session] = None,
+) -> dict[str, dict[str, Any]]:
     """Check if the system is up to date.
 
+    The remote signatures are downloaded concurrently with each other
+    and with mounting and reading the local partitions,
+    over a shared keep-alive session.
+
     Return a dictionary where the keys are the targets and the values are dictionaries with the following keys:
     - label: The label of the filesystem
     - mountpoint: The mountpoint of the filesystem
     - current_version: The current version of the filesystem
     - compared_to: The version to compare to
     - up_to_date: Whether the filesystem is up to date
+    - signature: The DownloadedSignatureResult for the "latest" version, or None if a specific version was passed;
+      pass it to download_update() to avoid downloading it again
     """
 
-    system_md = get_system_metadata(filesystems, sides, firmware)
+    session = session or requests.Session()
+    checking_os = "a" in targets or "b" in targets or "nonbooted" in targets or "booted" in targets
+    os_latest_sig: Optional[DownloadedSignatureResult] = None
+    esp_latest_sig: Optional[DownloadedSignatureResult] = None
+    with ThreadPoolExecutor() as executor:
+        os_future = esp_future = None
+        if update_version == "latest":
+            if checking_os:
+                os_future = executor.submit(
+                    download_update_signature, firmware, repository, psyopsOS_filename_format, "latest", session
+                )
+            if "efisys" in targets:
+                esp_future = executor.submit(
+                    download_update_signature, firmware, repository, psyopsESP_filename_format, "latest", session
+                )
+        system_md = get_system_metadata(filesystems, sides, firmware)
+        with timings.phase("wait for signatures"):
+            if os_future is not None:
+                os_latest_sig = os_future.result()
+            if esp_future is not None:
+                esp_latest_sig = esp_future.result()
+
     update_version_firmware = update_version
     update_version_os = update_version
-    if update_version == "latest":
-        if "a" in targets or "b" in targets or "nonbooted" in targets or "booted" in targets:
-            os_latest_sig = download_update_signature(firmware, repository, psyopsOS_filename_format, "latest")
-            update_version_os = os_latest_sig.unverified_metadata["version"]
-        if "efisys" in targets:
-            esp_latest_sig = download_update_signature(firmware, repository, psyopsESP_filename_format, "latest")
-            update_version_firmware = esp_latest_sig.unverified_metadata["version"]
+    if os_latest_sig is not None:
+        update_version_os = os_latest_sig.unverified_metadata["version"]
+    if esp_latest_sig is not None:
+        update_version_firmware = esp_latest_sig.unverified_metadata["version"]
 
     result = {}
     current_version_os = system_md.booted.metadata.get("version", "UNKNOWN")
@@ -284,6 +483,7 @@ def check_updates(
                 "current_version": current_version_os,
                 "compared_to": update_version_os,
                 "up_to_date": update_version_os == current_version_os,
+                "signature": os_latest_sig,
             }
         elif updatetype == "efisys":
             md = system_md.firmware
@@ -293,6 +493,7 @@ def check_updates(
                 "current_version": current_version_firmware,
                 "compared_to": update_version_firmware,
                 "up_to_date": update_version_firmware == current_version_firmware,
+                "signature": esp_latest_sig,
             }
         else:
             raise ValueError(f"Unknown updatetype {updatetype}")
@@ -0,0 +1,130 @@
+"""Serve cached updates to other nodes on the LAN
+
+`neuralupgrade serve` runs a small HTTP server for the update cache (see updatecache.py),
+so other nodes can list it first in `--repository` and fall back to the upstream repository.
+It serves only versioned update files and their signatures that are already in the cache,
+with Range support so that clients can download in parallel and resume.
+
+Peers are not trusted: clients verify everything against the minisig like they would from upstream.
+Because of that, the server only serves files by the versioned name in their trusted comment,
+and never "latest", which clients must always get from upstream.
+"""
+
+import os
+import re
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+
+from neuralupgrade import logger
+from neuralupgrade.updatecache import SAFE_FILENAME, UpdateCache
+
+
+DEFAULT_PORT = 8420
+
+SEND_SIZE = 1024 * 1024
+
+
+class PeerRequestHandler(BaseHTTPRequestHandler):
+    """Serve files from an UpdateCache"""
+
+    cache: UpdateCache
+    server_version = "neuralupgrade"
+
+    def log_message(self, format, *args):
+        logger.debug(f"{self.address_string()} {format % args}")
+
+    def _resolve(self) -> Optional[tuple[str, str]]:
+        """Return the path and ETag of the requested file, or None if it isn't in the cache"""
+        name = self.path.split("?", 1)[0].rsplit("/", 1)[-1]
+        filename = name[: -len(".minisig")] if name.endswith(".minisig") else name
+        if not SAFE_FILENAME.match(filename):
+            return None
+        cached = self.cache.get(filename)
+        if cached is None:
+            return None
+        path = os.path.join(self.cache.names, name)
+        if name.endswith(".minisig"):
+            return path, ""
+        # Objects are named after their hash, so the name is a perfect ETag
+        return cached.path, f'"{os.path.basename(cached.path)}"'
+
+    def _handle(self, send_body: bool):
+        resolved = self._resolve()
+        if resolved is None:
+            self.send_error(404, "Not in cache")
+            return
+        path, etag = resolved
+        try:
+            f = open(path, "rb")
+        except FileNotFoundError:
+            self.send_error(404, "Not in cache")
+            return
+        with f:
+            size = os.fstat(f.fileno()).st_size
+            start, end = 0, size - 1
+            partial = False
+            range_header = self.headers.get("Range")
+            if_range = self.headers.get("If-Range")
+            if range_header and etag and (not if_range or if_range == etag):
+                match = re.fullmatch(r"bytes=(\d+)-(\d*)", range_header.strip())
+                if match:
+                    start = int(match.group(1))
+                    if match.group(2):
+                        end = min(int(match.group(2)), size - 1)
+                    if start >= size or start > end:
+                        self.send_response(416)
+                        self.send_header("Content-Range", f"bytes */{size}")
+                        self.end_headers()
+                        return
+                    partial = True
+
+            self.send_response(206 if partial else 200)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Length", str(end - start + 1))
+            if etag:
+                self.send_header("ETag", etag)
+                self.send_header("Accept-Ranges", "bytes")
+            if partial:
+                self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+            self.end_headers()
+            if not send_body:
+                return
+            f.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                block = f.read(min(SEND_SIZE, remaining))
+                if not block:
+                    break
+                self.wfile.write(block)
+                remaining -= len(block)
+
+    def do_GET(self):
+        self._handle(send_body=True)
+
+    def do_HEAD(self):
+        self._handle(send_body=False)
+
+
+def make_server(cache: UpdateCache, address: str = "", port: int = DEFAULT_PORT) -> ThreadingHTTPServer:
+    """Make an HTTP server for an update cache; call serve_forever() on the result to run it"""
+
+    class Handler(PeerRequestHandler):
+        pass
+
+    Handler.cache = cache
+    server = ThreadingHTTPServer((address, port), Handler)
+    server.daemon_threads = True
+    return server
+
+
+def serve(cache: UpdateCache, address: str = "", port: int = DEFAULT_PORT):
+    """Serve an update cache until interrupted"""
+    server = make_server(cache, address, port)
+    host, port = server.server_address[:2]
+    logger.info(f"Serving update cache {cache.root} on {host}:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -0,0 +1,312 @@
+"""Resumable, parallel downloads using HTTP Range requests
+
+psyopsOS updates are hundreds of megabytes,
+and some nodes are on slow or unreliable links.
+Rather than starting over when a connection drops,
+we download into a preallocated FILENAME.part file,
+and keep track of which byte ranges we have in FILENAME.part.json.
+If the download is interrupted, the next attempt picks up where it left off.
+
+When the server supports ranges, the file is split into segments
+which are fetched over several connections at once,
+each writing directly to its own offset in the .part file.
+When every segment is complete, the .part file is renamed into place.
+
+Integrity is not checked here; callers should verify the result with minisign.
+"""
+
+import json
+import math
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import asdict, dataclass
+from typing import Optional
+
+import requests
+
+from neuralupgrade import logger
+from neuralupgrade.coginitivedefects import MultiError
+
+
+DEFAULT_CONNECTIONS = 4
+"""The default number of parallel connections to use for a download"""
+
+CHUNK_SIZE = 1024 * 1024
+"""The size of each read from the HTTP response"""
+
+MIN_SEGMENT_SIZE = 8 * 1024 * 1024
+"""Don't split a file into segments smaller than this"""
+
+STATE_SAVE_INTERVAL = 16 * 1024 * 1024
+"""Save the state file after a segment downloads at least this many bytes since the last save"""
+
+REPOSITORY_TIMEOUT = (10, 60)
+"""Connect and read timeouts for repository requests, so that an unreachable peer doesn't hang the update
+
+The read timeout is the longest to wait between bytes, not for the whole response.
+"""
+
+
+class RemoteChangedError(Exception):
+    """The remote file changed while we were downloading it"""
+
+
+@dataclass
+class Segment:
+    """A byte range of the file to download
+
+    start is inclusive, end is exclusive.
+    done is the number of bytes from start that have been written to the .part file.
+    """
+
+    start: int
+    end: int
+    done: int = 0
+
+    @property
+    def remaining(self) -> int:
+        return self.end - self.start - self.done
+
+
+@dataclass
+class RemoteFileInfo:
+    """What we know about the remote file from a HEAD request"""
+
+    url: str
+    size: Optional[int]
+    accept_ranges: bool
+    validator: str
+    """The ETag or Last-Modified header, used with If-Range to detect changes"""
+
+
+def probe_remote_file(url: str, session: requests.Session) -> RemoteFileInfo:
+    """Find the size of a remote file and whether the server will let us download ranges of it"""
+    response = session.head(url, allow_redirects=True, timeout=REPOSITORY_TIMEOUT)
+    if response.status_code in (405, 501):
+        logger.debug(f"Server does not support HEAD for {url}, will not use ranges")
+        return RemoteFileInfo(url, None, False, "")
+    response.raise_for_status()
+    length = response.headers.get("Content-Length")
+    return RemoteFileInfo(
+        url=url,
+        size=int(length) if length is not None else None,
+        accept_ranges=response.headers.get("Accept-Ranges", "").lower() == "bytes",
+        validator=response.headers.get("ETag") or response.headers.get("Last-Modified") or "",
+    )
+
+
+def plan_segments(size: int, connections: int) -> list[Segment]:
+    """Split a file of the given size into at most `connections` segments"""
+    count = max(1, min(connections, math.ceil(size / MIN_SEGMENT_SIZE)))
+    segment_size = math.ceil(size / count) if size else 0
+    segments = []
+    for idx in range(count):
+        start = idx * segment_size
+        end = min(size, start + segment_size)
+        if start < end or not segments:
+            segments.append(Segment(start, end))
+    return segments
+
+
+class PartialDownload:
+    """A download in progress, with its state saved next to the .part file"""
+
+    def __init__(self, output: str, remote: RemoteFileInfo, segments: list[Segment]):
+        self.output = output
+        self.remote = remote
+        self.segments = segments
+        self.lock = threading.Lock()
+
+    @property
+    def partpath(self) -> str:
+        return f"{self.output}.part"
+
+    @property
+    def statepath(self) -> str:
+        return f"{self.output}.part.json"
+
+    @property
+    def complete(self) -> bool:
+        return all(seg.remaining == 0 for seg in self.segments)
+
+    def save(self):
+        """Save the state file atomically"""
+        with self.lock:
+            state = {
+                "url": self.remote.url,
+                "size": self.remote.size,
+                "validator": self.remote.validator,
+                "segments": [asdict(seg) for seg in self.segments],
+            }
+            tmp = f"{self.statepath}.tmp"
+            with open(tmp, "w") as f:
+                json.dump(state, f)
+            os.replace(tmp, self.statepath)
+
+    def remove_state(self):
+        try:
+            os.remove(self.statepath)
+        except FileNotFoundError:
+            pass
+
+    @classmethod
+    def resume_or_start(cls, output: str, remote: RemoteFileInfo, connections: int) -> "PartialDownload":
+        """Resume a previous download of the same remote file, or start a new one.
+
+        A previous download is only resumed if the state file matches
+        the URL, size, and validator of the remote file,
+        and the .part file is the expected size.
+        """
+        assert remote.size is not None
+        candidate = cls(output, remote, [])
+        try:
+            with open(candidate.statepath) as f:
+                state = json.load(f)
+            if (
+                state["url"] == remote.url
+                and state["size"] == remote.size
+                and state["validator"] == remote.validator
+                and remote.validator
+                and os.path.getsize(candidate.partpath) == remote.size
+            ):
+                candidate.segments = [Segment(**seg) for seg in state["segments"]]
+                done = sum(seg.done for seg in candidate.segments)
+                logger.info(f"Resuming download of {remote.url}, {done}/{remote.size} bytes already downloaded")
+                return candidate
+            logger.debug(f"Existing partial download of {output} does not match {remote.url}, starting over")
+        except (FileNotFoundError, KeyError, TypeError, ValueError):
+            pass
+
+        candidate.segments = plan_segments(remote.size, connections)
+        with open(candidate.partpath, "wb") as f:
+            f.truncate(remote.size)
+        candidate.save()
+        return candidate
+
+
+def _fetch_segment(
+    download: PartialDownload, segment: Segment, fd: int, session: requests.Session, retries: int
+) -> None:
+    """Download the remaining part of a segment, retrying if the connection fails"""
+    attempt = 0
+    while segment.remaining > 0:
+        offset = segment.start + segment.done
+        headers = {"Range": f"bytes={offset}-{segment.end - 1}"}
+        if download.remote.validator:
+            headers["If-Range"] = download.remote.validator
+        unsaved = 0
+        try:
+            with session.get(
+                download.remote.url, headers=headers, stream=True, timeout=REPOSITORY_TIMEOUT
+            ) as response:
+                response.raise_for_status()
+                if response.status_code != 206:
+                    # If-Range didn't match (or the server ignored the Range header),
+                    # so the server is sending the entire file.
+                    # That's only usable if we wanted the entire file from the beginning.
+                    if offset != 0 or segment.end != download.remote.size:
+                        raise RemoteChangedError(
+                            f"Expected a partial response for {download.remote.url} but got HTTP {response.status_code}; the remote file may have changed"
+                        )
+                for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                    if not chunk:
+                        continue
+                    chunk = chunk[: segment.remaining]
+                    os.pwrite(fd, chunk, segment.start + segment.done)
+                    segment.done += len(chunk)
+                    unsaved += len(chunk)
+                    if unsaved >= STATE_SAVE_INTERVAL:
+                        download.save()
+                        unsaved = 0
+                    if segment.remaining == 0:
+                        break
+            if segment.remaining > 0:
+                raise requests.exceptions.ConnectionError(
+                    f"Connection closed with {segment.remaining} bytes left in segment {segment.start}-{segment.end}"
+                )
+        except (
+            requests.exceptions.ConnectionError,
+            requests.exceptions.ChunkedEncodingError,
+            requests.exceptions.Timeout,
+        ) as exc:
+            download.save()
+            attempt += 1
+            if attempt > retries:
+                raise
+            logger.warning(
+                f"Download of {download.remote.url} segment {segment.start}-{segment.end} failed (attempt {attempt}/{retries}), retrying: {exc}"
+            )
+
+
+def _download_unranged(url: str, output: str, session: requests.Session) -> None:
+    """Download a file in a single request without resume support"""
+    partpath = f"{output}.part"
+    with session.get(url, stream=True, timeout=REPOSITORY_TIMEOUT) as response:
+        response.raise_for_status()
+        with open(partpath, "wb") as f:
+            for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                if chunk:
+                    f.write(chunk)
+            f.flush()
+            os.fsync(f.fileno())
+    os.replace(partpath, output)
+
+
+def download_ranged(
+    url: str,
+    output: str,
+    connections: int = DEFAULT_CONNECTIONS,
+    session: Optional[requests.Session] = None,
+    retries: int = 5,
+) -> str:
+    """Download a URL to a local file, resuming partial downloads and using parallel connections.
+
+    Arguments:
+    - url: The URL to download
+    - output: The local path to save the file to
+    - connections: The maximum number of simultaneous connections
+    - session: A requests session to use; one is created if not passed
+    - retries: How many times each segment may be retried after a connection error
+
+    Falls back to a single unresumable request if the server doesn't support ranges.
+    Returns the output path.
+    """
+    session = session or requests.Session()
+    remote = probe_remote_file(url, session)
+    if not remote.accept_ranges or remote.size is None:
+        logger.debug(f"Server does not support ranges for {url}, downloading in a single request")
+        _download_unranged(url, output, session)
+        return output
+
+    download = PartialDownload.resume_or_start(output, remote, connections)
+    pending = [seg for seg in download.segments if seg.remaining > 0]
+    logger.debug(f"Downloading {url} to {output} in {len(pending)} segment(s) over up to {connections} connection(s)")
+
+    errors = []
+    fd = os.open(download.partpath, os.O_WRONLY)
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, min(connections, len(pending)))) as executor:
+            futures = [executor.submit(_fetch_segment, download, seg, fd, session, retries) for seg in pending]
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except Exception as exc:
+                    errors.append(exc)
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+        download.save()
+
+    if errors:
+        if any(isinstance(exc, RemoteChangedError) for exc in errors):
+            # There's nothing useful to resume, so don't leave stale state around
+            download.remove_state()
+        raise MultiError(f"Failed to download {url}", errors)
+    if not download.complete:
+        raise Exception(f"Download of {url} finished with missing segments")
+
+    os.replace(download.partpath, output)
+    download.remove_state()
+    logger.debug(f"Downloaded {url} to {output}")
+    return output
@@ -0,0 +1,170 @@
+"""Verify and extract a tarball in a single pass
+
+The traditional way to apply an update is to verify the whole tarball with minisign,
+then read it again with tar to extract it.
+Instead, we can read the tarball once,
+feeding each block both to the signature verifier and to a streaming tar extractor.
+
+Because we don't know whether the signature is valid until we've read the last byte,
+members are extracted into a staging directory on the destination filesystem,
+and only moved into place once the signature checks out.
+This means the destination needs enough free space for the old and new contents at the same time.
+"""
+
+import os
+import shutil
+import tarfile
+from typing import BinaryIO, Optional
+
+from neuralupgrade import logger
+from neuralupgrade.filewriter import fsync_directory, fsync_tree
+from neuralupgrade.minisign import READ_SIZE, PublicKey, Signature, Verifier
+
+
+STAGING_DIRNAME = ".neuralupgrade-staging"
+"""The name of the staging directory created inside the destination"""
+
+
+class UnsafeTarballError(Exception):
+    """A tarball contains a member we refuse to extract"""
+
+
+class HashingReader:
+    """A read-only file-like object that passes everything it reads to a Verifier"""
+
+    def __init__(self, stream: BinaryIO, verifier: Optional[Verifier]):
+        self.stream = stream
+        self.verifier = verifier
+        self.bytes_read = 0
+
+    def read(self, size: int = -1) -> bytes:
+        data = self.stream.read(size)
+        self.bytes_read += len(data)
+        if self.verifier is not None:
+            self.verifier.update(data)
+        return data
+
+    def drain(self):
+        """Read the rest of the stream
+
+        tarfile stops reading at the end-of-archive marker,
+        but the signature covers any padding after it too.
+        """
+        while self.read(READ_SIZE):
+            pass
+
+
+def _check_member(member: tarfile.TarInfo) -> str:
+    """Return the normalized relative path of a member, or raise if it isn't safe to extract"""
+    name = os.path.normpath(member.name)
+    if os.path.isabs(name) or name == ".." or name.startswith("../") or name == ".":
+        raise UnsafeTarballError(f"Refusing to extract member with unsafe path {member.name}")
+    if name == STAGING_DIRNAME or name.startswith(f"{STAGING_DIRNAME}/"):
+        raise UnsafeTarballError(f"Refusing to extract member inside the staging directory: {member.name}")
+    if member.issym():
+        target = os.path.normpath(os.path.join(os.path.dirname(name), member.linkname))
+        if os.path.isabs(member.linkname) or target == ".." or target.startswith("../"):
+            raise UnsafeTarballError(f"Refusing to extract symlink {member.name} pointing outside the tarball")
+    elif not (member.isfile() or member.isdir()):
+        raise UnsafeTarballError(f"Refusing to extract {member.name}, which is not a file, directory, or symlink")
+    return name
+
+
+def _extract_member(tar: tarfile.TarFile, member: tarfile.TarInfo, name: str, staging: str):
+    path = os.path.join(staging, name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if member.isdir():
+        # Permissions are set after extraction, in case the directory isn't writable
+        os.makedirs(path, exist_ok=True)
+        return
+    if member.issym():
+        os.symlink(member.linkname, path)
+        return
+    source = tar.extractfile(member)
+    assert source is not None
+    with open(path, "wb") as dest:
+        shutil.copyfileobj(source, dest, READ_SIZE)
+    os.chmod(path, member.mode & 0o7777)
+    os.utime(path, (member.mtime, member.mtime))
+
+
+def _commit_staging(staging: str, destination: str, toplevel: list[str]):
+    """Move each top level item from the staging directory into the destination
+
+    Existing directories are replaced wholesale rather than merged,
+    so files removed from the new tarball don't linger from the old one.
+    """
+    # Make sure the new data is on disk before any rename makes it visible.
+    fsync_tree(staging)
+    retired = os.path.join(staging, ".retired")
+    os.makedirs(retired, exist_ok=True)
+    for name in toplevel:
+        dest = os.path.join(destination, name)
+        staged = os.path.join(staging, name)
+        if os.path.isdir(dest) and not os.path.islink(dest):
+            os.rename(dest, os.path.join(retired, name))
+        elif os.path.lexists(dest) and os.path.isdir(staged) and not os.path.islink(staged):
+            os.remove(dest)
+        os.replace(staged, dest)
+    # Make sure the renames are on disk before the old data is removed.
+    fsync_directory(destination)
+    shutil.rmtree(staging)
+
+
+def extract_verified(
+    stream: BinaryIO,
+    destination: str,
+    pubkey: Optional[PublicKey] = None,
+    signature: Optional[Signature] = None,
+) -> Optional[str]:
+    """Extract a tarball from a stream, verifying its signature as it is read
+
+    Arguments:
+    - stream: A readable binary stream of the tarball, like an open file or an HTTP response body
+    - destination: The directory to extract into
+    - pubkey: The public key to verify with, or None to skip verification
+    - signature: The signature of the tarball; required if pubkey is passed
+
+    The destination is only modified if the signature is valid and the whole tarball extracted without error.
+    Returns the verified trusted comment, or None if verification was skipped.
+    """
+    if (pubkey is None) != (signature is None):
+        raise ValueError("Must pass both pubkey and signature to verify, or neither to skip verification")
+    verifier = Verifier(pubkey, signature) if pubkey is not None and signature is not None else None
+
+    staging = os.path.join(destination, STAGING_DIRNAME)
+    if os.path.lexists(staging):
+        logger.debug(f"Removing leftover staging directory {staging}")
+        shutil.rmtree(staging)
+    os.mkdir(staging, 0o700)
+
+    try:
+        reader = HashingReader(stream, verifier)
+        toplevel: list[str] = []
+        directories: list[tuple[str, tarfile.TarInfo]] = []
+        with tarfile.open(fileobj=reader, mode="r|", bufsize=READ_SIZE) as tar:  # type: ignore[call-overload]
+            for member in tar:
+                name = _check_member(member)
+                top = name.split("/", 1)[0]
+                if top not in toplevel:
+                    toplevel.append(top)
+                _extract_member(tar, member, name, staging)
+                if member.isdir():
+                    directories.append((name, member))
+        reader.drain()
+        for name, member in reversed(directories):
+            path = os.path.join(staging, name)
+            os.chmod(path, member.mode & 0o7777)
+            os.utime(path, (member.mtime, member.mtime))
+        logger.debug(f"Extracted {reader.bytes_read} bytes to staging directory {staging}")
+
+        trusted_comment = None
+        if verifier is not None:
+            trusted_comment = verifier.verify()
+            logger.debug(f"Verified signature with trusted comment: {trusted_comment}")
+    except BaseException:
+        shutil.rmtree(staging, ignore_errors=True)
+        raise
+
+    _commit_staging(staging, destination, toplevel)
+    return trusted_comment
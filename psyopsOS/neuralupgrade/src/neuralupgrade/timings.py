@@ -0,0 +1,56 @@
+"""Time how long each phase of a command takes
+
+Enabled with `neuralupgrade --timings`,
+which prints a table of phases to stderr when the command finishes.
+Phases can be timed from any thread;
+phases that run in parallel will add up to more than the total.
+"""
+
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from typing import Iterator, TextIO
+
+
+class Timings:
+    """A thread-safe record of how long named phases took"""
+
+    def __init__(self):
+        self.enabled = False
+        self.started = time.monotonic()
+        self.phases: list[tuple[str, str, float]] = []
+        self._lock = threading.Lock()
+
+    def enable(self):
+        self.enabled = True
+        self.started = time.monotonic()
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        """Time the enclosed block, if timing is enabled"""
+        if not self.enabled:
+            yield
+            return
+        began = time.monotonic()
+        try:
+            yield
+        finally:
+            elapsed = time.monotonic() - began
+            with self._lock:
+                self.phases.append((name, threading.current_thread().name, elapsed))
+
+    def report(self, file: TextIO = sys.stderr):
+        """Print the recorded phases, in the order they finished"""
+        total = time.monotonic() - self.started
+        with self._lock:
+            phases = list(self.phases)
+        width = max([len(name) for name, _, _ in phases] + [5])
+        print("Timings:", file=file)
+        for name, thread, elapsed in phases:
+            print(f"  {name:<{width}}  {elapsed * 1000:9.1f}ms  {thread}", file=file)
+        print(f"  {'total':<{width}}  {total * 1000:9.1f}ms", file=file)
+
+
+timings = Timings()
+"""The timings for this process"""
@@ -1,25 +1,26 @@
 """Functions for parsing and verifying trusted comments in minisigs and comments in the GRUB config file."""
 
-import subprocess
 from typing import Optional
 
 from neuralupgrade import logger
+from neuralupgrade.minisign import DEFAULT_PUBKEY_PATH, PublicKey, verify_file_cached
 
 
-def minisign_verify(file: str, pubkey: Optional[str] = None) -> None:
-    """Verify a file with minisign."""
-    pubkey_args = ["-p", pubkey] if pubkey else []
-    cmd = ["minisign", "-V", *pubkey_args, "-m", file]
-    logger.debug(f"Running minisign: {cmd}")
-    result = subprocess.run(cmd, text=True, capture_output=True)
-    stdout = result.stdout.strip()
-    stderr = result.stderr.strip()
-    logger.debug(f"minisign stdout: {stdout}")
-    logger.debug(f"minisign stderr: {stderr}")
-    if result.returncode != 0:
-        raise Exception(
-            f"minisign returned non-zero exit code {result.returncode} with stdout '{stdout}' and stderr '{stderr}'"
-        )
+def minisign_verify(file: str, pubkey: Optional[str] = None) -> str:
+    """Verify a file against file + ".minisig", like `minisign -V`, and return the trusted comment.
+
+    The pubkey is the path to a minisign public key file,
+    defaulting to ./minisign.pub like the minisign command.
+
+    Verification happens in-process and is cached,
+    so verifying the same unchanged file again doesn't read it again;
+    see minisign.py.
+    Raises MinisignError if the file doesn't verify.
+    """
+    logger.debug(f"Verifying {file} with public key {pubkey or DEFAULT_PUBKEY_PATH}")
+    trusted_comment = verify_file_cached(file, PublicKey.from_file(pubkey or DEFAULT_PUBKEY_PATH))
+    logger.debug(f"Verified {file} with trusted comment: {trusted_comment}")
+    return trusted_comment
 
 
 def parse_trusted_comment(
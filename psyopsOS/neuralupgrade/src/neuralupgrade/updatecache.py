@@ -0,0 +1,214 @@
+"""A local, content-addressed cache of verified updates
+
+When a node downloads an update, it can keep a copy in the cache,
+so that it can serve the update to other nodes on the LAN (see peerserver.py)
+instead of each of them downloading it from the upstream repository.
+
+Layout of the cache directory:
+
+    objects/BLAKE2B.tar         The update tarballs, named after the BLAKE2b-512 hash of their contents
+    names/FILENAME.minisig      The signature for each tarball, named after the trusted comment's filename
+    names/FILENAME              A symlink to the object for that filename
+
+Updates are verified against their signature when they are added,
+and again when they are copied out,
+so a corrupted cache can't cause a bad update.
+"""
+
+import hashlib
+import os
+import re
+import threading
+from dataclasses import dataclass
+from typing import Optional
+
+from neuralupgrade import logger
+from neuralupgrade.filewriter import fsync_file
+from neuralupgrade.minisign import READ_SIZE, PublicKey, Signature, Verifier, record_verified
+from neuralupgrade.update_metadata import parse_trusted_comment
+
+
+DEFAULT_KEEP = 3
+"""The default number of updates to keep in the cache"""
+
+SAFE_FILENAME = re.compile(r"^[A-Za-z0-9][A-Za-z0-9._-]*$")
+"""Filenames from trusted comments must match this to be used as cache names"""
+
+
+def _copy_verified(source: str, destination: str, verifier: Optional[Verifier]) -> str:
+    """Copy a file, hashing it as it is copied
+
+    Return the BLAKE2b-512 hex digest of the file.
+    If a verifier is passed, the signature is checked and the destination is removed if it doesn't match.
+    """
+    digest = hashlib.blake2b(digest_size=64)
+    try:
+        with open(source, "rb") as src, open(destination, "wb") as dst:
+            while block := src.read(READ_SIZE):
+                digest.update(block)
+                if verifier is not None:
+                    verifier.update(block)
+                dst.write(block)
+            dst.flush()
+            os.fsync(dst.fileno())
+        if verifier is not None:
+            verifier.verify()
+    except BaseException:
+        try:
+            os.remove(destination)
+        except FileNotFoundError:
+            pass
+        raise
+    return digest.hexdigest()
+
+
+def _hash_verified(source: str, verifier: Verifier) -> str:
+    """Hash and verify a file without copying it, returning its BLAKE2b-512 hex digest"""
+    digest = hashlib.blake2b(digest_size=64)
+    with open(source, "rb") as src:
+        while block := src.read(READ_SIZE):
+            digest.update(block)
+            verifier.update(block)
+    verifier.verify()
+    return digest.hexdigest()
+
+
+@dataclass
+class CachedUpdate:
+    filename: str
+    path: str
+    minisig_text: str
+
+
+class UpdateCache:
+    """A directory of verified updates"""
+
+    def __init__(self, root: str, keep: int = DEFAULT_KEEP):
+        self.root = root
+        self.keep = keep
+        self.objects = os.path.join(root, "objects")
+        self.names = os.path.join(root, "names")
+        # Updates can be added from several threads at once, like by `neuralupgrade check --prefetch`
+        self._lock = threading.Lock()
+
+    def _ensure_dirs(self):
+        os.makedirs(self.objects, exist_ok=True)
+        os.makedirs(self.names, exist_ok=True)
+
+    def get(self, filename: str) -> Optional[CachedUpdate]:
+        """Look up an update by its filename, returning None if it isn't cached"""
+        if not SAFE_FILENAME.match(filename):
+            return None
+        path = os.path.join(self.names, filename)
+        try:
+            with open(f"{path}.minisig") as f:
+                minisig_text = f.read()
+        except FileNotFoundError:
+            return None
+        if not os.path.isfile(path):
+            return None
+        return CachedUpdate(filename, os.path.realpath(path), minisig_text)
+
+    def add(self, tarball: str, minisig_text: str, pubkey: PublicKey, move: bool = False) -> CachedUpdate:
+        """Verify an update and add it to the cache
+
+        The update is named after the filename in its trusted comment.
+        Raise MinisignError if it doesn't verify.
+
+        If move is True and the tarball is on the same filesystem as the cache,
+        it is verified in place and then moved into the cache instead of copied,
+        so a download made only for the cache is written once.
+        The tarball is gone afterwards; otherwise it is left where it was.
+        """
+        signature = Signature.from_string(minisig_text)
+        filename = parse_trusted_comment(sigcontents=minisig_text).get("filename", "")
+        if not SAFE_FILENAME.match(filename):
+            raise ValueError(f"Cannot cache update with unsafe filename '{filename}'")
+        self._ensure_dirs()
+
+        partial = os.path.join(self.objects, f".incoming.{os.getpid()}.{threading.get_ident()}")
+        stat = os.stat(tarball)
+        if move and stat.st_dev == os.stat(self.objects).st_dev:
+            digest = _hash_verified(tarball, Verifier(pubkey, signature))
+            os.rename(tarball, partial)
+            fsync_file(partial)
+        else:
+            digest = _copy_verified(tarball, partial, Verifier(pubkey, signature))
+            # The source verified too, so don't read it again if someone verifies it later
+            record_verified(tarball, stat, pubkey, minisig_text, signature.trusted_comment)
+        obj = os.path.join(self.objects, f"{digest}.tar")
+
+        name = os.path.join(self.names, filename)
+        with self._lock:
+            os.replace(partial, obj)
+            tmp_sig = f"{name}.minisig.{os.getpid()}"
+            with open(tmp_sig, "w") as f:
+                f.write(minisig_text)
+            os.replace(tmp_sig, f"{name}.minisig")
+            tmp_link = f"{name}.{os.getpid()}"
+            os.symlink(os.path.join("..", "objects", f"{digest}.tar"), tmp_link)
+            os.replace(tmp_link, name)
+            logger.info(f"Added {filename} to update cache {self.root}")
+
+            self._prune()
+        return CachedUpdate(filename, obj, minisig_text)
+
+    def copy_out(self, filename: str, destination: str, pubkey: Optional[PublicKey]) -> Optional[str]:
+        """Copy a cached update to destination, verifying it as it is copied
+
+        Return the minisig text, or None if the update isn't cached or fails verification.
+        """
+        cached = self.get(filename)
+        if cached is None:
+            return None
+        verifier = Verifier(pubkey, Signature.from_string(cached.minisig_text)) if pubkey else None
+        try:
+            _copy_verified(cached.path, destination, verifier)
+        except Exception as exc:
+            logger.warning(f"Cached update {filename} could not be used, removing it from the cache: {exc}")
+            self.remove(filename)
+            return None
+        return cached.minisig_text
+
+    def remove(self, filename: str):
+        with self._lock:
+            self._remove(filename)
+
+    def _remove(self, filename: str):
+        name = os.path.join(self.names, filename)
+        for path in [name, f"{name}.minisig"]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        self._remove_unreferenced()
+
+    def entries(self) -> list[str]:
+        """Return the cached filenames, most recently added first"""
+        try:
+            names = [n for n in os.listdir(self.names) if n.endswith(".minisig")]
+        except FileNotFoundError:
+            return []
+        names.sort(key=lambda n: os.stat(os.path.join(self.names, n)).st_mtime_ns, reverse=True)
+        return [n[: -len(".minisig")] for n in names]
+
+    def prune(self):
+        """Remove all but the most recently added updates"""
+        with self._lock:
+            self._prune()
+
+    def _prune(self):
+        for filename in self.entries()[self.keep :]:
+            logger.debug(f"Pruning {filename} from update cache {self.root}")
+            self._remove(filename)
+
+    def _remove_unreferenced(self):
+        referenced = set()
+        for name in os.listdir(self.names):
+            path = os.path.join(self.names, name)
+            if os.path.islink(path):
+                referenced.add(os.path.basename(os.readlink(path)))
+        for obj in os.listdir(self.objects):
+            # Skip objects that another thread or process is still copying in
+            if obj not in referenced and not obj.startswith(".incoming."):
+                os.remove(os.path.join(self.objects, obj))
@@ -0,0 +1,134 @@
+"""A small HTTP server that understands Range requests, for tests and benchmarks.
+
+Python's http.server doesn't support Range or If-Range,
+so we can't use it to test resumable downloads directly.
+"""
+
+import os
+import re
+import threading
+import time
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+
+
+class RangeRequestHandler(SimpleHTTPRequestHandler):
+    """Serve files from a directory, honoring Range and If-Range headers.
+
+    Class attributes can be changed on a subclass to simulate different servers:
+    - support_ranges: If False, ignore Range headers and always send the whole file
+    - fail_after_bytes: If set, drop the connection after sending this many body bytes in a response
+    - throttle_bytes_per_second: If set, limit each response to roughly this many bytes per second
+    """
+
+    support_ranges = True
+    fail_after_bytes: Optional[int] = None
+    throttle_bytes_per_second: Optional[int] = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _etag(self, stat: os.stat_result) -> str:
+        return f'"{stat.st_size:x}-{stat.st_mtime_ns:x}"'
+
+    def _handle(self, send_body: bool):
+        path = self.translate_path(self.path)
+        if not os.path.isfile(path):
+            self.send_error(404, "File not found")
+            return
+        stat = os.stat(path)
+        size = stat.st_size
+        etag = self._etag(stat)
+
+        start, end = 0, size - 1
+        partial = False
+        range_header = self.headers.get("Range")
+        if_range = self.headers.get("If-Range")
+        if self.support_ranges and range_header and (not if_range or if_range == etag):
+            match = re.fullmatch(r"bytes=(\d+)-(\d*)", range_header.strip())
+            if not match:
+                self.send_error(416, "Unsupported range")
+                return
+            start = int(match.group(1))
+            if match.group(2):
+                end = min(int(match.group(2)), size - 1)
+            if start >= size or start > end:
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{size}")
+                self.end_headers()
+                return
+            partial = True
+
+        self.send_response(206 if partial else 200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(end - start + 1))
+        self.send_header("ETag", etag)
+        if self.support_ranges:
+            self.send_header("Accept-Ranges", "bytes")
+        if partial:
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        self.end_headers()
+        if not send_body:
+            return
+
+        sent = 0
+        began = time.monotonic()
+        with open(path, "rb") as f:
+            f.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                block = f.read(min(64 * 1024, remaining))
+                if not block:
+                    break
+                if self.fail_after_bytes is not None and sent + len(block) > self.fail_after_bytes:
+                    self.wfile.write(block[: self.fail_after_bytes - sent])
+                    self.close_connection = True
+                    return
+                self.wfile.write(block)
+                sent += len(block)
+                remaining -= len(block)
+                if self.throttle_bytes_per_second:
+                    expected = sent / self.throttle_bytes_per_second
+                    elapsed = time.monotonic() - began
+                    if expected > elapsed:
+                        time.sleep(expected - elapsed)
+
+    def do_GET(self):
+        self._handle(send_body=True)
+
+    def do_HEAD(self):
+        self._handle(send_body=False)
+
+
+class RangeHTTPServer:
+    """A context manager that serves a directory over HTTP on localhost in a background thread.
+
+    Returns the base URL of the server when entered.
+    """
+
+    def __init__(self, directory: str, handler: type[RangeRequestHandler] = RangeRequestHandler):
+        self.directory = directory
+        self.handler = handler
+        self.httpd: Optional[ThreadingHTTPServer] = None
+        self.thread: Optional[threading.Thread] = None
+
+    def __enter__(self) -> str:
+        directory = self.directory
+
+        class Handler(self.handler):  # type: ignore[name-defined]
+            def __init__(self, *args, **kwargs):
+                super().__init__(*args, directory=directory, **kwargs)
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.httpd.daemon_threads = True
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.httpd:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+        if self.thread:
+            self.thread.join()
@@ -0,0 +1,135 @@
+"""Tests for delta.py."""
+
+import io
+import json
+import os
+import random
+import tarfile
+import tempfile
+import unittest
+
+from neuralupgrade.delta import (
+    MANIFEST_SUFFIX,
+    MAX_CHUNK_SIZE,
+    MIN_CHUNK_SIZE,
+    Chunker,
+    chunk_stream,
+    download_manifest,
+    make_manifest,
+    rebuild_from_delta,
+    write_manifest,
+)
+
+from tests.rangehttpd import RangeHTTPServer
+
+
+def make_ostar(path: str, members: dict[str, bytes]):
+    with tarfile.open(path, "w") as tar:
+        for name, contents in members.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(contents)
+            info.mtime = 1700000000
+            tar.addfile(info, io.BytesIO(contents))
+
+
+class TestChunking(unittest.TestCase):
+    """Tests for chunk_stream"""
+
+    def test_chunk_sizes(self):
+        """Chunks cover the input and respect the size limits"""
+        data = random.Random(1).randbytes(5 * 1024 * 1024 + 123)
+        chunks = chunk_stream(io.BytesIO(data), len(data))
+        self.assertEqual(sum(size for _, size in chunks), len(data))
+        for _, size in chunks[:-1]:
+            self.assertGreaterEqual(size, MIN_CHUNK_SIZE)
+            self.assertLessEqual(size, MAX_CHUNK_SIZE)
+
+    def test_insertion_resynchronizes(self):
+        """Inserting bytes only changes the chunks around the insertion"""
+        data = random.Random(2).randbytes(4 * 1024 * 1024)
+        changed = data[: 2 * 1024 * 1024] + b"inserted" + data[2 * 1024 * 1024 :]
+        before = {digest for digest, _ in chunk_stream(io.BytesIO(data), len(data))}
+        after = [digest for digest, _ in chunk_stream(io.BytesIO(changed), len(changed))]
+        new = [digest for digest in after if digest not in before]
+        self.assertLessEqual(len(new), 2)
+
+    def test_chunker_ignores_write_sizes(self):
+        """Feeding a Chunker in odd-sized pieces makes the same chunks as chunk_stream"""
+        data = random.Random(3).randbytes(3 * 1024 * 1024 + 77)
+        chunker = Chunker()
+        pos = 0
+        for size in [1, 511, 512, 70000, 1024 * 1024 + 3] * 3:
+            chunker.update(data[pos : pos + size])
+            pos += size
+        chunker.update(data[pos:])
+        self.assertEqual(chunker.finish(), chunk_stream(io.BytesIO(data), len(data)))
+
+
+class TestDeltaUpdate(unittest.TestCase):
+    """Tests for rebuilding a tarball from a delta"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        rand = random.Random(3)
+        self.squashfs_v1 = rand.randbytes(6 * 1024 * 1024)
+        self.kernel = rand.randbytes(512 * 1024)
+
+        # The booted side has the files from the old ostar
+        self.booted = os.path.join(self.tmpdir.name, "booted")
+        os.mkdir(self.booted)
+        for name, contents in [("squashfs", self.squashfs_v1), ("kernel", self.kernel)]:
+            with open(os.path.join(self.booted, name), "wb") as f:
+                f.write(contents)
+
+        # The new ostar changes part of the squashfs and adds a new file
+        self.servedir = os.path.join(self.tmpdir.name, "repo")
+        os.mkdir(self.servedir)
+        squashfs_v2 = bytearray(self.squashfs_v1)
+        squashfs_v2[3 * 1024 * 1024 : 3 * 1024 * 1024 + 1000] = rand.randbytes(1000)
+        self.ostar = os.path.join(self.servedir, "psyopsOS.x86_64.v2.tar")
+        make_ostar(
+            self.ostar,
+            {"kernel": self.kernel, "squashfs": bytes(squashfs_v2), "kernel.version": b"6.6.36-0-lts\n"},
+        )
+        write_manifest(self.ostar)
+        with open(self.ostar, "rb") as f:
+            self.expected = f.read()
+        self.output = os.path.join(self.tmpdir.name, "rebuilt.tar")
+
+    def test_rebuild(self):
+        """The rebuilt tarball is identical, and most of it came from the booted side"""
+        with RangeHTTPServer(self.servedir) as url:
+            tarball_url = f"{url}/psyopsOS.x86_64.v2.tar"
+            manifest = download_manifest(tarball_url)
+            result = rebuild_from_delta(manifest, tarball_url, self.booted, self.output)
+        with open(self.output, "rb") as f:
+            self.assertEqual(f.read(), self.expected)
+        self.assertGreater(result.reused_bytes, 5 * 1024 * 1024)
+        self.assertLess(result.downloaded_bytes, 3 * MAX_CHUNK_SIZE)
+
+    def test_rebuild_with_installed_manifest(self):
+        """An installed manifest is used as the index, and corrupt local chunks are downloaded instead"""
+        old_ostar = os.path.join(self.tmpdir.name, "old.tar")
+        make_ostar(old_ostar, {"kernel": self.kernel, "squashfs": self.squashfs_v1})
+        with open(os.path.join(self.booted, "psyopsOS.tar" + MANIFEST_SUFFIX), "w") as f:
+            json.dump(make_manifest(old_ostar), f)
+        # Corrupt the start of the local kernel
+        with open(os.path.join(self.booted, "kernel"), "r+b") as f:
+            f.write(b"corrupt")
+
+        with RangeHTTPServer(self.servedir) as url:
+            tarball_url = f"{url}/psyopsOS.x86_64.v2.tar"
+            result = rebuild_from_delta(download_manifest(tarball_url), tarball_url, self.booted, self.output)
+        with open(self.output, "rb") as f:
+            self.assertEqual(f.read(), self.expected)
+        self.assertGreater(result.downloaded_bytes, 0)
+
+    def test_missing_manifest(self):
+        """A missing manifest is not an error"""
+        with RangeHTTPServer(self.servedir) as url:
+            self.assertIsNone(download_manifest(f"{url}/does-not-exist.tar"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,73 @@
+"""Tests for filewriter.py."""
+
+import datetime
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from neuralupgrade.filewriter import STAMP_FORMAT, atomic_write, prune_backups, write_file_carefully
+
+
+class TestWriteFileCarefully(unittest.TestCase):
+    """Tests for write_file_carefully and its helpers"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.path = os.path.join(self.tmpdir.name, "grub.cfg")
+
+    def backups(self) -> list[str]:
+        return sorted(n for n in os.listdir(self.tmpdir.name) if n.startswith("grub.cfg.old."))
+
+    def test_write_and_backup(self):
+        """The old contents are kept in a timestamped backup"""
+        first = datetime.datetime(2025, 1, 1, 12, 0, 0)
+        second = datetime.datetime(2025, 1, 2, 12, 0, 0)
+        write_file_carefully(self.path, "one", first)
+        self.assertEqual(self.backups(), [])
+        write_file_carefully(self.path, "two", second)
+        with open(self.path) as f:
+            self.assertEqual(f.read(), "two")
+        self.assertEqual(self.backups(), [f"grub.cfg.old.{second.strftime(STAMP_FORMAT)}"])
+        with open(os.path.join(self.tmpdir.name, self.backups()[0])) as f:
+            self.assertEqual(f.read(), "one")
+        self.assertEqual(sorted(os.listdir(self.tmpdir.name)), sorted(["grub.cfg", *self.backups()]))
+
+    def test_unchanged(self):
+        """Writing the same contents again doesn't make a backup"""
+        write_file_carefully(self.path, b"\x00\x01", datetime.datetime.now(), binary=True)
+        write_file_carefully(self.path, b"\x00\x01", datetime.datetime.now(), binary=True)
+        self.assertEqual(self.backups(), [])
+
+    def test_backup_without_hard_links(self):
+        """Backups are copied on filesystems without hard links, like FAT"""
+        write_file_carefully(self.path, "one", datetime.datetime(2025, 1, 1))
+        with patch("neuralupgrade.filewriter.os.link", side_effect=PermissionError("no hard links")):
+            write_file_carefully(self.path, "two", datetime.datetime(2025, 1, 2))
+        with open(os.path.join(self.tmpdir.name, self.backups()[0])) as f:
+            self.assertEqual(f.read(), "one")
+
+    def test_failed_write_keeps_old_file(self):
+        """If the new contents can't be written, the old file and directory are unchanged"""
+        atomic_write(self.path, "one")
+        with patch("neuralupgrade.filewriter.os.replace", side_effect=OSError("disk on fire")):
+            with self.assertRaises(OSError):
+                atomic_write(self.path, "two")
+        with open(self.path) as f:
+            self.assertEqual(f.read(), "one")
+        self.assertEqual(os.listdir(self.tmpdir.name), ["grub.cfg"])
+
+    def test_prune_by_age(self):
+        """Only backups beyond the newest max_old_files and older than max_old_days are removed"""
+        now = datetime.datetime(2025, 6, 1)
+        stamps = [now - datetime.timedelta(days=days) for days in [1, 40, 2, 50, 60]]
+        for stamp in stamps:
+            open(f"{self.path}.old.{stamp.strftime(STAMP_FORMAT)}", "w").close()
+        prune_backups(self.path, max_old_files=2, max_old_days=45, now=now)
+        kept = [now - datetime.timedelta(days=days) for days in [1, 2, 40]]
+        self.assertEqual(self.backups(), sorted(f"grub.cfg.old.{s.strftime(STAMP_FORMAT)}" for s in kept))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,103 @@
+"""Tests for inventory.py."""
+
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from neuralupgrade.filesystems import Filesystem, Filesystems, Mount, Sides
+from neuralupgrade.inventory import SystemInventory, mounts_for_device, read_mountinfo
+
+MOUNTINFO = """\
+22 1 8:3 / / rw,relatime - ext4 /dev/sda3 rw
+35 22 8:1 / /mnt/psyops\\040efi ro,relatime shared:5 - vfat /dev/sda1 rw,fmask=0022
+36 22 8:2 / /mnt/psyopsOS/a ro,relatime - ext4 /dev/sda2 rw
+"""
+
+FSTAB = """\
+# comment
+LABEL=PSYOPSOSEFI /mnt/psyops\\040efi vfat ro 0 0
+LABEL=psyopsOS-A /mnt/psyopsOS/a ext4 ro 0 0
+/dev/sda4 /mnt/psyopsOS/b ext4 ro 0 0
+"""
+
+CMDLINE = "BOOT_IMAGE=/psyopsOS-A/kernel quiet psyopsos=psyopsOS-A\n"
+
+
+class TestSystemInventory(unittest.TestCase):
+    """Tests for SystemInventory"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        root = self.tmpdir.name
+        self.proc = os.path.join(root, "proc")
+        self.etc = os.path.join(root, "etc")
+        self.dev = os.path.join(root, "dev")
+        os.makedirs(os.path.join(self.proc, "self"))
+        os.makedirs(self.etc)
+        os.makedirs(os.path.join(self.dev, "disk", "by-label"))
+        with open(os.path.join(self.proc, "self", "mountinfo"), "w") as f:
+            f.write(MOUNTINFO)
+        with open(os.path.join(self.proc, "cmdline"), "w") as f:
+            f.write(CMDLINE)
+        with open(os.path.join(self.etc, "fstab"), "w") as f:
+            f.write(FSTAB)
+        for label, device in [("PSYOPSOSEFI", "sda1"), ("psyopsOS-A", "sda2"), ("psyopsOS\\x20B", "sda4")]:
+            open(os.path.join(self.dev, device), "w").close()
+            os.symlink(f"../../{device}", os.path.join(self.dev, "disk", "by-label", label))
+        self.inventory = SystemInventory.snapshot(proc=self.proc, etc=self.etc, dev=self.dev)
+
+    def test_snapshot(self):
+        """All four sources are read and parsed"""
+        self.assertEqual(self.inventory.device_for_label("psyopsOS-A"), os.path.join(self.dev, "sda2"))
+        self.assertEqual(self.inventory.device_for_label("psyopsOS B"), os.path.join(self.dev, "sda4"))
+        self.assertIsNone(self.inventory.device_for_label("psyopsOS-C"))
+        self.assertEqual(self.inventory.kernel_argument("psyopsos"), "psyopsOS-A")
+        self.assertEqual(self.inventory.fstab[0]["mountpoint"], "/mnt/psyops efi")
+        self.assertEqual(self.inventory.mounts[1]["target"], "/mnt/psyops efi")
+        self.assertEqual(self.inventory.mounts[1]["options"], "ro,relatime,rw,fmask=0022")
+
+    def test_missing_files(self):
+        """Missing files are treated as empty"""
+        inventory = SystemInventory.snapshot(proc=self.etc, etc=self.proc, dev=self.proc)
+        self.assertEqual((inventory.mounts, inventory.fstab, inventory.labels, inventory.cmdline), ([], [], {}, []))
+
+    def test_mounts_for_device(self):
+        """Mounts are matched by source when the device isn't a real block device"""
+        mounts = read_mountinfo(os.path.join(self.proc, "self", "mountinfo"))
+        self.assertEqual([m["target"] for m in mounts_for_device("/dev/sda2", mounts)], ["/mnt/psyopsOS/a"])
+        self.assertEqual(mounts_for_device("/dev/sda4", mounts), [])
+
+    def test_filesystem_lookups(self):
+        """Filesystems find their device and mountpoint without running blkid"""
+        filesystems = Filesystems(inventory=self.inventory)
+        with patch("neuralupgrade.filesystems.subprocess.run") as run:
+            self.assertEqual(filesystems.a.device, os.path.join(self.dev, "sda2"))
+            self.assertEqual(filesystems.a.mountpoint, "/mnt/psyopsOS/a")
+            self.assertEqual(filesystems.efisys.mountpoint, "/mnt/psyops efi")
+            run.assert_not_called()
+        self.assertEqual(Sides.detect(filesystems, self.inventory), Sides("psyopsOS-A", "psyopsOS-B"))
+
+    def test_blkid_fallback(self):
+        """Labels that aren't in /dev/disk/by-label are looked up with blkid"""
+        fs = Filesystem("psyopsOS-C", inventory=self.inventory)
+        with patch("neuralupgrade.filesystems.subprocess.run") as run:
+            run.return_value.stdout = b"/dev/sdb1\n"
+            self.assertEqual(fs.device, "/dev/sdb1")
+            run.assert_called_once()
+
+    def test_mount_reloads(self):
+        """Mounting a filesystem reloads the mount table"""
+        mount = Mount("/dev/sda4", "/mnt/psyopsOS/b", inventory=self.inventory)
+        with patch("neuralupgrade.filesystems.subprocess.run") as run:
+            with open(os.path.join(self.proc, "self", "mountinfo"), "a") as f:
+                f.write("37 22 8:4 / /mnt/psyopsOS/b ro,relatime - ext4 /dev/sda4 rw\n")
+            self.assertEqual(self.inventory.mounts_for_device("/dev/sda4"), [])
+            mount.__enter__()
+            run.assert_called_once_with(["mount", "-o", "ro", "/dev/sda4", "/mnt/psyopsOS/b"], check=True)
+        self.assertEqual(len(self.inventory.mounts_for_device("/dev/sda4")), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,193 @@
+"""Tests for minisign.py."""
+
+import hashlib
+import os
+import tempfile
+import unittest
+from pathlib import Path
+from unittest.mock import patch
+
+from neuralupgrade.minisign import (
+    ALG_PREHASHED,
+    MinisignError,
+    PublicKey,
+    SecretKey,
+    Signature,
+    Verifier,
+    clear_verification_cache,
+    ed25519_public_key,
+    ed25519_sign,
+    ed25519_verify,
+    verify_file,
+    verify_file_cached,
+)
+from neuralupgrade.minisign import verify_stream as verify_stream_original
+from neuralupgrade.update_metadata import minisign_verify
+
+TESTS_DIR = Path(__file__).parent
+SCENARIO_AB_SAME = TESTS_DIR / "data" / "scenarios" / "ab_same"
+PSYOPSOS_PUBKEY = TESTS_DIR.parent.parent / "minisign.pubkey"
+
+# A secret key made by another minisign implementation with a small scrypt memlimit so it decrypts quickly
+ENCRYPTED_SECKEY = """untrusted comment: minisign encrypted secret key
+RWRTY0Iywn5tmnWCO61qkLUkhxA3ZOX/sZn11L04QQFR53JI8cwAgAAAAAAAAAAAEAAAAAAAAtmAGVk1Bw7Cy1DKhFo5YWI2SqBUSwF7IXyobTm6S7QbgvcJ8N3JO+kR7sYcn7ZwmcVzEHfqTcHhFOv5Js1a3BLUm8LOxReiZIxgN15T/qGM7DTe/DX+sc8BR/3DlI4S1Lj6NbJGpq0=
+"""
+ENCRYPTED_SECKEY_PASSWORD = "correct horse battery staple"
+ENCRYPTED_SECKEY_PUBKEY = "RWTGfGJT1W8ekax+hgR+M7ynEsWWvnz+MDPWJl+BKnG4sV7f4X1cfurR"
+
+
+class TestEd25519(unittest.TestCase):
+    """Tests for the Ed25519 implementation"""
+
+    def test_rfc8032_test1(self):
+        """RFC 8032 section 7.1, TEST 1 (empty message)"""
+        seed = bytes.fromhex("9d61b19deffd5a60ba844af492ec2cc44449c5697b326919703bac031cae7f60")
+        public = bytes.fromhex("d75a980182b10ab7d54bfed3c964073a0ee172f3daa62325af021a68f707511a")
+        signature = bytes.fromhex(
+            "e5564300c360ac729086e2cc806e828a84877f1eb8e5d974d873e06522490155"
+            "5fb8821590a33bacc61e39701cf9b46bd25bf5f0595bbe24655141438e7a100b"
+        )
+        self.assertEqual(ed25519_public_key(seed), public)
+        self.assertEqual(ed25519_sign(seed, b""), signature)
+        self.assertTrue(ed25519_verify(public, b"", signature))
+
+    def test_rfc8032_test2(self):
+        """RFC 8032 section 7.1, TEST 2 (one byte message)"""
+        seed = bytes.fromhex("4ccd089b28ff96da9db6c346ec114e0f5b8a319f35aba624da8cf6ed4fb8a6fb")
+        public = bytes.fromhex("3d4017c3e843895a92b70aa74d1b7ebc9c982ccf2ec4968cc0cd55f12af4660c")
+        signature = bytes.fromhex(
+            "92a009a9f0d4cab8720e820b5f642540a2b27b5416503f8fb3762223ebdb69da"
+            "085ac1e43e15996e458f3613d0f11d8c387b2eaeb4302aeeb00d291612bb0c00"
+        )
+        self.assertEqual(ed25519_public_key(seed), public)
+        self.assertEqual(ed25519_sign(seed, b"\x72"), signature)
+        self.assertTrue(ed25519_verify(public, b"\x72", signature))
+
+    def test_tampered(self):
+        """Changing the message, signature, or key fails verification"""
+        seed = os.urandom(32)
+        public = ed25519_public_key(seed)
+        signature = ed25519_sign(seed, b"psyopsOS")
+        self.assertTrue(ed25519_verify(public, b"psyopsOS", signature))
+        self.assertFalse(ed25519_verify(public, b"psyopsOs", signature))
+        self.assertFalse(ed25519_verify(public, b"psyopsOS", signature[:-1] + bytes([signature[-1] ^ 1])))
+        self.assertFalse(ed25519_verify(ed25519_public_key(os.urandom(32)), b"psyopsOS", signature))
+
+
+class TestMinisign(unittest.TestCase):
+    """Tests for minisign keys and signatures"""
+
+    def test_psyopsOS_signature_global(self):
+        """The trusted comment of a real psyopsOS minisig verifies against the real public key"""
+        pubkey = PublicKey.from_file(PSYOPSOS_PUBKEY)
+        self.assertEqual(str(pubkey), "46E9A66AF0BB9545")
+        sigfiles = [SCENARIO_AB_SAME / "a" / "psyopsOS.tar.minisig", SCENARIO_AB_SAME / "efisys" / "psyopsESP.tar.minisig"]
+        for sigfile in sigfiles:
+            signature = Signature.from_file(sigfile)
+            self.assertEqual(signature.algorithm, ALG_PREHASHED)
+            self.assertEqual(signature.keyid, pubkey.keyid)
+            global_message = signature.signature + signature.trusted_comment.encode()
+            self.assertTrue(ed25519_verify(pubkey.key, global_message, signature.global_signature))
+
+    def test_roundtrip(self):
+        """Signatures can be written and parsed again"""
+        seckey = SecretKey.generate()
+        signature = seckey.sign_hash(hashlib.blake2b(b"contents").digest(), "type=test version=1")
+        parsed = Signature.from_string(signature.to_string())
+        self.assertEqual(parsed, signature)
+        self.assertEqual(PublicKey.from_string(seckey.public_key.to_string()), seckey.public_key)
+
+    def test_verify_file(self):
+        """A signed file verifies, and a modified one does not"""
+        seckey = SecretKey.generate()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "psyopsOS.tar")
+            with open(path, "wb") as f:
+                f.write(os.urandom(3 * 1024 * 1024 + 5))
+            seckey.sign_file(path, "type=psyopsOS version=test")
+            self.assertEqual(verify_file(path, seckey.public_key), "type=psyopsOS version=test")
+            with open(path, "ab") as f:
+                f.write(b"\0")
+            with self.assertRaises(MinisignError):
+                verify_file(path, seckey.public_key)
+
+    def test_tampered_trusted_comment(self):
+        """Changing the trusted comment fails verification even if the file is unchanged"""
+        seckey = SecretKey.generate()
+        signature = seckey.sign_hash(hashlib.blake2b(b"contents").digest(), "type=psyopsOS version=1")
+        signature.trusted_comment = "type=psyopsOS version=2"
+        verifier = Verifier(seckey.public_key, signature)
+        verifier.update(b"contents")
+        with self.assertRaises(MinisignError):
+            verifier.verify()
+
+    def test_encrypted_secret_key(self):
+        """An encrypted minisign secret key decrypts to the matching public key, and can sign"""
+        seckey = SecretKey.from_string(ENCRYPTED_SECKEY, ENCRYPTED_SECKEY_PASSWORD)
+        self.assertEqual(seckey.public_key.to_string(), ENCRYPTED_SECKEY_PUBKEY)
+        signature = seckey.sign_hash(hashlib.blake2b(b"contents").digest(), "type=test")
+        verifier = Verifier(PublicKey.from_string(ENCRYPTED_SECKEY_PUBKEY), signature)
+        verifier.update(b"contents")
+        self.assertEqual(verifier.verify(), "type=test")
+
+    def test_encrypted_secret_key_wrong_password(self):
+        with self.assertRaises(MinisignError):
+            SecretKey.from_string(ENCRYPTED_SECKEY, "wrong password")
+
+    def test_wrong_key(self):
+        """A signature from a different key is rejected before reading the file"""
+        signature = SecretKey.generate().sign_hash(hashlib.blake2b(b"").digest(), "type=test")
+        with self.assertRaises(MinisignError):
+            Verifier(SecretKey.generate().public_key, signature)
+
+
+class TestVerificationCache(unittest.TestCase):
+    """Tests for verify_file_cached and minisign_verify"""
+
+    def setUp(self):
+        clear_verification_cache()
+        self.addCleanup(clear_verification_cache)
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.seckey = SecretKey.generate()
+        self.path = os.path.join(self.tmpdir.name, "psyopsOS.tar")
+        with open(self.path, "wb") as f:
+            f.write(os.urandom(1024 * 1024))
+        self.seckey.sign_file(self.path, "type=psyopsOS version=test")
+
+    def test_cached(self):
+        """An unchanged file is only read once"""
+        with patch("neuralupgrade.minisign.verify_stream", wraps=verify_stream_original) as verify_stream:
+            for _ in range(3):
+                self.assertEqual(verify_file_cached(self.path, self.seckey.public_key), "type=psyopsOS version=test")
+            self.assertEqual(verify_stream.call_count, 1)
+
+    def test_modified(self):
+        """A modified file is verified again, and fails"""
+        verify_file_cached(self.path, self.seckey.public_key)
+        with open(self.path, "r+b") as f:
+            f.write(b"\0" * 16)
+        os.utime(self.path, ns=(0, 0))
+        with self.assertRaises(MinisignError):
+            verify_file_cached(self.path, self.seckey.public_key)
+
+    def test_different_key(self):
+        """A cached result for one key is not used for another"""
+        verify_file_cached(self.path, self.seckey.public_key)
+        with self.assertRaises(MinisignError):
+            verify_file_cached(self.path, SecretKey.generate().public_key)
+
+    def test_minisign_verify(self):
+        """minisign_verify reads the public key file and the .minisig next to the file"""
+        pubkey = os.path.join(self.tmpdir.name, "minisign.pubkey")
+        with open(pubkey, "w") as f:
+            f.write(f"untrusted comment: test key\n{self.seckey.public_key.to_string()}\n")
+        self.assertEqual(minisign_verify(self.path, pubkey=pubkey), "type=psyopsOS version=test")
+        with open(self.path, "ab") as f:
+            f.write(b"\0")
+        with self.assertRaises(MinisignError):
+            minisign_verify(self.path, pubkey=pubkey)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,13 +1,31 @@
 """Tests for osupdates.py."""
 
+import argparse
+import io
+import os
+import tarfile
 import tempfile
+import shutil
 import unittest
 from pathlib import Path
 from unittest.mock import patch
 
+from neuralupgrade.cmd import prefetch_update
+from neuralupgrade.coginitivedefects import MultiError
+from neuralupgrade.downloader import download_update, open_update_stream
 from neuralupgrade.filesystems import Filesystem, Filesystems, Sides
-from neuralupgrade.firmware.uefipc import UEFIPCGrubBootloader
-from neuralupgrade.osupdates import get_system_metadata
+from neuralupgrade.firmware.uefipc import AMD64UEFIGrubBootloader
+from neuralupgrade.minisign import SecretKey
+from neuralupgrade.osupdates import (
+    apply_ostar,
+    apply_ostar_stream,
+    apply_updates,
+    check_updates,
+    get_system_metadata,
+)
+from neuralupgrade.updatecache import UpdateCache
+
+from tests.rangehttpd import RangeHTTPServer
 
 # Path to test scenario directories
 TESTS_DIR = Path(__file__).parent
@@ -22,7 +40,7 @@ class TestGetSystemVersions(unittest.TestCase):
         """Set up test environment."""
         self.sides = Sides(booted="psyopsOS-A", nonbooted="psyopsOS-B")
 
-        self.firmware = UEFIPCGrubBootloader()
+        self.firmware = AMD64UEFIGrubBootloader()
 
         # Create a mock Filesystems object that uses our scenario test data
         a_fs = Filesystem("psyopsOS-A", mountpoint=SCENARIO_AB_SAME / "a", mockmount=True)
@@ -77,5 +95,245 @@ class TestGetSystemVersions(unittest.TestCase):
         self.assertTrue("missing minisig" in result.b.metadata["error"])
 
 
+class TestApplyOstar(unittest.TestCase):
+    """Tests for apply_ostar function."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.osmount = os.path.join(self.tmpdir.name, "mnt")
+        os.mkdir(self.osmount)
+        self.tarball = os.path.join(self.tmpdir.name, "psyopsOS.x86_64.test.tar")
+        with tarfile.open(self.tarball, "w") as tar:
+            for name in ["kernel", "squashfs"]:
+                info = tarfile.TarInfo(name)
+                info.size = len(name)
+                tar.addfile(info, io.BytesIO(name.encode()))
+        self.seckey = SecretKey.generate()
+        self.pubkey = os.path.join(self.tmpdir.name, "minisign.pubkey")
+        with open(self.pubkey, "w") as f:
+            f.write(f"untrusted comment: test key\n{self.seckey.public_key.to_string()}\n")
+
+    def test_apply_ostar_single_pass(self):
+        """Test applying an ostar in a single pass."""
+        self.seckey.sign_file(self.tarball, "type=psyopsOS version=test")
+        apply_ostar(self.tarball, self.osmount, "psyopsOS-B", verify_pubkey=self.pubkey, single_pass=True)
+        with open(os.path.join(self.osmount, "squashfs")) as f:
+            self.assertEqual(f.read(), "squashfs")
+        with open(os.path.join(self.osmount, "psyopsOS-B")) as f:
+            self.assertEqual(f.read(), "psyopsOS-B")
+        self.assertTrue(os.path.exists(os.path.join(self.osmount, "psyopsOS.tar.minisig")))
+
+    def test_apply_ostar_single_pass_bad_signature(self):
+        """Test that a bad signature leaves the partition untouched in single pass mode."""
+        self.seckey.sign_file(self.tarball, "type=psyopsOS version=test")
+        with open(self.tarball, "ab") as f:
+            f.write(b"\0" * 512)
+        with self.assertRaises(Exception):
+            apply_ostar(self.tarball, self.osmount, "psyopsOS-B", verify_pubkey=self.pubkey, single_pass=True)
+        self.assertEqual(os.listdir(self.osmount), [])
+
+    def test_apply_ostar_single_pass_no_verify_without_minisig(self):
+        """Test that an unsigned ostar can be applied in a single pass when verification is off."""
+        apply_ostar(self.tarball, self.osmount, "psyopsOS-B", verify=False, single_pass=True)
+        with open(os.path.join(self.osmount, "kernel")) as f:
+            self.assertEqual(f.read(), "kernel")
+        self.assertFalse(os.path.exists(os.path.join(self.osmount, "psyopsOS.tar.minisig")))
+
+    def test_apply_ostar_single_pass_verify_without_minisig(self):
+        """Test that an unsigned ostar is refused in a single pass when verification is on."""
+        with self.assertRaises(FileNotFoundError):
+            apply_ostar(self.tarball, self.osmount, "psyopsOS-B", verify_pubkey=self.pubkey, single_pass=True)
+        self.assertEqual(os.listdir(self.osmount), [])
+
+    def test_apply_ostar_stream(self):
+        """Test applying an ostar as it is downloaded."""
+        self.seckey.sign_file(self.tarball, "type=psyopsOS filename=psyopsOS.x86_64.test.tar version=test")
+        with RangeHTTPServer(self.tmpdir.name) as url:
+            streamed = open_update_stream(AMD64UEFIGrubBootloader(), url, "psyopsOS.{arch}.{version}.tar", "test")
+            try:
+                apply_ostar_stream(
+                    streamed.stream, streamed.signature.text, self.osmount, "psyopsOS-A", verify_pubkey=self.pubkey
+                )
+            finally:
+                streamed.close()
+        with open(os.path.join(self.osmount, "kernel")) as f:
+            self.assertEqual(f.read(), "kernel")
+        with open(os.path.join(self.osmount, "psyopsOS.tar.minisig")) as f:
+            self.assertEqual(f.read(), streamed.signature.text)
+
+
+class RecordingFirmware(AMD64UEFIGrubBootloader):
+    """Firmware that records what it was asked to do instead of running grub-install"""
+
+    def __init__(self):
+        self.calls: list[tuple] = []
+
+    def prepare(self, efisys, tarball=None, verify=True, verify_pubkey=None):
+        self.calls.append(("prepare", efisys, tarball))
+
+    def configure(self, filesystems, efisys, default_boot_label):
+        self.calls.append(("configure", efisys, default_boot_label))
+
+
+class TestApplyUpdatesParallel(unittest.TestCase):
+    """Tests for apply_updates with parallel=True."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        mounts = {}
+        for name in ["efisys", "a", "b"]:
+            mounts[name] = os.path.join(self.tmpdir.name, name)
+            os.mkdir(mounts[name])
+        self.filesystems = Filesystems(
+            efisys=Filesystem("PSYOPSOSEFI", mountpoint=mounts["efisys"], mockmount=True),
+            a=Filesystem("psyopsOS-A", mountpoint=mounts["a"], mockmount=True),
+            b=Filesystem("psyopsOS-B", mountpoint=mounts["b"], mockmount=True),
+        )
+        self.sides = Sides(booted="psyopsOS-A", nonbooted="psyopsOS-B")
+        self.tarball = os.path.join(self.tmpdir.name, "psyopsOS.x86_64.test.tar")
+        with tarfile.open(self.tarball, "w") as tar:
+            info = tarfile.TarInfo("kernel")
+            info.size = 6
+            tar.addfile(info, io.BytesIO(b"kernel"))
+        seckey = SecretKey.generate()
+        seckey.sign_file(self.tarball, "type=psyopsOS version=test")
+        self.pubkey = os.path.join(self.tmpdir.name, "minisign.pubkey")
+        with open(self.pubkey, "w") as f:
+            f.write(f"untrusted comment: test key\n{seckey.public_key.to_string()}\n")
+
+    def test_parallel(self):
+        """Both sides are updated, and the boot configuration is written after efisys is prepared."""
+        firmware = RecordingFirmware()
+        apply_updates(
+            self.filesystems,
+            firmware,
+            self.sides,
+            ["a", "b", "efisys"],
+            ostar=self.tarball,
+            fwtar="esp.tar",
+            pubkey=self.pubkey,
+            default_boot_label="psyopsOS-A",
+            parallel=True,
+        )
+        for side in ["a", "b"]:
+            with open(os.path.join(self.tmpdir.name, side, "kernel")) as f:
+                self.assertEqual(f.read(), "kernel")
+        efisys = self.filesystems.efisys.mountpoint
+        self.assertEqual(firmware.calls, [("prepare", efisys, "esp.tar"), ("configure", efisys, "psyopsOS-A")])
+
+    def test_parallel_failure(self):
+        """If a side fails, the error is raised and the boot configuration is not written."""
+        firmware = RecordingFirmware()
+        os.rmdir(self.filesystems.b.mountpoint)
+        with self.assertRaises(MultiError):
+            apply_updates(
+                self.filesystems,
+                firmware,
+                self.sides,
+                ["nonbooted", "efisys"],
+                ostar=self.tarball,
+                pubkey=self.pubkey,
+                parallel=True,
+            )
+        self.assertEqual([call[0] for call in firmware.calls], ["prepare"])
+
+
+class TestCheckUpdates(unittest.TestCase):
+    """Tests for check_updates function."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.repodir = os.path.join(self.tmpdir.name, "repo")
+        os.mkdir(self.repodir)
+        self.seckey = SecretKey.generate()
+        self.pubkey = os.path.join(self.tmpdir.name, "minisign.pubkey")
+        with open(self.pubkey, "w") as f:
+            f.write(f"untrusted comment: test key\n{self.seckey.public_key.to_string()}\n")
+        for filename, comment in [
+            ("psyopsOS.x86_64.20250101-000000.tar", "type=psyopsOS version=20250101-000000"),
+            ("psyopsESP.x86_64-uefi.20240705-173849.tar", "type=psyopsESP version=20240705-173849"),
+        ]:
+            tarball = os.path.join(self.repodir, filename)
+            with open(tarball, "wb") as f:
+                f.write(os.urandom(64 * 1024))
+            self.seckey.sign_file(tarball, f"{comment} filename={filename}")
+            latest = filename.replace(comment.split("version=")[1], "latest")
+            shutil.copy(f"{tarball}.minisig", os.path.join(self.repodir, f"{latest}.minisig"))
+        self.filesystems = Filesystems(
+            efisys=Filesystem("PSYOPSOSEFI", mountpoint=SCENARIO_AB_SAME / "efisys", mockmount=True),
+            a=Filesystem("psyopsOS-A", mountpoint=SCENARIO_AB_SAME / "a", mockmount=True),
+            b=Filesystem("psyopsOS-B", mountpoint=SCENARIO_AB_SAME / "b", mockmount=True),
+        )
+        self.sides = Sides(booted="psyopsOS-A", nonbooted="psyopsOS-B")
+
+    def test_check_and_prefetch(self):
+        """Check against the latest signatures, then download using the signature check already fetched."""
+        firmware = AMD64UEFIGrubBootloader()
+        outdir = os.path.join(self.tmpdir.name, "out") + "/"
+        os.mkdir(outdir)
+        with RangeHTTPServer(self.repodir) as url:
+            checked = check_updates(
+                self.filesystems,
+                self.sides,
+                firmware,
+                ["nonbooted", "efisys"],
+                "latest",
+                url,
+                "psyopsOS.{arch}.{version}.tar",
+                "psyopsESP.{fwtype}.{version}.tar",
+            )
+            self.assertFalse(checked["nonbooted"]["up_to_date"])
+            self.assertEqual(checked["nonbooted"]["compared_to"], "20250101-000000")
+            self.assertTrue(checked["efisys"]["up_to_date"])
+
+            with patch("neuralupgrade.downloader.download_update_signature") as download_update_signature:
+                path = download_update(
+                    firmware,
+                    url,
+                    "psyopsOS.{arch}.{version}.tar",
+                    checked["nonbooted"]["compared_to"],
+                    outdir,
+                    pubkey=self.pubkey,
+                    signature=checked["nonbooted"]["signature"],
+                )
+                download_update_signature.assert_not_called()
+            self.assertEqual(os.path.basename(path), "psyopsOS.x86_64.20250101-000000.tar")
+
+            # A later download of the same version uses the prefetched file
+            with patch("neuralupgrade.downloader.download_ranged") as download_ranged:
+                download_update(
+                    firmware, url, "psyopsOS.{arch}.{version}.tar", "20250101-000000", outdir, pubkey=self.pubkey
+                )
+                download_ranged.assert_not_called()
+
+    def test_prefetch_into_cache(self):
+        """Prefetch into the update cache on disk, not --update-tmpdir, and don't leave a copy behind."""
+        firmware = AMD64UEFIGrubBootloader()
+        cache = UpdateCache(os.path.join(self.tmpdir.name, "cache"))
+        outdir = os.path.join(self.tmpdir.name, "out") + "/"
+        os.mkdir(outdir)
+        with RangeHTTPServer(self.repodir) as url:
+            parsed = argparse.Namespace(repository=url, pubkey=self.pubkey, verify=True, download_connections=2)
+            # The download is moved into the cache, not copied
+            with patch("neuralupgrade.updatecache._copy_verified") as copy_verified:
+                filename = prefetch_update(parsed, firmware, "psyopsOS.{arch}.{version}.tar", "latest", None, cache)
+                copy_verified.assert_not_called()
+            self.assertEqual(filename, "psyopsOS.x86_64.20250101-000000.tar")
+            self.assertEqual(cache.entries(), [filename])
+            self.assertEqual(os.listdir(os.path.join(cache.root, "prefetch")), [])
+
+            # Already cached, so it isn't downloaded again
+            with patch("neuralupgrade.downloader.download_ranged") as download_ranged:
+                prefetch_update(parsed, firmware, "psyopsOS.{arch}.{version}.tar", "latest", None, cache)
+                download_update(
+                    firmware, url, "psyopsOS.{arch}.{version}.tar", "latest", outdir, pubkey=self.pubkey, cache=cache
+                )
+                download_ranged.assert_not_called()
+            self.assertTrue(os.path.exists(os.path.join(outdir, filename)))
+
+
 if __name__ == "__main__":
     unittest.main()
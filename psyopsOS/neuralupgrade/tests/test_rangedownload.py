@@ -0,0 +1,203 @@
+"""Tests for rangedownload.py."""
+
+import json
+import os
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+from neuralupgrade import rangedownload
+from neuralupgrade.coginitivedefects import MultiError
+from neuralupgrade.rangedownload import PartialDownload, Segment, download_ranged, plan_segments, probe_remote_file
+
+from tests.rangehttpd import RangeHTTPServer, RangeRequestHandler
+
+
+class NoRangesHandler(RangeRequestHandler):
+    support_ranges = False
+
+
+class DropOnceHandler(RangeRequestHandler):
+    """Drop the first few GET responses partway through the body"""
+
+    drops_remaining = 0
+    lock = threading.Lock()
+
+    def do_GET(self):
+        with DropOnceHandler.lock:
+            drop = DropOnceHandler.drops_remaining > 0
+            if drop:
+                DropOnceHandler.drops_remaining -= 1
+        self.fail_after_bytes = 1000 if drop else None
+        super().do_GET()
+
+
+class StallOnceHandler(RangeRequestHandler):
+    """Stop sending the first few GET responses partway through the body, without closing the connection"""
+
+    stalls_remaining = 0
+    stall_seconds = 2.0
+    lock = threading.Lock()
+
+    def do_GET(self):
+        with StallOnceHandler.lock:
+            stall = StallOnceHandler.stalls_remaining > 0
+            if stall:
+                StallOnceHandler.stalls_remaining -= 1
+        self.fail_after_bytes = 1000 if stall else None
+        super().do_GET()
+        if stall:
+            # Hold the connection open after sending part of the body
+            self.wfile.flush()
+            time.sleep(self.stall_seconds)
+
+
+class TestRangeDownload(unittest.TestCase):
+    """Tests for download_ranged"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.servedir = os.path.join(self.tmpdir.name, "serve")
+        self.outdir = os.path.join(self.tmpdir.name, "out")
+        os.mkdir(self.servedir)
+        os.mkdir(self.outdir)
+        self.contents = os.urandom(300 * 1024 + 17)
+        with open(os.path.join(self.servedir, "update.tar"), "wb") as f:
+            f.write(self.contents)
+        self.output = os.path.join(self.outdir, "update.tar")
+
+        # Use small segments so that even a small test file is split up
+        patcher = mock.patch.object(rangedownload, "MIN_SEGMENT_SIZE", 64 * 1024)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.tmpdir.cleanup)
+
+    def read_output(self) -> bytes:
+        with open(self.output, "rb") as f:
+            return f.read()
+
+    def assert_no_leftovers(self):
+        self.assertFalse(os.path.exists(f"{self.output}.part"))
+        self.assertFalse(os.path.exists(f"{self.output}.part.json"))
+
+    def test_plan_segments(self):
+        """Segments cover the whole file without overlap"""
+        for size in [0, 1, 64 * 1024, 300 * 1024 + 17]:
+            for connections in [1, 3, 4, 8]:
+                segments = plan_segments(size, connections)
+                self.assertLessEqual(len(segments), max(1, connections))
+                self.assertEqual(segments[0].start, 0)
+                self.assertEqual(segments[-1].end, size)
+                for prev, cur in zip(segments, segments[1:]):
+                    self.assertEqual(prev.end, cur.start)
+
+    def test_parallel_download(self):
+        """A file is downloaded correctly over several connections"""
+        with RangeHTTPServer(self.servedir) as url:
+            download_ranged(f"{url}/update.tar", self.output, connections=4)
+        self.assertEqual(self.read_output(), self.contents)
+        self.assert_no_leftovers()
+
+    def test_single_connection(self):
+        """A file is downloaded correctly over a single connection"""
+        with RangeHTTPServer(self.servedir) as url:
+            download_ranged(f"{url}/update.tar", self.output, connections=1)
+        self.assertEqual(self.read_output(), self.contents)
+        self.assert_no_leftovers()
+
+    def test_no_range_support(self):
+        """Servers without range support are downloaded in one request"""
+        with RangeHTTPServer(self.servedir, NoRangesHandler) as url:
+            download_ranged(f"{url}/update.tar", self.output, connections=4)
+        self.assertEqual(self.read_output(), self.contents)
+        self.assert_no_leftovers()
+
+    def test_resume(self):
+        """An interrupted download resumes without refetching completed ranges"""
+        with RangeHTTPServer(self.servedir) as url:
+            remote = probe_remote_file(f"{url}/update.tar", rangedownload.requests.Session())
+            partial = PartialDownload.resume_or_start(self.output, remote, 4)
+
+            # Pretend the first half of the first segment was already downloaded
+            # by writing it to the .part file and recording it in the state file.
+            first = partial.segments[0]
+            first.done = (first.end - first.start) // 2
+            with open(partial.partpath, "r+b") as f:
+                f.write(self.contents[: first.done])
+            partial.save()
+
+            with mock.patch.object(rangedownload, "_fetch_segment", wraps=rangedownload._fetch_segment) as fetch:
+                download_ranged(f"{url}/update.tar", self.output, connections=4)
+                resumed = [call.args[1] for call in fetch.call_args_list if call.args[1].start == first.start]
+            self.assertEqual(len(resumed), 1)
+        self.assertEqual(self.read_output(), self.contents)
+        self.assert_no_leftovers()
+
+    def test_resume_discarded_when_remote_changes(self):
+        """State for a different version of the remote file is discarded"""
+        with RangeHTTPServer(self.servedir) as url:
+            with open(f"{self.output}.part", "wb") as f:
+                f.write(b"\0" * len(self.contents))
+            with open(f"{self.output}.part.json", "w") as f:
+                json.dump(
+                    {
+                        "url": f"{url}/update.tar",
+                        "size": len(self.contents),
+                        "validator": '"stale"',
+                        "segments": [{"start": 0, "end": len(self.contents), "done": len(self.contents)}],
+                    },
+                    f,
+                )
+            download_ranged(f"{url}/update.tar", self.output, connections=2)
+        self.assertEqual(self.read_output(), self.contents)
+        self.assert_no_leftovers()
+
+    def test_remote_changed_during_download(self):
+        """If-Range mismatches for a partial segment are an error, not silent corruption"""
+        with RangeHTTPServer(self.servedir) as url:
+            remote = probe_remote_file(f"{url}/update.tar", rangedownload.requests.Session())
+            remote.validator = '"not-the-etag"'
+            with mock.patch.object(rangedownload, "probe_remote_file", return_value=remote):
+                with self.assertRaises(MultiError):
+                    download_ranged(f"{url}/update.tar", self.output, connections=4)
+        self.assertFalse(os.path.exists(self.output))
+        self.assertFalse(os.path.exists(f"{self.output}.part.json"))
+
+    def test_retry_after_dropped_connection(self):
+        """Dropped connections are retried from where they left off"""
+        DropOnceHandler.drops_remaining = 2
+        with RangeHTTPServer(self.servedir, DropOnceHandler) as url:
+            download_ranged(f"{url}/update.tar", self.output, connections=4)
+        self.assertEqual(self.read_output(), self.contents)
+        self.assert_no_leftovers()
+
+    def test_retry_after_stalled_connection(self):
+        """A connection that stops sending times out and is retried, rather than hanging the download"""
+        StallOnceHandler.stalls_remaining = 1
+        with mock.patch.object(rangedownload, "REPOSITORY_TIMEOUT", (5, 0.2)):
+            with RangeHTTPServer(self.servedir, StallOnceHandler) as url:
+                began = time.monotonic()
+                download_ranged(f"{url}/update.tar", self.output, connections=2)
+                elapsed = time.monotonic() - began
+        self.assertLess(elapsed, StallOnceHandler.stall_seconds)
+        self.assertEqual(self.read_output(), self.contents)
+        self.assert_no_leftovers()
+
+    def test_retries_exhausted_keeps_partial(self):
+        """When retries run out, the partial download is kept for next time"""
+        DropOnceHandler.drops_remaining = 100
+        with RangeHTTPServer(self.servedir, DropOnceHandler) as url:
+            with self.assertRaises(MultiError):
+                download_ranged(f"{url}/update.tar", self.output, connections=2, retries=1)
+        self.assertFalse(os.path.exists(self.output))
+        self.assertEqual(os.path.getsize(f"{self.output}.part"), len(self.contents))
+        with open(f"{self.output}.part.json") as f:
+            state = json.load(f)
+        self.assertEqual(state["size"], len(self.contents))
+        self.assertFalse(all(Segment(**seg).remaining == 0 for seg in state["segments"]))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,108 @@
+"""Tests for tarstream.py."""
+
+import io
+import os
+import tarfile
+import tempfile
+import unittest
+
+from neuralupgrade.minisign import MinisignError, SecretKey
+from neuralupgrade.tarstream import STAGING_DIRNAME, UnsafeTarballError, extract_verified
+
+
+def make_tarball(path: str, members: dict[str, bytes]):
+    """Make a tarball from a dict of name: contents, adding parent directories as needed"""
+    with tarfile.open(path, "w") as tar:
+        for name, contents in members.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(contents)
+            info.mode = 0o644
+            info.mtime = 1700000000
+            tar.addfile(info, io.BytesIO(contents))
+
+
+class TestExtractVerified(unittest.TestCase):
+    """Tests for extract_verified"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.seckey = SecretKey.generate()
+        self.tarball = os.path.join(self.tmpdir.name, "psyopsOS.tar")
+        self.osmount = os.path.join(self.tmpdir.name, "psyopsOS-B")
+        os.mkdir(self.osmount)
+
+        # An existing OS on the partition
+        os.mkdir(os.path.join(self.osmount, "dtbs"))
+        for name in ["kernel", "squashfs", "dtbs/old.dtb"]:
+            with open(os.path.join(self.osmount, name), "w") as f:
+                f.write("old")
+
+        self.members = {
+            "kernel": os.urandom(100 * 1024),
+            "squashfs": os.urandom(2 * 1024 * 1024 + 3),
+            "kernel.version": b"6.6.36-0-lts\n",
+            "dtbs/new.dtb": b"dtb",
+        }
+        make_tarball(self.tarball, self.members)
+
+    def read(self, name: str) -> bytes:
+        with open(os.path.join(self.osmount, name), "rb") as f:
+            return f.read()
+
+    def assert_unchanged(self):
+        self.assertEqual(self.read("kernel"), b"old")
+        self.assertEqual(self.read("dtbs/old.dtb"), b"old")
+        self.assertFalse(os.path.exists(os.path.join(self.osmount, "kernel.version")))
+        self.assertFalse(os.path.exists(os.path.join(self.osmount, STAGING_DIRNAME)))
+
+    def test_verified_extract(self):
+        """A correctly signed tarball is extracted, replacing old contents"""
+        signature = self.seckey.sign_file(self.tarball, "type=psyopsOS version=test")
+        with open(self.tarball, "rb") as f:
+            comment = extract_verified(f, self.osmount, pubkey=self.seckey.public_key, signature=signature)
+        self.assertEqual(comment, "type=psyopsOS version=test")
+        for name, contents in self.members.items():
+            self.assertEqual(self.read(name), contents)
+        self.assertFalse(os.path.exists(os.path.join(self.osmount, "dtbs", "old.dtb")))
+        self.assertFalse(os.path.exists(os.path.join(self.osmount, STAGING_DIRNAME)))
+        self.assertEqual(os.stat(os.path.join(self.osmount, "kernel")).st_mtime, 1700000000)
+
+    def test_bad_signature(self):
+        """A tarball that doesn't match its signature leaves the destination untouched"""
+        signature = SecretKey.generate().sign_file(self.tarball, "type=psyopsOS version=test")
+        signature.keyid = self.seckey.keyid
+        with open(self.tarball, "rb") as f:
+            with self.assertRaises(MinisignError):
+                extract_verified(f, self.osmount, pubkey=self.seckey.public_key, signature=signature)
+        self.assert_unchanged()
+
+    def test_trailing_data_is_verified(self):
+        """Bytes after the end-of-archive marker are covered by the signature"""
+        signature = self.seckey.sign_file(self.tarball, "type=psyopsOS version=test")
+        with open(self.tarball, "ab") as f:
+            f.write(b"\0" * 512)
+        with open(self.tarball, "rb") as f:
+            with self.assertRaises(MinisignError):
+                extract_verified(f, self.osmount, pubkey=self.seckey.public_key, signature=signature)
+        self.assert_unchanged()
+
+    def test_unsafe_member(self):
+        """Members that would escape the destination are refused"""
+        make_tarball(self.tarball, {"kernel": b"new", "../escape": b"bad"})
+        signature = self.seckey.sign_file(self.tarball, "type=psyopsOS version=test")
+        with open(self.tarball, "rb") as f:
+            with self.assertRaises(UnsafeTarballError):
+                extract_verified(f, self.osmount, pubkey=self.seckey.public_key, signature=signature)
+        self.assert_unchanged()
+        self.assertFalse(os.path.exists(os.path.join(self.tmpdir.name, "escape")))
+
+    def test_no_verify(self):
+        """Verification can be skipped"""
+        with open(self.tarball, "rb") as f:
+            self.assertIsNone(extract_verified(f, self.osmount))
+        self.assertEqual(self.read("squashfs"), self.members["squashfs"])
+
+
+if __name__ == "__main__":
+    unittest.main()
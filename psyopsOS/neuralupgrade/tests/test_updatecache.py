@@ -0,0 +1,144 @@
+"""Tests for updatecache.py and peerserver.py."""
+
+import os
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+import requests
+
+from neuralupgrade.downloader import download_update
+from neuralupgrade.firmware.uefipc import AMD64UEFIGrubBootloader
+from neuralupgrade.minisign import MinisignError, SecretKey
+from neuralupgrade.peerserver import make_server
+from neuralupgrade.updatecache import UpdateCache
+
+
+class CacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.seckey = SecretKey.generate()
+        self.pubkey_path = os.path.join(self.tmpdir.name, "minisign.pubkey")
+        with open(self.pubkey_path, "w") as f:
+            f.write(f"untrusted comment: test key\n{self.seckey.public_key.to_string()}\n")
+        self.cache = UpdateCache(os.path.join(self.tmpdir.name, "cache"), keep=2)
+
+    def make_update(self, version: str, size: int = 256 * 1024) -> tuple[str, str]:
+        """Make a signed update in the temp dir, returning the tarball path and minisig text"""
+        filename = f"psyopsOS.x86_64.{version}.tar"
+        path = os.path.join(self.tmpdir.name, filename)
+        with open(path, "wb") as f:
+            f.write(os.urandom(size))
+        signature = self.seckey.sign_file(path, f"type=psyopsOS filename={filename} version={version}")
+        return path, signature.to_string()
+
+
+class TestUpdateCache(CacheTestCase):
+    """Tests for UpdateCache"""
+
+    def test_add_and_get(self):
+        tarball, minisig = self.make_update("v1")
+        self.cache.add(tarball, minisig, self.seckey.public_key)
+        cached = self.cache.get("psyopsOS.x86_64.v1.tar")
+        self.assertIsNotNone(cached)
+        self.assertEqual(cached.minisig_text, minisig)
+        with open(cached.path, "rb") as a, open(tarball, "rb") as b:
+            self.assertEqual(a.read(), b.read())
+
+    def test_add_rejects_bad_signature(self):
+        tarball, minisig = self.make_update("v1")
+        with open(tarball, "ab") as f:
+            f.write(b"tampered")
+        with self.assertRaises(MinisignError):
+            self.cache.add(tarball, minisig, self.seckey.public_key)
+        self.assertIsNone(self.cache.get("psyopsOS.x86_64.v1.tar"))
+        self.assertEqual(os.listdir(self.cache.objects), [])
+
+    def test_prune(self):
+        for version in ["v1", "v2", "v3"]:
+            self.cache.add(*self.make_update(version), self.seckey.public_key)
+        self.assertEqual(self.cache.entries(), ["psyopsOS.x86_64.v3.tar", "psyopsOS.x86_64.v2.tar"])
+        self.assertEqual(len(os.listdir(self.cache.objects)), 2)
+
+    def test_corrupt_cache_entry_is_discarded(self):
+        tarball, minisig = self.make_update("v1")
+        cached = self.cache.add(tarball, minisig, self.seckey.public_key)
+        with open(cached.path, "r+b") as f:
+            f.write(b"corrupt")
+        destination = os.path.join(self.tmpdir.name, "out.tar")
+        self.assertIsNone(self.cache.copy_out("psyopsOS.x86_64.v1.tar", destination, self.seckey.public_key))
+        self.assertFalse(os.path.exists(destination))
+        self.assertIsNone(self.cache.get("psyopsOS.x86_64.v1.tar"))
+
+    def test_unsafe_filename(self):
+        self.assertIsNone(self.cache.get("../etc/passwd"))
+
+
+class TestPeerServing(CacheTestCase):
+    """Tests for serving the cache to peers and using peers as repositories"""
+
+    def setUp(self):
+        super().setUp()
+        self.tarball, self.minisig = self.make_update("v1", size=3 * 1024 * 1024)
+        self.cache.add(self.tarball, self.minisig, self.seckey.public_key)
+        self.server = make_server(self.cache, "127.0.0.1", 0)
+        thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        host, port = self.server.server_address[:2]
+        self.url = f"http://{host}:{port}"
+
+    def test_serves_cached_files(self):
+        response = requests.get(f"{self.url}/psyopsOS.x86_64.v1.tar.minisig")
+        self.assertEqual(response.text, self.minisig)
+        response = requests.get(f"{self.url}/psyopsOS.x86_64.v1.tar", headers={"Range": "bytes=10-19"})
+        self.assertEqual(response.status_code, 206)
+        with open(self.tarball, "rb") as f:
+            self.assertEqual(response.content, f.read()[10:20])
+
+    def test_does_not_serve_other_files(self):
+        for path in ["latest.minisig", "psyopsOS.x86_64.v2.tar", "..%2Fobjects", ""]:
+            self.assertEqual(requests.get(f"{self.url}/{path}").status_code, 404)
+
+    def test_download_from_peer_list(self):
+        """A client tries repositories in order and caches what it downloads"""
+        client_cache = UpdateCache(os.path.join(self.tmpdir.name, "client-cache"))
+        outdir = os.path.join(self.tmpdir.name, "out") + "/"
+        os.mkdir(outdir)
+        repositories = f"http://127.0.0.1:9,{self.url}"
+        path = download_update(
+            AMD64UEFIGrubBootloader(),
+            repositories,
+            "psyopsOS.{arch}.{version}.tar",
+            "v1",
+            outdir,
+            pubkey=self.pubkey_path,
+            cache=client_cache,
+        )
+        with open(path, "rb") as a, open(self.tarball, "rb") as b:
+            self.assertEqual(a.read(), b.read())
+        self.assertIsNotNone(client_cache.get("psyopsOS.x86_64.v1.tar"))
+
+        # With the update in the client cache, only the signature is downloaded
+        os.remove(path)
+        with mock.patch("neuralupgrade.downloader.download_ranged") as download_ranged:
+            path = download_update(
+                AMD64UEFIGrubBootloader(),
+                repositories,
+                "psyopsOS.{arch}.{version}.tar",
+                "v1",
+                outdir,
+                pubkey=self.pubkey_path,
+                cache=client_cache,
+            )
+            download_ranged.assert_not_called()
+        with open(path, "rb") as a, open(self.tarball, "rb") as b:
+            self.assertEqual(a.read(), b.read())
+
+
+if __name__ == "__main__":
+    unittest.main()
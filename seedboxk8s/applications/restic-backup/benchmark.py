@@ -0,0 +1,241 @@
+"""Benchmark the kubectl and Kubernetes API backends against a fake API server.
+
+Run it from the restic-backup directory, with kubectl on the PATH to compare both backends:
+
+    python3 benchmark.py --pvcs 60 --rounds 5
+
+It starts a fake API server on localhost (in another process, so it doesn't count towards kvrb's CPU time)
+with a cluster of generated PVCs, pods, and workloads, and for each backend times:
+
+* A dry-run planning pass: the cluster snapshot, the backup plans, and each workload's replica count.
+* A get of each workload, one at a time, like the scale, create, and delete calls made during each backup.
+
+The kubectl backend needs kubectl on the PATH, and is skipped without it.
+Each kubectl round gets an empty discovery cache, like the CronJob pod does.
+It lives beside the kvrb package rather than in it, since it's only for development
+and isn't shipped in the kvrb ConfigMap.
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from multiprocessing.synchronize import Event
+from typing import Any
+
+for _name, _value in {
+    "AWS_ACCESS_KEY_ID": "benchmark",
+    "AWS_DEFAULT_REGION": "benchmark",
+    "AWS_SECRET_ACCESS_KEY": "benchmark",
+    "RESTIC_PASSWORD": "benchmark",
+    "RESTIC_REPOSITORY_BASE": "s3:https://example.invalid/benchmark",
+}.items():
+    os.environ.setdefault(_name, _value)
+
+from kvrb import api  # noqa: E402
+from kvrb.backup import plan_backups  # noqa: E402
+from kvrb.config import ANNOTATION  # noqa: E402
+from kvrb.kube import JsonMap, kubectl_json  # noqa: E402
+from kvrb.snapshot import ClusterSnapshot  # noqa: E402
+
+FAKE_GROUPS = ["apps/v1", "batch/v1", "coordination.k8s.io/v1", "storage.k8s.io/v1"]
+
+
+def fake_cluster(pvcs: int) -> dict[api.Resource, list[JsonMap]]:
+    """Generate a cluster where each opted-in PVC is used by a Deployment, with some unrelated objects too."""
+    objects: dict[api.Resource, list[JsonMap]] = {resource: [] for resource in api.RESOURCES.values()}
+
+    def add(kind: str, namespace: str, name: str, **fields: Any) -> None:
+        metadata = {"namespace": namespace, "name": name, "uid": f"{kind}-{namespace}-{name}"}
+        metadata.update(fields.pop("metadata", {}))
+        objects[api.RESOURCES_BY_KIND[kind]].append({"metadata": metadata, **fields})
+
+    for index in range(pvcs * 2):
+        namespace = f"app{index % 10}"
+        name = f"data{index}"
+        annotations = {ANNOTATION: "true"} if index < pvcs else {}
+        add("PersistentVolumeClaim", namespace, name, metadata={"annotations": annotations}, status={"phase": "Bound"})
+        add("Deployment", namespace, name, spec={"replicas": 1})
+        owner = {"metadata": {"ownerReferences": [{"kind": "Deployment", "name": name}]}}
+        add("ReplicaSet", namespace, f"{name}-5d8f7", spec={"replicas": 1}, **owner)
+        owner = {"metadata": {"ownerReferences": [{"kind": "ReplicaSet", "name": f"{name}-5d8f7"}]}}
+        volumes = [{"name": "data", "persistentVolumeClaim": {"claimName": name}}]
+        add("Pod", namespace, f"{name}-5d8f7-x2k4q", spec={"volumes": volumes}, **owner)
+    return objects
+
+
+def discovery(path: str) -> JsonMap | None:
+    """The legacy discovery documents kubectl reads before anything else."""
+    if path == "/api":
+        return {"kind": "APIVersions", "versions": ["v1"]}
+    if path == "/apis":
+        groups = [
+            {"name": gv.split("/")[0], "versions": [{"groupVersion": gv, "version": gv.split("/")[1]}]}
+            for gv in FAKE_GROUPS
+        ]
+        for group in groups:
+            group["preferredVersion"] = group["versions"][0]  # type: ignore[index]
+        return {"kind": "APIGroupList", "apiVersion": "v1", "groups": groups}
+    group_version = path.removeprefix("/api/").removeprefix("/apis/")
+    if path in ("/api/v1", *(f"/apis/{gv}" for gv in FAKE_GROUPS)):
+        resources = [
+            {
+                "name": resource.plural,
+                "singularName": resource.kind.lower(),
+                "namespaced": resource.namespaced,
+                "kind": resource.kind,
+                "verbs": ["create", "delete", "get", "list", "patch", "update", "watch"],
+            }
+            for resource in set(api.RESOURCES.values())
+            if resource.group_version == group_version
+        ]
+        return {"kind": "APIResourceList", "apiVersion": "v1", "groupVersion": group_version, "resources": resources}
+    return None
+
+
+def serve(pvcs: int, port_queue: "multiprocessing.Queue[int]", stop: Event) -> None:
+    """Run the fake API server until stop is set."""
+    cluster = fake_cluster(pvcs)
+    paths = {(resource.path(), resource) for resource in cluster}
+    requests = 0
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        # The headers and body are written separately, which Nagle's algorithm would delay by ~40ms
+        disable_nagle_algorithm = True
+
+        def log_message(self, format: str, *args: Any) -> None:
+            pass
+
+        def reply(self, status: int, body: JsonMap) -> None:
+            data = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self) -> None:
+            nonlocal requests
+            path = self.path.split("?")[0]
+            if path == "/benchmark/requests":
+                self.reply(200, {"requests": requests})
+                return
+            requests += 1
+            document = discovery(path)
+            if document is not None:
+                self.reply(200, document)
+                return
+            namespace = None
+            if "/namespaces/" in path:
+                prefix, _, rest = path.partition("/namespaces/")
+                namespace, _, rest = rest.partition("/")
+                path = f"{prefix}/{rest}"
+            for resource_path, resource in paths:
+                if path == resource_path or path.startswith(resource_path + "/"):
+                    name = path[len(resource_path) + 1 :]
+                    items = [obj for obj in cluster[resource] if namespace in (None, obj["metadata"]["namespace"])]
+                    if not name:
+                        metadata = {"resourceVersion": "1"}
+                        self.reply(200, {"kind": f"{resource.kind}List", "metadata": metadata, "items": items})
+                        return
+                    for obj in items:
+                        if obj["metadata"]["name"] == name:
+                            self.reply(200, {"apiVersion": resource.group_version, "kind": resource.kind, **obj})
+                            return
+            self.reply(404, {"kind": "Status", "reason": "NotFound", "message": f"{self.path} not found"})
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    port_queue.put(server.server_address[1])
+    server.timeout = 0.1
+    while not stop.is_set():
+        server.handle_request()
+
+
+def cpu_seconds() -> float:
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+
+def server_requests(client: api.ApiClient) -> int:
+    return int(client.request("GET", "/benchmark/requests")["requests"])
+
+
+def run_round(gets: int, counter: api.ApiClient) -> tuple[float, float, int, float, float]:
+    """Return the wall and CPU seconds and API requests of a planning pass, and the wall and CPU seconds of the gets."""
+    requests = server_requests(counter)
+    wall, cpu = time.perf_counter(), cpu_seconds()
+    with contextlib.redirect_stdout(io.StringIO()):
+        snapshot = ClusterSnapshot.take()
+        plans = plan_backups(snapshot)
+        workloads = [workload for plan in plans for workload in plan.workloads]
+        for workload in workloads:
+            snapshot.current_replicas(workload)
+    plan_wall, plan_cpu = time.perf_counter() - wall, cpu_seconds() - cpu
+    requests = server_requests(counter) - requests
+
+    wall, cpu = time.perf_counter(), cpu_seconds()
+    with contextlib.redirect_stdout(io.StringIO()):
+        for workload in (workloads * (gets // max(len(workloads), 1) + 1))[:gets]:
+            kubectl_json("-n", workload["namespace"], "get", workload["api"], workload["name"], "-o", "json")
+    return plan_wall, plan_cpu, requests, time.perf_counter() - wall, cpu_seconds() - cpu
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pvcs", type=int, default=60, help="How many opted-in PVCs the fake cluster has")
+    parser.add_argument("--rounds", type=int, default=5, help="How many times to run each benchmark per backend")
+    parser.add_argument("--gets", type=int, default=100, help="How many single-object gets to time per round")
+    parsed = parser.parse_args()
+
+    port_queue: "multiprocessing.Queue[int]" = multiprocessing.Queue()
+    stop = multiprocessing.Event()
+    server = multiprocessing.Process(target=serve, args=(parsed.pvcs, port_queue, stop), daemon=True)
+    server.start()
+    url = f"http://127.0.0.1:{port_queue.get(timeout=30)}"
+    counter = api.ApiClient(url)
+
+    backends: dict[str, api.ApiClient | None] = {"api": api.ApiClient(url)}
+    if shutil.which("kubectl"):
+        backends["kubectl"] = None
+    else:
+        print("kubectl is not on the PATH, only benchmarking the API backend")
+
+    print(f"Fake cluster at {url} with {parsed.pvcs} opted-in PVCs, {parsed.rounds} rounds, {parsed.gets} gets/round")
+    print(f"{'backend':<8} {'plan wall':>10} {'plan cpu':>10} {'plan reqs':>10} {'get wall':>10} {'get cpu':>10}")
+    try:
+        for name, client in backends.items():
+            api.configure(client)
+            results = []
+            for _ in range(parsed.rounds):
+                with tempfile.TemporaryDirectory() as home:
+                    kubeconfig = {
+                        "apiVersion": "v1",
+                        "kind": "Config",
+                        "clusters": [{"name": "fake", "cluster": {"server": url}}],
+                        "users": [{"name": "fake", "user": {}}],
+                        "contexts": [{"name": "fake", "context": {"cluster": "fake", "user": "fake"}}],
+                        "current-context": "fake",
+                    }
+                    with open(f"{home}/kubeconfig", "w") as f:
+                        json.dump(kubeconfig, f)
+                    os.environ.update(HOME=home, KUBECONFIG=f"{home}/kubeconfig")
+                    results.append(run_round(parsed.gets, counter))
+            plan_wall, plan_cpu, requests, get_wall, get_cpu = (sum(column) / len(results) for column in zip(*results))
+            print(
+                f"{name:<8} {plan_wall * 1000:>8.1f}ms {plan_cpu * 1000:>8.1f}ms {requests:>10.1f} "
+                f"{get_wall / parsed.gets * 1000:>6.2f}ms/1 {get_cpu / parsed.gets * 1000:>6.2f}ms/1"
+            )
+    finally:
+        stop.set()
+        server.join(timeout=5)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,368 @@
+"""Talk to the Kubernetes API server directly instead of running kubectl.
+
+Every kubectl call forks a process that loads its config, discovers the API, and opens a new TLS connection,
+which costs more CPU than the request itself in the CronJob pod.
+When kvrb runs in the cluster, ApiClient uses the pod's service account instead,
+with a pool of keep-alive HTTPS connections shared by all backup threads.
+
+run() takes the same arguments as kvrb.kube.kubectl() and returns the same kind of result,
+for the kubectl commands kvrb uses: get, create (of JSON manifests), delete, patch --type=merge, and scale.
+It returns None for anything else (like logs, or creating a YAML manifest),
+and kubectl() falls back to running kubectl.
+
+KVRB_KUBE_BACKEND selects the backend: "auto" (the API in the cluster, kubectl elsewhere), "api", or "kubectl".
+"""
+
+import http.client
+import json
+import os
+import queue
+import socket
+import ssl
+import subprocess
+import threading
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Iterator
+from urllib.parse import urlencode, urlsplit
+
+from kvrb.config import KUBE_BACKEND
+
+JsonMap = dict[str, Any]
+
+SERVICE_ACCOUNT = Path("/var/run/secrets/kubernetes.io/serviceaccount")
+TOKEN_REFRESH_SECONDS = 60
+"""How often to re-read the service account token, which the kubelet rotates"""
+POOL_SIZE = 8
+REQUEST_TIMEOUT_SECONDS = 60
+
+
+@dataclass(frozen=True)
+class Resource:
+    group_version: str
+    plural: str
+    kind: str
+    namespaced: bool = True
+
+    @property
+    def group(self) -> str:
+        return self.group_version.rpartition("/")[0]
+
+    @property
+    def display_name(self) -> str:
+        """The name kubectl prints for this resource, like deployment.apps"""
+        return f"{self.kind.lower()}.{self.group}" if self.group else self.kind.lower()
+
+    def path(self, namespace: str | None = None, name: str = "", subresource: str = "") -> str:
+        path = "/api/v1" if self.group_version == "v1" else f"/apis/{self.group_version}"
+        if self.namespaced and namespace:
+            path += f"/namespaces/{namespace}"
+        path += f"/{self.plural}"
+        if name:
+            path += f"/{name}"
+        if subresource:
+            path += f"/{subresource}"
+        return path
+
+
+RESOURCES: dict[str, Resource] = {}
+"""Resources kvrb uses, by each name kubectl accepts for them"""
+for _resource, _names in [
+    (Resource("v1", "persistentvolumeclaims", "PersistentVolumeClaim"), ["pvc", "persistentvolumeclaim"]),
+    (Resource("v1", "persistentvolumes", "PersistentVolume", namespaced=False), ["pv", "persistentvolume"]),
+    (Resource("v1", "pods", "Pod"), ["po", "pod"]),
+    (Resource("v1", "secrets", "Secret"), ["secret"]),
+    (Resource("apps/v1", "deployments", "Deployment"), ["deploy", "deployment"]),
+    (Resource("apps/v1", "replicasets", "ReplicaSet"), ["rs", "replicaset"]),
+    (Resource("apps/v1", "statefulsets", "StatefulSet"), ["sts", "statefulset"]),
+    (Resource("batch/v1", "jobs", "Job"), ["job"]),
+    (Resource("coordination.k8s.io/v1", "leases", "Lease"), ["lease"]),
+    (Resource("storage.k8s.io/v1", "storageclasses", "StorageClass", namespaced=False), ["sc", "storageclass"]),
+]:
+    for _name in [_resource.plural, *_names]:
+        RESOURCES[_name] = _resource
+        RESOURCES[f"{_name}.{_resource.group}" if _resource.group else _name] = _resource
+RESOURCES_BY_KIND = {resource.kind: resource for resource in RESOURCES.values()}
+
+
+class ApiError(Exception):
+    def __init__(self, status: int, body: JsonMap) -> None:
+        self.status = status
+        self.reason = str(body.get("reason") or http.client.responses.get(status, "Error"))
+        self.message = str(body.get("message") or body)
+        super().__init__(f"Error from server ({self.reason}): {self.message}")
+
+
+class ApiClient:
+    """A Kubernetes API client with a pool of keep-alive connections."""
+
+    def __init__(self, server: str, token_file: Path | None = None, cafile: Path | None = None) -> None:
+        url = urlsplit(server)
+        self.host = url.hostname or "localhost"
+        self.port = url.port or (443 if url.scheme == "https" else 80)
+        self.https = url.scheme == "https"
+        self.token_file = token_file
+        self.default_namespace = "default"
+        """The namespace of commands without -n, which for kubectl in a pod is the pod's namespace"""
+        self._token = ""
+        self._token_read = 0.0
+        self._ssl = ssl.create_default_context(cafile=str(cafile) if cafile else None) if self.https else None
+        self._pool: queue.LifoQueue[http.client.HTTPConnection] = queue.LifoQueue(maxsize=POOL_SIZE)
+
+    @classmethod
+    def in_cluster(cls) -> "ApiClient | None":
+        """Return a client using the pod's service account, or None if not running in a cluster."""
+        host = os.environ.get("KUBERNETES_SERVICE_HOST")
+        port = os.environ.get("KUBERNETES_SERVICE_PORT", "443")
+        if not host or not (SERVICE_ACCOUNT / "token").exists():
+            return None
+        if ":" in host:
+            host = f"[{host}]"
+        client = cls(f"https://{host}:{port}", SERVICE_ACCOUNT / "token", SERVICE_ACCOUNT / "ca.crt")
+        client.default_namespace = (SERVICE_ACCOUNT / "namespace").read_text().strip()
+        return client
+
+    def _headers(self, content_type: str | None) -> dict[str, str]:
+        headers = {"Accept": "application/json", "User-Agent": "kvrb"}
+        if content_type:
+            headers["Content-Type"] = content_type
+        if self.token_file:
+            if time.time() - self._token_read > TOKEN_REFRESH_SECONDS:
+                self._token = self.token_file.read_text().strip()
+                self._token_read = time.time()
+            headers["Authorization"] = f"Bearer {self._token}"
+        return headers
+
+    def _connect(self) -> http.client.HTTPConnection:
+        if self.https:
+            return http.client.HTTPSConnection(self.host, self.port, timeout=REQUEST_TIMEOUT_SECONDS, context=self._ssl)
+        return http.client.HTTPConnection(self.host, self.port, timeout=REQUEST_TIMEOUT_SECONDS)
+
+    def request(
+        self,
+        method: str,
+        path: str,
+        body: JsonMap | None = None,
+        content_type: str = "application/json",
+        query: dict[str, str] | None = None,
+    ) -> JsonMap:
+        """Make a request and return the JSON response, raising ApiError for an error status."""
+        url = f"{path}?{urlencode(query)}" if query else path
+        data = json.dumps(body).encode() if body is not None else None
+        headers = self._headers(content_type if data is not None else None)
+        for attempt in range(2):
+            try:
+                if attempt > 0:
+                    raise queue.Empty
+                connection = self._pool.get_nowait()
+                reused = True
+            except queue.Empty:
+                connection = self._connect()
+                reused = False
+            try:
+                connection.request(method, url, body=data, headers=headers)
+                response = connection.getresponse()
+                payload = response.read()
+            except (http.client.HTTPException, OSError):
+                connection.close()
+                # The server may have closed an idle keep-alive connection; try once more on a new one
+                if reused and attempt == 0:
+                    continue
+                raise
+            if response.will_close:
+                connection.close()
+            else:
+                try:
+                    self._pool.put_nowait(connection)
+                except queue.Full:
+                    connection.close()
+            result = json.loads(payload) if payload else {}
+            if response.status >= 400:
+                raise ApiError(response.status, result)
+            return result  # type: ignore[no-any-return]
+        raise AssertionError("unreachable")
+
+    def watch(self, path: str, resource_version: str = "") -> "WatchStream":
+        """Start a watch on its own connection, which is iterated for events until the server ends it."""
+        query = {"watch": "1"}
+        if resource_version:
+            query["resourceVersion"] = resource_version
+        connection = self._connect()
+        connection.request("GET", f"{path}?{urlencode(query)}", headers=self._headers(None))
+        connection.sock.settimeout(None)
+        return WatchStream(connection)
+
+
+class WatchStream:
+    """The events of a watch request."""
+
+    def __init__(self, connection: http.client.HTTPConnection) -> None:
+        self.connection = connection
+
+    def __iter__(self) -> Iterator[JsonMap]:
+        try:
+            response = self.connection.getresponse()
+            if response.status >= 400:
+                payload = response.read()
+                raise ApiError(response.status, json.loads(payload) if payload else {})
+            while line := response.readline():
+                if line.strip():
+                    event = json.loads(line)
+                    if event.get("type") == "ERROR":
+                        raise ApiError(int(event["object"].get("code", 500)), event["object"])
+                    yield event
+        finally:
+            self.connection.close()
+
+    def close(self) -> None:
+        """Stop the watch from another thread."""
+        if self.connection.sock is not None:
+            try:
+                self.connection.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+
+_client: ApiClient | None = None
+_client_chosen = False
+_client_lock = threading.Lock()
+
+
+def configure(client: ApiClient | None) -> None:
+    """Use this client for every kubectl() call, or run kubectl for all of them if client is None."""
+    global _client, _client_chosen
+    with _client_lock:
+        _client, _client_chosen = client, True
+
+
+def client() -> ApiClient | None:
+    """Return the API client kubectl() should use, or None to run kubectl."""
+    global _client, _client_chosen
+    with _client_lock:
+        if not _client_chosen:
+            if KUBE_BACKEND not in ("auto", "api", "kubectl"):
+                raise ValueError(f"KVRB_KUBE_BACKEND must be auto, api, or kubectl, got {KUBE_BACKEND!r}")
+            if KUBE_BACKEND != "kubectl":
+                _client = ApiClient.in_cluster()
+                if _client is None and KUBE_BACKEND == "api":
+                    raise RuntimeError("KVRB_KUBE_BACKEND is api, but kvrb is not running in a Kubernetes pod")
+            print(f"Using the {'Kubernetes API' if _client else 'kubectl'} backend", flush=True)
+            _client_chosen = True
+        return _client
+
+
+def parse_args(args: tuple[str, ...]) -> tuple[list[str], dict[str, str]]:
+    """Split kubectl arguments into positional arguments and options, or raise ValueError."""
+    with_values = {"-n", "--namespace", "-o", "--output", "-p", "--patch", "-f", "--filename", "--type"}
+    positional: list[str] = []
+    options: dict[str, str] = {}
+    items = iter(args)
+    for arg in items:
+        if arg.startswith("-") and "=" in arg:
+            key, _, value = arg.partition("=")
+            options[key] = value
+        elif arg in with_values:
+            options[arg] = next(items)
+        elif arg.startswith("-"):
+            options[arg] = "true"
+        else:
+            positional.append(arg)
+    for short, long in [("-n", "--namespace"), ("-o", "--output"), ("-p", "--patch"), ("-f", "--filename")]:
+        if short in options:
+            options[long] = options.pop(short)
+    return positional, options
+
+
+def _get(client: ApiClient, positional: list[str], options: dict[str, str], namespace: str | None) -> str | None:
+    if options.pop("--output", "") != "json" or len(positional) not in (2, 3):
+        return None
+    if options.pop("--all-namespaces", "") == "true":
+        namespace = None
+    if options:
+        return None
+    names = positional[1].split(",")
+    if any(name not in RESOURCES for name in names):
+        return None
+    resources = [RESOURCES[name] for name in names]
+    if len(positional) == 3:
+        if len(resources) != 1:
+            return None
+        return json.dumps(client.request("GET", resources[0].path(namespace, positional[2])))
+    items: list[JsonMap] = []
+    resource_version = ""
+    for resource in resources:
+        result = client.request("GET", resource.path(namespace))
+        resource_version = result.get("metadata", {}).get("resourceVersion", "")
+        for item in result.get("items", []):
+            items.append({"apiVersion": resource.group_version, "kind": resource.kind, **item})
+    metadata = {"resourceVersion": resource_version if len(resources) == 1 else ""}
+    return json.dumps({"apiVersion": "v1", "kind": "List", "items": items, "metadata": metadata})
+
+
+def _run(
+    client: ApiClient, positional: list[str], options: dict[str, str], input_text: str | None
+) -> tuple[int, str] | None:
+    namespace = options.pop("--namespace", client.default_namespace)
+    verb = positional[0] if positional else ""
+    if verb == "get":
+        output = _get(client, positional, options, namespace)
+        return None if output is None else (0, output)
+
+    if verb == "create" and options.get("--filename") == "-" and len(options) == 1 and input_text is not None:
+        try:
+            manifest = json.loads(input_text)
+        except ValueError:
+            return None
+        resource = RESOURCES_BY_KIND.get(manifest.get("kind", ""))
+        if resource is None:
+            return None
+        namespace = manifest.get("metadata", {}).get("namespace", namespace)
+        created = client.request("POST", resource.path(namespace), manifest)
+        return 0, f"{resource.display_name}/{created['metadata']['name']} created\n"
+
+    if len(positional) != 3 or positional[1] not in RESOURCES:
+        return None
+    resource, name = RESOURCES[positional[1]], positional[2]
+
+    if verb == "delete" and set(options) <= {"--ignore-not-found"}:
+        try:
+            client.request("DELETE", resource.path(namespace, name), {"propagationPolicy": "Background"})
+        except ApiError as exc:
+            if exc.status == 404 and options.get("--ignore-not-found") == "true":
+                return 0, ""
+            raise
+        return 0, f'{resource.display_name} "{name}" deleted\n'
+
+    if verb == "patch" and options.get("--type") == "merge" and set(options) == {"--type", "--patch"}:
+        patch = json.loads(options["--patch"])
+        client.request("PATCH", resource.path(namespace, name), patch, "application/merge-patch+json")
+        return 0, f"{resource.display_name}/{name} patched\n"
+
+    if verb == "scale" and set(options) == {"--replicas"}:
+        patch = {"spec": {"replicas": int(options["--replicas"])}}
+        client.request("PATCH", resource.path(namespace, name, "scale"), patch, "application/merge-patch+json")
+        return 0, f"{resource.display_name}/{name} scaled\n"
+
+    return None
+
+
+def run(args: tuple[str, ...], input_text: str | None = None) -> subprocess.CompletedProcess[str] | None:
+    """Do what `kubectl ARGS` would with the API client, or return None if kubectl should be run instead."""
+    api = client()
+    if api is None:
+        return None
+    try:
+        positional, options = parse_args(args)
+    except StopIteration:
+        return None
+    try:
+        result = _run(api, positional, options, input_text)
+    except ApiError as exc:
+        result = (1, f"{exc}\n")
+    except (http.client.HTTPException, OSError) as exc:
+        result = (1, f"Unable to connect to the server: {exc}\n")
+    if result is None:
+        return None
+    returncode, stdout = result
+    return subprocess.CompletedProcess(["kubectl", *args], returncode, stdout=stdout)
@@ -1,7 +1,7 @@
 #!/usr/bin/env python3
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, as_completed, wait
 from dataclasses import dataclass
-from threading import Lock
 
 from kvrb.config import (
     BACKUP_PARALLELISM,
@@ -14,22 +14,21 @@ from kvrb.config import (
     KEEP_MONTHLY_ANNOTATION,
     KEEP_WEEKLY_ANNOTATION,
     KEEP_YEARLY_ANNOTATION,
+    NODE_PARALLELISM,
+    STORAGE_CLASS_PARALLELISM,
 )
 from kvrb.kube import (
     JsonMap,
     Workload,
-    delete_stale_backup_jobs,
-    eligible_pvcs,
-    get_replicas,
     job_logs,
     kubectl,
     scale,
     short_name,
-    wait_for_job,
-    wait_for_no_pods_using_pvc,
-    workloads_for_pvc,
 )
 from kvrb.manifests import backup_job_manifest, create_temp_secret, restic_repository
+from kvrb.schedule import ALL_JOBS, BackupGroup, BackupPlan, SlotLimits, Slots, group_plans, next_group
+from kvrb.snapshot import ClusterSnapshot, object_key
+from kvrb.watch import stop_watches, wait_for_job, wait_for_no_pods_using_pvc
 
 
 class BackupFailures(Exception):
@@ -38,12 +37,6 @@ class BackupFailures(Exception):
         self.failures = failures
 
 
-@dataclass(frozen=True)
-class BackupPlan:
-    pvc: JsonMap
-    workloads: list[Workload]
-
-
 @dataclass(frozen=True)
 class RetentionPolicy:
     keep_daily: int
@@ -83,20 +76,13 @@ def pvc_retention(pvc: JsonMap) -> RetentionPolicy:
     )
 
 
-def workload_key(workload: Workload) -> tuple[str, str, str]:
-    return (workload["api"], workload["namespace"], workload["name"])
-
+def run_backup_job(snapshot: ClusterSnapshot, pvc: JsonMap) -> None:
+    """Back up the given PVC to the configured repository, once nothing else is using it.
 
-def backup_pvc(pvc: JsonMap, workloads: list[Workload] | None = None) -> None:
-    """Back up the given PVC to the configured repository.
-
-    - Scale down any workloads using the PVC to zero replicas.
-    - Wait for all pods using the PVC to terminate.
     - Create a temporary secret with the necessary environment variables for the backup job.
     - Create a Kubernetes Job to perform the backup.
     - Wait for the Job to complete successfully.
     - Clean up the Job and temporary secret.
-    - Scale the workloads back to their original replica counts.
     """
 
     namespace = pvc["metadata"]["namespace"]
@@ -106,10 +92,7 @@ def backup_pvc(pvc: JsonMap, workloads: list[Workload] | None = None) -> None:
     retention = pvc_retention(pvc)
     temp_secret = short_name("restic", pvc_name, "env")
     job_name = short_name("restic", pvc_name)
-    delete_stale_backup_jobs(namespace, pvc_name, job_name)
-    if workloads is None:
-        workloads = workloads_for_pvc(namespace, pvc_name)
-    original_replicas: dict[tuple[str, str, str], tuple[Workload, int]] = {}
+    snapshot.delete_stale_backup_jobs(namespace, pvc_name, job_name)
     job_created = False
 
     print(f"Backing up {namespace}/{pvc_name} to {repository}", flush=True)
@@ -121,19 +104,8 @@ def backup_pvc(pvc: JsonMap, workloads: list[Workload] | None = None) -> None:
         f"monthly={retention.keep_monthly}, yearly={retention.keep_yearly}",
         flush=True,
     )
-    if not workloads:
-        print(
-            f"No active workload currently uses {namespace}/{pvc_name}; backing up without scaling",
-            flush=True,
-        )
 
     try:
-        for workload in workloads:
-            key = (workload["api"], workload["namespace"], workload["name"])
-            original_replicas[key] = (workload, get_replicas(workload))
-            scale(workload, 0)
-
-        wait_for_no_pods_using_pvc(namespace, pvc_name)
         create_temp_secret(namespace, temp_secret, repository)
         kubectl(
             "create",
@@ -148,47 +120,104 @@ def backup_pvc(pvc: JsonMap, workloads: list[Workload] | None = None) -> None:
             job_logs(namespace, job_name)
         kubectl("-n", namespace, "delete", "job", job_name, "--ignore-not-found=true", check=False)
         kubectl("-n", namespace, "delete", "secret", temp_secret, "--ignore-not-found=true", check=False)
-        for workload, replicas in reversed(list(original_replicas.values())):
+
+
+def backup_group(snapshot: ClusterSnapshot, group: BackupGroup, limits: SlotLimits) -> list[str]:
+    """Back up every PVC in the group in one scale-down window, and return the PVCs that failed.
+
+    - Scale down every workload using any of the PVCs to zero replicas.
+    - Wait for all pods using the PVCs to terminate.
+    - Run a backup Job for each PVC, several at once if the group reserved more than one slot.
+    - Scale the workloads back to their original replica counts.
+    """
+
+    original_replicas: list[tuple[Workload, int]] = []
+    failures: list[str] = []
+    demand = group.demand(limits)
+    slots = Slots(dict(demand))
+    print(f"Backing up {', '.join(group.names)} with {demand[ALL_JOBS]} job(s) at once", flush=True)
+    for plan in group.plans:
+        if not plan.workloads:
+            namespace, pvc_name = object_key(plan.pvc)
+            print(f"No active workload currently uses {namespace}/{pvc_name}; backing up without scaling", flush=True)
+
+    try:
+        for workload in group.workloads:
+            original_replicas.append((workload, snapshot.current_replicas(workload)))
+            scale(workload, 0)
+        for plan in group.plans:
+            wait_for_no_pods_using_pvc(*object_key(plan.pvc))
+
+        def run_plan(plan: BackupPlan) -> None:
+            # Only the group's own slots, so a Job waits here for another Job of the group on the same node
+            slots.acquire(Counter(plan.resources))
+            try:
+                run_backup_job(snapshot, plan.pvc)
+            finally:
+                slots.release(Counter(plan.resources))
+
+        with ThreadPoolExecutor(max_workers=demand[ALL_JOBS]) as executor:
+            futures = {executor.submit(run_plan, plan): plan for plan in group.plans}
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except Exception as exc:
+                    failures.append(f"{'/'.join(object_key(futures[future].pvc))}: {exc}")
+                    print(f"ERROR: {failures[-1]}", flush=True)
+    finally:
+        for workload, replicas in reversed(original_replicas):
             scale(workload, replicas)
+    return failures
+
+
+def plan_backups(snapshot: ClusterSnapshot) -> list[BackupPlan]:
+    """Return a plan for each PVC that has opted in to backups, without changing anything."""
+    return [
+        BackupPlan(
+            pvc=pvc,
+            workloads=snapshot.workloads_for_pvc(*object_key(pvc)),
+            node=snapshot.node_for_pvc(pvc),
+            storage_class=snapshot.storage_class_for_pvc(pvc),
+        )
+        for pvc in snapshot.eligible_pvcs()
+    ]
 
 
 def backup_annotated_pvcs() -> None:
     """Enumerate and back up all PVCs that have opted in to backups."""
-    pvcs = eligible_pvcs()
-    if not pvcs:
+    snapshot = ClusterSnapshot.take()
+    plans = plan_backups(snapshot)
+    if not plans:
         print("No opted-in PVCs found", flush=True)
         return
 
-    plans: list[BackupPlan] = [
-        BackupPlan(pvc=pvc, workloads=workloads_for_pvc(pvc["metadata"]["namespace"], pvc["metadata"]["name"]))
-        for pvc in pvcs
-    ]
-
-    max_workers = max(1, min(BACKUP_PARALLELISM, len(plans)))
-    print(f"Running PVC backups with parallelism {max_workers}", flush=True)
-    workload_locks = {workload_key(workload): Lock() for plan in plans for workload in plan.workloads}
-
-    def run_plan(plan: BackupPlan) -> None:
-        keys = sorted({workload_key(workload) for workload in plan.workloads})
-        locks = [workload_locks[key] for key in keys]
-        for lock in locks:
-            lock.acquire()
-        try:
-            backup_pvc(plan.pvc, plan.workloads)
-        finally:
-            for lock in reversed(locks):
-                lock.release()
+    limits = SlotLimits(BACKUP_PARALLELISM, NODE_PARALLELISM, STORAGE_CLASS_PARALLELISM)
+    waiting = group_plans(plans, limits)
+    print(f"Running {len(plans)} PVC backup(s) in {len(waiting)} group(s), largest first", flush=True)
+    print(f"Running at most {limits.describe()} backup job(s) at once", flush=True)
+    slots = Slots(limits)
+    running: dict[Future[list[str]], BackupGroup] = {}
 
     failures: list[str] = []
-    with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        futures = {executor.submit(run_plan, plan): plan for plan in plans}
-        for future in as_completed(futures):
-            pvc = futures[future].pvc
-            try:
-                future.result()
-            except Exception as exc:
-                failures.append(f"{pvc['metadata']['namespace']}/{pvc['metadata']['name']}: {exc}")
-                print(f"ERROR: {failures[-1]}", flush=True)
+    try:
+        with ThreadPoolExecutor(max_workers=limits.parallelism) as executor:
+            while waiting or running:
+                while (group := next_group(waiting, slots, limits)) is not None:
+                    waiting.remove(group)
+                    slots.take(group.demand(limits))
+                    running[executor.submit(backup_group, snapshot, group, limits)] = group
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    group = running.pop(future)
+                    slots.give(group.demand(limits))
+                    try:
+                        failures.extend(future.result())
+                    except Exception as exc:
+                        for name in group.names:
+                            failures.append(f"{name}: {exc}")
+                            print(f"ERROR: {failures[-1]}", flush=True)
+    finally:
+        stop_watches()
 
     if failures:
         raise BackupFailures(failures)
@@ -17,11 +17,14 @@ DEFAULT_KEEP_MONTHLY = int(os.environ.get("RESTIC_KEEP_MONTHLY", "120"))
 DEFAULT_KEEP_WEEKLY = int(os.environ.get("RESTIC_KEEP_WEEKLY", "8"))
 DEFAULT_KEEP_YEARLY = int(os.environ.get("RESTIC_KEEP_YEARLY", "5"))
 JOB_TIMEOUT_SECONDS = int(os.environ.get("BACKUP_JOB_TIMEOUT_SECONDS", "7200"))
+KUBE_BACKEND = os.environ.get("KVRB_KUBE_BACKEND", "auto")
 LOCK_LEASE_NAME = os.environ.get("BACKUP_LOCK_LEASE_NAME", "restic-backup")
 LOCK_LEASE_NAMESPACE = os.environ.get("BACKUP_LOCK_LEASE_NAMESPACE", "restic-backup")
 LOCK_LEASE_TTL_SECONDS = int(os.environ.get("BACKUP_LOCK_LEASE_TTL_SECONDS", "21600"))
-POLL_SECONDS = int(os.environ.get("BACKUP_POLL_SECONDS", "5"))
+NODE_PARALLELISM = os.environ.get("BACKUP_NODE_PARALLELISM", "")
 REPOSITORY_BASE = os.environ["RESTIC_REPOSITORY_BASE"].rstrip("/")
 RESTIC_PASSWORD = os.environ["RESTIC_PASSWORD"]
 RESTIC_SECRET_TEMPLATE = Path(os.environ.get("RESTIC_SECRET_TEMPLATE", "/opt/kvrb/restic-secret.json"))
 SOURCE_MOUNT = "/source"
+STORAGE_CLASS_PARALLELISM = os.environ.get("BACKUP_STORAGE_CLASS_PARALLELISM", "")
+WATCH_RESYNC_SECONDS = int(os.environ.get("BACKUP_WATCH_RESYNC_SECONDS", "60"))
@@ -4,7 +4,7 @@ import subprocess
 import time
 from typing import Any, TypedDict, cast
 
-from kvrb.config import ANNOTATION, JOB_TIMEOUT_SECONDS, POLL_SECONDS
+from kvrb import api
 
 JsonMap = dict[str, Any]
 
@@ -22,19 +22,24 @@ def kubectl(
     log_command: bool = True,
     log_output: bool = True,
 ) -> subprocess.CompletedProcess[str]:
-    """Run kubectl, logging the command and its output."""
+    """Run kubectl, logging the command and its output.
+
+    The command is made with the Kubernetes API client instead of kubectl when possible, see kvrb.api.
+    """
 
     command = ["kubectl", *args]
     if log_command:
         print("+ " + " ".join(command), flush=True)
-    result = subprocess.run(
-        command,
-        check=False,
-        text=True,
-        input=input_text,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.STDOUT,
-    )
+    result = api.run(args, input_text)
+    if result is None:
+        result = subprocess.run(
+            command,
+            check=False,
+            text=True,
+            input=input_text,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+        )
     if log_output and result.stdout:
         print(result.stdout, end="", flush=True)
     if check and result.returncode != 0:
@@ -62,34 +67,26 @@ def short_name(*parts: str) -> str:
     return f"{base[:max_base].rstrip('-')}-{suffix}"
 
 
-def eligible_pvcs() -> list[JsonMap]:
-    """Return PVCs that explicitly opt in to backups."""
-    pvcs = kubectl_json("get", "pvc", "--all-namespaces", "-o", "json")["items"]
-    selected: list[JsonMap] = []
-    for pvc in pvcs:
-        annotations = pvc.get("metadata", {}).get("annotations", {})
-        if annotations.get(ANNOTATION, "").lower() != "true":
-            continue
-        if pvc.get("status", {}).get("phase") != "Bound":
-            print(f"Skipping {pvc['metadata']['namespace']}/{pvc['metadata']['name']}: PVC is not Bound", flush=True)
-            continue
-        selected.append(pvc)
-    selected_names = [f"{pvc['metadata']['namespace']}/{pvc['metadata']['name']}" for pvc in selected]
-    print(f"Found {len(selected)} opted-in PVC(s): {', '.join(selected_names) or 'none'}", flush=True)
-    return selected
-
-
-def pods_using_pvc(namespace: str, pvc_name: str) -> list[JsonMap]:
-    """Return pods in the given namespace that use the specified PVC."""
-    pods = kubectl_json("-n", namespace, "get", "pods", "-o", "json")["items"]
-    return [
-        pod
-        for pod in pods
-        if any(
-            volume.get("persistentVolumeClaim", {}).get("claimName") == pvc_name
-            for volume in pod.get("spec", {}).get("volumes", [])
-        )
-    ]
+def pod_uses_pvc(pod: JsonMap, pvc_name: str) -> bool:
+    return any(
+        volume.get("persistentVolumeClaim", {}).get("claimName") == pvc_name
+        for volume in pod.get("spec", {}).get("volumes", [])
+    )
+
+
+def volume_node(pv: JsonMap) -> str | None:
+    """Return the node a PersistentVolume is on, or None if it isn't tied to a single node.
+
+    Local volumes, like the ones the local-path provisioner creates,
+    have a node affinity that requires a single kubernetes.io/hostname.
+    """
+    terms = pv.get("spec", {}).get("nodeAffinity", {}).get("required", {}).get("nodeSelectorTerms", [])
+    nodes: set[str] = set()
+    for term in terms:
+        for expression in term.get("matchExpressions", []):
+            if expression.get("key") == "kubernetes.io/hostname" and expression.get("operator") == "In":
+                nodes.update(expression.get("values", []))
+    return nodes.pop() if len(nodes) == 1 else None
 
 
 def owner_ref(obj: JsonMap, kind: str) -> JsonMap | None:
@@ -118,127 +115,11 @@ def is_backup_job_pod(pod: JsonMap, pvc_name: str) -> bool:
     return job_name.startswith(f"{backup_job_prefix(pvc_name)}-")
 
 
-def workload_for_pod(pod: JsonMap) -> Workload:
-    """Return the owning workload (StatefulSet, ReplicaSet, Deployment) for the given pod.
-
-    Finds the workload that manages a given pod.
-    Used to determine which workloads need to be scaled down before backing up a PVC.
-    """
-
-    namespace = pod["metadata"]["namespace"]
-    statefulset = owner_ref(pod, "StatefulSet")
-    if statefulset:
-        return {
-            "api": "statefulset",
-            "namespace": namespace,
-            "name": statefulset["name"],
-        }
-
-    replicaset = owner_ref(pod, "ReplicaSet")
-    if replicaset:
-        rs = kubectl_json("-n", namespace, "get", "replicaset", replicaset["name"], "-o", "json")  # fmt: skip
-        deployment = owner_ref(rs, "Deployment")
-        if deployment:
-            return {
-                "api": "deployment",
-                "namespace": namespace,
-                "name": deployment["name"],
-            }
-        return {
-            "api": "replicaset",
-            "namespace": namespace,
-            "name": replicaset["name"],
-        }
-
-    raise RuntimeError(f"pod {namespace}/{pod['metadata']['name']} has no supported scalable owner")
-
-
-def workloads_for_pvc(namespace: str, pvc_name: str) -> list[Workload]:
-    """Return the unique workloads that use the given PVC."""
-    workloads: dict[tuple[str, str, str], Workload] = {}
-    for pod in pods_using_pvc(namespace, pvc_name):
-        if pod.get("metadata", {}).get("deletionTimestamp"):
-            continue
-        if is_backup_job_pod(pod, pvc_name):
-            continue
-        workload = workload_for_pod(pod)
-        workloads[(workload["api"], workload["namespace"], workload["name"])] = workload
-    selected = list(workloads.values())
-    workload_names = [f"{workload['namespace']}/{workload['api']}/{workload['name']}" for workload in selected]
-    print(
-        f"Found {len(selected)} workload(s) using {namespace}/{pvc_name}: {', '.join(workload_names) or 'none'}",
-        flush=True,
-    )
-    return selected
-
-
-def delete_stale_backup_jobs(namespace: str, pvc_name: str, current_job_name: str) -> None:
-    """Delete previous backup Jobs for this PVC before starting another one."""
-    jobs = kubectl_json("-n", namespace, "get", "jobs", "-o", "json")["items"]
-    prefix = f"{backup_job_prefix(pvc_name)}-"
-    for job in jobs:
-        job_name = job["metadata"]["name"]
-        if job_name == current_job_name or not str(job_name).startswith(prefix):
-            continue
-        print(f"Deleting stale backup job {namespace}/{job_name}", flush=True)
-        kubectl("-n", namespace, "delete", "job", job_name, "--ignore-not-found=true", check=False)
-
-
-def get_replicas(workload: Workload) -> int:
-    """Return the number of replicas for the given workload (StatefulSet, ReplicaSet, Deployment)."""
-    obj = kubectl_json("-n", workload["namespace"], "get", workload["api"], workload["name"], "-o", "json")  # fmt: skip
-    return int(obj.get("spec", {}).get("replicas", 1))
-
-
 def scale(workload: Workload, replicas: int) -> None:
     """Scale the given workload (StatefulSet, ReplicaSet, Deployment) to the specified number of replicas."""
     kubectl("-n", workload["namespace"], "scale", workload["api"], workload["name"], f"--replicas={replicas}")
 
 
-def wait_for_no_pods_using_pvc(namespace: str, pvc_name: str, timeout: int = 600) -> None:
-    """Wait for all pods using the given PVC to terminate, or raise a TimeoutError after the specified timeout."""
-    deadline = time.time() + timeout
-    last_active: list[str] | None = None
-    while time.time() < deadline:
-        pods = pods_using_pvc(namespace, pvc_name)
-        active = [
-            pod
-            for pod in pods
-            if not pod.get("metadata", {}).get("deletionTimestamp") and not is_backup_job_pod(pod, pvc_name)
-        ]
-        if not active:
-            return
-        active_names = [pod["metadata"]["name"] for pod in active]
-        if active_names != last_active:
-            print(
-                f"Waiting for {len(active)} pod(s) using {namespace}/{pvc_name} to terminate: {', '.join(active_names)}",
-                flush=True,
-            )
-            last_active = active_names
-        time.sleep(POLL_SECONDS)
-    raise TimeoutError(f"timed out waiting for pods using {namespace}/{pvc_name} to terminate")
-
-
-def wait_for_job(namespace: str, name: str) -> None:
-    """Wait for the given Kubernetes Job to complete successfully, or raise an error if it fails or times out."""
-    deadline = time.time() + JOB_TIMEOUT_SECONDS
-    last_log = 0.0
-    print(f"Waiting for backup job {namespace}/{name}", flush=True)
-    while time.time() < deadline:
-        job = kubectl_json("-n", namespace, "get", "job", name, "-o", "json")
-        status = job.get("status", {})
-        if status.get("succeeded", 0) >= 1:
-            print(f"Backup job {namespace}/{name} completed", flush=True)
-            return
-        if status.get("failed", 0) >= 1:
-            raise RuntimeError(f"backup job {namespace}/{name} failed")
-        if time.time() - last_log >= 60:
-            print(f"Backup job {namespace}/{name} is still running", flush=True)
-            last_log = time.time()
-        time.sleep(POLL_SECONDS)
-    raise TimeoutError(f"backup job {namespace}/{name} timed out")
-
-
 def job_logs(namespace: str, name: str) -> None:
     """Print logs from all pods owned by a Job without failing the controller."""
     print(f"Begin logs for job {namespace}/{name}", flush=True)
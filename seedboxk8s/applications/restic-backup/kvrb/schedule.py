@@ -0,0 +1,266 @@
+"""Decide which PVC backups run together, and in what order.
+
+PVC backups used to be scheduled one at a time, with a lock for each workload so that two PVCs of the same workload
+were never backed up at once.
+So a StatefulSet with two opted-in PVCs was scaled down and up twice,
+and a backup waiting on a workload lock held a slot that another backup could have used.
+
+Instead, PVCs whose workloads overlap are grouped, and each group is backed up in one scale-down window:
+every workload in the group is scaled down once, the group's PVCs are backed up by concurrent Jobs,
+and the workloads are scaled back up once all of those Jobs are finished.
+
+Each backup Job takes a slot from each of the limits that apply to it:
+BACKUP_PARALLELISM for every Job, BACKUP_NODE_PARALLELISM for the node its volume is on (if it's a local volume),
+and BACKUP_STORAGE_CLASS_PARALLELISM for the storage class of its volume.
+A group reserves the slots its Jobs need before it scales anything down, and shares them between its Jobs,
+so its workloads are never down while waiting on another group.
+
+Groups are independent of each other, so they can run in any order.
+To finish the whole run as early as possible, the largest groups start first (longest processing time first),
+using the size of each PVC as an estimate of how long its backup takes.
+Whenever slots are freed, the largest waiting group whose reservation fits starts next.
+The size of a group is how much each of its Jobs at once backs up:
+its largest PVC, or its total size divided by how many Jobs it runs at once.
+"""
+
+import re
+import threading
+from collections import Counter
+from dataclasses import dataclass, field
+
+from kvrb.kube import JsonMap, Workload
+from kvrb.snapshot import WorkloadKey, object_key, workload_key
+
+QUANTITY_SUFFIXES = {
+    "Ki": 2**10,
+    "Mi": 2**20,
+    "Gi": 2**30,
+    "Ti": 2**40,
+    "Pi": 2**50,
+    "Ei": 2**60,
+    "k": 10**3,
+    "M": 10**6,
+    "G": 10**9,
+    "T": 10**12,
+    "P": 10**15,
+    "E": 10**18,
+}
+
+ALL_JOBS = "all"
+"""The resource every backup Job uses a slot of, limited by BACKUP_PARALLELISM"""
+
+Demand = Counter[str]
+"""How many slots of each resource something needs, like {"all": 2, "node/kube1": 1}"""
+
+
+@dataclass(frozen=True)
+class BackupPlan:
+    pvc: JsonMap
+    workloads: list[Workload]
+    node: str | None = None
+    storage_class: str | None = None
+
+    @property
+    def resources(self) -> list[str]:
+        """The resources the backup Job of this PVC takes a slot of."""
+        resources = [ALL_JOBS]
+        if self.node:
+            resources.append(f"node/{self.node}")
+        if self.storage_class:
+            resources.append(f"storageclass/{self.storage_class}")
+        return resources
+
+
+def parse_limits(setting: str, value: str) -> tuple[int | None, dict[str, int]]:
+    """Parse a per-node or per-storage-class limit setting.
+
+    The value is a comma-separated list of NAME=LIMIT for specific nodes or storage classes,
+    and optionally a bare LIMIT for the rest, like "2" or "1,bigdisk=2" or "local-path=1".
+    Return the default limit (None if unlimited) and the specific limits.
+    """
+    default: int | None = None
+    limits: dict[str, int] = {}
+    for entry in value.split(","):
+        name, _, limit = entry.strip().rpartition("=")
+        if not limit:
+            continue
+        try:
+            parsed = int(limit)
+        except ValueError as exc:
+            raise ValueError(f"{setting} must be like 2 or 1,name=2, got {value!r}") from exc
+        if parsed < 1:
+            raise ValueError(f"{setting} limits must be at least 1, got {value!r}")
+        if name:
+            limits[name.strip()] = parsed
+        else:
+            default = parsed
+    return default, limits
+
+
+class SlotLimits:
+    """The number of backup Jobs that can run at once overall, on each node, and for each storage class."""
+
+    def __init__(self, parallelism: int, node_parallelism: str = "", storage_class_parallelism: str = "") -> None:
+        self.parallelism = max(1, parallelism)
+        self.nodes = parse_limits("BACKUP_NODE_PARALLELISM", node_parallelism)
+        self.storage_classes = parse_limits("BACKUP_STORAGE_CLASS_PARALLELISM", storage_class_parallelism)
+
+    def limit(self, resource: str) -> int | None:
+        """Return the limit of a resource, or None if it is unlimited."""
+        if resource == ALL_JOBS:
+            return self.parallelism
+        kind, _, name = resource.partition("/")
+        default, limits = self.nodes if kind == "node" else self.storage_classes
+        return limits.get(name, default)
+
+    def describe(self) -> str:
+        limits = [f"{self.parallelism} overall"]
+        for kind, (default, specific) in [("node", self.nodes), ("storage class", self.storage_classes)]:
+            if default is not None:
+                limits.append(f"{default} per {kind}")
+            limits.extend(f"{limit} on {kind} {name}" for name, limit in specific.items())
+        return ", ".join(limits)
+
+
+class Slots:
+    """Slots in use of each resource, and the limits they can't go over."""
+
+    def __init__(self, limits: dict[str, int] | SlotLimits) -> None:
+        self.limits = limits
+        self.used: Demand = Counter()
+        self._condition = threading.Condition()
+
+    def limit(self, resource: str) -> int | None:
+        if isinstance(self.limits, SlotLimits):
+            return self.limits.limit(resource)
+        return self.limits.get(resource)
+
+    def fits(self, demand: Demand) -> bool:
+        for resource, count in demand.items():
+            limit = self.limit(resource)
+            if limit is not None and self.used[resource] + count > limit:
+                return False
+        return True
+
+    def take(self, demand: Demand) -> None:
+        self.used.update(demand)
+
+    def give(self, demand: Demand) -> None:
+        self.used.subtract(demand)
+
+    def acquire(self, demand: Demand) -> None:
+        """Wait until the demand fits, then take it."""
+        with self._condition:
+            self._condition.wait_for(lambda: self.fits(demand))
+            self.take(demand)
+
+    def release(self, demand: Demand) -> None:
+        with self._condition:
+            self.give(demand)
+            self._condition.notify_all()
+
+
+@dataclass
+class BackupGroup:
+    """PVCs backed up in the same scale-down window of the workloads that use them."""
+
+    plans: list[BackupPlan] = field(default_factory=list)
+
+    @property
+    def workloads(self) -> list[Workload]:
+        """Every workload using any PVC in the group, in order."""
+        workloads: dict[WorkloadKey, Workload] = {}
+        for plan in self.plans:
+            for workload in plan.workloads:
+                workloads.setdefault(workload_key(workload), workload)
+        return list(workloads.values())
+
+    @property
+    def names(self) -> list[str]:
+        return ["/".join(object_key(plan.pvc)) for plan in self.plans]
+
+    def demand(self, limits: SlotLimits) -> Demand:
+        """Return the slots the group reserves.
+
+        That's as many of each node and storage class as its Jobs use, up to the limit,
+        and as many Jobs overall as can run at once within those limits.
+        """
+        needed: Demand = Counter(resource for plan in self.plans for resource in plan.resources)
+        demand: Demand = Counter()
+        for resource, count in needed.items():
+            limit = limits.limit(resource)
+            demand[resource] = count if limit is None else min(count, limit)
+        concurrent: Demand = Counter()
+        for plan in self.plans:
+            if all(concurrent[resource] < demand[resource] for resource in plan.resources):
+                concurrent.update(plan.resources)
+        demand[ALL_JOBS] = concurrent[ALL_JOBS]
+        return demand
+
+    def size(self, limits: SlotLimits) -> int:
+        """Estimate how long the group takes by how much each of its Jobs at once backs up."""
+        sizes = [pvc_size(plan.pvc) for plan in self.plans]
+        return max(max(sizes, default=0), sum(sizes) // self.demand(limits)[ALL_JOBS])
+
+
+def parse_quantity(quantity: str) -> int:
+    """Return a Kubernetes resource quantity like 10Gi or 500M as a number."""
+    match = re.fullmatch(r"([0-9.]+)(?:([KMGTPE]i|[kMGTPE])|[eE]([0-9]+))?", quantity.strip())
+    if not match:
+        raise ValueError(f"invalid quantity {quantity!r}")
+    number, suffix, exponent = match.groups()
+    if suffix:
+        return int(float(number) * QUANTITY_SUFFIXES[suffix])
+    return int(float(number) * 10 ** int(exponent or 0))
+
+
+def pvc_size(pvc: JsonMap) -> int:
+    """Return the size of a PVC in bytes, or 0 if it is unknown.
+
+    This is the capacity of the bound volume if known, which can be larger than what the PVC requested.
+    """
+    for storage in [
+        pvc.get("status", {}).get("capacity", {}).get("storage"),
+        pvc.get("spec", {}).get("resources", {}).get("requests", {}).get("storage"),
+    ]:
+        if storage:
+            try:
+                return parse_quantity(str(storage))
+            except ValueError:
+                pass
+    return 0
+
+
+def group_plans(plans: list[BackupPlan], limits: SlotLimits) -> list[BackupGroup]:
+    """Group backup plans whose PVCs share a workload, directly or through other PVCs in the group.
+
+    Returns groups with the largest first, and the largest PVC first within each group.
+    """
+    parents = list(range(len(plans)))
+
+    def find(index: int) -> int:
+        while parents[index] != index:
+            parents[index] = parents[parents[index]]
+            index = parents[index]
+        return index
+
+    first_user: dict[WorkloadKey, int] = {}
+    for index, plan in enumerate(plans):
+        for workload in plan.workloads:
+            other = first_user.setdefault(workload_key(workload), index)
+            parents[find(index)] = find(other)
+
+    groups: dict[int, BackupGroup] = {}
+    for index, plan in enumerate(plans):
+        groups.setdefault(find(index), BackupGroup()).plans.append(plan)
+    for group in groups.values():
+        group.plans.sort(key=lambda plan: pvc_size(plan.pvc), reverse=True)
+    return sorted(groups.values(), key=lambda group: group.size(limits), reverse=True)
+
+
+def next_group(waiting: list[BackupGroup], slots: Slots, limits: SlotLimits) -> BackupGroup | None:
+    """Return the first (and so the largest) waiting group whose reservation fits in the free slots, if any."""
+    for group in waiting:
+        if slots.fits(group.demand(limits)):
+            return group
+    return None
@@ -0,0 +1,209 @@
+"""A snapshot of the cluster objects that backup planning looks at.
+
+Planning used to run kubectl for every lookup:
+listing every pod in a namespace for each PVC, getting the ReplicaSet of each pod, getting each workload's replicas,
+and listing the Jobs in a namespace for each PVC.
+With dozens of opted-in PVCs that was hundreds of kubectl processes before the first backup started.
+
+Instead, ClusterSnapshot lists everything it needs in a single kubectl call
+and answers planning questions from indexes built in memory.
+
+Things that can change while a run is waiting its turn still ask the cluster:
+a workload's replica count is read just before kvrb scales it down,
+since someone (or an autoscaler) may have scaled it since the snapshot was taken,
+and pods come and go as workloads are scaled, so waiting for pods to terminate asks the cluster too.
+"""
+
+import time
+from threading import Lock
+
+from kvrb.config import ANNOTATION
+from kvrb.kube import (
+    JsonMap,
+    Workload,
+    backup_job_prefix,
+    is_backup_job_pod,
+    kubectl,
+    kubectl_json,
+    owner_ref,
+    volume_node,
+)
+
+SNAPSHOT_KINDS = ",".join(
+    [
+        "persistentvolumeclaims",
+        "persistentvolumes",
+        "pods",
+        "replicasets.apps",
+        "deployments.apps",
+        "statefulsets.apps",
+        "jobs.batch",
+    ]
+)
+
+ObjectKey = tuple[str, str]
+"""The namespace and name of an object"""
+
+WorkloadKey = tuple[str, str, str]
+"""The API, namespace, and name of a workload"""
+
+WORKLOAD_KINDS = {"Deployment": "deployment", "ReplicaSet": "replicaset", "StatefulSet": "statefulset"}
+"""Scalable object kinds, mapped to the API name that kubectl uses for them"""
+
+
+def object_key(obj: JsonMap) -> ObjectKey:
+    return (obj["metadata"]["namespace"], obj["metadata"]["name"])
+
+
+def workload_key(workload: Workload) -> WorkloadKey:
+    return (workload["api"], workload["namespace"], workload["name"])
+
+
+class ClusterSnapshot:
+    """PVCs, PVs, pods, workloads, and Jobs in every namespace, listed once and indexed."""
+
+    def __init__(self, objects: list[JsonMap]) -> None:
+        self.pvcs: list[JsonMap] = []
+        self.volumes: dict[str, JsonMap] = {}
+        self.pods_by_namespace: dict[str, list[JsonMap]] = {}
+        self.pods_by_pvc: dict[ObjectKey, list[JsonMap]] = {}
+        self.replicasets: dict[ObjectKey, JsonMap] = {}
+        self.workloads: dict[WorkloadKey, JsonMap] = {}
+        self.jobs_by_namespace: dict[str, list[JsonMap]] = {}
+        self._lock = Lock()
+
+        for obj in objects:
+            kind = obj.get("kind")
+            if kind == "PersistentVolume":
+                # The only kind here that isn't namespaced
+                self.volumes[obj["metadata"]["name"]] = obj
+                continue
+            namespace = obj["metadata"]["namespace"]
+            if kind == "PersistentVolumeClaim":
+                self.pvcs.append(obj)
+            elif kind == "Pod":
+                self.pods_by_namespace.setdefault(namespace, []).append(obj)
+                for volume in obj.get("spec", {}).get("volumes", []):
+                    claim = volume.get("persistentVolumeClaim", {}).get("claimName")
+                    if claim:
+                        self.pods_by_pvc.setdefault((namespace, claim), []).append(obj)
+            elif kind == "Job":
+                self.jobs_by_namespace.setdefault(namespace, []).append(obj)
+            elif kind in WORKLOAD_KINDS:
+                self.workloads[(WORKLOAD_KINDS[kind], namespace, obj["metadata"]["name"])] = obj
+                if kind == "ReplicaSet":
+                    self.replicasets[object_key(obj)] = obj
+
+    @classmethod
+    def take(cls) -> "ClusterSnapshot":
+        """List every object kvrb plans with, in all namespaces, in one kubectl call."""
+        started = time.time()
+        objects = kubectl_json("get", SNAPSHOT_KINDS, "--all-namespaces", "-o", "json")["items"]
+        snapshot = cls(objects)
+        pods = sum(len(pods) for pods in snapshot.pods_by_namespace.values())
+        jobs = sum(len(jobs) for jobs in snapshot.jobs_by_namespace.values())
+        print(
+            f"Took cluster snapshot of {len(objects)} objects in {time.time() - started:.1f}s: "
+            f"{len(snapshot.pvcs)} PVC(s), {len(snapshot.volumes)} PV(s), {pods} pod(s), "
+            f"{len(snapshot.workloads)} workload(s), {jobs} job(s)",
+            flush=True,
+        )
+        return snapshot
+
+    def eligible_pvcs(self) -> list[JsonMap]:
+        """Return PVCs that explicitly opt in to backups."""
+        selected: list[JsonMap] = []
+        for pvc in self.pvcs:
+            annotations = pvc.get("metadata", {}).get("annotations", {})
+            if annotations.get(ANNOTATION, "").lower() != "true":
+                continue
+            if pvc.get("status", {}).get("phase") != "Bound":
+                namespace, name = object_key(pvc)
+                print(f"Skipping {namespace}/{name}: PVC is not Bound", flush=True)
+                continue
+            selected.append(pvc)
+        selected_names = [f"{pvc['metadata']['namespace']}/{pvc['metadata']['name']}" for pvc in selected]
+        print(f"Found {len(selected)} opted-in PVC(s): {', '.join(selected_names) or 'none'}", flush=True)
+        return selected
+
+    def volume_for_pvc(self, pvc: JsonMap) -> JsonMap | None:
+        """Return the PersistentVolume the PVC is bound to, or None if it wasn't in the snapshot."""
+        return self.volumes.get(pvc.get("spec", {}).get("volumeName", ""))
+
+    def node_for_pvc(self, pvc: JsonMap) -> str | None:
+        """Return the node that the PVC's volume is on, or None if it isn't tied to a single node."""
+        volume = self.volume_for_pvc(pvc)
+        return volume_node(volume) if volume else None
+
+    def storage_class_for_pvc(self, pvc: JsonMap) -> str | None:
+        """Return the storage class of the PVC's volume, or of the PVC itself if the volume is unknown."""
+        volume = self.volume_for_pvc(pvc) or pvc
+        return volume.get("spec", {}).get("storageClassName") or None
+
+    def pods_using_pvc(self, namespace: str, pvc_name: str) -> list[JsonMap]:
+        """Return pods in the given namespace that used the specified PVC when the snapshot was taken."""
+        return list(self.pods_by_pvc.get((namespace, pvc_name), []))
+
+    def workload_for_pod(self, pod: JsonMap) -> Workload:
+        """Return the owning workload (StatefulSet, ReplicaSet, Deployment) for the given pod."""
+        namespace = pod["metadata"]["namespace"]
+        statefulset = owner_ref(pod, "StatefulSet")
+        if statefulset:
+            return {"api": "statefulset", "namespace": namespace, "name": statefulset["name"]}
+
+        replicaset = owner_ref(pod, "ReplicaSet")
+        if replicaset:
+            rs = self.replicasets.get((namespace, replicaset["name"]))
+            if rs is None:
+                # Created since the snapshot was taken
+                rs = kubectl_json("-n", namespace, "get", "replicaset", replicaset["name"], "-o", "json")
+                with self._lock:
+                    self.replicasets[(namespace, replicaset["name"])] = rs
+                    self.workloads[("replicaset", namespace, replicaset["name"])] = rs
+            deployment = owner_ref(rs, "Deployment")
+            if deployment:
+                return {"api": "deployment", "namespace": namespace, "name": deployment["name"]}
+            return {"api": "replicaset", "namespace": namespace, "name": replicaset["name"]}
+
+        raise RuntimeError(f"pod {namespace}/{pod['metadata']['name']} has no supported scalable owner")
+
+    def workloads_for_pvc(self, namespace: str, pvc_name: str) -> list[Workload]:
+        """Return the unique workloads that use the given PVC."""
+        workloads: dict[WorkloadKey, Workload] = {}
+        for pod in self.pods_using_pvc(namespace, pvc_name):
+            if pod.get("metadata", {}).get("deletionTimestamp"):
+                continue
+            if is_backup_job_pod(pod, pvc_name):
+                continue
+            workload = self.workload_for_pod(pod)
+            workloads[workload_key(workload)] = workload
+        selected = list(workloads.values())
+        workload_names = [f"{workload['namespace']}/{workload['api']}/{workload['name']}" for workload in selected]
+        print(
+            f"Found {len(selected)} workload(s) using {namespace}/{pvc_name}: {', '.join(workload_names) or 'none'}",
+            flush=True,
+        )
+        return selected
+
+    def current_replicas(self, workload: Workload) -> int:
+        """Return the number of replicas the given workload has now, which may have changed since the snapshot."""
+        namespace, name = workload["namespace"], workload["name"]
+        obj = kubectl_json("-n", namespace, "get", workload["api"], name, "-o", "json")
+        with self._lock:
+            self.workloads[workload_key(workload)] = obj
+        return int(obj.get("spec", {}).get("replicas", 1))
+
+    def delete_stale_backup_jobs(self, namespace: str, pvc_name: str, current_job_name: str) -> None:
+        """Delete previous backup Jobs for this PVC before starting another one."""
+        prefix = f"{backup_job_prefix(pvc_name)}-"
+        with self._lock:
+            jobs = self.jobs_by_namespace.get(namespace, [])
+            stale = [
+                job["metadata"]["name"]
+                for job in jobs
+                if job["metadata"]["name"] != current_job_name and str(job["metadata"]["name"]).startswith(prefix)
+            ]
+            self.jobs_by_namespace[namespace] = [job for job in jobs if job["metadata"]["name"] not in stale]
+        for job_name in stale:
+            print(f"Deleting stale backup job {namespace}/{job_name}", flush=True)
+            kubectl("-n", namespace, "delete", "job", job_name, "--ignore-not-found=true", check=False)
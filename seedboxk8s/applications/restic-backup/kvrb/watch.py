@@ -0,0 +1,238 @@
+"""Wait for cluster state changes with watches instead of polling.
+
+Waiting for pods to terminate and for backup Jobs to finish used to run kubectl every few seconds,
+so each backup paid up to that much extra latency at every phase,
+and with several backups running at once the polling multiplied.
+
+Instead, there is one long-lived `kubectl get --watch` per resource type (pods and Jobs) in all namespaces,
+shared by every backup thread.
+Each ResourceWatch keeps the current objects of its type up to date from the watch events,
+and wakes up the threads waiting on it whenever something changes,
+so a waiting thread sees the change as soon as the API server reports it.
+
+With the Kubernetes API backend (see kvrb.api), the watches are API requests instead of kubectl processes.
+
+Watches can miss events: when kubectl is restarted, or for objects deleted just as the watch starts.
+So like a Kubernetes informer, a watch also lists its resource from scratch when it starts,
+whenever kubectl is restarted, and when a waiting thread hears nothing for WATCH_RESYNC_SECONDS.
+"""
+
+import codecs
+import json
+import os
+import subprocess
+import threading
+import time
+from typing import Callable
+
+from kvrb import api
+from kvrb.config import JOB_TIMEOUT_SECONDS, WATCH_RESYNC_SECONDS
+from kvrb.kube import JsonMap, is_backup_job_pod, kubectl_json, pod_uses_pvc
+
+ObjectKey = tuple[str, str]
+
+READ_SIZE = 64 * 1024
+
+
+class ResourceWatch:
+    """The current objects of one resource type in all namespaces, kept up to date by a kubectl watch."""
+
+    def __init__(self, resource: str) -> None:
+        self.resource = resource
+        self.objects: dict[ObjectKey, JsonMap] = {}
+        self._condition = threading.Condition()
+        self._process: subprocess.Popen[bytes] | api.WatchStream | None = None
+        self._stopped = False
+        self._listed = 0.0
+        self._resource_version = ""
+        self._thread = threading.Thread(target=self._run, name=f"watch-{resource}", daemon=True)
+
+    def start(self) -> None:
+        self.relist()
+        self._thread.start()
+
+    def stop(self) -> None:
+        with self._condition:
+            self._stopped = True
+            process = self._process
+        if isinstance(process, api.WatchStream):
+            process.close()
+        elif process:
+            process.terminate()
+        self._thread.join(timeout=10)
+
+    def relist(self) -> None:
+        """Replace every object with a fresh list from the API server."""
+        result = kubectl_json("get", self.resource, "--all-namespaces", "-o", "json")
+        with self._condition:
+            self.objects = {(obj["metadata"]["namespace"], obj["metadata"]["name"]): obj for obj in result["items"]}
+            self._listed = time.time()
+            self._resource_version = result.get("metadata", {}).get("resourceVersion", "")
+            self._condition.notify_all()
+
+    def _handle(self, event: JsonMap) -> None:
+        obj = event.get("object", {})
+        metadata = obj.get("metadata", {})
+        if "name" not in metadata:
+            return
+        key = (metadata.get("namespace", ""), metadata["name"])
+        with self._condition:
+            if event.get("type") == "DELETED":
+                self.objects.pop(key, None)
+            elif event.get("type") in ("ADDED", "MODIFIED"):
+                self.objects[key] = obj
+            self._condition.notify_all()
+
+    def _stream(self) -> None:
+        """Run one watch, handling its events until it ends."""
+        client = api.client()
+        if client is not None:
+            # Watching from the version of the last list means no event between the list and the watch is missed
+            stream = client.watch(api.RESOURCES[self.resource].path(), self._resource_version)
+            with self._condition:
+                self._process = stream
+                if self._stopped:
+                    stream.close()
+            for event in stream:
+                self._handle(event)
+            return
+
+        command = ["kubectl", "get", self.resource, "--all-namespaces", "--watch", "--output-watch-events"]
+        command += ["-o", "json"]
+        process = subprocess.Popen(command, stdout=subprocess.PIPE)
+        with self._condition:
+            self._process = process
+            if self._stopped:
+                process.terminate()
+        assert process.stdout is not None
+        # kubectl writes one indented JSON object per event, not one per line
+        decoder = json.JSONDecoder()
+        utf8 = codecs.getincrementaldecoder("utf-8")()
+        buffer = ""
+        while chunk := os.read(process.stdout.fileno(), READ_SIZE):
+            buffer += utf8.decode(chunk)
+            while True:
+                buffer = buffer.lstrip()
+                try:
+                    event, end = decoder.raw_decode(buffer)
+                except ValueError:
+                    break
+                buffer = buffer[end:]
+                self._handle(event)
+        process.wait()
+
+    def _run(self) -> None:
+        restarts = 0
+        while True:
+            started = time.time()
+            try:
+                self._stream()
+            except Exception as exc:
+                if not self._stopped:
+                    print(f"Watch on {self.resource} failed: {exc}", flush=True)
+            with self._condition:
+                if self._stopped:
+                    return
+            # Back off if kubectl keeps failing right away, but restart a watch that ran for a while immediately
+            restarts = restarts + 1 if time.time() - started < 10 else 0
+            time.sleep(min(2**restarts, 30) if restarts else 0)
+            print(f"Restarting watch on {self.resource}", flush=True)
+            try:
+                self.relist()
+            except Exception as exc:
+                print(f"Could not list {self.resource}: {exc}", flush=True)
+
+    def wait_until(self, ready: Callable[[dict[ObjectKey, JsonMap]], bool], timeout: float) -> bool:
+        """Wait until ready(objects) returns True, and return False if it doesn't within timeout seconds.
+
+        ready is called with the lock held, whenever anything changes.
+        If nothing changes for WATCH_RESYNC_SECONDS, the objects are listed again in case an event was missed
+        (unless another waiting thread just did).
+        """
+        deadline = time.time() + timeout
+        with self._condition:
+            while not ready(self.objects):
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                if not self._condition.wait(timeout=min(remaining, WATCH_RESYNC_SECONDS)):
+                    if time.time() < deadline and time.time() - self._listed >= WATCH_RESYNC_SECONDS:
+                        self._condition.release()
+                        try:
+                            self.relist()
+                        finally:
+                            self._condition.acquire()
+        return True
+
+
+_watches: dict[str, ResourceWatch] = {}
+_watches_lock = threading.Lock()
+
+
+def watch(resource: str) -> ResourceWatch:
+    """Return the shared watch for a resource type, starting it if necessary."""
+    with _watches_lock:
+        if resource not in _watches:
+            resource_watch = ResourceWatch(resource)
+            resource_watch.start()
+            _watches[resource] = resource_watch
+        return _watches[resource]
+
+
+def stop_watches() -> None:
+    with _watches_lock:
+        for resource_watch in _watches.values():
+            resource_watch.stop()
+        _watches.clear()
+
+
+def wait_for_no_pods_using_pvc(namespace: str, pvc_name: str, timeout: int = 600) -> None:
+    """Wait for all pods using the given PVC to terminate, or raise a TimeoutError after the specified timeout."""
+    last_active: list[str] | None = None
+
+    def no_active_pods(pods: dict[ObjectKey, JsonMap]) -> bool:
+        nonlocal last_active
+        active_names = sorted(
+            pod["metadata"]["name"]
+            for (pod_namespace, _), pod in pods.items()
+            if pod_namespace == namespace
+            and pod_uses_pvc(pod, pvc_name)
+            and not pod.get("metadata", {}).get("deletionTimestamp")
+            and not is_backup_job_pod(pod, pvc_name)
+        )
+        if active_names and active_names != last_active:
+            print(
+                f"Waiting for {len(active_names)} pod(s) using {namespace}/{pvc_name} to terminate: "
+                + ", ".join(active_names),
+                flush=True,
+            )
+        last_active = active_names
+        return not active_names
+
+    if not watch("pods").wait_until(no_active_pods, timeout):
+        raise TimeoutError(f"timed out waiting for pods using {namespace}/{pvc_name} to terminate")
+
+
+def wait_for_job(namespace: str, name: str) -> None:
+    """Wait for the given Kubernetes Job to complete successfully, or raise an error if it fails or times out."""
+    print(f"Waiting for backup job {namespace}/{name}", flush=True)
+    last_log = time.time()
+    # Copied while the lock is held, since the watch thread replaces the object after we return
+    status: JsonMap = {}
+
+    def finished(jobs: dict[ObjectKey, JsonMap]) -> bool:
+        nonlocal last_log, status
+        status = dict(jobs.get((namespace, name), {}).get("status", {}))
+        if status.get("succeeded", 0) >= 1 or status.get("failed", 0) >= 1:
+            return True
+        if time.time() - last_log >= 60:
+            print(f"Backup job {namespace}/{name} is still running", flush=True)
+            last_log = time.time()
+        return False
+
+    jobs = watch("jobs")
+    if not jobs.wait_until(finished, JOB_TIMEOUT_SECONDS):
+        raise TimeoutError(f"backup job {namespace}/{name} timed out")
+    if status.get("failed", 0) >= 1:
+        raise RuntimeError(f"backup job {namespace}/{name} failed")
+    print(f"Backup job {namespace}/{name} completed", flush=True)
@@ -0,0 +1,12 @@
+"""Tests for kvrb.
+
+Run from the restic-backup directory with `python3 -m unittest`.
+kvrb.config reads its required settings from the environment when it is imported,
+so set placeholders for them here, before any test imports kvrb.
+"""
+
+import os
+
+for setting in ["AWS_DEFAULT_REGION", "AWS_ACCESS_KEY_ID", "AWS_SECRET_ACCESS_KEY", "RESTIC_PASSWORD"]:
+    os.environ.setdefault(setting, "test")
+os.environ.setdefault("RESTIC_REPOSITORY_BASE", "s3:https://s3.example.com/test")
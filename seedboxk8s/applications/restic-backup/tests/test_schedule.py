@@ -0,0 +1,167 @@
+"""Tests for kvrb/schedule.py."""
+
+import unittest
+from collections import Counter
+
+from kvrb.kube import JsonMap, Workload
+from kvrb.schedule import (
+    ALL_JOBS,
+    BackupGroup,
+    BackupPlan,
+    SlotLimits,
+    Slots,
+    group_plans,
+    next_group,
+    parse_limits,
+    parse_quantity,
+    pvc_size,
+)
+
+
+def pvc(name: str, size: str = "", capacity: str = "") -> JsonMap:
+    obj: JsonMap = {"metadata": {"namespace": "ns", "name": name}, "spec": {}, "status": {}}
+    if size:
+        obj["spec"]["resources"] = {"requests": {"storage": size}}
+    if capacity:
+        obj["status"]["capacity"] = {"storage": capacity}
+    return obj
+
+
+def workload(name: str) -> Workload:
+    return {"api": "statefulset", "namespace": "ns", "name": name}
+
+
+def plan(name: str, size: str, workloads: list[str], node: str | None = None, storage_class: str | None = None):
+    return BackupPlan(pvc(name, size), [workload(w) for w in workloads], node, storage_class)
+
+
+class TestParseQuantity(unittest.TestCase):
+    """Tests for parse_quantity function."""
+
+    def test_suffixes(self):
+        self.assertEqual(parse_quantity("10Gi"), 10 * 2**30)
+        self.assertEqual(parse_quantity("500M"), 500 * 10**6)
+        self.assertEqual(parse_quantity("1.5Ki"), 1536)
+        self.assertEqual(parse_quantity("2k"), 2000)
+        self.assertEqual(parse_quantity(" 1Ti "), 2**40)
+
+    def test_plain_and_exponent(self):
+        self.assertEqual(parse_quantity("1024"), 1024)
+        self.assertEqual(parse_quantity("1e3"), 1000)
+        self.assertEqual(parse_quantity("5E2"), 500)
+
+    def test_invalid(self):
+        for quantity in ["", "Gi", "10GB", "ten", "-1Gi"]:
+            with self.subTest(quantity=quantity), self.assertRaises(ValueError):
+                parse_quantity(quantity)
+
+    def test_pvc_size(self):
+        self.assertEqual(pvc_size(pvc("a", size="1Gi")), 2**30)
+        # The bound volume's capacity wins over the request
+        self.assertEqual(pvc_size(pvc("a", size="1Gi", capacity="2Gi")), 2 * 2**30)
+        self.assertEqual(pvc_size(pvc("a", size="bogus")), 0)
+        self.assertEqual(pvc_size(pvc("a")), 0)
+
+
+class TestParseLimits(unittest.TestCase):
+    """Tests for parse_limits function and SlotLimits."""
+
+    def test_parse(self):
+        self.assertEqual(parse_limits("X", ""), (None, {}))
+        self.assertEqual(parse_limits("X", "2"), (2, {}))
+        self.assertEqual(parse_limits("X", "1,bigdisk=2"), (1, {"bigdisk": 2}))
+        self.assertEqual(parse_limits("X", " local-path = 1 , "), (None, {"local-path": 1}))
+
+    def test_invalid(self):
+        for value in ["two", "a=b", "0", "a=0", "a=-1"]:
+            with self.subTest(value=value), self.assertRaises(ValueError) as raised:
+                parse_limits("BACKUP_NODE_PARALLELISM", value)
+            self.assertIn("BACKUP_NODE_PARALLELISM", str(raised.exception))
+
+    def test_slot_limits(self):
+        limits = SlotLimits(0, "1,big=3", "nfs=2")
+        # Overall parallelism is at least 1
+        self.assertEqual(limits.limit(ALL_JOBS), 1)
+        self.assertEqual(limits.limit("node/small"), 1)
+        self.assertEqual(limits.limit("node/big"), 3)
+        self.assertEqual(limits.limit("storageclass/nfs"), 2)
+        self.assertIsNone(limits.limit("storageclass/local-path"))
+        self.assertEqual(limits.describe(), "1 overall, 1 per node, 3 on node big, 2 on storage class nfs")
+
+
+class TestGroupPlans(unittest.TestCase):
+    """Tests for group_plans function."""
+
+    def test_grouping(self):
+        plans = [
+            plan("a1", "1Gi", ["db"]),
+            plan("b1", "5Gi", ["web"]),
+            plan("a2", "3Gi", ["db"]),
+            # c1 links x and y, so c2 is in the same group as c1 and c3
+            plan("c1", "2Gi", ["x", "y"]),
+            plan("c2", "1Gi", ["y"]),
+            plan("c3", "2Gi", ["x"]),
+            plan("d1", "500Mi", []),
+            plan("e1", "500Mi", []),
+        ]
+        groups = group_plans(plans, SlotLimits(1))
+        self.assertEqual(
+            [group.names for group in groups],
+            [["ns/b1"], ["ns/c1", "ns/c3", "ns/c2"], ["ns/a2", "ns/a1"], ["ns/d1"], ["ns/e1"]],
+        )
+        self.assertEqual([w["name"] for w in groups[1].workloads], ["x", "y"])
+
+    def test_size_with_parallelism(self):
+        plans = [plan("a1", "4Gi", ["db"]), plan("a2", "4Gi", ["db"]), plan("b1", "6Gi", ["web"])]
+        # One Job at a time: db's PVCs are backed up one after the other, 8Gi
+        self.assertEqual([g.names for g in group_plans(plans, SlotLimits(1))], [["ns/a1", "ns/a2"], ["ns/b1"]])
+        # Two Jobs at once: db's PVCs are backed up together, 4Gi each
+        self.assertEqual([g.names for g in group_plans(plans, SlotLimits(2))], [["ns/b1"], ["ns/a1", "ns/a2"]])
+
+
+class TestDemand(unittest.TestCase):
+    """Tests for BackupGroup.demand, and scheduling groups within the limits."""
+
+    def test_capped_by_parallelism(self):
+        group = BackupGroup([plan(f"p{i}", "1Gi", ["db"]) for i in range(5)])
+        self.assertEqual(group.demand(SlotLimits(3)), Counter({ALL_JOBS: 3}))
+        self.assertEqual(group.demand(SlotLimits(10)), Counter({ALL_JOBS: 5}))
+
+    def test_capped_by_node_and_storage_class(self):
+        group = BackupGroup(
+            [
+                plan("p1", "1Gi", ["db"], node="n1", storage_class="local"),
+                plan("p2", "1Gi", ["db"], node="n1", storage_class="local"),
+                plan("p3", "1Gi", ["db"], node="n2", storage_class="local"),
+                plan("p4", "1Gi", ["db"], storage_class="nfs"),
+            ]
+        )
+        demand = group.demand(SlotLimits(4, "1", "local=2"))
+        self.assertEqual(demand["node/n1"], 1)
+        self.assertEqual(demand["node/n2"], 1)
+        self.assertEqual(demand["storageclass/local"], 2)
+        self.assertEqual(demand["storageclass/nfs"], 1)
+        # Only p1, p3, and p4 can run at once; p2 waits for p1's node
+        self.assertEqual(demand[ALL_JOBS], 3)
+
+    def test_next_group(self):
+        limits = SlotLimits(2, "1")
+        big = BackupGroup([plan("a", "9Gi", ["a"], node="n1")])
+        same_node = BackupGroup([plan("b", "5Gi", ["b"], node="n1")])
+        other_node = BackupGroup([plan("c", "1Gi", ["c"], node="n2")])
+        slots = Slots(limits)
+        waiting = [big, same_node, other_node]
+        self.assertIs(next_group(waiting, slots, limits), big)
+        slots.take(big.demand(limits))
+        waiting.remove(big)
+        # The node of the next largest group is busy, so a smaller one goes first
+        self.assertIs(next_group(waiting, slots, limits), other_node)
+        slots.take(other_node.demand(limits))
+        waiting.remove(other_node)
+        self.assertIsNone(next_group(waiting, slots, limits))
+        slots.give(big.demand(limits))
+        self.assertIs(next_group(waiting, slots, limits), same_node)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,98 @@
+"""Benchmark listing the deaddrop bucket against a moto stand-in for S3
+
+Compares the old listing, which made one HEAD request after another,
+with s3_list_remote_files() without a manifest (concurrent HEADs)
+and with a manifest from a previous listing (no HEADs at all).
+
+moto answers in microseconds, so pass --latency-ms to add a delay to every request,
+like the round trip to a real S3 region.
+
+Run from the telekinesis directory, with telekinesis installed with its development extras (which include moto):
+
+    python -m benchmarks.bench_deaddrop_list [--objects 3000] [--latency-ms 20]
+"""
+
+import argparse
+import hashlib
+import tempfile
+import time
+from pathlib import Path
+
+import boto3
+from moto import mock_aws
+
+from telekinesis import deaddrop
+
+
+BUCKET = "bench-deaddrop"
+
+
+def legacy_list(session: boto3.Session, bucket_name: str) -> tuple[dict[str, str], dict[str, str]]:
+    """The listing before the manifest and thread pool, one HEAD at a time"""
+    s3 = session.client("s3")
+    files = {}
+    redirects = {}
+    paginator = s3.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket_name):
+        for obj in page.get("Contents", []):
+            head = s3.head_object(Bucket=bucket_name, Key=obj["Key"])
+            redirect = head.get("WebsiteRedirectLocation", "")
+            if redirect:
+                redirects[obj["Key"]] = redirect
+            else:
+                files[obj["Key"]] = head["Metadata"].get("md5", "")
+    return files, redirects
+
+
+def populate(session: boto3.Session, count: int):
+    s3 = session.client("s3")
+    s3.create_bucket(Bucket=BUCKET, CreateBucketConfiguration={"LocationConstraint": "us-east-2"})
+    for idx in range(count):
+        key = f"apk/v3.18/psyopsOS/x86_64/package-{idx}.apk"
+        body = f"package {idx}".encode()
+        s3.put_object(Bucket=BUCKET, Key=key, Body=body, Metadata={"md5": hashlib.md5(body).hexdigest()})
+        if idx % 100 == 0:
+            s3.put_object(Bucket=BUCKET, Key=f"latest-{idx}.apk", WebsiteRedirectLocation=f"/{key}")
+
+
+def timed(name: str, func):
+    began = time.monotonic()
+    result = func()
+    print(f"{name:<32} {time.monotonic() - began:8.2f}s")
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--objects", type=int, default=3000, help="How many objects to put in the bucket")
+    parser.add_argument("--latency-ms", type=float, default=0, help="Delay to add to every request")
+    parser.add_argument("--workers", type=int, default=deaddrop.DEFAULT_HEAD_WORKERS, help="HEAD requests at once")
+    parsed = parser.parse_args()
+
+    with mock_aws(), tempfile.TemporaryDirectory() as tmpdir:
+        session = boto3.session.Session(
+            aws_access_key_id="bench", aws_secret_access_key="bench", region_name="us-east-2"
+        )
+        print(f"Putting {parsed.objects} objects in the mock bucket...")
+        populate(session, parsed.objects)
+
+        if parsed.latency_ms:
+            # Clients created from the session after this inherit the handler
+            session.events.register("before-call.s3", lambda **kwargs: time.sleep(parsed.latency_ms / 1000))
+
+        manifest = Path(tmpdir) / "deaddrop.manifest.json"
+        expected = timed("serial HEADs (old)", lambda: legacy_list(session, BUCKET))
+        cold = timed(
+            "concurrent HEADs, no manifest",
+            lambda: deaddrop.s3_list_remote_files(session, BUCKET, manifest_path=manifest, max_workers=parsed.workers),
+        )
+        warm = timed(
+            "manifest, no HEADs",
+            lambda: deaddrop.s3_list_remote_files(session, BUCKET, manifest_path=manifest, max_workers=parsed.workers),
+        )
+        if not expected == cold == warm:
+            raise Exception("Listings differ")
+
+
+if __name__ == "__main__":
+    main()
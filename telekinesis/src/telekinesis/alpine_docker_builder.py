@@ -9,22 +9,45 @@ import subprocess
 import sys
 import tempfile
 
+from telekinesis import orchestrator
 from telekinesis.config import tkconfig
 from telekinesis.platforms import Architecture
 
 
+_built_containers: set[str] = set()
+"""Tags of containers that build_container() has already built in this process"""
+
+
 def build_container(
     builder_tag: str,
     builder_dir: str,
     platform: str,
     rebuild: bool = False,
 ):
-    """Generic function to build a Docker container"""
+    """Generic function to build a Docker container
+
+    Each tag is only built once per process, even if it's asked for by several build stages;
+    rebuild applies to that first build.
+    """
+    if builder_tag in _built_containers:
+        return
     cmd = ["docker", "build", "--platform", platform, "--progress=plain"]
     if rebuild:
         cmd += ["--no-cache"]
     cmd += ["--tag", builder_tag, builder_dir]
-    subprocess.run(cmd, check=True)
+    orchestrator.run(cmd, check=True)
+    _built_containers.add(builder_tag)
+
+
+def container_image_id(builder_tag: str) -> str:
+    """Return the ID of a Docker image, which changes whenever the image is rebuilt with different contents"""
+    result = subprocess.run(
+        ["docker", "image", "inspect", "--format", "{{.Id}}", builder_tag],
+        check=True,
+        capture_output=True,
+        text=True,
+    )
+    return result.stdout.strip()
 
 
 class AlpineDockerBuilder:
@@ -32,6 +55,14 @@ class AlpineDockerBuilder:
 
     It saves the psyopsOS build key from 1Password to a temp directory so that you can use it to sign packages.
     It has property `tempdir_apkkey` that you can pass to the Docker container to use the key.
+
+    It can be entered more than once, including nested;
+    setup happens on the first entry and cleanup on the last exit.
+    To do setup only once for a whole build, enter it around the whole build.
+
+    In session mode, a single container is started on the first entry and stopped on the last exit,
+    and each run_docker() call runs in it with `docker exec` rather than starting a new container.
+    Steps that change the container, like installing or removing packages, should pass isolated=True.
     """
 
     def __init__(
@@ -68,6 +99,10 @@ class AlpineDockerBuilder:
         dangerous_no_clean_tmp_dir=False,
         # If true, add '--privileged=true' to the docker run command
         privileged=False,
+        # If true, run every command in one long-lived container with 'docker exec'
+        session=False,
+        # If true, build the Docker image with --no-cache
+        rebuild_container=False,
     ):
         self.architecture = architecture
         self.platform = f"linux/{architecture.docker}"
@@ -87,6 +122,14 @@ class AlpineDockerBuilder:
         self.dangerous_no_clean_tmp_dir = dangerous_no_clean_tmp_dir
         self.docker_builder_dir = docker_builder_dir
         self.privileged = privileged
+        self.session = session
+        self.rebuild_container = rebuild_container
+
+        self._entered = 0
+        """How many times the context manager has been entered without being exited"""
+
+        self.session_container = ""
+        """The name of the running session container, if in session mode"""
 
         self.in_container_workdir = "/home/build/workdir"
         """An in-container path for handling the mkimage working directory.
@@ -111,8 +154,14 @@ class AlpineDockerBuilder:
         """The tag for the Docker image, including the Alpine version suffix"""
 
     def __enter__(self):
+        self._entered += 1
+        if self._entered > 1:
+            return self
+
         os.umask(0o022)
-        build_container(self.docker_builder_tag, self.docker_builder_dir, self.platform)
+        build_container(
+            self.docker_builder_tag, self.docker_builder_dir, self.platform, rebuild=self.rebuild_container
+        )
 
         os.makedirs(self.host_artifacts_dir, exist_ok=True)
 
@@ -129,27 +178,27 @@ class AlpineDockerBuilder:
         # permissions will get fucked up if you try to use a volume on the host.
         docreate_abuild_workdir_volume = False
         if self.clean_abuild_workdir_docker_volume:
-            subprocess.run(["docker", "volume", "rm", self.abuild_workdir_volname])
+            orchestrator.run(["docker", "volume", "rm", self.abuild_workdir_volname])
             docreate_abuild_workdir_volume = True
         else:
-            inspected_abuild_workdir = subprocess.run(
+            inspected_abuild_workdir = orchestrator.run(
                 f"docker volume inspect {self.abuild_workdir_volname}", shell=True
             )
             docreate_abuild_workdir_volume = inspected_abuild_workdir.returncode != 0
         if docreate_abuild_workdir_volume:
-            subprocess.run(f"docker volume create {self.abuild_workdir_volname}", shell=True)
+            orchestrator.run(f"docker volume create {self.abuild_workdir_volname}", shell=True)
 
         # A docuer local volume for the apk cache
         # This means we don't have to redownload the same apks over and over again
         docreate_apk_cache_volume = False
         if self.clean_abuild_workdir_docker_volume:
-            subprocess.run(["docker", "volume", "rm", self.apk_cache_volname])
+            orchestrator.run(["docker", "volume", "rm", self.apk_cache_volname])
             docreate_apk_cache_volume = True
         else:
-            inspected_apk_cache = subprocess.run(f"docker volume inspect {self.apk_cache_volname}", shell=True)
+            inspected_apk_cache = orchestrator.run(f"docker volume inspect {self.apk_cache_volname}", shell=True)
             docreate_apk_cache_volume = inspected_apk_cache.returncode != 0
         if docreate_apk_cache_volume:
-            subprocess.run(f"docker volume create {self.apk_cache_volname}", shell=True)
+            orchestrator.run(f"docker volume create {self.apk_cache_volname}", shell=True)
 
         self.mkimage_clean(self.in_container_workdir)
 
@@ -169,7 +218,7 @@ class AlpineDockerBuilder:
             "-out",
             tempdir_apkpub.as_posix(),
         ]
-        subprocess.run(cmd, check=True)
+        orchestrator.run(cmd, check=True)
 
         self.docker_cmd = [
             "docker",
@@ -256,15 +305,42 @@ class AlpineDockerBuilder:
             # "ls -alF /var/cache/apk",
         ]
 
+        if self.session and not self.interactive:
+            self.start_session()
+
         return self
 
-    def run_docker(self, commands: list[str]):
+    def start_session(self):
+        """Start a long-lived container with the same options as self.docker_cmd
+
+        It just waits until it is removed by self.stop_session().
+        """
+        self.session_container = f"{self.docker_builder_tag}-session-{os.getpid()}"
+        # self.docker_cmd is "docker run --rm ..."; keep its options and image, but detach and name it
+        session_cmd = ["docker", "run", "--detach", "--name", self.session_container, *self.docker_cmd[2:]]
+        session_cmd += ["tail", "-f", "/dev/null"]
+        print(f"Starting session container {self.session_container}")
+        orchestrator.run(session_cmd, check=True, stdout=subprocess.DEVNULL)
+
+    def stop_session(self):
+        """Remove the session container, killing anything still running in it"""
+        if not self.session_container:
+            return
+        print(f"Removing session container {self.session_container}")
+        orchestrator.run(["docker", "rm", "--force", self.session_container], stdout=subprocess.DEVNULL)
+        self.session_container = ""
+
+    def run_docker(self, commands: list[str], isolated: bool = False):
         """Run commands in a shell inside the Docker container
 
         Prepends self.docker_shell_commands to the command list.
+        In session mode, run them in the session container,
+        unless isolated is True, in which case run them in a new container that is removed afterwards.
         """
         in_container_cmds = self.docker_shell_commands + commands
         docker_run_cmd = self.docker_cmd + ["sh", "-c", " && ".join(in_container_cmds)]
+        if self.session_container and not isolated:
+            docker_run_cmd = ["docker", "exec", self.session_container, "sh", "-c", " && ".join(in_container_cmds)]
         if self.interactive:
             print(f"In interactive mode. Running docker with:")
             print(" \\\n  ".join(self.docker_cmd))
@@ -275,13 +351,20 @@ class AlpineDockerBuilder:
         else:
             print("Running Docker with:")
             print(" \\\n  ".join(docker_run_cmd))
-            subprocess.run(docker_run_cmd, check=True)
+            orchestrator.run(docker_run_cmd, check=True)
 
     def run_docker_raw(self, commands: list[str]):
         """Run commands inside the Docker container directly (without a shell)"""
-        subprocess.run(self.docker_cmd + commands)
+        if self.session_container:
+            orchestrator.run(["docker", "exec", self.session_container, *commands])
+        else:
+            orchestrator.run(self.docker_cmd + commands)
 
     def __exit__(self, exc_type, exc_value, traceback):
+        self._entered -= 1
+        if self._entered > 0:
+            return
+        self.stop_session()
         if not self.dangerous_no_clean_tmp_dir:
             if self.tempdir.exists():
                 shutil.rmtree(self.tempdir)
@@ -325,6 +408,8 @@ def get_configured_docker_builder(
     cleandockervol: bool = False,
     dangerous_no_clean_tmp_dir: bool = False,
     extra_volumes: None | list[str] = None,
+    session: bool = False,
+    rebuild: bool = False,
 ):
     """Make an AlpineDockerBuilder from the configuration"""
     return AlpineDockerBuilder(
@@ -343,4 +428,6 @@ def get_configured_docker_builder(
         dangerous_no_clean_tmp_dir=dangerous_no_clean_tmp_dir,
         privileged=True,
         extra_volumes=extra_volumes,
+        session=session,
+        rebuild_container=rebuild,
     )
@@ -0,0 +1,205 @@
+"""A content-addressed store for large build artifacts
+
+Every build copied its ostar and ESP tarballs from artifacts/ARCH/ into the local deaddrop under a new versioned name,
+so a few dozen builds meant a few dozen copies of a 630MB tarball, even when most of them were identical.
+
+Instead, artifacts are added to a store of blobs named by their SHA-256,
+and the versioned files in the deaddrop are hard links to (or reflinks of) the blobs,
+so a file only takes up space once no matter how many versions use it,
+and making a new version doesn't copy anything if the contents haven't changed.
+Blobs are made read-only, so nothing can change a version in the deaddrop by writing to it in place.
+
+The store looks like:
+
+    blobs/
+        sha256/ab/abcdef...     The blobs
+        index.json              {"refs": {PATH: DIGEST}, "sources": {PATH: [SIZE, MTIME_NS, INODE, DIGEST]}}
+
+refs records which files were made from which blob, so that gc() can tell which blobs are still used.
+sources remembers the digest of files added to the store, so adding an unchanged file again doesn't hash it.
+"""
+
+import ctypes
+import fcntl
+import hashlib
+import json
+import os
+import re
+import shutil
+import sys
+import threading
+from pathlib import Path
+from typing import Iterable
+
+from telekinesis import tklogger
+
+
+HASH_CHUNK_SIZE = 4 * 1024 * 1024
+
+FICLONE = 0x40049409
+"""The Linux ioctl that makes a reflink (a copy-on-write copy) of a file, on filesystems that support it"""
+
+DIGEST_NAME = re.compile(r"^[0-9a-f]{64}$")
+"""The name of a finished blob; anything else under sha256/, like a temporary file being added, is left alone"""
+
+_index_lock = threading.Lock()
+"""Held while reading and writing any store's index, since build pipelines add to the store from several threads"""
+
+
+def sha256_file(path: Path) -> str:
+    digest = hashlib.sha256()
+    with path.open("rb") as f:
+        while chunk := f.read(HASH_CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def reflink(src: Path, dst: Path) -> bool:
+    """Make dst a copy-on-write copy of src, returning False if the filesystem doesn't support it"""
+    try:
+        if sys.platform == "darwin":
+            libc = ctypes.CDLL(None, use_errno=True)
+            return libc.clonefile(os.fsencode(src), os.fsencode(dst), 0) == 0
+        elif sys.platform.startswith("linux"):
+            with src.open("rb") as s, dst.open("wb") as d:
+                fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+            return True
+    except (OSError, AttributeError):
+        pass
+    dst.unlink(missing_ok=True)
+    return False
+
+
+class BlobStore:
+    """A directory of files named by their SHA-256 digest
+
+    Arguments:
+    root:   The store directory, which must be on the same filesystem as the files made from it to hard link them
+    """
+
+    def __init__(self, root: Path):
+        self.root = root
+        self.index_path = root / "index.json"
+
+    def blob_path(self, digest: str) -> Path:
+        return self.root / "sha256" / digest[:2] / digest
+
+    def _load_index(self) -> dict:
+        try:
+            with self.index_path.open() as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {"refs": {}, "sources": {}}
+        except ValueError as exc:
+            tklogger.warning(f"Ignoring corrupt blob store index {self.index_path}: {exc}")
+            return {"refs": {}, "sources": {}}
+
+    def _save_index(self, index: dict):
+        self.root.mkdir(parents=True, exist_ok=True)
+        tmp = self.index_path.with_name(f"{self.index_path.name}.{os.getpid()}")
+        with tmp.open("w") as f:
+            json.dump(index, f, indent=2, sort_keys=True)
+        os.replace(tmp, self.index_path)
+
+    def put(self, path: Path) -> str:
+        """Add a file to the store if its contents aren't already there, and return its digest
+
+        The file is reflinked or copied into the store, not hard linked,
+        because some build steps rewrite their outputs in place.
+        """
+        stat = path.stat()
+        key = path.resolve().as_posix()
+        with _index_lock:
+            cached = self._load_index()["sources"].get(key)
+        if cached and cached[:3] == [stat.st_size, stat.st_mtime_ns, stat.st_ino]:
+            digest = cached[3]
+        else:
+            digest = sha256_file(path)
+
+        blob = self.blob_path(digest)
+        if not blob.exists():
+            blob.parent.mkdir(parents=True, exist_ok=True)
+            tmp = blob.with_name(f"{blob.name}.{os.getpid()}.{threading.get_ident()}")
+            if not reflink(path, tmp):
+                shutil.copyfile(path, tmp)
+            tmp.chmod(0o444)
+            os.replace(tmp, blob)
+            tklogger.debug(f"Added {path} to the blob store as {digest}")
+
+        with _index_lock:
+            index = self._load_index()
+            index["sources"][key] = [stat.st_size, stat.st_mtime_ns, stat.st_ino, digest]
+            self._save_index(index)
+        return digest
+
+    def materialize(self, digest: str, dest: Path):
+        """Make dest a hard link to a blob, or a reflink or copy if it can't be hard linked
+
+        dest is replaced atomically, and nothing is done if it is already a link to the blob.
+        """
+        blob = self.blob_path(digest)
+        if dest.exists() and os.path.samefile(blob, dest):
+            return
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        tmp = dest.with_name(f".{dest.name}.{os.getpid()}.{threading.get_ident()}")
+        tmp.unlink(missing_ok=True)
+        try:
+            os.link(blob, tmp)
+        except OSError:
+            if not reflink(blob, tmp):
+                shutil.copyfile(blob, tmp)
+        os.replace(tmp, dest)
+        with _index_lock:
+            index = self._load_index()
+            index["refs"][dest.resolve().as_posix()] = digest
+            self._save_index(index)
+
+    def copy(self, src: Path, dest: Path) -> str:
+        """Add src to the store and make dest from it, like shutil.copy() without the copying"""
+        digest = self.put(src)
+        self.materialize(digest, dest)
+        return digest
+
+    def _is_referenced(self, digest: str, path: Path) -> bool:
+        """Whether a file that was made from a blob still has the blob's contents"""
+        blob = self.blob_path(digest)
+        try:
+            if os.path.samefile(blob, path):
+                return True
+            # A reflink or copy of the blob, which might have been replaced since
+            return path.stat().st_size == blob.stat().st_size and sha256_file(path) == digest
+        except FileNotFoundError:
+            return False
+
+    def gc(self, dry_run: bool = False, removing: Iterable[Path] = ()) -> list[Path]:
+        """Remove blobs that no file is made from any more, and return their paths
+
+        Files in removing are counted as already gone, even if they still exist,
+        so that a dry run of pruning followed by a dry run of gc reports what the real runs would free.
+        """
+        gone = {path.resolve().as_posix() for path in removing}
+        with _index_lock:
+            index = self._load_index()
+            refs = {
+                path: digest
+                for path, digest in index["refs"].items()
+                if path not in gone and self._is_referenced(digest, Path(path))
+            }
+            sources = {path: entry for path, entry in index["sources"].items() if Path(path).exists()}
+            used = set(refs.values())
+            removed = []
+            freed = 0
+            for blob in sorted((self.root / "sha256").glob("*/*")):
+                if blob.name in used or not DIGEST_NAME.match(blob.name):
+                    continue
+                removed.append(blob)
+                freed += blob.stat().st_size
+                if not dry_run:
+                    blob.unlink()
+            if not dry_run:
+                index["refs"] = refs
+                index["sources"] = sources
+                self._save_index(index)
+        verb = "Would remove" if dry_run else "Removed"
+        tklogger.info(f"{verb} {len(removed)} unused blobs, {freed / 2**20:.1f} MiB")
+        return removed
@@ -8,34 +8,43 @@ import pprint
 import subprocess
 import sys
 import textwrap
+from typing import Optional
 
-from telekinesis import aports, deaddrop, minisign, tklogger, tksecrets
+from telekinesis import aports, deaddrop, minisign, orchestrator, tklogger, tksecrets
 from telekinesis.alpine_docker_builder import (
     AlpineDockerBuilder,
     build_container,
     get_configured_docker_builder,
 )
+from telekinesis.blobstore import BlobStore
 from telekinesis.cli import idb_excepthook
 from telekinesis.cli.tk.subcommands.buildpkg import (
     abuild_blacksite,
     abuild_psyopsOS_base,
+    apk_stage_inputs,
+    apk_stage_outputs,
     build_neuralupgrade_apk,
     build_neuralupgrade_pyz,
 )
 from telekinesis.cli.tk.subcommands.mkimage import (
     copy_esptar_to_deaddrop,
     copy_ostar_to_deaddrop,
+    diskimg_stage_inputs,
+    diskimg_stage_outputs,
     make_boot_tar,
     make_boot_image,
     make_kernel,
+    prune_deaddrop_os_versions,
     make_ostar,
     make_squashfs,
     mkimage_iso,
 )
-from telekinesis.cli.tk.subcommands.requisites import get_x64_ovmf
+from telekinesis.cli.tk.subcommands.requisites import get_requisites, get_x64_ovmf
 from telekinesis.cli.tk.subcommands.vm import vm_diskimg, vm_osdir
 from telekinesis.config import tkconfig
-from telekinesis.platforms import Architecture, PLATFORMS
+from telekinesis.hashindex import LocalHashIndex
+from telekinesis.platforms import Architecture, Platform, PLATFORMS
+from telekinesis.stagecache import StageCache
 
 
 class ListKeyValuePairsAndExit(argparse.Action):
@@ -180,14 +189,55 @@ def makeparser(prog=None):
         "ls",
         help="List the files in the bucket",
     )
+
+    # Options for commands that transfer files to or from the bucket
+    deaddrop_transfer_opts = argparse.ArgumentParser(add_help=False)
+    deaddrop_transfer_opts.add_argument(
+        "--workers",
+        type=int,
+        default=deaddrop.DEFAULT_TRANSFER_WORKERS,
+        help="How many files to transfer at once",
+    )
+    deaddrop_transfer_opts.add_argument(
+        "--multipart-concurrency",
+        type=int,
+        default=deaddrop.DEFAULT_MULTIPART_CONCURRENCY,
+        help="How many parts of each large file, like an ostar, to transfer at once",
+    )
+    deaddrop_transfer_opts.add_argument(
+        "--max-cost",
+        type=float,
+        default=deaddrop.DEFAULT_MAX_COST,
+        help="Refuse to sync if the plan's estimated S3 cost is more than this many US dollars",
+    )
+    sub_deaddrop_plan = sub_deaddrop_subparsers.add_parser(
+        "plan",
+        help="Show what forcepull or forcepush would do, with an estimate of the bytes, requests, and cost, without changing anything",
+    )
+    sub_deaddrop_plan.add_argument("direction", choices=["pull", "push"], help="Plan a forcepull or a forcepush")
     sub_deaddrop_subparsers.add_parser(
         "forcepull",
+        parents=[deaddrop_transfer_opts],
         help="Pull files from the bucket into the local replica and delete any local files that are not in the bucket... we don't do a nicer sync operation because APKINDEX files can't be managed that way.",
     )
     sub_deaddrop_subparsers.add_parser(
         "forcepush",
+        parents=[deaddrop_transfer_opts],
         help="Push files from the local replica to the bucket and delete any bucket files that are not in the local replica.",
     )
+    sub_deaddrop_gc = sub_deaddrop_subparsers.add_parser(
+        "gc",
+        help="Remove old versions of ostars and ESP tarballs from the local replica, and blobs no version uses any more. (Use 'tk deaddrop forcepush' to remove them from the bucket too.)",
+    )
+    sub_deaddrop_gc.add_argument(
+        "--keep",
+        type=int,
+        default=tkconfig.deaddrop.keep_versions,
+        help="How many versions of each architecture's ostar and each platform's ESP tarball to keep; the version a latest symlink points to is always kept",
+    )
+    sub_deaddrop_gc.add_argument(
+        "--dry-run", action="store_true", help="Show what would be removed without removing anything"
+    )
 
     # Options related to the build container
     buildcontainer_opts = argparse.ArgumentParser(add_help=False)
@@ -203,6 +253,23 @@ def makeparser(prog=None):
         action="store_true",
         help="Don't clean the temporary directory containing the APK key",
     )
+    buildcontainer_opts.add_argument(
+        "--no-session",
+        action="store_true",
+        help="Start a new container for every build step, instead of one container per architecture that every step runs in",
+    )
+    buildcontainer_opts.add_argument(
+        "--jobs",
+        "-j",
+        type=int,
+        default=2,
+        help="How many architectures to build at once, each in its own container. Interactive builds always run one at a time. Default: %(default)s.",
+    )
+    buildcontainer_opts.add_argument(
+        "--keep-going",
+        action="store_true",
+        help="If the build for one architecture fails, finish the others instead of stopping them",
+    )
 
     # The builder subcommand
     sub_builder = subparsers.add_parser(
@@ -233,6 +300,11 @@ def makeparser(prog=None):
         help="Make a psyopsOS image",
     )
     sub_mkimage.add_argument("--skip-build-apks", action="store_true", help="Don't build APKs before building ISO")
+    sub_mkimage.add_argument(
+        "--force",
+        action="store_true",
+        help="Rebuild APKs and stages even if their inputs haven't changed since they were last built",
+    )
     sub_mkimage_subparsers = sub_mkimage.add_subparsers(dest="mkimage_action", required=True)
     sub_mkimage_subparsers.add_parser(
         "iso",
@@ -431,7 +503,8 @@ def main_impl() -> None:
 
     #### Early setup
     conhandler = logging.StreamHandler()
-    conhandler.setFormatter(logging.Formatter("%(levelname)s: %(message)s"))
+    conhandler.setFormatter(logging.Formatter("%(prefix)s%(levelname)s: %(message)s"))
+    conhandler.addFilter(orchestrator.PrefixFilter())
     tklogger.addHandler(conhandler)
     if parsed.debug:
         print(f"Arguments: {parsed}")
@@ -448,7 +521,12 @@ def main_impl() -> None:
         """Get a build container context manager"""
         if arch.name not in _build_container_cms:
             _build_container_cms[arch.name] = get_configured_docker_builder(
-                arch, parsed.interactive, parsed.clean, parsed.dangerous_no_clean_tmp_dir
+                arch,
+                parsed.interactive,
+                parsed.clean,
+                parsed.dangerous_no_clean_tmp_dir,
+                session=not parsed.no_session,
+                rebuild=parsed.rebuild,
             )
         return _build_container_cms[arch.name]
 
@@ -473,10 +551,49 @@ def main_impl() -> None:
         # (Different Alpine versions use different Python versions,
         # and if the latest APK doesn't match what's installed on the new ISO,
         # it will fail.)
+        # Skip packages whose sources haven't changed since they were last built.
         if not parsed.skip_build_apks:
-            abuild_blacksite(builder)
-            abuild_psyopsOS_base(builder)
-            build_neuralupgrade_apk(builder)
+            for package, build in [
+                ("progfiguration_blacksite", abuild_blacksite),
+                ("psyopsOS-base", abuild_psyopsOS_base),
+                ("neuralupgrade", build_neuralupgrade_apk),
+            ]:
+                stage = f"apk/{package}/{architecture.name}"
+                inputs = apk_stage_inputs(package, architecture)
+                if not stagecache.fresh(stage, inputs):
+                    build(builder)
+                    stagecache.record(stage, inputs, apk_stage_outputs(package, architecture))
+
+    def run_pipelines(pipeline, architectures: list[Architecture], hold_builder: bool = True):
+        """Run a pipeline function for each architecture, several at once if --jobs allows
+
+        Builders are made first, in this thread, because making one reads the signing key from gopass.
+        If hold_builder is True, each pipeline runs inside its builder,
+        so the build container, volumes, key, and session container are set up once for the whole pipeline
+        rather than for every stage.
+        """
+        for arch in architectures:
+            getbldcm(arch)
+
+        def run_in_builder(arch: Architecture):
+            if not hold_builder:
+                return pipeline(arch)
+            with getbldcm(arch):
+                pipeline(arch)
+
+        orchestrator.run_pipelines(
+            {arch.name: (lambda arch=arch: run_in_builder(arch)) for arch in architectures},
+            max_parallel=1 if interactive else parsed.jobs,
+            keep_going=parsed.keep_going,
+        )
+
+    def run_diskimg_stage(stage: str, architecture: Architecture, build, platform: Optional[Platform] = None):
+        """Run a diskimg stage unless its inputs haven't changed since it was last built"""
+        name = f"{stage}/{platform.name if platform else architecture.name}"
+        inputs = diskimg_stage_inputs(stage, architecture, platform)
+        if not stagecache.fresh(name, inputs):
+            build()
+            stagecache.record(name, inputs, diskimg_stage_outputs(stage, architecture))
 
     #### Early argument validation
     try:
@@ -488,7 +605,15 @@ def main_impl() -> None:
     # architectures = [all_architectures[arch] for arch in parsed.architecture]
     # bootsystem = [BOOTSYSTEMS[bs] for bs in parsed.bootsystem]
     platforms = [PLATFORMS[plat] for plat in parsed.platform]
-    architectures = set(plat.architecture for plat in platforms)
+    architectures = sorted(set(plat.architecture for plat in platforms), key=lambda arch: arch.name)
+
+    # Interactive builds might not build anything, so don't skip or record stages for them
+    stagecache = StageCache(
+        tkconfig.noarch_artifacts.stagecache,
+        tkconfig.repopaths.artifacts,
+        force=getattr(parsed, "force", False),
+        enabled=not interactive,
+    )
 
     #### Main logic
 
@@ -501,30 +626,73 @@ def main_impl() -> None:
         ]:
             subprocess.run(["cog", "-r", path.as_posix()], check=True)
     elif parsed.action == "deaddrop":
+        if parsed.deaddrop_action == "gc":
+            pruned = prune_deaddrop_os_versions(parsed.keep, dry_run=parsed.dry_run)
+            BlobStore(tkconfig.deaddrop.blobstore).gc(dry_run=parsed.dry_run, removing=pruned)
+            return
         aws_keyid, aws_secret = tkconfig.deaddrop.get_credential()
         aws_sess = deaddrop.makesession(aws_keyid, aws_secret, tkconfig.deaddrop.region)
         if parsed.deaddrop_action == "ls":
-            files, symlinks = deaddrop.s3_list_remote_files(aws_sess, tkconfig.deaddrop.bucketname)
+            files, symlinks = deaddrop.s3_list_remote_files(
+                aws_sess, tkconfig.deaddrop.bucketname, manifest_path=tkconfig.deaddrop.manifest
+            )
             print("Files:")
             pprint.pprint(files)
             print("Symlinks:")
             pprint.pprint(symlinks)
+        elif parsed.deaddrop_action == "plan":
+            with LocalHashIndex(tkconfig.deaddrop.localpath, tkconfig.deaddrop.hashindex) as hashindex:
+                plan = deaddrop.plan_sync(
+                    aws_sess,
+                    tkconfig.deaddrop.bucketname,
+                    tkconfig.deaddrop.localpath,
+                    parsed.direction,
+                    hashindex,
+                    tkconfig.deaddrop.manifest,
+                )
+            print(plan.format())
         elif parsed.deaddrop_action == "forcepull":
-            deaddrop.s3_forcepull_directory(aws_sess, tkconfig.deaddrop.bucketname, tkconfig.deaddrop.localpath)
+            deaddrop.s3_forcepull_directory(
+                aws_sess,
+                tkconfig.deaddrop.bucketname,
+                tkconfig.deaddrop.localpath,
+                tkconfig.deaddrop.manifest,
+                max_workers=parsed.workers,
+                multipart_concurrency=parsed.multipart_concurrency,
+                hashindex_path=tkconfig.deaddrop.hashindex,
+                max_cost=parsed.max_cost,
+            )
         elif parsed.deaddrop_action == "forcepush":
-            deaddrop.s3_forcepush_deaddrop(aws_sess, tkconfig.deaddrop.bucketname, tkconfig.deaddrop.localpath)
+            deaddrop.s3_forcepush_deaddrop(
+                aws_sess,
+                tkconfig.deaddrop.bucketname,
+                tkconfig.deaddrop.localpath,
+                tkconfig.deaddrop.manifest,
+                max_workers=parsed.workers,
+                multipart_concurrency=parsed.multipart_concurrency,
+                hashindex_path=tkconfig.deaddrop.hashindex,
+                max_cost=parsed.max_cost,
+            )
         else:
             parser.error(f"Unknown deaddrop action: {parsed.deaddrop_action}")
     elif parsed.action == "builder":
         if parsed.builder_action == "build":
-            for arch in architectures:
-                platform = f"linux/{arch.docker}"
-                build_container(
-                    tkconfig.buildcontainer.build_container_tag(arch),
-                    tkconfig.repopaths.buildcontainer.as_posix(),
-                    platform,
-                    rebuild=parsed.rebuild,
-                )
+            # Building the container doesn't need the signing key, so don't make builders with getbldcm()
+            orchestrator.run_pipelines(
+                {
+                    arch.name: (
+                        lambda arch=arch: build_container(
+                            tkconfig.buildcontainer.build_container_tag(arch),
+                            tkconfig.repopaths.buildcontainer.as_posix(),
+                            f"linux/{arch.docker}",
+                            rebuild=parsed.rebuild,
+                        )
+                    )
+                    for arch in architectures
+                },
+                max_parallel=1 if interactive else parsed.jobs,
+                keep_going=parsed.keep_going,
+            )
         elif parsed.builder_action == "runcmd":
             for arch in architectures:
                 with getbldcm(arch) as builder:
@@ -533,10 +701,15 @@ def main_impl() -> None:
             parser.error(f"Unknown builder action: {parsed.builder_action}")
     elif parsed.action == "mkimage":
         if parsed.mkimage_action == "iso":
-            for plat in platforms:
-                mkimage_prepare(plat.architecture)
-                with getbldcm(plat.architecture) as builder:
-                    mkimage_iso(plat.architecture, builder)
+
+            def iso_pipeline(arch: Architecture):
+                for plat in platforms:
+                    if plat.architecture == arch:
+                        mkimage_prepare(arch)
+                        with getbldcm(arch) as builder:
+                            mkimage_iso(arch, builder)
+
+            run_pipelines(iso_pipeline, architectures)
         elif parsed.mkimage_action == "diskimg":
             initdir = tkconfig.repopaths.root / "psyopsOS" / "osbuild" / "initramfs-init"
             init_patch = initdir / "initramfs-init.patch"
@@ -562,29 +735,6 @@ def main_impl() -> None:
                     cwd=initdir,
                     check=True,
                 )
-            if "kernel" in parsed.stages:
-                for arch in architectures:
-                    mkimage_prepare(arch)
-                    with getbldcm(arch) as builder:
-                        make_kernel(builder)
-            if "squashfs" in parsed.stages:
-                for arch in architectures:
-                    mkimage_prepare(arch)
-                    with getbldcm(arch) as builder:
-                        make_squashfs(builder)
-            if "ostar" in parsed.stages:
-                for arch in architectures:
-                    make_ostar(arch)
-            if "ostar-dd" in parsed.stages:
-                for arch in architectures:
-                    copy_ostar_to_deaddrop(arch)
-            if "efisystar" in parsed.stages:
-                for plat in platforms:
-                    with getbldcm(plat.architecture) as builder:
-                        make_boot_tar(plat, builder)
-            if "efisystar-dd" in parsed.stages:
-                for plat in platforms:
-                    copy_esptar_to_deaddrop(plat)
             if "sectar" in parsed.stages and parsed.node_secrets:
                 subprocess.run(
                     [
@@ -596,17 +746,50 @@ def main_impl() -> None:
                         "--force",
                     ],
                 )
-            if "diskimg" in parsed.stages:
-                for plat in platforms:
-                    arch = plat.architecture
-                    mkimage_prepare(plat.architecture)
-                    out_filename = tkconfig.arch_artifacts[arch.name].node_image(plat).name
-                    secrets_tarball = ""
-                    if parsed.node_secrets:
-                        out_filename = tkconfig.arch_artifacts[arch.name].node_image(plat, parsed.node_secrets).name
-                        secrets_tarball = tkconfig.noarch_artifacts.node_secrets(parsed.node_secrets).as_posix()
+
+            def diskimg_pipeline(arch: Architecture):
+                """Run the architecture-specific stages in order for one architecture"""
+                arch_platforms = [plat for plat in platforms if plat.architecture == arch]
+                if "kernel" in parsed.stages:
+                    mkimage_prepare(arch)
+                    with getbldcm(arch) as builder:
+                        run_diskimg_stage("kernel", arch, lambda: make_kernel(builder))
+                if "squashfs" in parsed.stages:
+                    mkimage_prepare(arch)
                     with getbldcm(arch) as builder:
-                        make_boot_image(plat, out_filename, builder, secrets_tarball=secrets_tarball)
+                        run_diskimg_stage("squashfs", arch, lambda: make_squashfs(builder))
+                if "ostar" in parsed.stages:
+                    run_diskimg_stage("ostar", arch, lambda: make_ostar(arch))
+                if "ostar-dd" in parsed.stages:
+                    copy_ostar_to_deaddrop(arch)
+                if "efisystar" in parsed.stages:
+                    for plat in arch_platforms:
+                        with getbldcm(arch) as builder:
+                            run_diskimg_stage("efisystar", arch, lambda: make_boot_tar(plat, builder), platform=plat)
+                if "efisystar-dd" in parsed.stages:
+                    for plat in arch_platforms:
+                        copy_esptar_to_deaddrop(plat)
+                if "diskimg" in parsed.stages:
+                    for plat in arch_platforms:
+                        mkimage_prepare(arch)
+                        out_filename = tkconfig.arch_artifacts[arch.name].node_image(plat).name
+                        secrets_tarball = ""
+                        if parsed.node_secrets:
+                            out_filename = tkconfig.arch_artifacts[arch.name].node_image(plat, parsed.node_secrets).name
+                            secrets_tarball = tkconfig.noarch_artifacts.node_secrets(parsed.node_secrets).as_posix()
+                        with getbldcm(arch) as builder:
+                            make_boot_image(plat, out_filename, builder, secrets_tarball=secrets_tarball)
+
+            # Download firmware and other requisites for every architecture at once,
+            # rather than each pipeline downloading its own when it gets to the efisystar stage
+            if "efisystar" in parsed.stages:
+                get_requisites(architectures)
+
+            # mkinitpatch, applyinitpatch, and sectar don't depend on the architecture and run first, above
+            if set(parsed.stages) - {"mkinitpatch", "applyinitpatch", "sectar"}:
+                container_stages = {"kernel", "squashfs", "efisystar", "diskimg"}
+                hold_builder = bool(container_stages & set(parsed.stages))
+                run_pipelines(diskimg_pipeline, architectures, hold_builder=hold_builder)
         else:
             parser.error(f"Unknown mkimage action: {parsed.mkimage_action}")
     elif parsed.action == "vm":
@@ -633,7 +816,8 @@ def main_impl() -> None:
             parser.error(f"Unknown vm action: {parsed.vm_action}")
     elif parsed.action == "buildpkg":
         # arch-specific packages
-        for arch in architectures:
+
+        def buildpkg_pipeline(arch: Architecture):
             builder = getbldcm(arch)
             if "base" in parsed.package:
                 abuild_psyopsOS_base(builder)
@@ -641,6 +825,9 @@ def main_impl() -> None:
                 abuild_blacksite(builder)
             if "neuralupgrade-apk" in parsed.package:
                 build_neuralupgrade_apk(builder)
+
+        if {"base", "blacksite", "neuralupgrade-apk"} & set(parsed.package):
+            run_pipelines(buildpkg_pipeline, architectures)
         # no-arch packages
         if "neuralupgrade-pyz" in parsed.package:
             build_neuralupgrade_pyz()
@@ -1,17 +1,37 @@
 """The buildpkg subcommand"""
 
 from datetime import datetime, UTC
+from pathlib import Path
 import subprocess
+import threading
 from typing import Optional
 
-from telekinesis.alpine_docker_builder import AlpineDockerBuilder, get_configured_docker_builder
+from telekinesis.alpine_docker_builder import AlpineDockerBuilder, container_image_id, get_configured_docker_builder
 from telekinesis.config import tkconfig
+from telekinesis.platforms import Architecture
+from telekinesis.stagecache import file_digest, tree_digest
+
+
+_abuild_locks: dict[str, threading.Lock] = {}
+"""A lock for each package, so that pipelines for different architectures never build the same package at once
+
+Every architecture builds in the same bind-mounted checkout,
+where abuild rewrites the APKBUILD and uses $startdir/src and $startdir/pkg,
+and some packages (like neuralupgrade) build from a source directory elsewhere in the checkout.
+"""
+_abuild_locks_lock = threading.Lock()
+
+
+def _abuild_lock(package: str) -> threading.Lock:
+    with _abuild_locks_lock:
+        return _abuild_locks.setdefault(package, threading.Lock())
 
 
 def abuild_psyopsOS_package(
     package: str,
     builder: AlpineDockerBuilder,
     setupcmds: Optional[list[str]] = None,
+    isolated: bool = False,
 ):
     """Build a psyopsOS APK package in the mkimage docker container.
 
@@ -21,6 +41,8 @@ def abuild_psyopsOS_package(
     Arguments:
     package: The name of the package to build.
     setupcmds: A list of commands to run before building the package.
+    isolated: Build in a new container even if the builder is in session mode,
+        for packages whose setupcmds change the container.
     """
     setupcmds = setupcmds or []
     with builder:
@@ -34,7 +56,8 @@ def abuild_psyopsOS_package(
             "abuild checksum",
             f"abuild -r -P {apkindexpath} -D {tkconfig.buildcontainer.apkreponame}",
         ]
-        builder.run_docker(in_container_build_cmd)
+        with _abuild_lock(package):
+            builder.run_docker(in_container_build_cmd, isolated=isolated)
 
 
 def abuild_blacksite(builder: AlpineDockerBuilder):
@@ -59,7 +82,8 @@ def abuild_psyopsOS_base(builder: AlpineDockerBuilder):
         "sudo apk del grub-efi",
         "sudo apk fix",
     ]
-    abuild_psyopsOS_package("psyopsOS-base", builder, setupcmds=setupcmds)
+    # Removing grub-efi would break later steps that share a session container, like making the disk image
+    abuild_psyopsOS_package("psyopsOS-base", builder, setupcmds=setupcmds, isolated=True)
 
 
 def build_neuralupgrade_pyz():
@@ -85,3 +109,53 @@ def build_neuralupgrade_pyz():
 def build_neuralupgrade_apk(builder):
     """Build the neuralupgrade APK package"""
     abuild_psyopsOS_package("neuralupgrade", builder)
+
+
+def build_container_inputs(architecture: Architecture) -> dict[str, str]:
+    """Return the stage cache inputs common to everything built in the build container"""
+    try:
+        image_id = container_image_id(tkconfig.buildcontainer.build_container_tag(architecture))
+    except subprocess.CalledProcessError:
+        # The build will make it, and the stage will be rebuilt next time
+        image_id = "missing"
+    return {
+        "alpine_version": tkconfig.alpine_version,
+        "container_image": image_id,
+    }
+
+
+def local_apk_repo(architecture: Architecture) -> Path:
+    """The local replica of the psyopsOS APK repository for an architecture"""
+    return (
+        tkconfig.deaddrop.apk_repo_root
+        / f"v{tkconfig.alpine_version}"
+        / tkconfig.buildcontainer.apkreponame
+        / architecture.name
+    )
+
+
+def local_apk_repo_digest(architecture: Architecture) -> str:
+    """Return a digest of the local APK repository, which changes whenever a package is added to it"""
+    return file_digest(local_apk_repo(architecture) / "APKINDEX.tar.gz")
+
+
+APK_SOURCES = {
+    "progfiguration_blacksite": tkconfig.repopaths.root / "progfiguration_blacksite",
+    "psyopsOS-base": None,
+    "neuralupgrade": tkconfig.repopaths.neuralupgrade,
+}
+"""Packages built by mkimage, and where their source is if it isn't next to the APKBUILD"""
+
+
+def apk_stage_inputs(package: str, architecture: Architecture) -> dict[str, str]:
+    """Return the stage cache inputs for building an APK"""
+    inputs = build_container_inputs(architecture)
+    inputs["apkbuild"] = tree_digest(tkconfig.repopaths.root / "psyopsOS" / "abuild" / "psyopsOS" / package)
+    if APK_SOURCES[package] is not None:
+        inputs["source"] = tree_digest(APK_SOURCES[package])
+    return inputs
+
+
+def apk_stage_outputs(package: str, architecture: Architecture) -> list[Path]:
+    """Return the stage cache outputs for building an APK: every version of the package in the local repository"""
+    return sorted(local_apk_repo(architecture).glob(f"{package}-[0-9]*.apk"))
@@ -2,20 +2,31 @@
 
 from dataclasses import dataclass
 import datetime
+import hashlib
 import json
 import os
 from pathlib import Path
+import re
 import shutil
-import subprocess
+import sys
 import tarfile
 import textwrap
+import threading
+from typing import Optional
 
 import telekinesis.minisign as minisign
+from telekinesis import orchestrator, ostar, tklogger
 from telekinesis.alpine_docker_builder import AlpineDockerBuilder
-from telekinesis.cli.tk.subcommands.buildpkg import build_neuralupgrade_pyz
+from telekinesis.blobstore import BlobStore
+from telekinesis.cli.tk.subcommands.buildpkg import (
+    build_container_inputs,
+    build_neuralupgrade_pyz,
+    local_apk_repo_digest,
+)
 from telekinesis.cli.tk.subcommands.requisites import get_rpi_firmware, get_x64_memtest, get_x64_ovmf
 from telekinesis.config import tkconfig
 from telekinesis.platforms import Architecture, Platform, PLATFORMS
+from telekinesis.stagecache import file_digest, stat_digest, tree_digest
 
 
 def mkimage_iso(architecture: Architecture, builder: AlpineDockerBuilder):
@@ -81,10 +92,13 @@ def generate_apk_repositories_files(alpine_version: str) -> tuple[Path, Path]:
     os.makedirs(tkconfig.noarch_artifacts.noarchroot, exist_ok=True)
     all_repos = tkconfig.noarch_artifacts.noarchroot / "psyopsOS.repositories.all"
     psyopsOS_only_repo = tkconfig.noarch_artifacts.noarchroot / "psyopsOS.repositories.psyopsOSonly"
-    with all_repos.open("w") as f:
-        f.write(psyopsOS_apk_repositories)
-    with psyopsOS_only_repo.open("w") as f:
-        f.write(f"{psyopsOS_repo}\n")
+    # Builds for different architectures run at the same time and mount these files into their containers,
+    # so don't rewrite them unless they change, and never leave them half written.
+    for path, contents in [(all_repos, psyopsOS_apk_repositories), (psyopsOS_only_repo, f"{psyopsOS_repo}\n")]:
+        if not path.exists() or path.read_text() != contents:
+            tmp = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}")
+            tmp.write_text(contents)
+            os.replace(tmp, path)
     return (all_repos, psyopsOS_only_repo)
 
 
@@ -127,7 +141,7 @@ def make_kernel(builder: AlpineDockerBuilder):
         ]
         builder.run_docker(in_container_build_cmd)
         if arch_artifacts.osdir_path.exists():
-            subprocess.run(["ls", "-larth", arch_artifacts.osdir_path], check=True)
+            orchestrator.run(["ls", "-larth", arch_artifacts.osdir_path], check=True)
 
 
 def make_squashfs(builder: AlpineDockerBuilder):
@@ -186,7 +200,7 @@ def make_squashfs(builder: AlpineDockerBuilder):
         alpine_version_file = osdir_path / "squashfs.alpine_version"
         with alpine_version_file.open("w") as f:
             f.write(tkconfig.alpine_version)
-        subprocess.run(["ls", "-larth", osdir_path], check=True)
+        orchestrator.run(["ls", "-larth", osdir_path], check=True)
 
 
 def make_boot_image(
@@ -251,38 +265,87 @@ def make_ostar(architecture: Architecture):
     ]
     # We don't compress because the big files - kernel/squashfs/initramfs - are already compressed
     # Compressing with "w:gz" saved about 4MB out of 630MB as of 20231215
-    with tarfile.open(arch_artifacts.ostar_path.as_posix(), "w") as tar:
+    # The writer normalizes mtimes, owners, and modes, so the same osdir always makes the same tarball.
+    # It hashes and chunks it as it goes so that signing and the chunk manifest don't have to read it again.
+    delta = _neuralupgrade_delta()
+    with ostar.OstarWriter(arch_artifacts.ostar_path, chunker=delta.Chunker) as writer:
         for item in items:
-            tar.add(arch_artifacts.osdir_path / item, arcname=item)
-    with tarfile.open(arch_artifacts.ostar_path.as_posix(), "a") as tar:
+            writer.add(arch_artifacts.osdir_path / item, arcname=item)
         for item in optional_items:
             item_path = arch_artifacts.osdir_path / item
             if not item_path.exists():
                 continue
-            tar.add(item_path, arcname=item)
+            writer.add(item_path, arcname=item)
+    members_digest = hashlib.sha256(writer.members_manifest()).hexdigest()
 
     with open(arch_artifacts.osdir_path / "squashfs.alpine_version", "r") as f:
         alpine_version = f.read().strip()
     with open(arch_artifacts.osdir_path / "kernel.version", "r") as f:
         kernel_version = f.read().strip()
 
-    trusted_comment = f"type=psyopsOS filename={tarball_file} version={build_date} kernel={kernel_version} alpine={alpine_version} architecture={architecture.kernel}"
+    trusted_comment = f"type=psyopsOS filename={tarball_file} version={build_date} kernel={kernel_version} alpine={alpine_version} architecture={architecture.kernel} members={members_digest}"
 
     # Note that we're signing the tarball using the unversioned name from arch_artifacts,
     # but the trusted_comment contains the versioned name.
     # This doesn't matter, even though the default trusted_comment contains the signed filename.
-    minisign.sign(arch_artifacts.ostar_path.as_posix(), trusted_comment=trusted_comment)
+    # The members manifest isn't signed itself, but its hash is in the trusted comment.
+    minisign.sign_hash(arch_artifacts.ostar_path, writer.blake2b, trusted_comment=trusted_comment)
+    write_ostar_chunk_manifest(writer, tarball_file)
+
+
+def _neuralupgrade_delta():
+    """Import neuralupgrade's delta module from the source tree
+
+    neuralupgrade is not a dependency of telekinesis,
+    so add its source directory to the path like telekinesis.minisign does.
+    """
+    srcroot = (tkconfig.repopaths.neuralupgrade / "src").as_posix()
+    if srcroot not in sys.path:
+        sys.path.append(srcroot)
+    from neuralupgrade import delta
+
+    return delta
+
+
+def write_ostar_chunk_manifest(writer: ostar.OstarWriter, filename: str):
+    """Write the chunk manifest that neuralupgrade uses for delta updates next to the OS tarball
+
+    The writer recorded the regions while writing the tarball, so this doesn't read it again.
+    The manifest format is owned by neuralupgrade,
+    so we build it with neuralupgrade's own code rather than reimplementing it here.
+    """
+    delta = _neuralupgrade_delta()
+    regions = [delta.literal_region(r) if isinstance(r, bytes) else delta.member_region(*r) for r in writer.regions]
+    manifest_path = Path(f"{writer.path}{delta.MANIFEST_SUFFIX}")
+    with manifest_path.open("w") as f:
+        json.dump(delta.build_manifest(filename, writer.size, regions), f)
+    tklogger.info(f"Wrote chunk manifest {manifest_path}")
 
 
 def copy_ostar_to_deaddrop(architecture: Architecture):
-    """Copy the OS tarball and signature to the deaddrop, making sure they have correct names"""
+    """Copy the OS tarball, its signature, and its manifests to the deaddrop, making sure they have correct names"""
     arch_artifacts = tkconfig.arch_artifacts[architecture.name]
     trusted_comment = minisign.verify(arch_artifacts.ostar_path)
     metadata = {kv[0]: kv[1] for kv in [x.split("=") for x in trusted_comment.split()]}
     os.makedirs(tkconfig.deaddrop.osdir, exist_ok=True)
-    shutil.copy(arch_artifacts.ostar_path, tkconfig.deaddrop.osdir / metadata["filename"])
-    sig = f"{arch_artifacts.ostar_path}.minisig"
-    shutil.copy(sig, tkconfig.deaddrop.osdir / f"{metadata['filename']}.minisig")
+    blobs = BlobStore(tkconfig.deaddrop.blobstore)
+    blobs.copy(arch_artifacts.ostar_path, tkconfig.deaddrop.osdir / metadata["filename"])
+    sig = Path(f"{arch_artifacts.ostar_path}.minisig")
+    blobs.copy(sig, tkconfig.deaddrop.osdir / f"{metadata['filename']}.minisig")
+    members = Path(f"{arch_artifacts.ostar_path}{ostar.MEMBERS_SUFFIX}")
+    if "members" in metadata:
+        if hashlib.sha256(members.read_bytes()).hexdigest() != metadata["members"]:
+            raise Exception(
+                f"{members} does not match the members hash in the signature of {arch_artifacts.ostar_path}"
+            )
+        blobs.copy(members, tkconfig.deaddrop.osdir / f"{metadata['filename']}{ostar.MEMBERS_SUFFIX}")
+    chunk_manifest = Path(f"{arch_artifacts.ostar_path}.chunks.json")
+    if chunk_manifest.exists():
+        blobs.copy(chunk_manifest, tkconfig.deaddrop.osdir / f"{metadata['filename']}.chunks.json")
+    else:
+        tklogger.warning(
+            f"No chunk manifest at {chunk_manifest}, nodes will not be able to do a delta update to this version"
+        )
 
     # symlink the minisig to latest.minisig
     ostar_name = arch_artifacts.ostar_versioned_fmt.format(arch=architecture.name, version="latest")
@@ -316,8 +379,7 @@ def make_x64_efi_boot_tar(builder: AlpineDockerBuilder):
     build_date = datetime.datetime.now(datetime.timezone.utc).strftime("%Y%m%d-%H%M%S")
     arch_artifacts = tkconfig.arch_artifacts[architecture.name]
     tarball_file = arch_artifacts.esptar_versioned(plat, build_date).name
-    get_x64_ovmf()
-    get_x64_memtest()
+    orchestrator.run_concurrently(get_x64_ovmf, get_x64_memtest)
 
     @dataclass
     class EfiProgram:
@@ -415,9 +477,10 @@ def copy_esptar_to_deaddrop(platform: Platform):
     metadata = {kv[0]: kv[1] for kv in [x.split("=") for x in trusted_comment.split()]}
     filename = metadata["filename"]
     os.makedirs(tkconfig.deaddrop.osdir, exist_ok=True)
-    shutil.copy(arch_artifacts.esptar_path, tkconfig.deaddrop.osdir / filename)
-    sig = f"{arch_artifacts.esptar_path}.minisig"
-    shutil.copy(sig, tkconfig.deaddrop.osdir / f"{filename}.minisig")
+    blobs = BlobStore(tkconfig.deaddrop.blobstore)
+    blobs.copy(arch_artifacts.esptar_path, tkconfig.deaddrop.osdir / filename)
+    sig = Path(f"{arch_artifacts.esptar_path}.minisig")
+    blobs.copy(sig, tkconfig.deaddrop.osdir / f"{filename}.minisig")
 
     # make "latest.minisig" symlink to the latest version
     latest_name = arch_artifacts.esptar_versioned(platform, "latest").name
@@ -427,3 +490,105 @@ def copy_esptar_to_deaddrop(platform: Platform):
     latest_sig.unlink(missing_ok=True)
     os.symlink(f"{filename}.minisig", latest_sig.as_posix())
     # latest_sig.symlink_to(f"{filename}.minisig")
+
+
+VERSIONED_OS_FILE = re.compile(r"^(?P<kind>psyopsOS|psyopsESP)\.(?P<target>[^.]+)\.(?P<version>\d{8}-\d{6})\.tar")
+"""Versioned ostars and ESP tarballs in the deaddrop, and their signatures and manifests,
+like psyopsOS.x86_64.20240101-123456.tar.minisig; target is the architecture for ostars or the platform for ESPs"""
+
+
+def prune_deaddrop_os_versions(keep: int, dry_run: bool = False) -> list[Path]:
+    """Remove all but the newest versions of each architecture's ostar and each platform's ESP tarball
+
+    Keeps the newest `keep` versions of each, and whatever version the latest.minisig symlink points to.
+    Returns the paths removed (or that would be removed, with dry_run).
+    Note that pushing the deaddrop afterwards removes them from the bucket too.
+    """
+    osdir = tkconfig.deaddrop.osdir
+    if not osdir.exists():
+        return []
+    latest = {os.readlink(path) for path in osdir.iterdir() if path.is_symlink()}
+    versions: dict[tuple[str, str], dict[str, list[Path]]] = {}
+    for path in osdir.iterdir():
+        match = VERSIONED_OS_FILE.match(path.name)
+        if not match or path.is_symlink():
+            continue
+        group = versions.setdefault((match["kind"], match["target"]), {})
+        group.setdefault(match["version"], []).append(path)
+    removed = []
+    for (kind, target), group in sorted(versions.items()):
+        for version in sorted(group, reverse=True)[keep:]:
+            files = group[version]
+            if any(path.name in latest for path in files):
+                continue
+            tklogger.info(f"{'Would remove' if dry_run else 'Removing'} {kind} {target} version {version}")
+            for path in sorted(files):
+                removed.append(path)
+                if not dry_run:
+                    path.unlink()
+    return removed
+
+
+KERNEL_OUTPUTS = ["kernel", "kernel.version", "modloop", "initramfs", "System.map", "config"]
+"""Files in the osdir made by make_kernel()"""
+
+SQUASHFS_OUTPUTS = ["squashfs", "squashfs.alpine_version"]
+"""Files in the osdir made by make_squashfs()"""
+
+
+def diskimg_stage_inputs(stage: str, architecture: Architecture, platform: Optional[Platform] = None) -> dict[str, str]:
+    """Return the stage cache inputs of a diskimg stage
+
+    Every stage includes this module, since it contains the commands that build them.
+    Packages from the upstream Alpine repositories are not included;
+    pass --force to pick up new upstream packages.
+    """
+    osbuild = tkconfig.repopaths.root / "psyopsOS" / "osbuild"
+    arch_artifacts = tkconfig.arch_artifacts[architecture.name]
+    inputs = {"mkimage": file_digest(Path(__file__))}
+    if stage == "kernel":
+        inputs.update(build_container_inputs(architecture))
+        inputs["psyopsOS_apks"] = local_apk_repo_digest(architecture)
+        inputs["script"] = file_digest(osbuild / "make-psyopsOS-kernel.sh")
+        inputs["initramfs_init"] = tree_digest(osbuild / "initramfs-init")
+    elif stage == "squashfs":
+        inputs.update(build_container_inputs(architecture))
+        inputs["psyopsOS_apks"] = local_apk_repo_digest(architecture)
+        inputs["script"] = file_digest(osbuild / "make-psyopsOS-squashfs.sh")
+        inputs["os_overlay"] = tree_digest(tkconfig.repopaths.root / "psyopsOS" / "os-overlay")
+    elif stage == "ostar":
+        # The kernel and squashfs are hundreds of megabytes, so use their size and mtime
+        osdir_items = KERNEL_OUTPUTS + SQUASHFS_OUTPUTS + ["dtbs"]
+        inputs["osdir"] = stat_digest(arch_artifacts.osdir_path / item for item in osdir_items)
+        inputs["delta"] = file_digest(tkconfig.repopaths.neuralupgrade / "src" / "neuralupgrade" / "delta.py")
+        inputs["ostar"] = file_digest(Path(ostar.__file__))
+    elif stage == "efisystar" and platform == PLATFORMS["x86_64-uefi"]:
+        inputs["ovmf_url"] = arch_artifacts.ovmf_url
+        inputs["memtest_url"] = arch_artifacts.memtest_url
+    elif stage == "efisystar" and platform == PLATFORMS["aarch64-rpi4uboot"]:
+        # U-Boot comes from the APK installed in the build container
+        inputs.update(build_container_inputs(architecture))
+        inputs["rpi_firmware_url"] = arch_artifacts.rpi_firmware_url
+    else:
+        raise ValueError(f"Stage {stage} for {platform or architecture.name} is not cached")
+    return inputs
+
+
+def diskimg_stage_outputs(stage: str, architecture: Architecture) -> list[Path]:
+    """Return the stage cache outputs of a diskimg stage"""
+    arch_artifacts = tkconfig.arch_artifacts[architecture.name]
+    if stage == "kernel":
+        return [arch_artifacts.osdir_path / item for item in KERNEL_OUTPUTS]
+    elif stage == "squashfs":
+        return [arch_artifacts.osdir_path / item for item in SQUASHFS_OUTPUTS]
+    elif stage == "ostar":
+        ostar_path = arch_artifacts.ostar_path.as_posix()
+        return [
+            Path(ostar_path),
+            Path(f"{ostar_path}.minisig"),
+            Path(f"{ostar_path}.chunks.json"),
+            Path(f"{ostar_path}{ostar.MEMBERS_SUFFIX}"),
+        ]
+    elif stage == "efisystar":
+        return [arch_artifacts.esptar_path, Path(f"{arch_artifacts.esptar_path}.minisig")]
+    raise ValueError(f"Stage {stage} is not cached")
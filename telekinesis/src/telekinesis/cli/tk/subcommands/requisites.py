@@ -1,10 +1,11 @@
 """Artifact prerequisites"""
 
-import subprocess
 import tarfile
 import zipfile
 
+from telekinesis import orchestrator
 from telekinesis.config import tkconfig
+from telekinesis.platforms import Architecture
 from telekinesis.rget import rget
 
 
@@ -16,13 +17,13 @@ def get_x64_ovmf():
     TODO: we probably need to build this ourselves, unless Alpine packages it in some normal way in the future.
     """
     artifacts = tkconfig.arch_artifacts["x86_64"]
-    rget(artifacts.ovmf_url, artifacts.ovmf_rpm)
+    changed = rget(artifacts.ovmf_url, artifacts.ovmf_rpm, sha256=artifacts.ovmf_sha256)
     results = [
         artifacts.ovmf_extracted_code,
         artifacts.ovmf_extracted_vars,
         artifacts.uefishell_extracted_bin,
     ]
-    if not all(result.exists() for result in results):
+    if changed or not all(result.exists() for result in results):
         in_container_rpm_path = f"/work/{artifacts.ovmf_rpm.name}"
         in_container_ovmf_extracted_path = f"/work/{artifacts.ovmf_extracted_path.name}"
         in_container_uefishell_iso_path = f"{in_container_ovmf_extracted_path}/{artifacts.uefishell_iso_relpath}"
@@ -47,18 +48,14 @@ def get_x64_ovmf():
             "-c",
             extract_rpm_script,
         ]
-        subprocess.run(docker_run_cmd, check=True)
+        orchestrator.run(docker_run_cmd, check=True)
 
 
 def get_x64_memtest():
     """Download and extract memtest binaries"""
     artifacts = tkconfig.arch_artifacts["x86_64"]
-    # code to download memtest from memtest.org with requestslibrary:
-    rget(
-        "https://memtest.org/download/v6.20/mt86plus_6.20.binaries.zip",
-        artifacts.memtest_zipfile,
-    )
-    if not artifacts.memtest64efi.exists():
+    changed = rget(artifacts.memtest_url, artifacts.memtest_zipfile, sha256=artifacts.memtest_sha256)
+    if changed or not artifacts.memtest64efi.exists():
         with zipfile.ZipFile(artifacts.memtest_zipfile, "r") as zip_ref:
             zip_ref.extract("memtest64.efi", artifacts.archroot)
 
@@ -66,7 +63,23 @@ def get_x64_memtest():
 def get_rpi_firmware():
     """Download the Raspberry Pi firmware"""
     artifacts = tkconfig.arch_artifacts["aarch64"]
+    changed = rget(artifacts.rpi_firmware_url, artifacts.rpi_firmware_tarball, sha256=artifacts.rpi_firmware_sha256)
+    if changed or not artifacts.rpi_firmware_extracted.exists():
+        with tarfile.open(artifacts.rpi_firmware_tarball, "r:xz") as tar:
+            tar.extractall(artifacts.archroot)
 
-    rget(artifacts.rpi_firmware_url, artifacts.rpi_firmware_tarball)
-    with tarfile.open(artifacts.rpi_firmware_tarball, "r:xz") as tar:
-        tar.extractall(artifacts.archroot)
+
+REQUISITES = {
+    "x86_64": [get_x64_ovmf, get_x64_memtest],
+    "aarch64": [get_rpi_firmware],
+}
+"""The functions that get the requisites for each architecture"""
+
+
+def get_requisites(architectures: list[Architecture]):
+    """Download and extract the requisites for all of these architectures at once
+
+    The individual functions can still be called later; they won't download anything again in this process.
+    """
+    getters = [getter for arch in architectures for getter in REQUISITES.get(arch.name, [])]
+    orchestrator.run_concurrently(*getters)
@@ -5,6 +5,7 @@ This is necessarily full of implementation details and local paths.
 Secrets should be stored in 1Password, and accessed with the getsecret function.
 """
 
+import os
 from pathlib import Path
 import pprint
 
@@ -38,6 +39,11 @@ class TelekinesisConfig:
             self.minisign_pubkey = root / "psyopsOS" / "minisign.pubkey"
             """The path to the minisign public key on the host"""
             self.neuralupgrade = root / "psyopsOS" / "neuralupgrade"
+            self.requisite_pins = root / "telekinesis" / "requisites.sha256.json"
+            """The path to the SHA-256 pins of downloaded requisites, keyed by URL, see rget.rget
+
+            Pins are recorded the first time a URL is downloaded and enforced afterwards; commit new ones.
+            """
 
     class TelekinesisConfigDeaddropNode:
         """Configuration for the deaddrop config node"""
@@ -49,6 +55,10 @@ class TelekinesisConfig:
             """The S3 region"""
             self.localpath = artifacts / "deaddrop"
             """Path to the local directory that is synced with the bucket"""
+            self.manifest = artifacts / "deaddrop.manifest.json"
+            """Path to the manifest of object checksums and redirects in the bucket, see deaddrop.RemoteManifest"""
+            self.hashindex = artifacts / "deaddrop.hashindex.sqlite"
+            """Path to the index of local file checksums, see hashindex.LocalHashIndex"""
             self.osdir = self.localpath / "os"
             """Path to the directory containing OS images"""
             self.apk_repo_root = self.localpath / "apk"
@@ -59,6 +69,13 @@ class TelekinesisConfig:
             """The filename that our mkimage creates"""
             self.isopath = self.osdir / self.isofilename
             """The path to the ISO image"""
+            self.blobstore = artifacts / "blobs"
+            """Path to the content-addressed store that versioned files in osdir are hard links to, see blobstore.BlobStore
+
+            It must be on the same filesystem as localpath, and must not be inside it, or it would be uploaded.
+            """
+            self.keep_versions = 5
+            """How many versions of each architecture's ostar and each platform's ESP tarball 'tk deaddrop gc' keeps"""
 
         def get_credential(self) -> tuple[str, str]:
             """Get the AWS credentials from 1Password, and return them as a tuple of (username, password)"""
@@ -115,6 +132,16 @@ class TelekinesisConfig:
             self.neuralupgrade = self.noarchroot / "neuralupgrade.pyz"
             """Path to the pyz file for neuralupgrade"""
 
+            self.stagecache = self.noarchroot / "stagecache.json"
+            """Path to the record of build stage inputs and outputs, see stagecache.StageCache"""
+
+            xdg_cache = Path(os.environ.get("XDG_CACHE_HOME", Path.home() / ".cache"))
+            self.requisites_cache = xdg_cache / "psyops" / "requisites"
+            """Path to the cache of downloaded requisites like OVMF and memtest, see rget.rget
+
+            Shared by every architecture and every psyops checkout, so a new checkout doesn't download them again.
+            """
+
         def node_secrets(self, nodename: str) -> Path:
             """Get the path to the node secrets tarball"""
             return self.noarchroot / self.node_secrets_filename_fmt.format(nodename=nodename)
@@ -131,6 +158,14 @@ class TelekinesisConfig:
 
             # TODO: some of the downloaded things are architecture-specific
 
+            self.memtest_url = "https://memtest.org/download/v6.20/mt86plus_6.20.binaries.zip"
+            """The URL of the memtest binaries zipfile"""
+            self.memtest_sha256: str | None = None
+            """The SHA-256 of the memtest binaries zipfile
+
+            If set, it overrides the pin for memtest_url in repopaths.requisite_pins.
+            Either way, a cached copy is used without checking the URL, and a download that doesn't match is an error.
+            """
             self.memtest_zipfile = self.archroot / "memtest.zip"
             """The path to the memtest86+ zipfile"""
             self.memtest64efi = self.archroot / "memtest64.efi"
@@ -138,6 +173,8 @@ class TelekinesisConfig:
 
             self.ovmf_url = "https://www.kraxel.org/repos/jenkins/edk2/edk2.git-ovmf-x64-0-20220719.209.gf0064ac3af.EOL.no.nore.updates.noarch.rpm"
             """The URL to download the OVMF firmware from"""
+            self.ovmf_sha256: str | None = None
+            """The SHA-256 of the OVMF RPM, see memtest_sha256"""
             self.ovmf_rpm = (
                 self.archroot / "edk2.git-ovmf-x64-0-20220719.209.gf0064ac3af.EOL.no.nore.updates.noarch.rpm"
             )
@@ -159,6 +196,8 @@ class TelekinesisConfig:
             """The version of the Raspberry Pi firmware"""
             self.rpi_firmware_url = f"https://github.com/raspberrypi/firmware/releases/download/1.20250326/raspi-firmware_{self.rpi_firmware_version}.orig.tar.xz"
             """The URL to download the Raspberry Pi firmware from"""
+            self.rpi_firmware_sha256: str | None = None
+            """The SHA-256 of the Raspberry Pi firmware tarball, see memtest_sha256"""
             # self.rpi_firmware_zip_url = (
             #     f"https://codeload.github.com/raspberrypi/firmware/zip/refs/tags/{self.rpi_firmware_version}"
             # )
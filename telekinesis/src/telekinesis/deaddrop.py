@@ -1,13 +1,21 @@
 """Manage the S3 bucket used for psyopsOS, called deaddrop"""
 
-import hashlib
+import json
 import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
 from pathlib import Path
-from typing import Union
+from typing import Any, Optional, Union
 
 import boto3
+import boto3.s3.transfer
+import botocore.config
+import botocore.exceptions
 
 from telekinesis import tklogger
+from telekinesis.hashindex import LocalHashIndex
+from telekinesis.syncplan import LocalFile, LocalTree, SyncPlan, plan_pull, plan_push
 
 
 def makesession(aws_access_key_id, aws_secret_access_key, aws_region):
@@ -28,226 +36,575 @@ class S3PriceWarningError(Exception):
     pass
 
 
-def s3_list_remote_files(
+DEFAULT_HEAD_WORKERS = 16
+"""How many HEAD requests to make at once when listing the bucket"""
+
+
+class RemoteManifest:
+    """A local record of what we learned about each object in the bucket from its HEAD request
+
+    The md5 checksum and redirect location of an object are only returned by a HEAD request,
+    but the ETag and LastModified are returned for every object by list_objects_v2.
+    Any change to an object's contents or metadata replaces the object,
+    which changes its LastModified (and usually its ETag),
+    so if both match what we saw last time, the md5 and redirect haven't changed either.
+
+    The manifest is a JSON file like:
+    {"bucket": BUCKET, "objects": {KEY: {"etag", "last_modified", "size", "md5", "redirect"}}}
+
+    It must not live inside the local replica,
+    or forcepush would upload it and forcepull would delete it.
+    """
+
+    def __init__(self, bucket_name: str, path: Optional[Path] = None):
+        self.bucket_name = bucket_name
+        self.path = path
+        self.objects: dict[str, dict[str, Any]] = {}
+        if path is not None:
+            self.load()
+
+    def load(self):
+        """Load the manifest from disk, ignoring it if it is missing, corrupt, or for a different bucket"""
+        try:
+            with open(self.path) as f:
+                contents = json.load(f)
+        except FileNotFoundError:
+            tklogger.debug(f"No deaddrop manifest at {self.path}, will HEAD every object")
+            return
+        except (OSError, ValueError) as exc:
+            tklogger.warning(f"Ignoring unreadable deaddrop manifest at {self.path}: {exc}")
+            return
+        if contents.get("bucket") != self.bucket_name:
+            tklogger.debug(f"Deaddrop manifest at {self.path} is for a different bucket, ignoring it")
+            return
+        self.objects = contents.get("objects", {})
+
+    def save(self):
+        """Write the manifest to disk atomically"""
+        if self.path is None:
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_name(f"{self.path.name}.{os.getpid()}")
+        with open(tmp, "w") as f:
+            json.dump({"bucket": self.bucket_name, "objects": self.objects}, f, indent=0, sort_keys=True)
+        os.replace(tmp, self.path)
+        tklogger.debug(f"Saved deaddrop manifest with {len(self.objects)} objects to {self.path}")
+
+    def lookup(self, obj: dict) -> Optional[dict[str, Any]]:
+        """Return the manifest entry for an object from list_objects_v2, or None if it is missing or stale"""
+        entry = self.objects.get(obj["Key"])
+        if entry is None:
+            return None
+        if entry["etag"] != obj["ETag"] or entry["last_modified"] != obj["LastModified"].isoformat():
+            return None
+        return entry
+
+    @staticmethod
+    def entry(obj: dict, head: dict) -> dict[str, Any]:
+        """Make a manifest entry from an object from list_objects_v2 and its HEAD response"""
+        return {
+            "etag": obj["ETag"],
+            "last_modified": obj["LastModified"].isoformat(),
+            "size": obj["Size"],
+            "md5": head["Metadata"].get("md5", ""),
+            "redirect": head.get("WebsiteRedirectLocation", ""),
+        }
+
+
+def s3_list_remote_objects(
     session: boto3.Session,
     bucket_name: str,
     too_many_requests=1_000_000,
-) -> tuple[dict[str, str], dict[str, str]]:
-    """Return a list of all remote files.
-
-    Return a tuple[{filepath: MD5}, {filepath: WebsiteRedirectLocation}].
-    The first item in the tuple represents regular files mapped to their MD5 checksum.
-    The second item in the tuple represents symlinks mapped to their target.
+    manifest_path: Optional[Path] = None,
+    max_workers: int = DEFAULT_HEAD_WORKERS,
+) -> dict[str, dict[str, Any]]:
+    """Return every object in the bucket, mapped to its manifest entry (see RemoteManifest)
 
     We assume the md5 checksums are stored in the metadata of the S3 objects.
     We do NOT use the ETag, which is not the MD5 checksum of the file contents
     for files uploaded as multipart uploads.
     Large files like our OS tarballs are uploaded as multipart uploads automatically by boto3.
 
+    The metadata is only returned by a HEAD request for each object,
+    so we make those from a pool of threads sharing one client,
+    and skip them entirely for objects that the manifest says haven't changed (see RemoteManifest).
+
     Arguments:
     - session: boto3 session
     - bucket_name: name of the S3 bucket
     - too_many_requests: maximum number of requests before raising a S3PriceWarningError
         At the time of this writing, 1m requests is $0.40.
+    - manifest_path: where to keep the manifest, or None to HEAD every object
+    - max_workers: how many HEAD requests to make at once
     """
 
-    s3 = session.client("s3")
+    # The default connection pool is 10, which would make extra threads wait for a connection
+    s3 = session.client("s3", config=botocore.config.Config(max_pool_connections=max(max_workers, 10)))
+    manifest = RemoteManifest(bucket_name, manifest_path)
 
-    files = {}
-    redirects = {}
+    entries: dict[str, dict[str, Any]] = {}
+    heads: dict[str, Future] = {}
+    listed: dict[str, dict] = {}
 
     paginator = s3.get_paginator("list_objects_v2")
-    objctr = 0
-    api_calls_per_obj = 2  # one to .get() and one to .head_object()
+    callctr = 0
     tklogger.debug(f"Listing objects in S3 bucket {bucket_name}...")
-    for page in paginator.paginate(Bucket=bucket_name):
-        for obj in page.get("Contents", []):
-            objctr += 1
-            callctr = objctr * api_calls_per_obj
-            filepath = obj["Key"]
-            head = s3.head_object(Bucket=bucket_name, Key=obj["Key"])
-            redirect = head.get("WebsiteRedirectLocation", "")
-            md5sum = head["Metadata"].get("md5", "")
-            if redirect:
-                redirects[filepath] = redirect
-            else:
-                files[filepath] = md5sum
-            if callctr > too_many_requests:
-                raise S3PriceWarningError(
-                    f"We made (at least) {too_many_requests} requests, but haven't enumerated all the files. Raise the too_many_requests linmit if you're sure you want to do this."
-                )
-    tklogger.debug(f"Found {len(files)} files and {len(redirects)} redirects in S3 bucket {bucket_name}.")
-
-    return (files, redirects)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        try:
+            for page in paginator.paginate(Bucket=bucket_name):
+                callctr += 1
+                for obj in page.get("Contents", []):
+                    filepath = obj["Key"]
+                    listed[filepath] = obj
+                    entry = manifest.lookup(obj)
+                    if entry is not None:
+                        entries[filepath] = entry
+                        continue
+                    callctr += 1
+                    if callctr > too_many_requests:
+                        raise S3PriceWarningError(
+                            f"We made (at least) {too_many_requests} requests, but haven't enumerated all the files. Raise the too_many_requests linmit if you're sure you want to do this."
+                        )
+                    heads[filepath] = executor.submit(s3.head_object, Bucket=bucket_name, Key=filepath)
+            for filepath, future in heads.items():
+                entries[filepath] = RemoteManifest.entry(listed[filepath], future.result())
+        except BaseException:
+            executor.shutdown(wait=True, cancel_futures=True)
+            raise
+
+    tklogger.debug(f"Made {len(heads)} HEAD requests, {len(entries) - len(heads)} objects were unchanged")
+    manifest.objects = entries
+    manifest.save()
+    return entries
 
 
-def compute_md5(file: Path):
-    """Compute the MD5 checksum of a file"""
-    hash_md5 = hashlib.md5()
-    with file.open("rb") as f:
-        for chunk in iter(lambda: f.read(4096), b""):
-            hash_md5.update(chunk)
-    return hash_md5.hexdigest()
-
+def s3_list_remote_files(
+    session: boto3.Session,
+    bucket_name: str,
+    too_many_requests=1_000_000,
+    manifest_path: Optional[Path] = None,
+    max_workers: int = DEFAULT_HEAD_WORKERS,
+) -> tuple[dict[str, str], dict[str, str]]:
+    """Return a list of all remote files.
 
-def s3_forcepull_directory(session: boto3.Session, bucket_name: str, local_directory: Path):
-    """Force-pull a directory from S3, deleting any local files that are not in the bucket
+    Return a tuple[{filepath: MD5}, {filepath: WebsiteRedirectLocation}].
+    The first item in the tuple represents regular files mapped to their MD5 checksum.
+    The second item in the tuple represents symlinks mapped to their target.
 
-    Use MD5 checksums to determine whether a file has been modified locally and needs to be re-downloaded.
+    See s3_list_remote_objects() for the arguments.
     """
-    s3 = session.client("s3")
+    entries = s3_list_remote_objects(session, bucket_name, too_many_requests, manifest_path, max_workers)
+    files = {}
+    redirects = {}
+    for filepath, entry in entries.items():
+        if entry["redirect"]:
+            redirects[filepath] = entry["redirect"]
+        else:
+            files[filepath] = entry["md5"]
+    tklogger.debug(f"Found {len(files)} files and {len(redirects)} redirects in S3 bucket {bucket_name}.")
 
-    remote_files, remote_symlinks = s3_list_remote_files(session, bucket_name)
+    return (files, redirects)
 
-    # Download files from bucket
-    for filepath, remote_checksum in remote_files.items():
-        local_file_path = local_directory / filepath
 
-        # Checksum comparison
-        should_download = True
-        if local_file_path.exists():
-            local_checksum = compute_md5(local_file_path)
-            should_download = local_checksum != remote_checksum
+DEFAULT_TRANSFER_WORKERS = 8
+"""How many files to upload or download at once"""
 
-        # Download file if it doesn't exist or checksum is different
-        if should_download:
-            tklogger.debug(f"Downloading {filepath}...")
-            local_file_path.parent.mkdir(parents=True, exist_ok=True)
-            s3.download_file(bucket_name, filepath, local_file_path.as_posix())
+DEFAULT_MULTIPART_CONCURRENCY = 10
+"""How many parts of one large file to upload or download at once"""
 
-    # Set local symlinks to match remote redirects
-    for s3link, s3target in remote_symlinks.items():
-        if s3target.startswith("http"):
-            tklogger.warning(
-                f"Skipping symlink {s3link} -> {s3target} because it is a full URL and not a relative path."
-            )
-            continue
-        local_link = local_directory / s3link
-        local_link.parent.mkdir(parents=True, exist_ok=True)
-        local_target_abs = local_directory / s3target.lstrip("/")
-        local_target = os.path.relpath(local_target_abs.as_posix(), local_link.parent.as_posix())
-        if local_link.exists() and local_link.is_symlink() and local_link.resolve() == local_target_abs:
-            tklogger.debug(
-                f"Skipping symlink {local_link.as_posix()} -> {local_target} because it is already up to date."
-            )
-        else:
-            if local_link.exists():
-                local_link.unlink()
-            tklogger.debug(f"Creating local symlink {local_link.as_posix()} -> {local_target}")
-            os.symlink(local_target, local_link.as_posix())
+DEFAULT_TRANSFER_RETRIES = 3
+"""How many times to retry a failed transfer before giving up on it"""
 
-    # Delete local files not present in bucket
-    local_files = set()
-    directories = set()
-    for local_file_path in local_directory.rglob("*"):
-        if local_file_path.is_file():
-            relative_path = str(local_file_path.relative_to(local_directory))
-            local_files.add(relative_path)
-            exists_remotely = relative_path in remote_files.keys() or relative_path in remote_symlinks.keys()
-            if not exists_remotely:
-                tklogger.debug(f"Deleting local file {relative_path}...")
-                local_file_path.unlink()
-        elif local_file_path.is_dir():
-            directories.add(local_file_path)
+DELETE_BATCH_SIZE = 1000
+"""The most keys that S3 will delete in one delete_objects call"""
 
-    # Delete empty directories
-    for directory in sorted(directories, key=lambda x: len(x.parts), reverse=True):
-        if not any(directory.iterdir()):
-            tklogger.debug(f"Deleting empty directory {directory}...")
-            directory.rmdir()
 
+class TransferError(Exception):
+    pass
 
-def s3_forcepush_directory(session: boto3.Session, bucket_name: str, local_directory: Path):
-    """Force-push a directory to S3, deleting any remote files that are not in the local directory.
 
-    Calculate a local MD5 checksum and add it as metadata to the S3 object.
-    We don't use ETag for this because it is not the MD5 checksum of the file contents for files uploaded as multipart uploads.
-    """
-    s3 = session.client("s3")
+class TransferScheduler:
+    """Upload, download, and delete objects in a bucket concurrently
 
-    # Get list of all remote files in S3 bucket with their checksums
-    remote_files, remote_symlinks = s3_list_remote_files(session, bucket_name)
+    Transfers are submitted with upload(), download(), and put(),
+    run in a pool of worker threads sharing one client,
+    and retried with a backoff if they fail.
+    Large files are transferred as multipart uploads/downloads by boto3,
+    with multipart_concurrency parts at once per file.
+    Deletions are collected with delete() and sent in batches of up to 1000 keys by wait().
 
-    # Keep track of local files
-    # This includes all files, including symlinks to files,
-    # but not directories or symlinks to directories.
-    # The loop below also ignores macOS garbage .DS_Store and ._* files
-    local_files_relpath_list = []
+    Progress in bytes and files is logged every progress_interval seconds.
 
-    # Upload local files to S3 if they are different or don't exist remotely
-    for local_file_path in list(local_directory.rglob("*")):
-        # Ignore goddamn fucking macOS gunk files
-        if local_file_path.name == ".DS_Store":
-            continue
-        if local_file_path.name.startswith("._"):
-            continue
+    Call wait() after submitting everything;
+    it raises TransferError if any transfer failed after all its retries.
+    """
 
-        # Ignore directories, as there is no concept of directories in S3.
-        # Note that is_file() returns False for symlinks which point to directories, which is good too.
+    def __init__(
+        self,
+        session: boto3.Session,
+        bucket_name: str,
+        max_workers: int = DEFAULT_TRANSFER_WORKERS,
+        multipart_concurrency: int = DEFAULT_MULTIPART_CONCURRENCY,
+        retries: int = DEFAULT_TRANSFER_RETRIES,
+        progress_interval: float = 5.0,
+    ):
+        self.bucket_name = bucket_name
+        self.retries = retries
+        self.progress_interval = progress_interval
+        # Each worker can have up to multipart_concurrency requests in flight
+        self.s3 = session.client(
+            "s3",
+            config=botocore.config.Config(max_pool_connections=max(max_workers * multipart_concurrency, 10)),
+        )
+        self.transfer_config = boto3.s3.transfer.TransferConfig(max_concurrency=multipart_concurrency)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="deaddrop-transfer")
+        self.futures: dict[Future, str] = {}
+        self.deletions: list[str] = []
+
+        self._lock = threading.Lock()
+        self.started = time.monotonic()
+        self.last_report = self.started
+        self.bytes_done = 0
+        self.files_done = 0
+
+    def _progress(self, nbytes: int):
+        """Count transferred bytes, and log progress if it has been a while"""
+        with self._lock:
+            self.bytes_done += nbytes
+            now = time.monotonic()
+            if now - self.last_report < self.progress_interval:
+                return
+            self.last_report = now
+            elapsed = now - self.started
+            done, total, transferred = self.files_done, len(self.futures), self.bytes_done
+        tklogger.info(
+            f"Transferred {transferred / 2**20:.1f} MiB in {done}/{total} files "
+            f"({transferred / 2**20 / elapsed:.1f} MiB/s)"
+        )
+
+    def _retry(self, description: str, func, progress: bool, **kwargs):
+        """Call func, retrying it with a backoff if it fails, and return its result
+
+        If progress is set, pass func a Callback that counts transferred bytes.
+        Bytes counted by a failed attempt are taken back out of the count,
+        since the retry transfers them again.
+        """
+        for attempt in range(self.retries + 1):
+            attempt_bytes = 0
+
+            def callback(nbytes: int):
+                nonlocal attempt_bytes
+                attempt_bytes += nbytes
+                self._progress(nbytes)
+
+            if progress:
+                kwargs["Callback"] = callback
+            try:
+                return func(**kwargs)
+            except (botocore.exceptions.BotoCoreError, botocore.exceptions.ClientError, OSError) as exc:
+                self._progress(-attempt_bytes)
+                if attempt == self.retries:
+                    raise
+                delay = 2**attempt
+                tklogger.warning(f"{description} failed, retrying in {delay}s: {exc}")
+                time.sleep(delay)
+
+    def _transfer(self, description: str, func, progress: bool, **kwargs):
+        self._retry(description, func, progress, **kwargs)
+        with self._lock:
+            self.files_done += 1
+        tklogger.debug(f"{description} done")
+
+    def _submit(self, description: str, func, progress: bool = False, **kwargs):
+        future = self.executor.submit(self._transfer, description, func, progress, **kwargs)
+        self.futures[future] = description
+
+    def upload(self, path: Path, key: str, extra_args: Optional[dict[str, Any]] = None):
+        """Upload a file, as a multipart upload if it is large"""
+        self._submit(
+            f"Upload {key}",
+            self.s3.upload_file,
+            progress=True,
+            Filename=path.as_posix(),
+            Bucket=self.bucket_name,
+            Key=key,
+            ExtraArgs=extra_args,
+            Config=self.transfer_config,
+        )
+
+    def download(self, key: str, path: Path):
+        """Download a file, as a multipart download if it is large"""
+        self._submit(
+            f"Download {key}",
+            self.s3.download_file,
+            progress=True,
+            Bucket=self.bucket_name,
+            Key=key,
+            Filename=path.as_posix(),
+            Config=self.transfer_config,
+        )
+
+    def put(self, key: str, **kwargs):
+        """Put a small object with no body, like a redirect"""
+        self._submit(f"Put {key}", self.s3.put_object, Bucket=self.bucket_name, Key=key, **kwargs)
+
+    def delete(self, key: str):
+        """Delete an object when wait() is called"""
+        self.deletions.append(key)
+
+    def _delete_batches(self) -> list[str]:
+        """Delete the collected keys in batches, returning a list of failures"""
+        failures = []
+        for idx in range(0, len(self.deletions), DELETE_BATCH_SIZE):
+            batch = self.deletions[idx : idx + DELETE_BATCH_SIZE]
+            tklogger.debug(f"Deleting {len(batch)} remote objects...")
+            try:
+                result = self._retry(
+                    f"Delete {len(batch)} objects",
+                    self.s3.delete_objects,
+                    progress=False,
+                    Bucket=self.bucket_name,
+                    Delete={"Objects": [{"Key": key} for key in batch], "Quiet": True},
+                )
+            except Exception as exc:
+                failures.append(f"Delete {len(batch)} objects starting with {batch[0]}: {exc}")
+                continue
+            # S3 reports per-key failures in the response, not as an exception
+            for error in result.get("Errors", []):
+                failures.append(f"Delete {error['Key']}: {error.get('Code')} {error.get('Message')}")
+        return failures
+
+    def wait(self):
+        """Wait for all transfers, then delete the collected keys
+
+        Deletions happen last, and not at all if a transfer failed,
+        like the old one-at-a-time loop which stopped at the first failure.
+        Raise TransferError if anything failed.
+        """
+        failures = []
+        for future in as_completed(self.futures):
+            exc = future.exception()
+            if exc is not None:
+                failures.append(f"{self.futures[future]}: {exc}")
+        self.executor.shutdown(wait=True)
+        if not failures:
+            failures.extend(self._delete_batches())
+        elapsed = time.monotonic() - self.started
+        deleted = f" and deleted {len(self.deletions)} objects" if self.deletions else ""
+        tklogger.info(
+            f"Transferred {self.bytes_done / 2**20:.1f} MiB in {self.files_done}/{len(self.futures)} files"
+            f"{deleted} in {elapsed:.1f}s"
+        )
+        if failures:
+            raise TransferError(f"{len(failures)} transfers failed:\n" + "\n".join(failures))
+
+
+DEFAULT_MAX_COST = 1.00
+"""The most a sync may cost in US dollars before we refuse to apply it, see SyncPlan.estimated_cost"""
+
+
+def _is_pushable(local_file_path: Path) -> bool:
+    """Return True if a local file should be pushed to the bucket"""
+    # Ignore goddamn fucking macOS gunk files
+    if local_file_path.name == ".DS_Store":
+        return False
+    if local_file_path.name.startswith("._"):
+        return False
+
+    # Ignore directories, as there is no concept of directories in S3.
+    # Note that is_file() returns False for symlinks which point to directories, which is good too.
+    return local_file_path.is_file()
+
+
+def scan_local_tree(
+    local_directory: Path, hashindex: LocalHashIndex, hash_only: Optional[set[str]] = None
+) -> LocalTree:
+    """Take a snapshot of the local replica for the sync planner
+
+    Checksums come from the hash index, which only hashes files that changed.
+    If hash_only is set, files not in it are not hashed at all,
+    because a pull will remove them without looking at their contents.
+    """
+    tree = LocalTree()
+    regular: dict[str, Path] = {}
+    root = local_directory.resolve()
+    for local_file_path in local_directory.rglob("*"):
         if not local_file_path.is_file():
             continue
-
-        relative_path = str(local_file_path.relative_to(local_directory))
-        local_files_relpath_list.append(relative_path)
-
-        # Handle symlinks
-        if local_file_path.is_symlink():
+        relative_path = local_file_path.relative_to(local_directory).as_posix()
+        if not _is_pushable(local_file_path):
+            tree.ignored.add(relative_path)
+        elif local_file_path.is_symlink():
             target = local_file_path.resolve()
             try:
-                reltarget = str(target.relative_to(local_directory))
                 # S3 Object Redirects must be absolute paths from bucket root with a leading slash (or a full URL).
-                abstarget = f"/{reltarget}"
+                tree.symlinks[relative_path] = f"/{target.relative_to(root).as_posix()}"
             except ValueError:
                 tklogger.warning(
-                    f"Skipping symlink {relative_path} -> {target} because it points outside of the local directory."
+                    f"Symlink {relative_path} -> {target} points outside of the local directory and cannot be pushed."
                 )
-                continue
-            if relative_path in remote_symlinks and remote_symlinks[relative_path] == abstarget:
-                tklogger.debug(f"Skipping symlink {relative_path} -> {abstarget} because it is already up to date.")
-            else:
-                tklogger.debug(f"Creating S3 Object Redirect for {relative_path} -> {abstarget}")
-                s3.put_object(Bucket=bucket_name, Key=relative_path, WebsiteRedirectLocation=abstarget)
-
-        # Handle regular files
+                tree.external.add(relative_path)
         else:
-            local_checksum = compute_md5(local_file_path)
-
-            exists_remotely = relative_path in remote_files.keys()
-            remote_checksum = remote_files.get(relative_path, "NONE")
-            checksum_matches = local_checksum == remote_checksum
-            tklogger.debug(
-                f"path relative/existsremote: {relative_path}/{exists_remotely}, checksum local/remote/matches: {local_checksum}/{remote_checksum}/{checksum_matches}"
-            )
-
-            if exists_remotely and checksum_matches:
-                tklogger.debug(f"Skipping {relative_path} because it is already up to date.")
-            else:
-                tklogger.debug(f"Uploading {relative_path}...")
-                extra_args: dict[str, Union[str, dict[str, str]]] = {}
-
-                extra_args["Metadata"] = {"md5": local_checksum}
-
-                # If you don't do this, browsing to these files will download them without displaying them.
-                # We mostly just care about this for the index/error html files.
-                if local_file_path.as_posix().endswith(".html"):
-                    extra_args["ContentType"] = "text/html"
-
-                # Note that upload_file enables multipart uploads for large files by default
-                s3.upload_file(
-                    Filename=local_file_path.as_posix(), Bucket=bucket_name, Key=relative_path, ExtraArgs=extra_args
-                )
+            regular[relative_path] = local_file_path
+
+    to_hash = [path for relpath, path in regular.items() if hash_only is None or relpath in hash_only]
+    checksums = hashindex.checksums(to_hash)
+    hashindex.prune(regular.values())
+    for relative_path, local_file_path in regular.items():
+        tree.files[relative_path] = LocalFile(checksums.get(local_file_path, ""), local_file_path.stat().st_size)
+    return tree
+
+
+def plan_sync(
+    session: boto3.Session,
+    bucket_name: str,
+    local_directory: Path,
+    direction: str,
+    hashindex: LocalHashIndex,
+    manifest_path: Optional[Path] = None,
+) -> SyncPlan:
+    """List the bucket, scan the local replica, and plan a push or pull between them
+
+    This doesn't change anything; see apply_sync_plan().
+    """
+    remote = s3_list_remote_objects(session, bucket_name, manifest_path=manifest_path)
+    if direction == "push":
+        return plan_push(scan_local_tree(local_directory, hashindex), remote)
+    elif direction == "pull":
+        remote_files = {key for key, entry in remote.items() if not entry["redirect"]}
+        return plan_pull(scan_local_tree(local_directory, hashindex, hash_only=remote_files), remote)
+    raise ValueError(f"Unknown sync direction {direction}")
+
+
+def apply_sync_plan(
+    session: boto3.Session,
+    bucket_name: str,
+    local_directory: Path,
+    plan: SyncPlan,
+    hashindex: LocalHashIndex,
+    max_workers: int = DEFAULT_TRANSFER_WORKERS,
+    multipart_concurrency: int = DEFAULT_MULTIPART_CONCURRENCY,
+):
+    """Make the changes in a sync plan
+
+    Transfers and bucket deletions are run by a TransferScheduler.
+    Local symlinks and removals happen after the transfers finish,
+    because boto3 downloads to temporary files next to the destination,
+    which we would otherwise remove.
+    """
+    transfers = TransferScheduler(session, bucket_name, max_workers, multipart_concurrency)
+    for action in plan.of_kind("upload", "redirect", "delete", "download"):
+        local_file_path = local_directory / action.path
+        if action.kind == "upload":
+            tklogger.debug(f"Uploading {action.path}...")
+            extra_args: dict[str, Union[str, dict[str, str]]] = {}
+
+            extra_args["Metadata"] = {"md5": action.md5}
+
+            # If you don't do this, browsing to these files will download them without displaying them.
+            # We mostly just care about this for the index/error html files.
+            if action.path.endswith(".html"):
+                extra_args["ContentType"] = "text/html"
+
+            # Note that upload_file enables multipart uploads for large files by default
+            transfers.upload(local_file_path, action.path, extra_args)
+        elif action.kind == "redirect":
+            tklogger.debug(f"Creating S3 Object Redirect for {action.path} -> {action.target}")
+            transfers.put(action.path, WebsiteRedirectLocation=action.target)
+        elif action.kind == "delete":
+            tklogger.debug(f"Deleting remote object {action.path}...")
+            transfers.delete(action.path)
+        elif action.kind == "download":
+            tklogger.debug(f"Downloading {action.path}...")
+            local_file_path.parent.mkdir(parents=True, exist_ok=True)
+            transfers.download(action.path, local_file_path)
+    transfers.wait()
+
+    # The bucket told us the checksums of the files we just downloaded, so don't hash them next time
+    for action in plan.of_kind("download"):
+        if action.md5:
+            hashindex.record(local_directory / action.path, action.md5)
+
+    # Set local symlinks to match remote redirects
+    for action in plan.of_kind("symlink"):
+        local_link = local_directory / action.path
+        local_link.parent.mkdir(parents=True, exist_ok=True)
+        local_target = os.path.relpath(
+            (local_directory / action.target.lstrip("/")).as_posix(), local_link.parent.as_posix()
+        )
+        if local_link.is_symlink() or local_link.exists():
+            local_link.unlink()
+        tklogger.debug(f"Creating local symlink {local_link.as_posix()} -> {local_target}")
+        os.symlink(local_target, local_link.as_posix())
+
+    # Delete local files not present in bucket
+    for action in plan.of_kind("remove"):
+        tklogger.debug(f"Deleting local file {action.path}...")
+        (local_directory / action.path).unlink()
+
+    # Delete empty directories
+    if plan.direction == "pull":
+        directories = [path for path in local_directory.rglob("*") if path.is_dir() and not path.is_symlink()]
+        for directory in sorted(directories, key=lambda x: len(x.parts), reverse=True):
+            if not any(directory.iterdir()):
+                tklogger.debug(f"Deleting empty directory {directory}...")
+                directory.rmdir()
+
+
+def check_plan_cost(plan: SyncPlan, max_cost: Optional[float]):
+    """Raise S3PriceWarningError if a plan would cost more than max_cost US dollars"""
+    if max_cost is not None and plan.estimated_cost > max_cost:
+        raise S3PriceWarningError(
+            f"This {plan.direction} would cost about ${plan.estimated_cost:.2f}, more than the limit of ${max_cost:.2f}. "
+            "Check it with 'tk deaddrop plan' and raise the limit if you're sure you want to do this."
+        )
+
+
+def s3_forcepull_directory(
+    session: boto3.Session,
+    bucket_name: str,
+    local_directory: Path,
+    manifest_path: Optional[Path] = None,
+    max_workers: int = DEFAULT_TRANSFER_WORKERS,
+    multipart_concurrency: int = DEFAULT_MULTIPART_CONCURRENCY,
+    hashindex_path: Optional[Path] = None,
+    max_cost: Optional[float] = DEFAULT_MAX_COST,
+):
+    """Force-pull a directory from S3, deleting any local files that are not in the bucket
 
-    # Delete files from S3 bucket not present in local directory
-    files_to_delete = [f for f in remote_files.keys() if f not in local_files_relpath_list]
-    for file_key in files_to_delete:
-        tklogger.debug(f"Deleting remote file {file_key}...")
-        s3.delete_object(Bucket=bucket_name, Key=file_key)
+    Use MD5 checksums to determine whether a file has been modified locally and needs to be re-downloaded.
+    Local checksums are kept in a LocalHashIndex at hashindex_path, if it is set.
+    See plan_pull() for what this does.
+    """
+    with LocalHashIndex(local_directory, hashindex_path) as hashindex:
+        plan = plan_sync(session, bucket_name, local_directory, "pull", hashindex, manifest_path)
+        tklogger.info(plan.format(verbose=False))
+        check_plan_cost(plan, max_cost)
+        apply_sync_plan(session, bucket_name, local_directory, plan, hashindex, max_workers, multipart_concurrency)
 
-    # Delete redirecting objects from S3 bucket not present as symlinks in local directory
-    links_to_delete = [f for f in remote_symlinks.keys() if f not in local_files_relpath_list]
-    for link_key in links_to_delete:
-        tklogger.debug(f"Deleting remote symlink {link_key}...")
-        s3.delete_object(Bucket=bucket_name, Key=link_key)
+
+def s3_forcepush_directory(
+    session: boto3.Session,
+    bucket_name: str,
+    local_directory: Path,
+    manifest_path: Optional[Path] = None,
+    max_workers: int = DEFAULT_TRANSFER_WORKERS,
+    multipart_concurrency: int = DEFAULT_MULTIPART_CONCURRENCY,
+    hashindex_path: Optional[Path] = None,
+    max_cost: Optional[float] = DEFAULT_MAX_COST,
+):
+    """Force-push a directory to S3, deleting any remote files that are not in the local directory.
+
+    Calculate a local MD5 checksum and add it as metadata to the S3 object.
+    We don't use ETag for this because it is not the MD5 checksum of the file contents for files uploaded as multipart uploads.
+    Local checksums are kept in a LocalHashIndex at hashindex_path, if it is set.
+    See plan_push() for what this does.
+    """
+    with LocalHashIndex(local_directory, hashindex_path) as hashindex:
+        plan = plan_sync(session, bucket_name, local_directory, "push", hashindex, manifest_path)
+        tklogger.info(plan.format(verbose=False))
+        check_plan_cost(plan, max_cost)
+        apply_sync_plan(session, bucket_name, local_directory, plan, hashindex, max_workers, multipart_concurrency)
 
 
 deaddrop_error_html = """
@@ -276,7 +633,16 @@ deaddrop_index_html = """
 """
 
 
-def s3_forcepush_deaddrop(session: boto3.Session, bucket_name: str, local_directory: Path):
+def s3_forcepush_deaddrop(
+    session: boto3.Session,
+    bucket_name: str,
+    local_directory: Path,
+    manifest_path: Optional[Path] = None,
+    max_workers: int = DEFAULT_TRANSFER_WORKERS,
+    multipart_concurrency: int = DEFAULT_MULTIPART_CONCURRENCY,
+    hashindex_path: Optional[Path] = None,
+    max_cost: Optional[float] = DEFAULT_MAX_COST,
+):
     """Force-push the local directory to the deaddrop S3 bucket
 
     Wrapper function for s3_forcepush_directory that also writes the error and index pages.
@@ -289,4 +655,13 @@ def s3_forcepush_deaddrop(session: boto3.Session, bucket_name: str, local_direct
         f.write(deaddrop_index_html)
 
     # Upload
-    s3_forcepush_directory(session, bucket_name, local_directory)
+    s3_forcepush_directory(
+        session,
+        bucket_name,
+        local_directory,
+        manifest_path,
+        max_workers,
+        multipart_concurrency,
+        hashindex_path,
+        max_cost,
+    )
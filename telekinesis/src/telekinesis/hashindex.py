@@ -0,0 +1,127 @@
+"""A persistent index of local file checksums
+
+Syncing the deaddrop compares the md5 checksum of every local file with the one in the bucket,
+and the local replica holds ostars and ISOs of hundreds of megabytes each.
+Rather than hashing everything on every sync,
+keep the checksums in a small SQLite database keyed by path,
+and only hash files whose size, mtime, or inode have changed since they were last hashed.
+Files that do need hashing are hashed in a process pool, since md5 is CPU bound.
+"""
+
+import hashlib
+import os
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Iterable, Optional
+
+from telekinesis import tklogger
+
+
+HASH_CHUNK_SIZE = 1024 * 1024
+"""How much of a file to read at once when hashing it"""
+
+
+def md5_file(path: str) -> str:
+    """Compute the MD5 checksum of a file"""
+    hash_md5 = hashlib.md5()
+    with open(path, "rb") as f:
+        while chunk := f.read(HASH_CHUNK_SIZE):
+            hash_md5.update(chunk)
+    return hash_md5.hexdigest()
+
+
+class LocalHashIndex:
+    """A SQLite database of md5 checksums for files in a directory
+
+    Arguments:
+    root:           The directory; paths in the database are relative to it
+    path:           The database file, or None to keep the index in memory for this process only.
+                    This must not be inside root, or syncing root would sync the index too.
+    max_workers:    How many processes to hash files with, or None for one per CPU
+    """
+
+    def __init__(self, root: Path, path: Optional[Path] = None, max_workers: Optional[int] = None):
+        self.root = root
+        self.path = path
+        self.max_workers = max_workers
+        if path is not None:
+            path.parent.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(path.as_posix() if path is not None else ":memory:")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS files "
+            "(path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, inode INTEGER, md5 TEXT)"
+        )
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self) -> "LocalHashIndex":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _relpath(self, file: Path) -> str:
+        return file.relative_to(self.root).as_posix()
+
+    def _lookup(self, relpath: str, stat: os.stat_result) -> Optional[str]:
+        row = self.db.execute(
+            "SELECT md5 FROM files WHERE path = ? AND size = ? AND mtime_ns = ? AND inode = ?",
+            (relpath, stat.st_size, stat.st_mtime_ns, stat.st_ino),
+        ).fetchone()
+        return row[0] if row else None
+
+    def _store(self, relpath: str, stat: os.stat_result, md5: str):
+        self.db.execute(
+            "INSERT OR REPLACE INTO files (path, size, mtime_ns, inode, md5) VALUES (?, ?, ?, ?, ?)",
+            (relpath, stat.st_size, stat.st_mtime_ns, stat.st_ino, md5),
+        )
+
+    def checksums(self, files: Iterable[Path]) -> dict[Path, str]:
+        """Return the md5 checksum of each file, hashing only the files that changed since last time
+
+        A file that changes while it is being hashed will have a different mtime afterwards,
+        so its checksum is returned but not stored, and it is hashed again next time.
+        """
+        result: dict[Path, str] = {}
+        stale: list[tuple[Path, str, os.stat_result]] = []
+        for file in files:
+            relpath = self._relpath(file)
+            stat = file.stat()
+            md5 = self._lookup(relpath, stat)
+            if md5 is None:
+                stale.append((file, relpath, stat))
+            else:
+                result[file] = md5
+
+        if stale:
+            tklogger.debug(f"Hashing {len(stale)} new or modified files, {len(result)} are unchanged")
+            paths = [file.as_posix() for file, _, _ in stale]
+            if len(stale) == 1:
+                md5s = [md5_file(paths[0])]
+            else:
+                with ProcessPoolExecutor(max_workers=self.max_workers) as executor:
+                    md5s = list(executor.map(md5_file, paths, chunksize=16))
+            for (file, relpath, stat), md5 in zip(stale, md5s):
+                result[file] = md5
+                if file.stat().st_mtime_ns == stat.st_mtime_ns:
+                    self._store(relpath, stat, md5)
+            self.db.commit()
+
+        return result
+
+    def record(self, file: Path, md5: str):
+        """Record the checksum of a file we already know, like one we just downloaded"""
+        self._store(self._relpath(file), file.stat(), md5)
+        self.db.commit()
+
+    def prune(self, keep: Iterable[Path]):
+        """Forget every file except these"""
+        keep_relpaths = {self._relpath(file) for file in keep}
+        indexed = [row[0] for row in self.db.execute("SELECT path FROM files")]
+        forget = [(relpath,) for relpath in indexed if relpath not in keep_relpaths]
+        if forget:
+            self.db.executemany("DELETE FROM files WHERE path = ?", forget)
+            self.db.commit()
+            tklogger.debug(f"Removed {len(forget)} files from the hash index")
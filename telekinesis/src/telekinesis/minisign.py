@@ -1,7 +1,20 @@
-"""Minisign signing and verification."""
+"""Minisign signing and verification.
+
+sign() uses the minisign binary, which reads the whole file.
+sign_hash() signs a BLAKE2b-512 hash that the caller already computed while writing the file.
+The minisign binary can't sign a hash, so this happens in-process:
+neuralupgrade's code decrypts the secret key and builds the signature file,
+but the Ed25519 signing itself is done by the cryptography package (OpenSSL),
+because neuralupgrade's pure Python Ed25519 is not constant-time and so is not safe to sign with our real key.
+Verification happens in-process with neuralupgrade's verifier,
+which caches results so that verifying the same unchanged file again doesn't read it again.
+"""
 
 import subprocess
-from typing import Union
+import sys
+import threading
+from pathlib import Path
+from typing import Any, Optional, Union
 
 from telekinesis.config import tkconfig
 from telekinesis.tksecrets import gopass_get
@@ -22,12 +35,68 @@ def sign(files: Union[str, list[str]], trusted_comment: str = "", untrusted_comm
     return result.stdout.strip()
 
 
-def verify(file: str) -> str:
-    """Verify a file with minisign and return the verified trusted comment."""
-    result = subprocess.run(
-        ["minisign", "-V", "-Q", "-p", tkconfig.repopaths.minisign_pubkey, "-m", file],
-        check=True,
-        text=True,
-        capture_output=True,
+def _neuralupgrade_minisign():
+    """Import neuralupgrade's minisign module from the source tree
+
+    neuralupgrade is not a dependency of telekinesis,
+    so add its source directory to the path like we do for progfiguration.
+    """
+    srcroot = (tkconfig.repopaths.neuralupgrade / "src").as_posix()
+    if srcroot not in sys.path:
+        sys.path.append(srcroot)
+    from neuralupgrade import minisign as nu_minisign
+
+    return nu_minisign
+
+
+_secret_key: Optional[tuple[Any, Any]] = None
+_secret_key_lock = threading.Lock()
+
+
+def _get_secret_key():
+    """Decrypt the minisign secret key, once per process
+
+    Decrypting it takes a few seconds and a gigabyte of memory for scrypt,
+    so builds signing several files at once share it.
+    Returns the neuralupgrade SecretKey and an equivalent cryptography Ed25519PrivateKey.
+    """
+    global _secret_key
+    with _secret_key_lock:
+        if _secret_key is None:
+            from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey
+
+            nu_minisign = _neuralupgrade_minisign()
+            mspassword = gopass_get("psyopsOS/minisign.seckey.pw")
+            seckey = nu_minisign.SecretKey.from_file(tkconfig.repopaths.minisign_seckey.as_posix(), mspassword)
+            _secret_key = (seckey, Ed25519PrivateKey.from_private_bytes(seckey.seed))
+        return _secret_key
+
+
+def sign_hash(file: Union[str, Path], digest: bytes, trusted_comment: str, untrusted_comment: str = "") -> str:
+    """Sign a file given the BLAKE2b-512 hash of its contents, writing file + ".minisig"
+
+    The file itself is not read.
+    Returns the contents of the signature file.
+    """
+    nu_minisign = _neuralupgrade_minisign()
+    seckey, private_key = _get_secret_key()
+    hash_signature = private_key.sign(digest)
+    signature = nu_minisign.Signature(
+        untrusted_comment=untrusted_comment or "signature from minisign secret key",
+        algorithm=nu_minisign.ALG_PREHASHED,
+        keyid=seckey.keyid,
+        signature=hash_signature,
+        trusted_comment=trusted_comment,
+        global_signature=private_key.sign(hash_signature + trusted_comment.encode()),
     )
-    return result.stdout.strip()
+    signature_text = signature.to_string()
+    with open(f"{file}.minisig", "w") as f:
+        f.write(signature_text)
+    return signature_text
+
+
+def verify(file: Union[str, Path]) -> str:
+    """Verify a file against file + ".minisig" and return the verified trusted comment."""
+    nu_minisign = _neuralupgrade_minisign()
+    pubkey = nu_minisign.PublicKey.from_file(tkconfig.repopaths.minisign_pubkey)
+    return nu_minisign.verify_file_cached(str(file), pubkey)
@@ -0,0 +1,255 @@
+"""Run independent build pipelines concurrently
+
+A release build does the same work for each architecture:
+build the container, build the APKs, build the kernel and squashfs, make the ostar, and so on.
+The architectures don't depend on each other, and each has its own build container and Docker volumes,
+so there's no reason an aarch64 build (which is slow, because it's emulated) should wait for the x86_64 build.
+
+run_pipelines() takes a pipeline function for each architecture and runs them in threads.
+Output from a pipeline is prefixed with its name, like "[x86_64] ",
+including output from subprocesses run with run() rather than subprocess.run() directly.
+If one pipeline fails, the others are stopped (fail-fast), unless keep_going is set.
+"""
+
+import logging
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import Any, Callable, TextIO
+
+from telekinesis import tklogger
+
+
+_local = threading.local()
+"""Thread-local state: the prefix of the pipeline running in this thread"""
+
+_output_lock = threading.Lock()
+"""Held while writing a line of output, so that lines from different pipelines don't mix"""
+
+_cancelled = threading.Event()
+"""Set when a pipeline fails in fail-fast mode, so that the others stop"""
+
+_processes_lock = threading.Lock()
+_processes: set[subprocess.Popen] = set()
+"""Subprocesses started by pipelines, which are terminated if the build is cancelled"""
+
+
+class PipelineCancelled(Exception):
+    """Raised in a pipeline that was stopped because another pipeline failed"""
+
+    pass
+
+
+class PipelineError(Exception):
+    """Raised when more than one pipeline failed
+
+    Arguments:
+    failures: A dict of pipeline names to the exception each one raised
+    """
+
+    def __init__(self, failures: dict[str, Exception]):
+        self.failures = failures
+        super().__init__(
+            f"{len(failures)} pipelines failed: " + ", ".join(f"{name} ({exc})" for name, exc in failures.items())
+        )
+
+
+def current_prefix() -> str:
+    """Return the output prefix of the pipeline running in this thread, or "" outside of a pipeline"""
+    return getattr(_local, "prefix", "")
+
+
+class PrefixedStream:
+    """A wrapper around sys.stdout or sys.stderr that prefixes each line written from a pipeline thread
+
+    Each thread's partial lines are buffered until they're finished,
+    so that a line printed in several writes isn't split up by lines from another pipeline.
+    """
+
+    def __init__(self, stream: TextIO):
+        self.stream = stream
+        self._partial = threading.local()
+
+    def write(self, text: str) -> int:
+        prefix = current_prefix()
+        if not prefix:
+            with _output_lock:
+                return self.stream.write(text)
+        buffered = getattr(self._partial, "text", "") + text
+        *lines, self._partial.text = buffered.split("\n")
+        if lines:
+            with _output_lock:
+                for line in lines:
+                    self.stream.write(f"{prefix}{line}\n")
+                self.stream.flush()
+        return len(text)
+
+    def flush(self):
+        prefix = current_prefix()
+        partial = getattr(self._partial, "text", "")
+        with _output_lock:
+            if prefix and partial:
+                self.stream.write(f"{prefix}{partial}\n")
+                self._partial.text = ""
+            self.stream.flush()
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.stream, name)
+
+
+class PrefixFilter(logging.Filter):
+    """A logging filter that sets the "prefix" attribute on each record to the pipeline prefix
+
+    Add it to a handler whose formatter uses "%(prefix)s".
+    """
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.prefix = current_prefix()
+        return True
+
+
+def run(cmd, **kwargs) -> subprocess.CompletedProcess:
+    """Run a command like subprocess.run(), prefixing its output if it's run from a pipeline
+
+    Outside of a pipeline, or when the caller captures or redirects output or passes input,
+    this is just subprocess.run().
+    Inside a pipeline, stdout and stderr are read line by line and written with the pipeline prefix,
+    and the process is terminated if another pipeline fails.
+    """
+    prefix = current_prefix()
+    if not prefix or kwargs.keys() & {"capture_output", "stdout", "stderr", "input"}:
+        return subprocess.run(cmd, **kwargs)
+
+    if _cancelled.is_set():
+        raise PipelineCancelled(f"Not running {cmd}, the build was cancelled")
+    check = kwargs.pop("check", False)
+    process = subprocess.Popen(
+        cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, errors="replace", **kwargs
+    )
+    with _processes_lock:
+        _processes.add(process)
+    try:
+        assert process.stdout is not None
+        for line in process.stdout:
+            sys.stdout.write(line)
+        returncode = process.wait()
+    finally:
+        with _processes_lock:
+            _processes.discard(process)
+    if _cancelled.is_set() and returncode != 0:
+        raise PipelineCancelled(f"Stopped {cmd}, the build was cancelled")
+    if check and returncode != 0:
+        raise subprocess.CalledProcessError(returncode, cmd)
+    return subprocess.CompletedProcess(cmd, returncode)
+
+
+def run_concurrently(*functions: Callable[[], Any]) -> list[Any]:
+    """Call functions that take no arguments in threads, and return their results in order
+
+    Output from each thread gets the prefix of the pipeline that called this, if any.
+    If any function raises an exception, the first one is re-raised once they have all finished.
+    """
+    prefix = current_prefix()
+
+    def call(function: Callable[[], Any]) -> Any:
+        _local.prefix = prefix
+        try:
+            return function()
+        finally:
+            if prefix:
+                sys.stdout.flush()
+                sys.stderr.flush()
+            _local.prefix = ""
+
+    with ThreadPoolExecutor(max_workers=max(len(functions), 1), thread_name_prefix="concurrent") as executor:
+        futures = [executor.submit(call, function) for function in functions]
+    return [future.result() for future in futures]
+
+
+def _cancel():
+    """Stop every running pipeline by terminating its subprocesses"""
+    _cancelled.set()
+    with _processes_lock:
+        for process in _processes:
+            process.terminate()
+
+
+def run_pipelines(
+    pipelines: dict[str, Callable[[], None]],
+    max_parallel: int = 2,
+    keep_going: bool = False,
+):
+    """Run build pipelines, up to max_parallel at once
+
+    Arguments:
+    pipelines:      A dict of pipeline names (like architecture names) to functions that take no arguments
+    max_parallel:   How many pipelines to run at once.
+                    With 1, or with only one pipeline, they run one after another in this thread without prefixes,
+                    which is what interactive builds need.
+    keep_going:     If a pipeline fails, let the others finish instead of stopping them
+
+    If one pipeline fails, its exception is re-raised once the others have stopped;
+    if several fail, a PipelineError is raised.
+    """
+    results: dict[str, str] = {name: "skipped" for name in pipelines}
+    failures: dict[str, Exception] = {}
+    elapsed: dict[str, float] = {}
+    width = max((len(name) for name in pipelines), default=0)
+    _cancelled.clear()
+
+    def run_one(name: str, pipeline: Callable[[], None], prefix: str):
+        if _cancelled.is_set():
+            return
+        _local.prefix = prefix
+        start = time.monotonic()
+        try:
+            pipeline()
+            results[name] = "ok"
+        except Exception as exc:
+            if _cancelled.is_set():
+                results[name] = "cancelled"
+            else:
+                results[name] = "failed"
+                failures[name] = exc
+                tklogger.error(f"Pipeline {name} failed: {exc}")
+                if not keep_going:
+                    _cancel()
+        finally:
+            elapsed[name] = time.monotonic() - start
+            if prefix:
+                sys.stdout.flush()
+                sys.stderr.flush()
+            _local.prefix = ""
+
+    if max_parallel <= 1 or len(pipelines) <= 1:
+        for name, pipeline in pipelines.items():
+            run_one(name, pipeline, "")
+    else:
+        stdout, stderr = sys.stdout, sys.stderr
+        sys.stdout, sys.stderr = PrefixedStream(stdout), PrefixedStream(stderr)
+        try:
+            with ThreadPoolExecutor(max_workers=max_parallel, thread_name_prefix="pipeline") as executor:
+                futures = [
+                    executor.submit(run_one, name, pipeline, f"[{name:<{width}}] ")
+                    for name, pipeline in pipelines.items()
+                ]
+                try:
+                    wait(futures)
+                except KeyboardInterrupt:
+                    _cancel()
+                    raise
+        finally:
+            sys.stdout, sys.stderr = stdout, stderr
+
+    if len(pipelines) > 1:
+        print("Pipeline summary:")
+        for name in pipelines:
+            took = f" in {elapsed[name]:.0f}s" if name in elapsed else ""
+            print(f"  {name:<{width}}  {results[name]}{took}")
+
+    if len(failures) == 1:
+        raise next(iter(failures.values()))
+    elif failures:
+        raise PipelineError(failures)
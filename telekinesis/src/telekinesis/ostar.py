@@ -0,0 +1,209 @@
+"""Write reproducible OS tarballs in one pass
+
+An ostar is an uncompressed tarball of the kernel, squashfs, initramfs, and so on, around 630MB.
+Writing it with tarfile.add() records the mtime, owner, and mode of each file,
+so two builds of the same inputs made different tarballs,
+and signing it with the minisign binary read the whole thing again.
+
+OstarWriter instead writes members in the order they are added (and directories in sorted order),
+with a fixed mtime, root ownership, and normalized modes,
+so the same inputs always make a byte-identical tarball.
+While writing, it computes the BLAKE2b-512 hash of the whole tarball,
+which is what a minisign prehashed signature signs,
+and the SHA-256 of each member, which is saved in a members manifest next to the tarball.
+Given a chunker, it also records the regions of the chunk manifest used for delta updates,
+so that nothing has to read the tarball back after it is written.
+"""
+
+import hashlib
+import json
+import os
+import stat
+import tarfile
+from pathlib import Path
+from typing import Any, BinaryIO, Callable, Optional, Union
+
+
+MEMBERS_SUFFIX = ".members.json"
+"""Appended to the tarball path to get the members manifest path"""
+
+MEMBERS_FORMAT = "psyopsOS-ostar-members-v1"
+
+READ_SIZE = 4 * 1024 * 1024
+
+
+def source_date_epoch() -> int:
+    """The mtime to give every member, from SOURCE_DATE_EPOCH like other reproducible builds, or 0"""
+    return int(os.environ.get("SOURCE_DATE_EPOCH", "0"))
+
+
+class _HashingWriter:
+    """A file object that hashes everything written to it before writing it to the underlying file
+
+    If literals is set, it also keeps a copy of everything written outside of the member data range,
+    which is the tar headers, padding, and end-of-archive marker that go in the chunk manifest.
+    """
+
+    def __init__(self, fileobj: BinaryIO, literals: bool = False):
+        self.fileobj = fileobj
+        self.blake2b = hashlib.blake2b(digest_size=64)
+        self.size = 0
+        self.literal: Optional[bytearray] = bytearray() if literals else None
+        self.member_start = self.member_end = 0
+        """The range of the tarball holding the data of the member being written, which isn't kept in literal"""
+
+    def write(self, data: bytes) -> int:
+        self.blake2b.update(data)
+        start = self.size
+        self.size += len(data)
+        if self.literal is not None:
+            if start < self.member_start:
+                self.literal += data[: min(self.size, self.member_start) - start]
+            if self.size > self.member_end:
+                self.literal += data[max(start, self.member_end) - start :]
+        return self.fileobj.write(data)
+
+    def tell(self) -> int:
+        return self.size
+
+
+class _MemberReader:
+    """A file object that hashes everything read from it, and chunks it if given a chunker"""
+
+    def __init__(self, fileobj: BinaryIO, chunker: Optional[Any] = None):
+        self.fileobj = fileobj
+        self.sha256 = hashlib.sha256()
+        self.chunker = chunker
+
+    def read(self, size: int = -1) -> bytes:
+        data = self.fileobj.read(size)
+        self.sha256.update(data)
+        if self.chunker is not None:
+            self.chunker.update(data)
+        return data
+
+
+class OstarWriter:
+    """Write a reproducible tarball, hashing it as it is written
+
+    Use it like:
+
+        with OstarWriter(path) as writer:
+            writer.add(osdir / "kernel", "kernel")
+            ...
+        sign(path, writer.blake2b)
+
+    The tarball is written to a temporary file and renamed into place when the writer is closed,
+    along with the members manifest.
+
+    Arguments:
+    - path: Where to write the tarball
+    - mtime: The mtime of every member, defaulting to source_date_epoch()
+    - chunker: A function returning a new content-defined chunker, like neuralupgrade.delta.Chunker;
+      if set, the writer records the chunk manifest regions in regions
+    """
+
+    def __init__(self, path: Path, mtime: Optional[int] = None, chunker: Optional[Callable[[], Any]] = None):
+        self.path = path
+        self.mtime = source_date_epoch() if mtime is None else mtime
+        self.members: dict[str, dict] = {}
+        """Each regular file member's name, mapped to its size and SHA-256"""
+        self.regions: list[Union[bytes, tuple[str, int, list[tuple[str, int]]]]] = []
+        """The chunk manifest regions if there is a chunker, set when the writer is closed
+
+        Each is either literal bytes, or a (member name, offset of its data, chunks) tuple for a nonempty regular file.
+        """
+        self.blake2b = b""
+        """The BLAKE2b-512 hash of the whole tarball, set when the writer is closed"""
+        self.size = 0
+        """The size of the whole tarball, set when the writer is closed"""
+        self._chunker = chunker
+        self._literal_start = 0
+        self._tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        self._file = self._tmp.open("wb")
+        self._writer = _HashingWriter(self._file, literals=chunker is not None)
+        self._tar = tarfile.open(fileobj=self._writer, mode="w", format=tarfile.GNU_FORMAT, copybufsize=READ_SIZE)
+
+    def _tarinfo(self, arcname: str, st: os.stat_result) -> tarfile.TarInfo:
+        info = tarfile.TarInfo(arcname)
+        info.mtime = self.mtime
+        info.uid = info.gid = 0
+        info.uname = info.gname = "root"
+        if stat.S_ISDIR(st.st_mode):
+            info.type = tarfile.DIRTYPE
+            info.mode = 0o755
+        elif stat.S_ISLNK(st.st_mode):
+            info.type = tarfile.SYMTYPE
+            info.mode = 0o777
+        else:
+            info.size = st.st_size
+            info.mode = 0o755 if st.st_mode & 0o111 else 0o644
+        return info
+
+    def add(self, path: Path, arcname: str):
+        """Add a file, or a directory and everything in it
+
+        Symlinks are stored as symlinks, not followed, like tarfile.add() does.
+        """
+        st = path.lstat()
+        info = self._tarinfo(arcname, st)
+        if info.issym():
+            info.linkname = os.readlink(path)
+            self._tar.addfile(info)
+            return
+        if info.isdir():
+            self._tar.addfile(info)
+            for child in sorted(path.iterdir()):
+                self.add(child, f"{arcname}/{child.name}")
+            return
+        chunker = self._chunker() if self._chunker is not None and info.size > 0 else None
+        if chunker is not None:
+            header = info.tobuf(self._tar.format, self._tar.encoding, self._tar.errors)
+            offset = self._writer.size + len(header)
+            self._writer.member_start, self._writer.member_end = offset, offset + info.size
+        with path.open("rb") as f:
+            reader = _MemberReader(f, chunker)
+            self._tar.addfile(info, reader)
+        self.members[arcname] = {"size": info.size, "sha256": reader.sha256.hexdigest()}
+        if chunker is not None:
+            # The literal buffer holds everything since the previous member's data, and the padding after this one's
+            literal = self._writer.literal
+            split = offset - self._literal_start
+            self.regions.append(bytes(literal[:split]))
+            self.regions.append((arcname, offset, chunker.finish()))
+            del literal[:split]
+            self._literal_start = offset + info.size
+
+    @property
+    def members_path(self) -> Path:
+        return self.path.with_name(self.path.name + MEMBERS_SUFFIX)
+
+    def members_manifest(self) -> bytes:
+        """The members manifest, as the bytes written to members_path"""
+        manifest = {"format": MEMBERS_FORMAT, "members": self.members}
+        return json.dumps(manifest, indent=2).encode() + b"\n"
+
+    def close(self):
+        """Finish the tarball, move it into place, and write the members manifest"""
+        self._tar.close()
+        self._file.close()
+        self.blake2b = self._writer.blake2b.digest()
+        self.size = self._writer.size
+        if self._writer.literal is not None:
+            self.regions.append(bytes(self._writer.literal))
+        os.replace(self._tmp, self.path)
+        self.members_path.write_bytes(self.members_manifest())
+
+    def abort(self):
+        """Remove the partial tarball"""
+        self._file.close()
+        self._tmp.unlink(missing_ok=True)
+
+    def __enter__(self) -> "OstarWriter":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
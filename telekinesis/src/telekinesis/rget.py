@@ -1,24 +1,265 @@
-"""Download files with requests"""
+"""Download files with requests
 
+Downloads go to a cache directory shared by every architecture (and every psyops checkout),
+and are then hard linked (or copied) to where the caller asked for them.
+Next to each cached file is a FILE.meta.json with the URL, its ETag and Last-Modified headers,
+and the size, mtime, and SHA-256 of the file, so that:
+
+* Every URL has an expected SHA-256, either passed by the caller or pinned in tkconfig.repopaths.requisite_pins,
+  and a download that doesn't match it is an error.
+* A URL that isn't pinned yet is pinned on first use:
+  its SHA-256 is recorded in the pins file with a warning, and should be checked and committed.
+* A cached file whose expected SHA-256 is known is used without contacting the server at all.
+* Otherwise, the server is asked with a conditional request (If-None-Match / If-Modified-Since)
+  and only sends the file again if it has changed.
+* A cached file that was changed or truncated since it was downloaded is noticed and downloaded again.
+* An interrupted download is kept as FILE.part and resumed with a Range request.
+* If the server can't be reached but a complete cached copy exists, the cached copy is used.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import threading
 from pathlib import Path
+from typing import Optional
+from urllib.parse import urlparse
 
 import requests
 
+from telekinesis import tklogger
+from telekinesis.config import tkconfig
+
+
+CHUNK_SIZE = 1024 * 1024
+"""How much to read from the network and write to disk at once"""
+
+TIMEOUT = 30
+"""Seconds to wait to connect, and between bytes received"""
+
+_url_locks: dict[str, threading.Lock] = {}
+"""A lock for each URL, so that two threads never download the same URL at once"""
+_url_locks_lock = threading.Lock()
+
+_checked: set[str] = set()
+"""URLs already downloaded or checked for changes by this process, which aren't checked again"""
+
+_pins_lock = threading.Lock()
+"""Held while updating the pins file, which is shared by every URL"""
+
+
+class ChecksumMismatchError(Exception):
+    """Raised when a downloaded file doesn't have the expected SHA-256"""
+
+    pass
 
-def rget(url: str, filepath: Path, no_clobber=True):
-    """Downloads a file from the given URL and saves it locally.
 
-    If no_clobber is True (default), this function will not redownload an existing file.
+def _load_pins(pins_path: Path) -> dict[str, str]:
+    try:
+        with pins_path.open() as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def _pin_on_first_use(pins_path: Path, url: str, digest: str, previous: Optional[str]):
+    """Record the SHA-256 of a URL that wasn't pinned, so that it is verified from now on"""
+    if previous is not None and previous != digest:
+        tklogger.warning(
+            f"UNVERIFIED DOWNLOAD: {url} changed on the server since it was cached, "
+            f"from SHA-256 {previous} to {digest}"
+        )
+    with _pins_lock:
+        pins = _load_pins(pins_path)
+        pins[url] = digest
+        tmp = pins_path.with_name(f"{pins_path.name}.{os.getpid()}.tmp")
+        tmp.write_text(json.dumps(pins, indent=2, sort_keys=True) + "\n")
+        os.replace(tmp, pins_path)
+    tklogger.warning(
+        f"UNVERIFIED DOWNLOAD: no SHA-256 was pinned for {url}, so it was not verified. "
+        f"Pinned its SHA-256 {digest} in {pins_path} on first use; check it and commit it."
+    )
+
+
+def _url_lock(url: str) -> threading.Lock:
+    with _url_locks_lock:
+        return _url_locks.setdefault(url, threading.Lock())
+
+
+def cache_path(cache_dir: Path, url: str) -> Path:
+    """The path to the cached copy of a URL
+
+    The name is the last part of the URL path, prefixed with a hash of the whole URL,
+    so that two URLs with the same filename don't collide.
     """
-    if no_clobber and filepath.exists():
-        return
-    filepath.parent.mkdir(parents=True, exist_ok=True)
-    response = requests.get(url, stream=True)
-    if response.status_code == 200:
-        with filepath.open("wb") as file:
-            for chunk in response.iter_content(chunk_size=128):
-                file.write(chunk)
+    name = os.path.basename(urlparse(url).path) or "index"
+    urlhash = hashlib.sha256(url.encode()).hexdigest()[:12]
+    return cache_dir / f"{urlhash}-{name}"
+
+
+def _load_meta(meta_path: Path) -> dict:
+    try:
+        with meta_path.open() as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def _cached_digest(cached: Path, meta: dict) -> Optional[str]:
+    """The SHA-256 of a complete cached file, or None if the file is missing or changed since it was downloaded"""
+    try:
+        stat = cached.stat()
+    except FileNotFoundError:
+        return None
+    if [stat.st_size, stat.st_mtime_ns] != [meta.get("size"), meta.get("mtime_ns")]:
+        return None
+    return meta.get("sha256")
+
+
+def _download(url: str, cached: Path, meta: dict, revalidate: bool) -> dict:
+    """Download url to cached, resuming a partial download, and return the new metadata
+
+    If revalidate is set and the server says the file hasn't changed, return meta unchanged.
+    """
+    part = cached.with_name(f"{cached.name}.part")
+    headers = {}
+    if revalidate:
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+
+    # A partial download is only useful if the server still has the same file,
+    # which If-Range checks for us: the server sends the whole file instead of a range if it has changed.
+    partial = _load_meta(part.with_name(f"{part.name}.meta.json"))
+    offset = part.stat().st_size if part.exists() else 0
+    if offset and partial.get("url") == url and (partial.get("etag") or partial.get("last_modified")):
+        headers["Range"] = f"bytes={offset}-"
+        headers["If-Range"] = partial.get("etag") or partial["last_modified"]
     else:
-        raise requests.exceptions.HTTPError(
-            f"HTTP Error {response.status_code} trying to download {url} - {response.reason}"
-        )
+        offset = 0
+
+    with requests.get(url, headers=headers, stream=True, timeout=TIMEOUT) as response:
+        if response.status_code == 304:
+            tklogger.debug(f"{url} has not changed since it was cached at {cached}")
+            return meta
+        if response.status_code == 416 and "Range" in headers:
+            # The partial download was already complete when it was interrupted
+            part.unlink()
+            return _download(url, cached, meta, revalidate)
+        if response.status_code not in (200, 206):
+            raise requests.exceptions.HTTPError(
+                f"HTTP Error {response.status_code} trying to download {url} - {response.reason}"
+            )
+        new_meta = {
+            "url": url,
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+        }
+        digest = hashlib.sha256()
+        if response.status_code == 206:
+            tklogger.info(f"Resuming download of {url} at {offset} bytes")
+            with part.open("rb") as f:
+                while chunk := f.read(CHUNK_SIZE):
+                    digest.update(chunk)
+            mode = "ab"
+        else:
+            tklogger.info(f"Downloading {url}")
+            mode = "wb"
+        part.with_name(f"{part.name}.meta.json").write_text(json.dumps(new_meta))
+        with part.open(mode) as f:
+            for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                digest.update(chunk)
+                f.write(chunk)
+
+    os.replace(part, cached)
+    part.with_name(f"{part.name}.meta.json").unlink(missing_ok=True)
+    stat = cached.stat()
+    new_meta.update(size=stat.st_size, mtime_ns=stat.st_mtime_ns, sha256=digest.hexdigest())
+    return new_meta
+
+
+def _is_current(cached: Path, filepath: Path) -> bool:
+    """Whether filepath is a hard link to cached, or a copy made since it was last downloaded"""
+    try:
+        if os.path.samefile(cached, filepath):
+            return True
+        src, dst = cached.stat(), filepath.stat()
+    except FileNotFoundError:
+        return False
+    return (src.st_size, src.st_mtime_ns) == (dst.st_size, dst.st_mtime_ns)
+
+
+def _materialize(cached: Path, filepath: Path):
+    """Make filepath a hard link to cached, or a copy if it can't be linked"""
+    filepath.parent.mkdir(parents=True, exist_ok=True)
+    tmp = filepath.with_name(f".{filepath.name}.{os.getpid()}.{threading.get_ident()}")
+    tmp.unlink(missing_ok=True)
+    try:
+        os.link(cached, tmp)
+    except OSError:
+        shutil.copy2(cached, tmp)
+    os.replace(tmp, filepath)
+
+
+def rget(
+    url: str,
+    filepath: Path,
+    sha256: Optional[str] = None,
+    cache_dir: Optional[Path] = None,
+    pins_path: Optional[Path] = None,
+) -> bool:
+    """Download a file from the given URL and save it locally, returning True if the file at filepath changed
+
+    Arguments:
+    url:        The URL to download
+    filepath:   Where to save it
+    sha256:     The expected SHA-256 of the file, by default the one pinned for the URL in pins_path.
+                A cached copy with this digest is used without contacting the server,
+                and a download with a different digest raises ChecksumMismatchError.
+                If there is neither, the download is pinned on first use, see _pin_on_first_use.
+    cache_dir:  The shared download cache, by default tkconfig.noarch_artifacts.requisites_cache
+    pins_path:  The pins file, by default tkconfig.repopaths.requisite_pins
+    """
+    if cache_dir is None:
+        cache_dir = tkconfig.noarch_artifacts.requisites_cache
+    if pins_path is None:
+        pins_path = tkconfig.repopaths.requisite_pins
+    if sha256 is None:
+        sha256 = _load_pins(pins_path).get(url)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    cached = cache_path(cache_dir, url)
+    meta_path = cached.with_name(f"{cached.name}.meta.json")
+
+    with _url_lock(url):
+        meta = _load_meta(meta_path)
+        digest = _cached_digest(cached, meta)
+        if sha256 is not None:
+            fresh = digest == sha256
+        else:
+            fresh = digest is not None and url in _checked
+        if not fresh:
+            previous = digest
+            try:
+                meta = _download(url, cached, meta, revalidate=digest is not None)
+            except requests.exceptions.RequestException as exc:
+                if digest is None or (sha256 is not None and digest != sha256):
+                    raise
+                tklogger.warning(f"Could not check {url} for changes, using the cached copy: {exc}")
+            digest = meta["sha256"]
+            if sha256 is not None and digest != sha256:
+                cached.unlink(missing_ok=True)
+                meta_path.unlink(missing_ok=True)
+                raise ChecksumMismatchError(f"Downloaded {url} has SHA-256 {digest}, expected {sha256}")
+            if sha256 is None:
+                _pin_on_first_use(pins_path, url, digest, previous)
+            tmp = meta_path.with_name(f"{meta_path.name}.tmp")
+            tmp.write_text(json.dumps(meta, indent=2))
+            os.replace(tmp, meta_path)
+            _checked.add(url)
+
+        if _is_current(cached, filepath):
+            return False
+        _materialize(cached, filepath)
+    return True
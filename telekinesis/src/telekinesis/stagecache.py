@@ -0,0 +1,162 @@
+"""Skip build stages whose inputs haven't changed
+
+Each stage of an image build (building the APKs, the kernel, the squashfs, the ostar, ...)
+declares its inputs as a dict of names to digests:
+source trees, the Alpine version, the build container image ID, the outputs of upstream stages, etc.
+When a stage finishes, we record the digests of its inputs and the size and mtime of its outputs.
+The next time it is asked for, it is skipped if its inputs are the same
+and its outputs are still there and haven't been touched.
+
+The record is a JSON file in the artifacts directory, like:
+{STAGE: {"inputs": {NAME: DIGEST, ...}, "outputs": {RELPATH: [SIZE, MTIME_NS], ...}}}
+"""
+
+import hashlib
+import json
+import os
+import threading
+from pathlib import Path
+from typing import Iterable, Optional
+
+from telekinesis import tklogger
+
+
+IGNORED_NAMES = {".git", "__pycache__", ".mypy_cache", "dist", "build", ".DS_Store"}
+"""Files and directories that don't count as part of a source tree"""
+
+
+def file_digest(path: Path) -> str:
+    """Return a digest of a file's contents, or "missing" if it doesn't exist"""
+    digest = hashlib.sha256()
+    try:
+        with path.open("rb") as f:
+            while chunk := f.read(1024 * 1024):
+                digest.update(chunk)
+    except FileNotFoundError:
+        return "missing"
+    return digest.hexdigest()
+
+
+def tree_digest(path: Path) -> str:
+    """Return a digest of the names and contents of every file in a source tree
+
+    Contents are hashed rather than mtimes, because git checkouts change mtimes without changing anything.
+    """
+    digest = hashlib.sha256()
+    for root, dirs, files in os.walk(path):
+        dirs[:] = sorted(d for d in dirs if d not in IGNORED_NAMES and not d.endswith(".egg-info"))
+        for name in sorted(files):
+            if name in IGNORED_NAMES or name.endswith(".pyc"):
+                continue
+            filepath = Path(root) / name
+            digest.update(filepath.relative_to(path).as_posix().encode())
+            digest.update(b"\0")
+            digest.update(file_digest(filepath).encode())
+            digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def stat_digest(paths: Iterable[Path]) -> str:
+    """Return a digest of the size and mtime of files, for large build outputs that are too slow to hash
+
+    Missing files are included as missing, so that creating them changes the digest.
+    """
+    digest = hashlib.sha256()
+    for path in paths:
+        try:
+            stat = path.stat()
+            digest.update(f"{path.name} {stat.st_size} {stat.st_mtime_ns}\n".encode())
+        except FileNotFoundError:
+            digest.update(f"{path.name} missing\n".encode())
+    return digest.hexdigest()
+
+
+class StageCache:
+    """A record of the inputs and outputs of build stages
+
+    Arguments:
+    path:   The JSON file to keep the record in
+    root:   Outputs are recorded relative to this directory, normally the artifacts directory
+    force:  Run every stage, even if its inputs haven't changed (but still record it)
+    enabled: If False, run every stage and record nothing, like for interactive builds
+
+    It is safe to share between build pipelines running in threads.
+
+    Use it like:
+
+        inputs = {"source": tree_digest(...), ...}
+        if not stagecache.fresh("stage/x86_64", inputs):
+            build_the_stage()
+            stagecache.record("stage/x86_64", inputs, [output1, output2])
+    """
+
+    def __init__(self, path: Path, root: Path, force: bool = False, enabled: bool = True):
+        self.path = path
+        self.root = root
+        self.force = force
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        try:
+            with path.open() as f:
+                self.stages = json.load(f)
+        except FileNotFoundError:
+            self.stages = {}
+        except ValueError as exc:
+            tklogger.warning(f"Ignoring corrupt stage cache {path}: {exc}")
+            self.stages = {}
+
+    def _save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_name(f"{self.path.name}.{os.getpid()}")
+        with tmp.open("w") as f:
+            json.dump(self.stages, f, indent=2, sort_keys=True)
+        os.replace(tmp, self.path)
+
+    def _output_stats(self, outputs: Iterable[Path]) -> Optional[dict[str, list[int]]]:
+        """Return the size and mtime of each output, or None if any of them are missing"""
+        stats = {}
+        for output in outputs:
+            try:
+                stat = output.stat()
+            except FileNotFoundError:
+                return None
+            stats[output.relative_to(self.root).as_posix()] = [stat.st_size, stat.st_mtime_ns]
+        return stats
+
+    def fresh(self, stage: str, inputs: dict[str, str]) -> bool:
+        """Return True if the stage last ran with these inputs and its outputs haven't changed since
+
+        Compute the inputs before running the stage,
+        so that anything that changes them during the build is caught next time.
+        """
+        if not self.enabled or self.force:
+            return False
+        record = self.stages.get(stage)
+        if record is None:
+            tklogger.debug(f"Stage {stage} has not been built before")
+            return False
+        changed = sorted(
+            name for name in inputs.keys() | record["inputs"].keys() if inputs.get(name) != record["inputs"].get(name)
+        )
+        if changed:
+            tklogger.debug(f"Stage {stage} inputs changed: {', '.join(changed)}")
+            return False
+        outputs = self._output_stats(self.root / relpath for relpath in record["outputs"])
+        if outputs != record["outputs"]:
+            tklogger.debug(f"Stage {stage} outputs are missing or were modified")
+            return False
+        tklogger.info(f"Skipping stage {stage}, its inputs have not changed since it was last built")
+        return True
+
+    def record(self, stage: str, inputs: dict[str, str], outputs: Iterable[Path]):
+        """Record that a stage ran with these inputs and made these outputs"""
+        if not self.enabled:
+            return
+        stats = self._output_stats(outputs)
+        with self._lock:
+            if stats is None:
+                tklogger.warning(f"Stage {stage} did not make all of its outputs, not caching it")
+                self.stages.pop(stage, None)
+            else:
+                self.stages[stage] = {"inputs": inputs, "outputs": stats}
+            self._save()
@@ -0,0 +1,196 @@
+"""Plan a sync between the local deaddrop replica and the bucket
+
+The planner compares a snapshot of the local tree with a listing of the bucket,
+and returns a SyncPlan of every upload, download, deletion, and redirect the sync would make,
+with how many bytes and requests that adds up to and roughly what S3 will charge for it.
+It does no I/O, so it can be run against made-up trees;
+deaddrop.py takes the snapshots and applies the plan.
+"""
+
+import math
+from dataclasses import dataclass, field
+from typing import Any
+
+
+MULTIPART_CHUNK_SIZE = 8 * 1024 * 1024
+"""The part size boto3 uses for multipart transfers, and the size above which it uses them"""
+
+PRICE_PER_1000_PUT = 0.005
+"""US dollars per 1000 PUT, COPY, POST, or LIST requests, at the time of this writing"""
+
+PRICE_PER_1000_GET = 0.0004
+"""US dollars per 1000 GET or HEAD requests, at the time of this writing"""
+
+PRICE_PER_GB_OUT = 0.09
+"""US dollars per GB transferred out of S3 to the Internet, at the time of this writing"""
+
+
+@dataclass
+class LocalFile:
+    """A regular file in the local replica"""
+
+    md5: str
+    """The MD5 checksum of the file, or "" if it wasn't hashed because it doesn't matter to the plan"""
+    size: int
+    """The size of the file in bytes"""
+
+
+@dataclass
+class LocalTree:
+    """A snapshot of the local replica, with paths relative to its root"""
+
+    files: dict[str, LocalFile] = field(default_factory=dict)
+    """Regular files"""
+    symlinks: dict[str, str] = field(default_factory=dict)
+    """Symlinks to files inside the replica, mapped to their target as an S3 redirect (like /path/from/root)"""
+    external: set[str] = field(default_factory=set)
+    """Symlinks to files outside the replica, which can't be pushed but are left alone in the bucket"""
+    ignored: set[str] = field(default_factory=set)
+    """Files that are never pushed, like macOS .DS_Store files"""
+
+
+@dataclass
+class SyncAction:
+    """One thing a sync will do"""
+
+    kind: str
+    """One of upload, redirect, delete (from the bucket), download, symlink, or remove (from the replica)"""
+    path: str
+    """The key in the bucket, which is also the path relative to the replica"""
+    size: int = 0
+    """The bytes this action transfers"""
+    md5: str = ""
+    """For uploads, the checksum to store in the object's metadata; for downloads, the checksum we expect"""
+    target: str = ""
+    """For redirects and symlinks, the redirect location"""
+
+    @property
+    def requests(self) -> int:
+        """How many requests S3 will charge for this action"""
+        if self.kind in ("upload", "download"):
+            if self.size <= MULTIPART_CHUNK_SIZE:
+                return 1
+            parts = math.ceil(self.size / MULTIPART_CHUNK_SIZE)
+            # Multipart uploads also need a request to start and one to finish
+            return parts + 2 if self.kind == "upload" else parts + 1
+        if self.kind == "redirect":
+            return 1
+        # Deletions are batched and free, and local changes don't touch S3
+        return 0
+
+
+@dataclass
+class SyncPlan:
+    """Everything a sync will do"""
+
+    direction: str
+    """push or pull"""
+    actions: list[SyncAction] = field(default_factory=list)
+
+    def of_kind(self, *kinds: str) -> list[SyncAction]:
+        return [action for action in self.actions if action.kind in kinds]
+
+    @property
+    def upload_bytes(self) -> int:
+        return sum(action.size for action in self.of_kind("upload"))
+
+    @property
+    def download_bytes(self) -> int:
+        return sum(action.size for action in self.of_kind("download"))
+
+    @property
+    def put_requests(self) -> int:
+        return sum(action.requests for action in self.of_kind("upload", "redirect"))
+
+    @property
+    def get_requests(self) -> int:
+        return sum(action.requests for action in self.of_kind("download"))
+
+    @property
+    def delete_requests(self) -> int:
+        """How many delete_objects calls the deletions take, at up to 1000 keys each"""
+        return math.ceil(len(self.of_kind("delete")) / 1000)
+
+    @property
+    def estimated_cost(self) -> float:
+        """Roughly what S3 will charge for the plan in US dollars, not counting listing the bucket"""
+        return (
+            self.put_requests / 1000 * PRICE_PER_1000_PUT
+            + self.get_requests / 1000 * PRICE_PER_1000_GET
+            + self.download_bytes / 1e9 * PRICE_PER_GB_OUT
+        )
+
+    def format(self, verbose: bool = True) -> str:
+        """Return a human-readable description of the plan"""
+        lines = []
+        if verbose:
+            for action in self.actions:
+                detail = f"-> {action.target}" if action.target else f"{action.size} bytes" if action.size else ""
+                lines.append(f"{action.kind:<9} {action.path} {detail}".rstrip())
+        if not self.actions:
+            lines.append(f"Nothing to {self.direction}")
+        counts = ", ".join(
+            f"{len(self.of_kind(kind))} {kind}"
+            for kind in ["upload", "redirect", "delete", "download", "symlink", "remove"]
+            if self.of_kind(kind)
+        )
+        if counts:
+            lines.append(f"Plan to {self.direction}: {counts}")
+        lines.append(f"Upload {self.upload_bytes / 2**20:.1f} MiB, download {self.download_bytes / 2**20:.1f} MiB")
+        lines.append(
+            f"Requests: {self.put_requests} PUT, {self.get_requests} GET, {self.delete_requests} DELETE batches; "
+            f"estimated cost ${self.estimated_cost:.4f}"
+        )
+        return "\n".join(lines)
+
+
+def plan_push(local: LocalTree, remote: dict[str, dict[str, Any]]) -> SyncPlan:
+    """Plan a push of the local replica to the bucket
+
+    remote is the bucket listing from deaddrop.s3_list_remote_objects(),
+    a map of keys to entries with md5, size, and redirect.
+
+    - Upload files that aren't in the bucket or have a different checksum
+    - Make redirects for symlinks that aren't in the bucket or point somewhere else
+    - Delete objects from the bucket that aren't in the replica
+    """
+    plan = SyncPlan("push")
+    for path, file in sorted(local.files.items()):
+        entry = remote.get(path)
+        if entry is None or entry["redirect"] or entry["md5"] != file.md5:
+            plan.actions.append(SyncAction("upload", path, size=file.size, md5=file.md5))
+    for path, target in sorted(local.symlinks.items()):
+        entry = remote.get(path)
+        if entry is None or entry["redirect"] != target:
+            plan.actions.append(SyncAction("redirect", path, target=target))
+    present = local.files.keys() | local.symlinks.keys() | local.external
+    for path in sorted(remote.keys() - present):
+        plan.actions.append(SyncAction("delete", path))
+    return plan
+
+
+def plan_pull(local: LocalTree, remote: dict[str, dict[str, Any]]) -> SyncPlan:
+    """Plan a pull of the bucket into the local replica
+
+    remote is the bucket listing, as for plan_push().
+
+    - Download files that aren't in the replica or have a different checksum
+    - Make symlinks for redirects that aren't in the replica or point somewhere else;
+      redirects to full URLs can't be symlinks, and are skipped
+    - Remove files from the replica that aren't in the bucket
+    """
+    plan = SyncPlan("pull")
+    for path, entry in sorted(remote.items()):
+        if entry["redirect"]:
+            if entry["redirect"].startswith("http"):
+                continue
+            if local.symlinks.get(path) != entry["redirect"]:
+                plan.actions.append(SyncAction("symlink", path, target=entry["redirect"]))
+        else:
+            file = local.files.get(path)
+            if file is None or file.md5 != entry["md5"]:
+                plan.actions.append(SyncAction("download", path, size=entry["size"], md5=entry["md5"]))
+    present = local.files.keys() | local.symlinks.keys() | local.external | local.ignored
+    for path in sorted(present - remote.keys()):
+        plan.actions.append(SyncAction("remove", path))
+    return plan
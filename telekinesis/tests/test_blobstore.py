@@ -0,0 +1,39 @@
+"""Tests for blobstore.py."""
+
+import tempfile
+import unittest
+from pathlib import Path
+
+from telekinesis.blobstore import BlobStore
+
+
+class TestBlobStoreGc(unittest.TestCase):
+    """Tests for BlobStore.gc method."""
+
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.root = Path(tmpdir.name)
+        self.store = BlobStore(self.root / "blobs")
+        for name in ["a", "b"]:
+            (self.root / name).write_bytes(name.encode() * 100)
+        self.kept = self.store.copy(self.root / "a", self.root / "out" / "a")
+        self.pruned = self.store.copy(self.root / "b", self.root / "out" / "b")
+
+    def test_dry_run_counts_removing_as_gone(self):
+        self.assertEqual(self.store.gc(dry_run=True), [])
+        removed = self.store.gc(dry_run=True, removing=[self.root / "out" / "b"])
+        self.assertEqual(removed, [self.store.blob_path(self.pruned)])
+        self.assertTrue(self.store.blob_path(self.pruned).exists())
+
+    def test_skips_temporary_blobs(self):
+        (self.root / "out" / "b").unlink()
+        partial = self.store.blob_path(self.pruned).with_name(f"{self.pruned}.123.456")
+        partial.write_bytes(b"in flight")
+        self.assertEqual(self.store.gc(), [self.store.blob_path(self.pruned)])
+        self.assertTrue(partial.exists())
+        self.assertTrue(self.store.blob_path(self.kept).exists())
+
+
+if __name__ == "__main__":
+    unittest.main()
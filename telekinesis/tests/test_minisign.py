@@ -0,0 +1,40 @@
+"""Tests for minisign.py."""
+
+import hashlib
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey
+
+from telekinesis import minisign
+
+
+class TestSignHash(unittest.TestCase):
+    """Tests for sign_hash"""
+
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.file = Path(tmpdir.name) / "psyopsOS.tar"
+        self.file.write_bytes(b"an ostar" * 1000)
+        self.nu_minisign = minisign._neuralupgrade_minisign()
+        self.seckey = self.nu_minisign.SecretKey.generate()
+        key = (self.seckey, Ed25519PrivateKey.from_private_bytes(self.seckey.seed))
+        patcher = mock.patch.object(minisign, "_secret_key", key)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_signature_verifies(self):
+        digest = hashlib.blake2b(self.file.read_bytes(), digest_size=64).digest()
+        text = minisign.sign_hash(self.file, digest, trusted_comment="type=psyopsOS version=1")
+        self.assertEqual(Path(f"{self.file}.minisig").read_text(), text)
+        trusted_comment = self.nu_minisign.verify_file(self.file.as_posix(), self.seckey.public_key)
+        self.assertEqual(trusted_comment, "type=psyopsOS version=1")
+        # Ed25519 is deterministic, so OpenSSL and the reference implementation make the same signature
+        self.assertEqual(text, self.seckey.sign_hash(digest, "type=psyopsOS version=1").to_string())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,75 @@
+"""Tests for ostar.py."""
+
+import hashlib
+import json
+import os
+import random
+import sys
+import tarfile
+import tempfile
+import unittest
+from pathlib import Path
+
+from telekinesis.config import tkconfig
+from telekinesis.ostar import OstarWriter
+
+sys.path.append((tkconfig.repopaths.neuralupgrade / "src").as_posix())
+from neuralupgrade import delta  # noqa: E402
+
+
+class TestOstarWriter(unittest.TestCase):
+    """Tests for OstarWriter"""
+
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.root = Path(tmpdir.name)
+        self.osdir = self.root / "os"
+        (self.osdir / "dtbs" / "vendor").mkdir(parents=True)
+        rand = random.Random(1)
+        (self.osdir / "squashfs").write_bytes(rand.randbytes(3 * 1024 * 1024 + 5))
+        (self.osdir / "kernel").write_bytes(rand.randbytes(700 * 1024))
+        (self.osdir / "empty").write_bytes(b"")
+        (self.osdir / "dtbs" / "vendor" / ("board-" * 20 + ".dtb")).write_bytes(rand.randbytes(3000))
+        os.symlink("vendor", self.osdir / "dtbs" / "current")
+        self.ostar = self.root / "psyopsOS.tar"
+
+    def write(self) -> OstarWriter:
+        with OstarWriter(self.ostar, mtime=0, chunker=delta.Chunker) as writer:
+            for item in ["kernel", "empty", "squashfs", "dtbs"]:
+                writer.add(self.osdir / item, arcname=item)
+        return writer
+
+    def test_same_pass_manifest_matches_reading_the_tarball(self):
+        writer = self.write()
+        regions = [delta.literal_region(r) if isinstance(r, bytes) else delta.member_region(*r) for r in writer.regions]
+        manifest = delta.build_manifest("psyopsOS.tar", writer.size, regions)
+        self.assertEqual(
+            json.loads(json.dumps(manifest)), json.loads(json.dumps(delta.make_manifest(self.ostar.as_posix())))
+        )
+        self.assertEqual(writer.blake2b, hashlib.blake2b(self.ostar.read_bytes(), digest_size=64).digest())
+
+    def test_members_manifest(self):
+        writer = self.write()
+        members = json.loads(writer.members_path.read_bytes())["members"]
+        self.assertEqual(
+            members["squashfs"]["sha256"], hashlib.sha256((self.osdir / "squashfs").read_bytes()).hexdigest()
+        )
+        self.assertEqual(members["empty"], {"size": 0, "sha256": hashlib.sha256(b"").hexdigest()})
+        self.assertNotIn("dtbs/current", members)
+
+    def test_symlinks_are_stored_as_symlinks(self):
+        self.write()
+        with tarfile.open(self.ostar) as tar:
+            link = tar.getmember("dtbs/current")
+        self.assertTrue(link.issym())
+        self.assertEqual((link.linkname, link.mode, link.uname, link.mtime), ("vendor", 0o777, "root", 0))
+
+    def test_reproducible(self):
+        first = self.write().blake2b
+        os.utime(self.osdir / "kernel", (1700000000, 1700000000))
+        self.assertEqual(self.write().blake2b, first)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,55 @@
+"""Tests for rget.py."""
+
+import functools
+import hashlib
+import http.server
+import json
+import tempfile
+import threading
+import unittest
+from pathlib import Path
+
+from telekinesis import rget
+
+
+class QuietHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+class TestPinning(unittest.TestCase):
+    """Tests for pinning the SHA-256 of downloads"""
+
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.root = Path(tmpdir.name)
+        (self.root / "www").mkdir()
+        self.served = self.root / "www" / "firmware.zip"
+        self.served.write_bytes(b"firmware v1")
+        handler = functools.partial(QuietHandler, directory=(self.root / "www").as_posix())
+        server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        self.url = f"http://127.0.0.1:{server.server_address[1]}/firmware.zip"
+        self.pins = self.root / "pins.json"
+        self.addCleanup(rget._checked.clear)
+
+    def get(self, cache: str) -> bool:
+        rget._checked.clear()
+        return rget.rget(self.url, self.root / "out.zip", cache_dir=self.root / cache, pins_path=self.pins)
+
+    def test_pins_on_first_use_and_enforces_afterwards(self):
+        with self.assertLogs("telekinesis", level="WARNING"):
+            self.assertTrue(self.get("cache1"))
+        self.assertEqual(json.loads(self.pins.read_text()), {self.url: hashlib.sha256(b"firmware v1").hexdigest()})
+
+        self.served.write_bytes(b"firmware v2, swapped on the server")
+        with self.assertRaises(rget.ChecksumMismatchError):
+            self.get("cache2")
+        self.assertEqual((self.root / "out.zip").read_bytes(), b"firmware v1")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,193 @@
+"""Tests for syncplan.py."""
+
+import unittest
+
+from telekinesis.deaddrop import S3PriceWarningError, check_plan_cost
+from telekinesis.syncplan import (
+    MULTIPART_CHUNK_SIZE,
+    PRICE_PER_1000_GET,
+    PRICE_PER_1000_PUT,
+    PRICE_PER_GB_OUT,
+    LocalFile,
+    LocalTree,
+    SyncAction,
+    SyncPlan,
+    plan_pull,
+    plan_push,
+)
+
+
+def remote_file(md5: str, size: int) -> dict:
+    return {"md5": md5, "size": size, "redirect": ""}
+
+
+def remote_redirect(target: str) -> dict:
+    return {"md5": "", "size": 0, "redirect": target}
+
+
+def summary(plan: SyncPlan) -> list[tuple[str, str]]:
+    return [(action.kind, action.path) for action in plan.actions]
+
+
+class TestPlanPush(unittest.TestCase):
+    """Tests for plan_push function."""
+
+    def test_push(self):
+        local = LocalTree(
+            files={
+                "same.txt": LocalFile("aaa", 10),
+                "changed.txt": LocalFile("bbb", 20),
+                "new.txt": LocalFile("ccc", 30),
+                "was-redirect.txt": LocalFile("ddd", 40),
+            },
+            symlinks={
+                "same-link": "/same.txt",
+                "moved-link": "/new.txt",
+                "new-link": "/changed.txt",
+            },
+            external={"external-link"},
+        )
+        remote = {
+            "same.txt": remote_file("aaa", 10),
+            "changed.txt": remote_file("old", 20),
+            "was-redirect.txt": remote_redirect("/same.txt"),
+            "same-link": remote_redirect("/same.txt"),
+            "moved-link": remote_redirect("/same.txt"),
+            "external-link": remote_file("eee", 50),
+            "gone.txt": remote_file("fff", 60),
+        }
+        plan = plan_push(local, remote)
+        self.assertEqual(
+            summary(plan),
+            [
+                ("upload", "changed.txt"),
+                ("upload", "new.txt"),
+                ("upload", "was-redirect.txt"),
+                ("redirect", "moved-link"),
+                ("redirect", "new-link"),
+                ("delete", "gone.txt"),
+            ],
+        )
+        self.assertEqual(plan.of_kind("upload")[0].md5, "bbb")
+        self.assertEqual(plan.of_kind("redirect")[0].target, "/new.txt")
+        self.assertEqual(plan.upload_bytes, 90)
+
+    def test_push_nothing(self):
+        local = LocalTree(files={"same.txt": LocalFile("aaa", 10)}, symlinks={"link": "/same.txt"})
+        remote = {"same.txt": remote_file("aaa", 10), "link": remote_redirect("/same.txt")}
+        plan = plan_push(local, remote)
+        self.assertEqual(plan.actions, [])
+        self.assertIn("Nothing to push", plan.format())
+
+    def test_push_ignored_files_are_deleted(self):
+        """Ignored files are never pushed, so if one is in the bucket, it is deleted."""
+        local = LocalTree(ignored={".DS_Store"})
+        plan = plan_push(local, {".DS_Store": remote_file("aaa", 10)})
+        self.assertEqual(summary(plan), [("delete", ".DS_Store")])
+
+
+class TestPlanPull(unittest.TestCase):
+    """Tests for plan_pull function."""
+
+    def test_pull(self):
+        local = LocalTree(
+            files={
+                "same.txt": LocalFile("aaa", 10),
+                "changed.txt": LocalFile("old", 20),
+                "gone.txt": LocalFile("fff", 60),
+            },
+            symlinks={"same-link": "/same.txt", "moved-link": "/same.txt"},
+            ignored={".DS_Store"},
+        )
+        remote = {
+            "same.txt": remote_file("aaa", 10),
+            "changed.txt": remote_file("bbb", 20),
+            "new.txt": remote_file("ccc", 30),
+            "same-link": remote_redirect("/same.txt"),
+            "moved-link": remote_redirect("/new.txt"),
+            "new-link": remote_redirect("/changed.txt"),
+            "url-link": remote_redirect("https://example.com/"),
+        }
+        plan = plan_pull(local, remote)
+        self.assertEqual(
+            summary(plan),
+            [
+                ("download", "changed.txt"),
+                ("symlink", "moved-link"),
+                ("symlink", "new-link"),
+                ("download", "new.txt"),
+                ("remove", ".DS_Store"),
+                ("remove", "gone.txt"),
+            ],
+        )
+        self.assertEqual(plan.of_kind("download")[0].md5, "bbb")
+        self.assertEqual(plan.download_bytes, 50)
+
+    def test_pull_nothing(self):
+        local = LocalTree(files={"same.txt": LocalFile("aaa", 10)}, symlinks={"link": "/same.txt"})
+        remote = {"same.txt": remote_file("aaa", 10), "link": remote_redirect("/same.txt")}
+        plan = plan_pull(local, remote)
+        self.assertEqual(plan.actions, [])
+        self.assertIn("Nothing to pull", plan.format())
+
+
+class TestSyncPlanCost(unittest.TestCase):
+    """Tests for the request counts and estimated cost of a SyncPlan."""
+
+    def test_requests(self):
+        self.assertEqual(SyncAction("upload", "small", size=MULTIPART_CHUNK_SIZE).requests, 1)
+        self.assertEqual(SyncAction("download", "small", size=1).requests, 1)
+        # Three parts, plus starting and finishing the multipart upload
+        self.assertEqual(SyncAction("upload", "large", size=2 * MULTIPART_CHUNK_SIZE + 1).requests, 5)
+        self.assertEqual(SyncAction("download", "large", size=2 * MULTIPART_CHUNK_SIZE + 1).requests, 4)
+        self.assertEqual(SyncAction("redirect", "link", target="/x").requests, 1)
+        for kind in ["delete", "symlink", "remove"]:
+            self.assertEqual(SyncAction(kind, "x").requests, 0)
+
+    def test_estimated_cost(self):
+        plan = SyncPlan(
+            "pull",
+            [
+                SyncAction("upload", "a", size=2 * MULTIPART_CHUNK_SIZE),
+                SyncAction("redirect", "b", target="/a"),
+                SyncAction("download", "c", size=10**9),
+                SyncAction("download", "d", size=10),
+            ]
+            + [SyncAction("delete", f"e{i}") for i in range(1001)],
+        )
+        downloaded_parts = -(-(10**9) // MULTIPART_CHUNK_SIZE) + 1
+        self.assertEqual(plan.put_requests, 5)
+        self.assertEqual(plan.get_requests, downloaded_parts + 1)
+        self.assertEqual(plan.delete_requests, 2)
+        self.assertAlmostEqual(
+            plan.estimated_cost,
+            5 / 1000 * PRICE_PER_1000_PUT
+            + (downloaded_parts + 1) / 1000 * PRICE_PER_1000_GET
+            + (10**9 + 10) / 1e9 * PRICE_PER_GB_OUT,
+        )
+
+    def test_empty_plan_is_free(self):
+        self.assertEqual(SyncPlan("push").estimated_cost, 0)
+
+
+class TestCheckPlanCost(unittest.TestCase):
+    """Tests for check_plan_cost function, which enforces --max-cost."""
+
+    def setUp(self):
+        # About $0.09 of transfer out
+        self.plan = SyncPlan("pull", [SyncAction("download", "big", size=10**9)])
+
+    def test_over_limit(self):
+        with self.assertRaises(S3PriceWarningError) as raised:
+            check_plan_cost(self.plan, 0.05)
+        self.assertIn("more than the limit of $0.05", str(raised.exception))
+
+    def test_under_limit(self):
+        check_plan_cost(self.plan, 1.00)
+
+    def test_no_limit(self):
+        check_plan_cost(self.plan, None)
+
+
+if __name__ == "__main__":
+    unittest.main()